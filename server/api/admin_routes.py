@@ -2,7 +2,6 @@ from fastapi import APIRouter, HTTPException, Depends, Header, Request
 from typing import Optional, Dict, Any, List
 import logging
 from services.s3_service import get_s3_service
-from services.dicom_processor import dicom_processor
 import uuid
 from datetime import datetime
 
@@ -273,6 +272,8 @@ async def process_dicom_file(
         Extracted metadata and processing status
     """
     try:
+        from services.dicom_processor import dicom_processor
+        
         # Extract metadata from DICOM
         metadata = dicom_processor.extract_metadata_from_url(dicom_url)
         
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, HTTPException, Depends, Header, Request
-from typing import Optional, Dict, Any, Union, List
+from typing import Optional, Dict, Any, Union, List, Tuple
 from datetime import datetime
 import logging
 import os
@@ -7,6 +7,8 @@ import base64
 import requests
 import jwt
 import json
+import asyncio
+import time
 from pathlib import Path
 
 from models.analyze import AnalyzeXrayRequest, AnalyzeXrayResponse, SuggestChangesRequest, SuggestChangesResponse
@@ -16,6 +18,8 @@ from services.supabase import supabase_service
 from services.roboflow import roboflow_service
 from services.openai_analysis import openai_service
 from utils.image import generate_annotated_filename
+from utils.metrics import track_stage
+from utils.stage_graph import StageGraph, StageTimeoutError, in_thread
 
 from services.video_generator import video_generator_service
 from services.elevenlabs_service import elevenlabs_service
@@ -23,13 +27,11 @@ from services.insurance_verification import insurance_service
 import os
 from services.tooth_mapping import tooth_mapping_service, Detection
 from services.roboflow import roboflow_service
-from services.april_vision_mapper import map_with_segmentation
 from services.image_overlay import image_overlay_service
 from lib.stagingV2 import build_staged_plan_v2
 import tempfile
 import uuid
-from services.stripe_service import stripe_service
-from services.email_tracking_service import calculate_urgency_level
+from services.email_tracking_service import calculate_urgency_level, save_tracking_record
 from api.admin_routes import admin_router
 
 # Enhanced models for new functionality
@@ -108,6 +110,15 @@ class InsuranceVerificationResponse(BaseModel):
     verification_date: str
     next_verification_due: Optional[str] = None
     notes: Optional[str] = None
+    cached: bool = False  # Served from an earlier verification still within next_verification_due
+
+class InsuranceBatchVerificationRequest(BaseModel):
+    appointments: List[InsuranceVerificationRequest]
+    force_refresh: bool = False  # Ask the providers again even for members verified recently
+
+class InsuranceBatchVerificationResponse(BaseModel):
+    results: List[InsuranceVerificationResponse]
+    summary: Dict[str, Any]
 
 class ToothNumberOverlayRequest(BaseModel):
     image_url: str
@@ -116,6 +127,7 @@ class ToothNumberOverlayRequest(BaseModel):
     text_size_multiplier: float = 1.0
     condition_data: Optional[Union[Dict, List]] = None
     cached_segmentation_data: Optional[Dict] = None  # NEW: Allow passing cached data
+    content_hash: Optional[str] = None  # Scan's upload hash, to reuse its stored segmentation
 
 class TreatmentCostEstimate(BaseModel):
     treatment_code: str
@@ -152,6 +164,108 @@ async def get_auth_token(authorization: Optional[str] = Header(None)) -> str:
         raise HTTPException(status_code=401, detail="Invalid authentication token")
     
 
+# ==================== SHARED SCAN ANALYSIS ====================
+
+# Per-stage timeouts (seconds) for the analysis stage graphs
+ROBOFLOW_STAGE_TIMEOUT_S = float(os.getenv('ANALYZE_ROBOFLOW_TIMEOUT_S', '60'))
+UPLOAD_STAGE_TIMEOUT_S = float(os.getenv('ANALYZE_UPLOAD_TIMEOUT_S', '30'))
+SUMMARY_STAGE_TIMEOUT_S = float(os.getenv('ANALYZE_SUMMARY_TIMEOUT_S', '60'))
+PLAN_STAGE_TIMEOUT_S = float(os.getenv('ANALYZE_PLAN_TIMEOUT_S', '90'))
+VIDEO_STAGE_TIMEOUT_S = float(os.getenv('ANALYZE_VIDEO_TIMEOUT_S', '300'))
+
+async def _open_scan(image_url: str, token: str, content_hash: Optional[str] = None) -> Optional[Tuple[Any, str, str]]:
+    """(store, user_id, image hash) for the scan's shared analysis record, or None without one"""
+    from services.scan_analysis import get_scan_analysis
+    
+    scan_store = get_scan_analysis()
+    user_id = jwt.decode(token, options={"verify_signature": False}).get('sub')
+    if not scan_store or not user_id:
+        return None
+    image_hash = await scan_store.resolve_key(user_id, image_url, token, content_hash)
+    if not image_hash:
+        return None
+    return scan_store, user_id, image_hash
+
+
+async def _run_scan_stage(scan, stage: str, compute, token: str, image_url: Optional[str] = None,
+                          cacheable=None) -> Tuple[Any, bool]:
+    """Run a stage once per scan through its analysis record; just compute it without one"""
+    if scan is None:
+        return await compute(), False
+    scan_store, user_id, image_hash = scan
+    return await scan_store.run_stage(user_id, image_hash, token, stage, compute, image_url, cacheable)
+
+
+async def _detect_conditions_once(scan, image_url: str, token: str, annotated_filename: str) -> Dict[str, Any]:
+    """Roboflow detection plus the annotated image upload, reused by every endpoint for this scan"""
+    async def detect():
+        predictions, annotated_image = await roboflow_service.detect_conditions(image_url)
+        if not predictions or not annotated_image:
+            raise HTTPException(status_code=500, detail="Failed to process image with Roboflow")
+        
+        annotated_url = await supabase_service.upload_image(annotated_image, annotated_filename, token)
+        if not annotated_url:
+            raise HTTPException(status_code=500, detail="Failed to upload annotated image")
+        return {"predictions": predictions, "annotated_image_url": annotated_url}
+    
+    detection, reused = await _run_scan_stage(scan, "detection", detect, token, image_url)
+    if reused:
+        logger.info("🔄 Reusing stored Roboflow detection, skipping detection and annotated upload")
+    return detection
+
+
+def _add_detection_stages(graph, scan, image_url: str, token: str, annotated_filename: str,
+                          known_detection: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Add the detection stages to a stage graph
+
+    "roboflow" yields the predictions, "annotated_upload" the annotated image
+    URL and "detection" both, stored on the scan's analysis record. Stages that
+    only need predictions depend on "roboflow" so they overlap the upload. A
+    detection already stored for the scan, or passed in as `known_detection`
+    (pre-analyzed AWS images), short-circuits all three.
+    """
+    async def roboflow():
+        detection = known_detection
+        if detection is None and scan is not None:
+            scan_store, user_id, image_hash = scan
+            record = await scan_store.get(user_id, image_hash, token)
+            if record.get('predictions') is not None and record.get('annotated_image_url'):
+                logger.info("🔄 Reusing stored Roboflow detection, skipping detection and annotated upload")
+                detection = {"predictions": record['predictions'], "annotated_image_url": record['annotated_image_url']}
+        if detection is not None:
+            return {**detection, "reused": True}
+
+        predictions, annotated_image = await roboflow_service.detect_conditions(image_url)
+        if not predictions or not annotated_image:
+            raise HTTPException(status_code=500, detail="Failed to process image with Roboflow")
+        return {"predictions": predictions, "annotated_image": annotated_image, "reused": False}
+
+    async def annotated_upload(roboflow):
+        if roboflow["reused"]:
+            return roboflow["annotated_image_url"]
+        annotated_url = await in_thread(supabase_service.upload_image, roboflow["annotated_image"], annotated_filename, token)
+        if not annotated_url:
+            raise HTTPException(status_code=500, detail="Failed to upload annotated image")
+        return annotated_url
+
+    async def detection(roboflow, annotated_upload):
+        detection = {"predictions": roboflow["predictions"], "annotated_image_url": annotated_upload}
+        if not roboflow["reused"] and scan is not None:
+            scan_store, user_id, image_hash = scan
+            await scan_store.save(user_id, image_hash, token, image_url, **detection)
+        return detection
+
+    graph.add("roboflow", roboflow, timeout=ROBOFLOW_STAGE_TIMEOUT_S)
+    graph.add("annotated_upload", annotated_upload, deps=("roboflow",), timeout=UPLOAD_STAGE_TIMEOUT_S)
+    graph.add("detection", detection, deps=("roboflow", "annotated_upload"))
+
+
+def _is_real_findings_summary(summary: Dict) -> bool:
+    """False for the placeholder returned when GPT fails, which shouldn't be stored"""
+    return summary.get("overall_summary") != "Error processing AI analysis"
+
+
 @router.post("/analyze-xray-immediate")
 async def analyze_xray_immediate(
     request: AnalyzeXrayRequest,
@@ -159,29 +273,33 @@ async def analyze_xray_immediate(
 ):
     """
     Immediately analyze X-ray after upload to provide findings summary
+    The annotated upload and the GPT findings summary run concurrently once Roboflow returns
     """
     try:
         logger.info(f"Starting immediate X-ray analysis for image: {request.image_url}")
         
-        # Step 1: Send image to Roboflow for detection
-        predictions, annotated_image = await roboflow_service.detect_conditions(str(request.image_url))
-        
-        if not predictions or not annotated_image:
-            raise HTTPException(status_code=500, detail="Failed to process image with Roboflow")
+        # Creates the scan's shared analysis record; /analyze-xray, /tooth-mapping and /image/overlay reuse it
+        scan = await _open_scan(str(request.image_url), token, request.content_hash)
         
-        # Step 2: Upload annotated image to Supabase Storage
+        # Steps 1-3: Roboflow detection, then the annotated upload alongside the findings summary (once per scan)
         annotated_filename = f"annotated/immediate_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-        annotated_url = await supabase_service.upload_image(
-            annotated_image,
-            annotated_filename,
-            token
-        )
+        graph = StageGraph("analyze_xray_immediate")
+        _add_detection_stages(graph, scan, str(request.image_url), token, annotated_filename)
+        
+        async def findings_summary(roboflow):
+            summary, _ = await _run_scan_stage(
+                scan, "findings_summary",
+                lambda: in_thread(openai_service.generate_immediate_findings_summary, roboflow["predictions"]),
+                token, cacheable=_is_real_findings_summary
+            )
+            return summary
         
-        if not annotated_url:
-            raise HTTPException(status_code=500, detail="Failed to upload annotated image")
+        graph.add("findings_summary", findings_summary, deps=("roboflow",), timeout=SUMMARY_STAGE_TIMEOUT_S)
         
-        # Step 3: Generate immediate findings summary with OpenAI
-        findings_summary = await openai_service.generate_immediate_findings_summary(predictions)
+        results = await graph.run()
+        predictions = results["detection"]["predictions"]
+        annotated_url = results["detection"]["annotated_image_url"]
+        findings_summary = results["findings_summary"]
         
         # Step 4: Prepare response with detailed findings
         detections = []
@@ -208,7 +326,8 @@ async def analyze_xray_immediate(
             "annotated_image_url": annotated_url,
             "detections": detections,
             "findings_summary": findings_summary,
-            "original_predictions": predictions
+            "original_predictions": predictions,
+            "scan_hash": scan[2] if scan else None
         }
         
         logger.info(f"Successfully completed immediate X-ray analysis. Found {len(detections)} detections")
@@ -216,11 +335,127 @@ async def analyze_xray_immediate(
         
     except HTTPException:
         raise
+    except StageTimeoutError as e:
+        logger.error(f"❌ Immediate X-ray analysis timed out: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         logger.error(f"Unexpected error in analyze_xray_immediate: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@router.post("/analyze-xray-immediate/stream")
+async def analyze_xray_immediate_stream(
+    request: AnalyzeXrayRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Same as /analyze-xray-immediate, streamed as server-sent events
+
+    Events: detections ({annotated_image_url, detections, original_predictions})
+    as soon as Roboflow returns, token ({text}) for the summary JSON as it is
+    written, done ({findings_summary}) or error ({detail}).
+    """
+    from utils.sse import sse_event, sse_response
+
+    async def events():
+        try:
+            logger.info(f"Starting streamed immediate X-ray analysis for image: {request.image_url}")
+
+            scan = await _open_scan(str(request.image_url), token, request.content_hash)
+            annotated_filename = f"annotated/immediate_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
+            try:
+                detection = await _detect_conditions_once(scan, str(request.image_url), token, annotated_filename)
+            except HTTPException as e:
+                yield sse_event("error", {"detail": e.detail})
+                return
+            predictions = detection["predictions"]
+            annotated_url = detection["annotated_image_url"]
+
+            detections = [
+                {
+                    'class': pred.get('class', 'Unknown'),
+                    'class_name': pred.get('class', 'Unknown'),
+                    'confidence': pred.get('confidence', 0),
+                    'x': pred.get('x', 0),
+                    'y': pred.get('y', 0),
+                    'width': pred.get('width', 0),
+                    'height': pred.get('height', 0)
+                }
+                for pred in predictions.get('predictions', [])
+            ]
+            yield sse_event("detections", {
+                "annotated_image_url": annotated_url,
+                "detections": detections,
+                "original_predictions": predictions,
+                "scan_hash": scan[2] if scan else None
+            })
+
+            # A summary already stored for this scan is sent straight away
+            stored_summary = None
+            if scan is not None:
+                scan_store, user_id, image_hash = scan
+                stored_summary = (await scan_store.get(user_id, image_hash, token)).get("findings_summary")
+            if stored_summary:
+                yield sse_event("done", {"findings_summary": stored_summary})
+            else:
+                async for event, payload in openai_service.stream_immediate_findings_summary(predictions):
+                    if event == "token":
+                        yield sse_event("token", {"text": payload})
+                    else:
+                        if scan is not None and _is_real_findings_summary(payload):
+                            await scan_store.save(user_id, image_hash, token, findings_summary=payload)
+                        yield sse_event("done", {"findings_summary": payload})
+
+            logger.info(f"✅ Streamed immediate X-ray analysis. Found {len(detections)} detections")
+        except Exception as e:
+            logger.error(f"❌ Error in analyze_xray_immediate_stream: {str(e)}")
+            yield sse_event("error", {"detail": f"Internal server error: {str(e)}"})
+
+    return sse_response(events())
+
+
+async def build_treatment_analysis(predictions: Dict, findings_dict: List[Dict], token: str) -> Dict:
+    """
+    Treatment plan for /analyze-xray in the analyze_dental_conditions shape
+
+    By default the plan comes from the rule-based planner (catalogue mappings,
+    clinic pricing, StagingEngineV2) and GPT only rewrites the summary/notes
+    when ANALYSIS_GPT_PROSE is enabled, bounded by ANALYSIS_PROSE_TIMEOUT_S.
+    ANALYSIS_PLANNER=gpt restores the full GPT analysis, which is also used
+    if the treatment catalogue can't be loaded.
+    """
+    from services.treatment_planner import get_treatment_planner
+
+    planner = get_treatment_planner()
+    if os.getenv('ANALYSIS_PLANNER', 'rules').lower() == 'gpt' or not planner.available:
+        return await openai_service.analyze_dental_conditions(predictions, findings_dict)
+
+    treatment_settings = {}
+    try:
+        clinic_pricing = await supabase_service.get_treatment_settings(token)
+        treatment_settings = (clinic_pricing or {}).get('treatment_settings') or {}
+    except Exception as e:
+        logger.warning(f"⚠️ Clinic treatment settings unavailable, using catalogue prices: {str(e)}")
+
+    try:
+        analysis = planner.build_plan(predictions, findings_dict, treatment_settings)
+    except Exception as e:
+        logger.error(f"❌ Rule-based treatment plan failed, falling back to GPT: {str(e)}")
+        return await openai_service.analyze_dental_conditions(predictions, findings_dict)
+
+    if os.getenv('ANALYSIS_GPT_PROSE', 'false').lower() == 'true' and analysis['treatment_stages']:
+        try:
+            prose = await asyncio.wait_for(
+                openai_service.write_plan_prose(analysis['treatment_stages'], analysis['unmapped_conditions']),
+                timeout=float(os.getenv('ANALYSIS_PROSE_TIMEOUT_S', '8'))
+            )
+            analysis.update({key: value for key, value in prose.items() if value})
+        except Exception as e:
+            logger.warning(f"⚠️ GPT plan prose unavailable, keeping templated summary: {str(e) or type(e).__name__}")
+
+    return analysis
+
+
 @router.post("/analyze-xray", response_model=AnalyzeXrayResponse)
 async def analyze_xray(
     request: AnalyzeXrayRequest,
@@ -231,79 +466,97 @@ async def analyze_xray(
     Main endpoint to analyze dental X-ray
     Note: Supabase handles user authentication and RLS automatically
     Supports pre-analyzed AWS images via pre_analyzed_detections and pre_analyzed_annotated_url
+    Otherwise reuses the scan's stored detection from /analyze-xray-immediate
+
+    Stages run as a dependency graph: the treatment plan starts as soon as the
+    predictions are known (overlapping the annotated upload), and the video is
+    rendered while the diagnosis is saved, then attached to it.
     """
     try:
         logger.info(f"Starting X-ray analysis for patient: {request.patient_name}")
+        graph = StageGraph("analyze_xray")
         
-        # Check if we have pre-analyzed data (for AWS images)
+        # Steps 1-2: Roboflow detection and annotated upload, reused from /analyze-xray-immediate when it ran
         if request.pre_analyzed_detections and request.pre_analyzed_annotated_url:
             logger.info("🔄 Using pre-analyzed AWS data, skipping Roboflow detection")
-            predictions = {"predictions": request.pre_analyzed_detections}
-            annotated_url = request.pre_analyzed_annotated_url
+            scan = None
+            known_detection = {
+                "predictions": {"predictions": request.pre_analyzed_detections},
+                "annotated_image_url": request.pre_analyzed_annotated_url
+            }
         else:
-            # Step 1: Send image to Roboflow for detection (for manual uploads)
             logger.info("🤖 Running Roboflow detection for manual upload")
-            predictions, annotated_image = await roboflow_service.detect_conditions(str(request.image_url))
-            
-            if not predictions or not annotated_image:
-                raise HTTPException(status_code=500, detail="Failed to process image with Roboflow")
-            
-            # Step 2: Upload annotated image to Supabase Storage
-            annotated_filename = generate_annotated_filename(str(request.image_url), request.patient_name)
-            annotated_url = await supabase_service.upload_image(
-                annotated_image,
-                f"{annotated_filename}",
-                token
-            )
-            
-            if not annotated_url:
-                raise HTTPException(status_code=500, detail="Failed to upload annotated image")
+            scan = await _open_scan(str(request.image_url), token, request.content_hash)
+            known_detection = None
+        annotated_filename = generate_annotated_filename(str(request.image_url), request.patient_name)
+        _add_detection_stages(graph, scan, str(request.image_url), token, annotated_filename, known_detection)
         
-        # Step 3: Analyze with OpenAI
+        # Step 3: Build the treatment plan (rule-based unless ANALYSIS_PLANNER=gpt)
         findings_dict = [f.model_dump() for f in request.findings] if request.findings else []
-        ai_analysis = await openai_service.analyze_dental_conditions(predictions, findings_dict)
+        
+        async def treatment_analysis(roboflow):
+            return await in_thread(build_treatment_analysis, roboflow["predictions"], findings_dict, token)
         
         # Step 4: Save to database (Supabase handles user_id via RLS)
         # SKIP HTML generation here - let frontend generate HTML from organized stages
         # This ensures the report uses the dentist's organized stages from the stage editor
-        # html_report = await openai_service.generate_html_report_content(findings_dict, request.patient_name)
+        async def save_diagnosis(detection, treatment_analysis):
+            diagnosis_data = {
+                'patient_name': request.patient_name,
+                'image_url': str(request.image_url),
+                'annotated_image_url': detection["annotated_image_url"],
+                'summary': treatment_analysis.get('summary', ''),
+                'ai_notes': treatment_analysis.get('ai_notes', ''),
+                'treatment_stages': treatment_analysis.get('treatment_stages', []),
+                'report_html': None,  # Let frontend generate HTML from organized stages
+                'is_xray_based': True
+            }
+            return await in_thread(supabase_service.save_diagnosis, diagnosis_data, token)
         
-        diagnosis_data = {
-            'patient_name': request.patient_name,
-            'image_url': str(request.image_url),
-            'annotated_image_url': annotated_url,
-            'summary': ai_analysis.get('summary', ''),
-            'ai_notes': ai_analysis.get('ai_notes', ''),
-            'treatment_stages': ai_analysis.get('treatment_stages', []),
-            'report_html': None,  # Let frontend generate HTML from organized stages
-            'is_xray_based': True
-        }
+        graph.add("treatment_analysis", treatment_analysis, deps=("roboflow",), timeout=PLAN_STAGE_TIMEOUT_S)
+        graph.add("save_diagnosis", save_diagnosis, deps=("detection", "treatment_analysis"))
         
-        saved_diagnosis = await supabase_service.save_diagnosis(diagnosis_data, token)
-        diagnosis_id = saved_diagnosis.get('id')
-
         # Use generate_video from request body, fallback to query param
         should_generate_video = request.generate_video if hasattr(request, 'generate_video') else generate_video
         logger.info(f"Will generate video: {should_generate_video}")
         
-        # Step 5: Generate video synchronously (not in background)
-        video_url = None
-        if should_generate_video and diagnosis_id and annotated_url:  # Use should_generate_video
-            logger.info(f"Generating video for diagnosis: {diagnosis_id}")
-            try:
-                # Get video language from request, default to English
-                video_language = request.video_language or "english"
-                logger.info(f"Video language: {video_language}")
-                
-                # Call the video generation function directly (not in background)
-                video_url = await generate_video_sync(diagnosis_id, annotated_url, ai_analysis.get('treatment_stages', []), request.patient_name, token, video_language)
-                logger.info(f"Video generated successfully: {video_url}")
-            except Exception as video_error:
-                logger.error(f"Video generation failed: {str(video_error)}")
-                # Don't fail the entire request if video fails
-                video_url = None
+        # Step 5: Generate the video alongside the save (not in background); a failed video doesn't fail the request
+        if should_generate_video:
+            video_language = request.video_language or "english"
+            logger.info(f"Video language: {video_language}")
+            
+            async def video_render(detection, treatment_analysis):
+                try:
+                    video_url, video_script = await in_thread(
+                        render_diagnosis_video, detection["annotated_image_url"],
+                        treatment_analysis.get('treatment_stages', []), request.patient_name, token, video_language,
+                        label=f"patient: {request.patient_name}"
+                    )
+                    return {"video_url": video_url, "video_script": video_script}
+                except Exception as video_error:
+                    logger.error(f"Video generation failed: {str(video_error)}")
+                    return {"error": str(video_error)}
+            
+            async def video_record(save_diagnosis, video_render):
+                video = video_render or {"error": f"Video generation timed out after {VIDEO_STAGE_TIMEOUT_S:g}s"}
+                diagnosis_id = save_diagnosis.get('id')
+                if diagnosis_id:
+                    await in_thread(record_video_result, diagnosis_id, token, **video)
+                return video.get("video_url")
+            
+            graph.add("video_render", video_render, deps=("detection", "treatment_analysis"),
+                      timeout=VIDEO_STAGE_TIMEOUT_S, optional=True)
+            graph.add("video_record", video_record, deps=("save_diagnosis", "video_render"), optional=True)
         else:
-            logger.info(f"Skipping video generation. Conditions: generate_video={should_generate_video}, diagnosis_id={diagnosis_id}, annotated_url={bool(annotated_url)}")
+            logger.info(f"Skipping video generation. Conditions: generate_video={should_generate_video}")
+        
+        results = await graph.run()
+        annotated_url = results["detection"]["annotated_image_url"]
+        ai_analysis = results["treatment_analysis"]
+        diagnosis_id = results["save_diagnosis"].get('id')
+        video_url = results.get("video_record")
+        if video_url:
+            logger.info(f"Video generated successfully: {video_url}")
         
         # Return response with video URL
         response_data = {
@@ -326,6 +579,9 @@ async def analyze_xray(
         
     except HTTPException:
         raise
+    except StageTimeoutError as e:
+        logger.error(f"❌ X-ray analysis timed out: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         logger.error(f"Unexpected error in analyze_xray: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
@@ -335,23 +591,42 @@ async def generate_video_sync(diagnosis_id: str, annotated_url: str, treatment_s
     """
     Generate video synchronously and return the URL
     """
+    try:
+        video_url, video_script = await render_diagnosis_video(
+            annotated_url, treatment_stages, patient_name, token, video_language, label=f"diagnosis: {diagnosis_id}"
+        )
+    except Exception as e:
+        logger.error(f"Error in synchronous video generation: {str(e)}")
+        await record_video_result(diagnosis_id, token, error=str(e))
+        return None
+    
+    await record_video_result(diagnosis_id, token, video_url=video_url, video_script=video_script)
+    return video_url
+
+
+async def render_diagnosis_video(annotated_url: str, treatment_stages: list, patient_name: str, token: str,
+                                 video_language: str = "english", label: str = "new diagnosis") -> Tuple[str, str]:
+    """
+    Script, narrate, render and upload the patient video; returns (video_url, video_script)
+    Needs no diagnosis row, so /analyze-xray renders it while the diagnosis is being saved
+    """
     temp_dir = None
     try:
-        logger.info(f"Starting synchronous video generation for diagnosis: {diagnosis_id} in {video_language}")
+        logger.info(f"Starting video generation for {label} in {video_language}")
         
         # Convert annotated image to base64
-        logger.info(f"Converting image to base64 for diagnosis: {diagnosis_id}")
+        logger.info(f"Converting image to base64 for {label}")
         image_base64 = video_generator_service.image_to_base64(annotated_url)
         
         # Generate video script with patient name and language
-        logger.info(f"Generating video script for diagnosis: {diagnosis_id} in {video_language}")
+        logger.info(f"Generating video script for {label} in {video_language}")
         video_script = await openai_service.generate_video_script(treatment_stages, image_base64, patient_name, video_language)
         
         if not video_script or len(video_script.strip()) == 0:
             raise Exception("Generated video script is empty")
         
         # Generate voice audio with specified language
-        logger.info(f"Generating voice audio for diagnosis: {diagnosis_id} in {video_language}")
+        logger.info(f"Generating voice audio for {label} in {video_language}")
         audio_bytes = await elevenlabs_service.generate_voice(video_script, video_language)
         
         if not audio_bytes or len(audio_bytes) == 0:
@@ -391,7 +666,7 @@ async def generate_video_sync(diagnosis_id: str, annotated_url: str, treatment_s
             f.write(audio_bytes)
         
         # Create video
-        logger.info(f"Creating video with subtitles for diagnosis: {diagnosis_id}")
+        logger.info(f"Creating video with subtitles for {label}")
         video_path = os.path.join(temp_dir, f"patient_video_{unique_id}.mp4")
         duration = video_generator_service.create_video_with_subtitles(
             image_path,
@@ -400,7 +675,7 @@ async def generate_video_sync(diagnosis_id: str, annotated_url: str, treatment_s
         )
         
         # Upload video
-        logger.info(f"Uploading video to storage for diagnosis: {diagnosis_id}")
+        logger.info(f"Uploading video to storage for {label}")
         with open(video_path, 'rb') as video_file:
             video_data = video_file.read()
         
@@ -411,10 +686,29 @@ async def generate_video_sync(diagnosis_id: str, annotated_url: str, treatment_s
             token
         )
         
-        # Update diagnosis with video URL
+        if not video_url:
+            raise Exception("Failed to upload video to storage")
+        
+        return video_url, video_script
+    
+    finally:
+        # Cleanup temporary files
+        if temp_dir and os.path.exists(temp_dir):
+            try:
+                import shutil
+                shutil.rmtree(temp_dir)
+                logger.info(f"Cleaned up temp directory: {temp_dir}")
+            except Exception as cleanup_error:
+                logger.error(f"Failed to cleanup temp directory: {str(cleanup_error)}")
+
+
+async def record_video_result(diagnosis_id: str, token: str, video_url: Optional[str] = None,
+                              video_script: Optional[str] = None, error: Optional[str] = None) -> None:
+    """Store the rendered video on the diagnosis, or mark its generation as failed"""
+    try:
+        auth_client = supabase_service._create_authenticated_client(token)
         if video_url:
             logger.info(f"Updating database with video URL for diagnosis: {diagnosis_id}")
-            auth_client = supabase_service._create_authenticated_client(token)
             auth_client.table('patient_diagnosis').update({
                 'video_url': video_url,
                 'video_script': video_script,
@@ -422,35 +716,15 @@ async def generate_video_sync(diagnosis_id: str, annotated_url: str, treatment_s
                 'video_generation_failed': False,
                 'video_error': None
             }).eq('id', diagnosis_id).execute()
-            
-            return video_url
         else:
-            raise Exception("Failed to upload video to storage")
-        
-    except Exception as e:
-        logger.error(f"Error in synchronous video generation: {str(e)}")
-        # Update diagnosis to indicate video generation failed
-        try:
-            auth_client = supabase_service._create_authenticated_client(token)
+            # Update diagnosis to indicate video generation failed
             auth_client.table('patient_diagnosis').update({
                 'video_generation_failed': True,
-                'video_error': str(e)[:500],
+                'video_error': (error or 'Video generation failed')[:500],
                 'video_generated_at': datetime.now().isoformat()
             }).eq('id', diagnosis_id).execute()
-        except Exception as update_error:
-            logger.error(f"Failed to update diagnosis with video error: {str(update_error)}")
-        
-        return None
-    
-    finally:
-        # Cleanup temporary files
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                import shutil
-                shutil.rmtree(temp_dir)
-                logger.info(f"Cleaned up temp directory: {temp_dir}")
-            except Exception as cleanup_error:
-                logger.error(f"Failed to cleanup temp directory: {str(cleanup_error)}")
+    except Exception as update_error:
+        logger.error(f"Failed to update diagnosis with video result: {str(update_error)}")
 
 @router.get("/health")
 async def health_check() -> Dict:
@@ -518,6 +792,30 @@ async def detailed_health_check() -> Dict:
     
     health_status["status"] = "healthy" if all_services_ok else "unhealthy"
     
+    # Which lazily-constructed services have been built so far
+    from services.registry import registry
+    health_status["lazy_services"] = registry.status()
+
+    # GPT completion cache hit rate (only once something has used it)
+    if health_status["lazy_services"].get("completion_cache", {}).get("initialized"):
+        from services.completion_cache import get_completion_cache
+        health_status["completion_cache"] = get_completion_cache().stats()
+    if health_status["lazy_services"].get("effective_settings", {}).get("initialized"):
+        from services.effective_settings import get_effective_settings
+        health_status["effective_settings"] = get_effective_settings().stats()
+    if health_status["lazy_services"].get("scan_analysis", {}).get("initialized"):
+        from services.scan_analysis import get_scan_analysis
+        health_status["scan_analysis"] = get_scan_analysis().stats()
+    if health_status["lazy_services"].get("stripe_webhooks", {}).get("initialized"):
+        from services.stripe_webhook_queue import get_stripe_webhook_queue
+        health_status["stripe_webhooks"] = get_stripe_webhook_queue().stats()
+    if health_status["lazy_services"].get("insurance", {}).get("initialized"):
+        from services.insurance_verification import get_insurance_service
+        health_status["insurance"] = get_insurance_service().stats()
+    if health_status["lazy_services"].get("email_delivery", {}).get("initialized"):
+        from services.email_delivery import get_email_delivery_queue
+        health_status["email_delivery"] = get_email_delivery_queue().stats()
+    
     return health_status
 
 @router.get("/diagnoses")
@@ -601,7 +899,10 @@ async def upload_xray_image(
     file: UploadFile = File(...),
     token: str = Depends(get_auth_token)
 ):
-    """Upload X-ray image to Supabase Storage (supports JPEG, PNG, TIFF, and DICOM)"""
+    """
+    Upload X-ray image to Supabase Storage (supports JPEG, PNG, TIFF, and DICOM)
+    Stores analysis, display and thumbnail renditions under the file's content hash
+    """
     try:
         # Check if this is a DICOM file
         is_dicom = (
@@ -614,69 +915,182 @@ async def upload_xray_image(
         if not is_dicom and file.content_type not in allowed_types:
             raise HTTPException(status_code=400, detail="Invalid file type. Supported: JPEG, PNG, TIFF, DICOM")
         
-        # Read file content
-        file_content = await file.read()
+        from utils.upload_spool import UploadTooLargeError, spool_upload_file
         
-        # Generate unique filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Spool to disk in chunks (hashing as we go) rather than reading it all into memory
+        try:
+            spooled = await spool_upload_file(file)
+        except UploadTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
         
-        # Handle DICOM files - convert to JPEG
-        if is_dicom:
-            logger.info(f"🏥 Detected DICOM file upload: {file.filename}")
-            from services.dicom_processor import dicom_processor
-            
-            # Convert DICOM to JPEG
-            conversion_result = dicom_processor.convert_dicom_bytes_to_image(file_content)
-            
-            if not conversion_result:
-                raise HTTPException(status_code=500, detail="Failed to convert DICOM file. Please ensure it's a valid DICOM with image data.")
-            
-            image_bytes, dicom_metadata = conversion_result
-            logger.info(f"✅ DICOM converted to JPEG: {len(image_bytes)} bytes, Patient: {dicom_metadata.get('patient_name', 'Unknown')}")
-            
-            # Use JPEG bytes and change extension
-            file_content = image_bytes
-            file_name = f"xrays/dicom_{timestamp}_{file.filename.replace('.dcm', '.jpg')}"
+        with spooled:
+            return await _store_uploaded_xray(spooled, is_dicom, token)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error uploading image: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _store_uploaded_xray(spooled, is_dicom: bool, token: str) -> Dict[str, Any]:
+    """Normalise a spooled X-ray upload and store its renditions"""
+    from services.image_ingest import InvalidImageError, XRAY_PROFILE, normalise_image, store_image_variants
+    
+    # Normalise straight from the spooled file (its hash is already known)
+    image_source = spooled.path
+    dicom_metadata = None
+    
+    # Handle DICOM files - convert to JPEG
+    if is_dicom:
+        logger.info(f"🏥 Detected DICOM file upload: {spooled.filename}")
+        from services.dicom_processor import dicom_processor
+        
+        # Convert DICOM to JPEG, reading the spooled file directly
+        conversion_result = await asyncio.to_thread(dicom_processor.convert_dicom_file_to_image, spooled.path)
+        
+        if not conversion_result:
+            raise HTTPException(status_code=500, detail="Failed to convert DICOM file. Please ensure it's a valid DICOM with image data.")
+        
+        image_source, dicom_metadata = conversion_result
+        logger.info(f"✅ DICOM converted to JPEG: {len(image_source)} bytes, Patient: {dicom_metadata.get('patient_name', 'Unknown')}")
+        
+        # Store metadata for future use (optional - could save to database here too)
+        logger.info(f"📋 DICOM metadata: {dicom_metadata.get('patient_name')}, ID: {dicom_metadata.get('patient_id')}")
+    
+    # Decode once: oriented, metadata-free analysis JPEG plus display and thumbnail WebPs
+    try:
+        variants = await asyncio.to_thread(normalise_image, image_source, XRAY_PROFILE, spooled.content_hash)
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Upload to Supabase under the content hash of the original file
+    try:
+        urls = await store_image_variants(supabase_service, variants, "xrays", token)
+    except RuntimeError as e:
+        logger.error(f"❌ {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to upload image")
+    
+    # Prepare response; `url` is the analysis rendition every downstream consumer should use
+    response = {
+        "status": "success",
+        "url": urls["canonical"],
+        "filename": f"xrays/{variants.content_hash}/{variants.renditions['canonical'][1]}",
+        "content_hash": variants.content_hash,
+        "width": variants.width,
+        "height": variants.height,
+        "variants": {
+            "analysis": urls["canonical"],
+            "display": urls["display"],
+            "thumbnail": urls["thumbnail"]
+        }
+    }
+    
+    # Add DICOM metadata if available
+    if dicom_metadata is not None:
+        response["metadata"] = {
+            "patient_name": dicom_metadata.get('patient_name'),
+            "patient_id": dicom_metadata.get('patient_id'),
+            "patient_email": dicom_metadata.get('patient_email'),
+            "is_dicom": True
+        }
+        logger.info(f"📤 Returning DICOM metadata with upload response")
+    
+    return response
+
+
+# ==================== LARGE SCAN UPLOADS ====================
+
+@router.post("/uploads/scans")
+async def upload_scans(
+    files: List[UploadFile] = File(...),
+    token: str = Depends(get_auth_token)
+):
+    """
+    Upload one or more large files (CBCT volumes, DICOM series, archives) as-is
+    Each file is spooled to disk in chunks and streamed to S3 (multipart) or Supabase (resumable)
+    """
+    try:
+        from services.scan_storage import store_spooled_uploads
+        from utils.upload_spool import UploadTooLargeError, spool_upload_file
+        
+        decoded = jwt.decode(token, options={"verify_signature": False})
+        user_id = decoded.get('sub')
+        
+        if not user_id:
+            raise HTTPException(status_code=401, detail="Invalid authentication")
+        
+        logger.info(f"📤 Receiving {len(files)} scan file(s)")
+        
+        spooled = []
+        try:
+            for file in files:
+                spooled.append(await spool_upload_file(file))
             
-            # Store metadata for future use (optional - could save to database here too)
-            logger.info(f"📋 DICOM metadata: {dicom_metadata.get('patient_name')}, ID: {dicom_metadata.get('patient_id')}")
-        else:
-            # Regular image file
-            file_extension = file.filename.split('.')[-1]
-            file_name = f"xrays/{timestamp}_{file.filename}"
-        
-        # Upload to Supabase
-        public_url = await supabase_service.upload_image(
-            file_content,
-            file_name,
-            token
-        )
+            results = await store_spooled_uploads(spooled, user_id, token)
+        except UploadTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        finally:
+            for upload in spooled:
+                upload.cleanup()
         
-        if not public_url:
-            raise HTTPException(status_code=500, detail="Failed to upload image")
+        failed = sum(1 for result in results if result["status"] != "success")
+        logger.info(f"✅ Stored {len(results) - failed}/{len(results)} scan file(s)")
         
-        # Prepare response
-        response = {
-            "status": "success",
-            "url": public_url,
-            "filename": file_name
+        return {
+            "status": "success" if not failed else "partial",
+            "uploaded": len(results) - failed,
+            "failed": failed,
+            "files": results
         }
         
-        # Add DICOM metadata if available
-        if is_dicom and 'dicom_metadata' in locals():
-            response["metadata"] = {
-                "patient_name": dicom_metadata.get('patient_name'),
-                "patient_id": dicom_metadata.get('patient_id'),
-                "patient_email": dicom_metadata.get('patient_email'),
-                "is_dicom": True
-            }
-            logger.info(f"📤 Returning DICOM metadata with upload response")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error uploading scans: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to upload scans: {str(e)}")
+
+
+@router.put("/uploads/scans/{filename}")
+async def stream_scan_upload(
+    filename: str,
+    request: Request,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Upload a single large file as the raw request body (no multipart parsing)
+    The body is written to disk as it arrives, so worker memory stays flat
+    """
+    try:
+        from services.scan_storage import store_spooled_upload
+        from utils.upload_spool import UploadTooLargeError, spool_request_body
         
-        return response
+        decoded = jwt.decode(token, options={"verify_signature": False})
+        user_id = decoded.get('sub')
+        
+        if not user_id:
+            raise HTTPException(status_code=401, detail="Invalid authentication")
+        
+        try:
+            spooled = await spool_request_body(request, filename, request.headers.get('content-type'))
+        except UploadTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
         
+        with spooled:
+            try:
+                result = await store_spooled_upload(spooled, user_id, token)
+            except RuntimeError as e:
+                logger.error(f"❌ {str(e)}")
+                raise HTTPException(status_code=502, detail=str(e))
+        
+        logger.info(f"✅ Stored streamed scan {result['filename']} ({result['size']} bytes, {result['storage']})")
+        return {"status": "success", **result}
+        
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error uploading image: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error(f"❌ Error streaming scan upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to upload scan: {str(e)}")
     
 
 @router.post("/apply-suggested-changes", response_model=SuggestChangesResponse)
@@ -684,7 +1098,12 @@ async def apply_suggested_changes(
     request: SuggestChangesRequest,
     token: str = Depends(get_auth_token)
 ):
-    """Apply AI-suggested changes to the report HTML"""
+    """
+    Apply AI-suggested changes to the report HTML
+
+    Only the sections the change touches are sent to GPT and spliced back in;
+    the whole document is rewritten only when the change can't be localised.
+    """
     try:
         if not request.previous_report_html or not request.change_request_text:
             raise HTTPException(status_code=400, detail="Missing required fields")
@@ -692,47 +1111,12 @@ async def apply_suggested_changes(
         # Log the request details for debugging
         logger.info(f"Applying suggested changes. HTML length: {len(request.previous_report_html)}, Request: {request.change_request_text[:100]}...")
         
-        system_prompt = """You are an expert dental assistant AI and HTML editor. You will receive:
-
-1. An existing HTML dental treatment plan report, already formatted with inline styles and condition blocks.
-2. A plain-text change request written by a dentist, describing edits they'd like made to the content.
-
-Your task is to carefully update the HTML to reflect these requested changes.
-
-Instructions:
-- Maintain the full structure and inline styles of the HTML exactly as-is.
-- Only modify the **text content inside HTML elements** when explicitly instructed.
-- If the dentist asks to remove a condition entirely, you may delete that entire <div> block.
-- Do not reword, reformat, or reorder any part of the document unless the change request specifies it.
-- Do not add or alter colors, classes, or structure.
-- The output must be a valid, continuous HTML string (starting with <div and ending with </div>).
-- Do not include markdown, code fences, or JSON formatting.
-- Accuracy is critical. This output will be used in patient-facing medical documents."""
-
-        user_prompt = f"""Here is the current HTML version of the treatment report:
-{request.previous_report_html}
-
-Here is the dentist's change request (typed or dictated):
-{request.change_request_text}
-
-Please apply the change exactly as described, keeping the HTML structure intact and updating only the necessary content."""
-
-        # Check if the combined prompt is too long
-        total_length = len(system_prompt) + len(user_prompt)
-        logger.info(f"Total prompt length: {total_length} characters")
-        
-        # Increase max_tokens to handle larger reports
-        max_tokens_needed = min(8000, max(4000, len(request.previous_report_html) // 2))
+        from services.report_editor import get_report_editor
         
         try:
-            response = openai_service.client.chat.completions.create(
-                model=openai_service.model_edit,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=max_tokens_needed  # Dynamic based on input size
+            updated_html = await get_report_editor().apply_changes(
+                request.previous_report_html,
+                request.change_request_text
             )
         except Exception as api_error:
             logger.error(f"OpenAI API error: {str(api_error)}")
@@ -744,19 +1128,6 @@ Please apply the change exactly as described, keeping the HTML structure intact
                 )
             raise
         
-        updated_html = response.choices[0].message.content
-        
-        # Clean up any potential markdown formatting
-        updated_html = updated_html.strip()
-        if updated_html.startswith("```html"):
-            # Remove code fences if present
-            updated_html = updated_html[7:]  # Remove ```html
-            if updated_html.endswith("```"):
-                updated_html = updated_html[:-3]
-        elif updated_html.startswith("```"):
-            # Remove generic code fences
-            updated_html = updated_html.split("\n", 1)[1].rsplit("\n", 1)[0]
-        
         logger.info(f"Successfully applied suggested changes. Output length: {len(updated_html)}")
         return SuggestChangesResponse(updated_html=updated_html)
         
@@ -768,12 +1139,46 @@ Please apply the change exactly as described, keeping the HTML structure intact
         if hasattr(e, 'response'):
             logger.error(f"API Response: {getattr(e.response, 'text', 'No response text')}")
         raise HTTPException(status_code=500, detail=f"Failed to apply suggested changes: {str(e)}")
+
+
+@router.post("/apply-suggested-changes/stream")
+async def apply_suggested_changes_stream(
+    request: SuggestChangesRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Same as /apply-suggested-changes, streamed as server-sent events
+
+    Events: parsed, targets, section (each edited fragment), fallback,
+    done ({updated_html, mode, sections_edited}) or error ({detail}).
+    """
+    if not request.previous_report_html or not request.change_request_text:
+        raise HTTPException(status_code=400, detail="Missing required fields")
+
+    from services.report_editor import get_report_editor
+    from utils.sse import sse_event, sse_response
+
+    editor = get_report_editor()
+
+    async def events():
+        try:
+            async for event, payload in editor.apply_changes_stream(
+                request.previous_report_html,
+                request.change_request_text
+            ):
+                yield sse_event(event, payload)
+        except Exception as e:
+            logger.error(f"❌ Error streaming suggested changes: {str(e)}")
+            yield sse_event("error", {"detail": f"Failed to apply suggested changes: {str(e)}"})
+
+    return sse_response(events())
     
 
 @router.post("/generate-patient-video")
 async def generate_patient_video(
     diagnosis_id: str,
-    token: str = Depends(get_auth_token)
+    token: str = Depends(get_auth_token),
+    force_refresh: bool = False
 ):
     """Generate educational video for patient based on diagnosis"""
     temp_files = []
@@ -799,7 +1204,8 @@ async def generate_patient_video(
         # Step 3: Generate video script with OpenAI (with patient name and default English)
         logger.info("Generating video script...")
         video_language = "english"  # Default to English for this endpoint
-        video_script = await openai_service.generate_video_script(treatment_stages, image_base64, patient_name, video_language)
+        video_script = await openai_service.generate_video_script(treatment_stages, image_base64, patient_name, video_language,
+                                                                  force_refresh=force_refresh)
         
         # Step 4: Generate voice audio with ElevenLabs
         logger.info("Generating voice audio...")
@@ -928,12 +1334,67 @@ async def regenerate_video(
 ):
     """Regenerate video for an existing diagnosis"""
     try:
-        # Just call the generate_patient_video endpoint
-        return await generate_patient_video(diagnosis_id, token)
+        # Just call the generate_patient_video endpoint, with a fresh script
+        return await generate_patient_video(diagnosis_id, token, force_refresh=True)
         
     except Exception as e:
         logger.error(f"Error regenerating video: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to regenerate video: {str(e)}")
+
+
+@router.post("/diagnosis/{diagnosis_id}/video-script/stream")
+async def stream_video_script(
+    diagnosis_id: str,
+    video_language: str = "english",
+    token: str = Depends(get_auth_token)
+):
+    """
+    Write the patient video script for a diagnosis, streamed as server-sent events
+
+    Lets the clinician read (and abort) the script before the voice/video
+    steps run. Events: token ({text}), reset (discard streamed text, the
+    script is being regenerated without the image), done ({video_script})
+    once saved on the diagnosis, or error ({detail}).
+    """
+    from utils.sse import sse_event, sse_response
+
+    auth_client = supabase_service._create_authenticated_client(token)
+    diagnosis_response = auth_client.table('patient_diagnosis').select("*").eq('id', diagnosis_id).execute()
+    if not diagnosis_response.data:
+        raise HTTPException(status_code=404, detail="Diagnosis not found")
+    diagnosis = diagnosis_response.data[0]
+
+    async def events():
+        try:
+            image_base64 = await asyncio.to_thread(
+                video_generator_service.image_to_base64, diagnosis.get('annotated_image_url')
+            )
+
+            video_script = ''
+            async for event, payload in openai_service.stream_video_script(
+                diagnosis.get('treatment_stages', []),
+                image_base64,
+                diagnosis.get('patient_name'),
+                video_language
+            ):
+                if event == "token":
+                    yield sse_event("token", {"text": payload})
+                elif event == "reset":
+                    yield sse_event("reset", {"reason": payload})
+                else:
+                    video_script = payload
+
+            auth_client.table('patient_diagnosis').update({
+                'video_script': video_script
+            }).eq('id', diagnosis_id).execute()
+
+            yield sse_event("done", {"video_script": video_script})
+            logger.info(f"✅ Streamed video script for diagnosis: {diagnosis_id}")
+        except Exception as e:
+            logger.error(f"❌ Error streaming video script: {str(e)}")
+            yield sse_event("error", {"detail": f"Failed to generate video script: {str(e)}"})
+
+    return sse_response(events())
     
 
 @router.get("/diagnoses/{diagnosis_id}")
@@ -1218,6 +1679,78 @@ async def analyze_without_xray(
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@router.post("/analyze-without-xray/stream")
+async def analyze_without_xray_stream(
+    request: Dict,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Same as /analyze-without-xray, streamed as server-sent events
+
+    Events: analysis ({summary, treatment_stages, ai_notes}), section (each
+    report block as soon as it is complete), reset (discard streamed sections,
+    the report is being regenerated), done ({diagnosis_id, report_html}) once
+    the diagnosis is saved, or error ({detail}).
+    """
+    from utils.sse import sse_event, sse_response
+
+    patient_name = request.get('patient_name')
+    observations = request.get('observations', '')
+    findings = request.get('findings', [])
+
+    async def events():
+        try:
+            logger.info(f"Starting streamed analysis without X-ray for patient: {patient_name}")
+
+            enhanced_findings = findings.copy()
+            if observations:
+                enhanced_findings.append({
+                    'tooth': 'General',
+                    'condition': 'Clinical Observations',
+                    'treatment': observations
+                })
+
+            ai_analysis = await openai_service.analyze_dental_conditions({'predictions': []}, enhanced_findings)
+            yield sse_event("analysis", {
+                "summary": ai_analysis.get('summary', ''),
+                "treatment_stages": ai_analysis.get('treatment_stages', []),
+                "ai_notes": ai_analysis.get('ai_notes', '')
+            })
+
+            html_report = ''
+            async for event, payload in openai_service.stream_html_report_content(findings, patient_name):
+                if event == "section":
+                    yield sse_event("section", {"html": payload})
+                elif event == "reset":
+                    yield sse_event("reset", {"reason": payload})
+                else:
+                    html_report = payload
+
+            diagnosis_data = {
+                'patient_name': patient_name,
+                'image_url': 'placeholder-no-xray.jpg',
+                'annotated_image_url': 'placeholder-no-xray.jpg',
+                'summary': ai_analysis.get('summary', ''),
+                'ai_notes': ai_analysis.get('ai_notes', ''),
+                'treatment_stages': ai_analysis.get('treatment_stages', []),
+                'is_xray_based': False,
+                'report_html': html_report
+            }
+            saved_diagnosis = await supabase_service.save_diagnosis(diagnosis_data, token)
+
+            yield sse_event("done", {
+                "diagnosis_id": saved_diagnosis.get('id') if saved_diagnosis else None,
+                "diagnosis_timestamp": datetime.now(),
+                "report_html": html_report
+            })
+            logger.info(f"✅ Streamed analysis without X-ray for patient: {patient_name}")
+        except Exception as e:
+            logger.error(f"❌ Error in analyze_without_xray_stream: {str(e)}")
+            yield sse_event("error", {"detail": f"Internal server error: {str(e)}"})
+
+    return sse_response(events())
+
+
 @router.post("/clinic-pricing")
 async def save_clinic_pricing(
     pricing_data: Dict[str, float],
@@ -1285,218 +1818,54 @@ async def get_clinic_pricing(
         raise HTTPException(status_code=500, detail=f"Failed to get pricing: {str(e)}")
 
 
+def _invalidate_effective_settings(token: str) -> None:
+    """Drop the caller's cached merged treatment table after a settings write"""
+    from services.effective_settings import get_effective_settings
+    
+    user_id = jwt.decode(token, options={"verify_signature": False}).get('sub')
+    effective_settings_service = get_effective_settings()
+    if user_id and effective_settings_service:
+        effective_settings_service.invalidate(user_id)
+
 @router.get("/treatment-settings")
 async def get_treatment_settings(
+    request: Request,
     token: str = Depends(get_auth_token)
 ):
-    """Get clinic-specific treatment settings with fallback to defaults"""
+    """
+    Get clinic-specific treatment settings with fallback to defaults
+    Served from the per-clinic merged table; answers 304 when If-None-Match matches its ETag
+    """
     try:
         logger.info("Fetching treatment settings for clinic")
         
-        # Hardcoded defaults as fallback (matching dental-data.ts exactly)
-        # This ensures prices/durations work even if database is empty
-        HARDCODED_DEFAULTS = {
-            # Legacy codes (for backwards compatibility)
-            'filling': {'duration': 30, 'price': 220},
-            'extraction': {'duration': 30, 'price': 250},
-            'root-canal-treatment': {'duration': 90, 'price': 1100},
-            'crown': {'duration': 60, 'price': 1800},
-            'bridge': {'duration': 120, 'price': 850},
-            'implant-placement': {'duration': 90, 'price': 2300},
-            'partial-denture': {'duration': 60, 'price': 1600},
-            'scale-and-clean': {'duration': 30, 'price': 190},
-            'periodontal-treatment': {'duration': 60, 'price': 280},
-            'veneer': {'duration': 60, 'price': 1500},
-            'fluoride-treatment': {'duration': 15, 'price': 40},
-            'composite-build-up': {'duration': 45, 'price': 200},
-            'surgical-extraction': {'duration': 45, 'price': 450},
-            'deep-cleaning': {'duration': 60, 'price': 280},
-            'complete-denture': {'duration': 90, 'price': 2500},
-            'inlay': {'duration': 60, 'price': 1400},
-            'onlay': {'duration': 60, 'price': 1400},
-            'whitening': {'duration': 60, 'price': 750},
-            'bonding': {'duration': 30, 'price': 150},
-            'sealant': {'duration': 15, 'price': 70},
-            'night-guard': {'duration': 30, 'price': 600},
-            'orthodontic-treatment': {'duration': 60, 'price': 4000},
-            'braces': {'duration': 60, 'price': 3500},
-            'invisalign': {'duration': 60, 'price': 4500},
-            'retainer': {'duration': 30, 'price': 200},
-            'space-maintainer': {'duration': 30, 'price': 180},
-            'apicoectomy': {'duration': 90, 'price': 950},
-            'bone-graft': {'duration': 90, 'price': 800},
-            'sinus-lift': {'duration': 120, 'price': 1200},
-            'gum-graft': {'duration': 90, 'price': 750},
-            
-            # NEW: Current dental codes (matching dental-data.ts)
-            # Examinations
-            'exam_emergency': {'duration': 20, 'price': 100},
-            'exam_comprehensive': {'duration': 40, 'price': 120},
-            'radiograph_intraoral': {'duration': 10, 'price': 45},
-            'radiograph_opg': {'duration': 15, 'price': 100},
-            
-            # Preventive
-            'scale_clean_polish': {'duration': 30, 'price': 190},
-            'fluoride_application': {'duration': 15, 'price': 40},
-            'fissure_sealant': {'duration': 15, 'price': 70},
-            'desensitising': {'duration': 15, 'price': 55},
-            'oh_instructions': {'duration': 15, 'price': 40},
-            'whitening_inchair': {'duration': 90, 'price': 750},
-            'whitening_takehome': {'duration': 20, 'price': 450},
-            
-            # Restorative - Composite
-            'resto_comp_one_surface_ant': {'duration': 30, 'price': 220},
-            'resto_comp_two_surface_ant': {'duration': 40, 'price': 280},
-            'resto_comp_three_plus_ant': {'duration': 50, 'price': 340},
-            'resto_comp_one_surface_post': {'duration': 35, 'price': 260},
-            'resto_comp_two_surface_post': {'duration': 45, 'price': 320},
-            'resto_comp_three_plus_post': {'duration': 55, 'price': 380},
-            'resto_glassionomer': {'duration': 25, 'price': 160},
-            'resto_amalgam_post': {'duration': 35, 'price': 290},
-            
-            # Crowns and indirect restorations
-            'crown_temp': {'duration': 30, 'price': 180},
-            'crown_full_tooth_coloured': {'duration': 60, 'price': 1800},
-            'crown_full_metal': {'duration': 60, 'price': 1650},
-            'onlay_inlay_indirect_tc': {'duration': 60, 'price': 1400},
-            'veneer_indirect': {'duration': 60, 'price': 1500},
-            'veneer_direct': {'duration': 45, 'price': 650},
-            
-            # Endodontic
-            'endo_direct_pulp_cap': {'duration': 30, 'price': 120},
-            'endo_indirect_pulp_cap': {'duration': 25, 'price': 120},
-            'endo_pulpotomy': {'duration': 35, 'price': 220},
-            'endo_extirpation': {'duration': 40, 'price': 180},
-            'endo_rct_single': {'duration': 90, 'price': 1100},
-            'endo_rct_multi': {'duration': 120, 'price': 1600},
-            'endo_retx': {'duration': 150, 'price': 1900},
-            'endo_apicectomy': {'duration': 90, 'price': 950},
-            'endo_rct_1_canal': {'duration': 90, 'price': 1100},
-            'endo_rct_2_canals': {'duration': 105, 'price': 1350},
-            'endo_rct_3_canals': {'duration': 120, 'price': 1650},
-            'endo_rct_4_canals': {'duration': 135, 'price': 1850},
-            'endo_retx_load': {'duration': 30, 'price': 300},
-            'endo_calcified_per_canal': {'duration': 20, 'price': 150},
-            'endo_remove_post': {'duration': 25, 'price': 180},
-            'endo_remove_root_filling_per_canal': {'duration': 15, 'price': 120},
-            'endo_additional_irrigation_visit': {'duration': 20, 'price': 120},
-            'endo_interim_therapeutic_fill': {'duration': 25, 'price': 180},
-            'endo_apicectomy_per_root': {'duration': 90, 'price': 950},
-            'endo_extirpation_emergency': {'duration': 40, 'price': 180},
-            
-            # Periodontal
-            'perio_scale_root_planing': {'duration': 60, 'price': 280},
-            'perio_curettage': {'duration': 60, 'price': 280},
-            'perio_flap_surgery': {'duration': 90, 'price': 950},
-            'perio_graft': {'duration': 90, 'price': 750},
-            'perio_crown_lengthening': {'duration': 90, 'price': 950},
-            'perio_guided_tissue_regen': {'duration': 120, 'price': 1100},
-            'perio_bone_graft': {'duration': 90, 'price': 950},
-            
-            # Surgical
-            'surg_simple_extraction': {'duration': 30, 'price': 250},
-            'surg_surgical_extraction': {'duration': 45, 'price': 450},
-            'surg_incision_drainage': {'duration': 30, 'price': 200},
-            'surg_replantation': {'duration': 60, 'price': 500},
-            'surg_frenectomy': {'duration': 45, 'price': 400},
-            'surg_biopsy': {'duration': 40, 'price': 350},
-            'surg_exposure_unerupted': {'duration': 60, 'price': 400},
-            'surg_alveoloplasty': {'duration': 60, 'price': 500},
-            'surg_tori_removal': {'duration': 90, 'price': 850},
-            'surg_minor_soft_tissue': {'duration': 45, 'price': 400},
-            'surg_apical_cystectomy': {'duration': 120, 'price': 1200},
-            
-            # Prosthodontic
-            'prost_partial_denture_resin': {'duration': 60, 'price': 1600},
-            'prost_partial_denture_cast': {'duration': 75, 'price': 2200},
-            'prost_full_denture_resin': {'duration': 90, 'price': 2500},
-            'prost_denture_reline': {'duration': 45, 'price': 550},
-            'prost_denture_repair': {'duration': 30, 'price': 300},
-            'prost_partial_denture_resin_1to3': {'duration': 55, 'price': 1450},
-            'prost_partial_denture_resin_4plus': {'duration': 65, 'price': 1700},
-            'prost_partial_denture_cast_1to3': {'duration': 70, 'price': 2100},
-            'prost_partial_denture_cast_4plus': {'duration': 80, 'price': 2400},
-            'prost_immediate_denture_partial': {'duration': 70, 'price': 1850},
-            'prost_immediate_denture_full': {'duration': 95, 'price': 2700},
-            'prost_full_denture_upper': {'duration': 90, 'price': 2500},
-            'prost_full_denture_lower': {'duration': 90, 'price': 2600},
-            'prost_add_to_denture': {'duration': 30, 'price': 300},
-            'prost_soft_reline': {'duration': 40, 'price': 380},
-            'prost_hard_reline_lab': {'duration': 50, 'price': 550},
-            'prost_denture_repair_fracture': {'duration': 30, 'price': 300},
-            'prost_denture_adjustment': {'duration': 20, 'price': 120},
-            'prost_resilient_lining': {'duration': 45, 'price': 400},
-            'prost_overdenture': {'duration': 120, 'price': 2800},
-            
-            # Posts and Bridges
-            'post_core_direct': {'duration': 40, 'price': 420},
-            'post_core_indirect': {'duration': 60, 'price': 650},
-            'bridge_temp': {'duration': 35, 'price': 220},
-            'bridge_pontic_indirect_tc': {'duration': 60, 'price': 1600},
-            'bridge_abutment_crown_tc': {'duration': 65, 'price': 1700},
-            'bridge_recement': {'duration': 25, 'price': 220},
-            'crown_recement': {'duration': 20, 'price': 180},
-            
-            # Implant Restorative
-            'crown_implant_supported_tc': {'duration': 70, 'price': 1950},
-            'abutment_custom': {'duration': 40, 'price': 420},
-            
-            # Functional
-            'splint_occlusal': {'duration': 30, 'price': 600},
-            'tmj_adjustment': {'duration': 30, 'price': 250},
-            
-            # Palliative/Sedation
-            'palliative_care': {'duration': 25, 'price': 120},
-            'postop_review_simple': {'duration': 15, 'price': 60},
-            'medication_prescription': {'duration': 10, 'price': 30},
-            'nitrous_sedation': {'duration': 30, 'price': 180},
-            'iv_sedation_inhouse': {'duration': 60, 'price': 800},
-            'mouthguard_custom': {'duration': 30, 'price': 220},
-            
-            # Trauma
-            'trauma_splinting': {'duration': 45, 'price': 350},
-            'trauma_pulpotomy_temp': {'duration': 30, 'price': 200},
-            
-            # Orthodontic
-            'ortho_removable_appliance': {'duration': 45, 'price': 750},
-            'ortho_clear_aligner_simple': {'duration': 60, 'price': 2500},
-            'ortho_retainer': {'duration': 30, 'price': 400},
-        }
-        
-        # Pass the token to the service method
-        custom_settings = await supabase_service.get_treatment_settings(token)
+        from fastapi.responses import JSONResponse, Response
+        from services.effective_settings import etag_matches, get_effective_settings
         
-        # Get default treatments from master table (no token needed)
-        default_treatments = await supabase_service.get_dental_treatments()
+        decoded_token = jwt.decode(token, options={"verify_signature": False})
+        user_id = decoded_token.get('sub')
         
-        # Merge custom settings with defaults
-        treatment_data = {}
+        if not user_id:
+            raise HTTPException(status_code=401, detail="Invalid token")
         
-        # Start with hardcoded defaults
-        treatment_data = HARDCODED_DEFAULTS.copy()
+        effective_settings_service = get_effective_settings()
+        if not effective_settings_service:
+            raise HTTPException(status_code=500, detail="Effective settings service not available")
         
-        # Override with database defaults if available
-        for treatment in default_treatments:
-            treatment_data[treatment['code']] = {
-                'duration': treatment['default_duration'],
-                'price': treatment['default_price']
-            }
+        settings = await effective_settings_service.get(user_id, token)
+        # Revalidate every time, but let the browser reuse its copy on a 304
+        headers = {"ETag": settings.etag, "Cache-Control": "private, no-cache"}
         
-        # Finally override with custom settings if they exist
-        if custom_settings and custom_settings.get('treatment_settings'):
-            custom_data = custom_settings.get('treatment_settings', {})
-            for code, settings in custom_data.items():
-                treatment_data[code] = settings
+        if etag_matches(request.headers.get('if-none-match'), settings.etag):
+            logger.info("✅ Treatment settings unchanged (304)")
+            return Response(status_code=304, headers=headers)
         
-        logger.info(f"✅ Returning {len(treatment_data)} treatment settings")
+        logger.info(f"✅ Returning {len(settings.treatment_data)} treatment settings")
         
-        return {
-            "status": "success",
-            "treatment_data": treatment_data,
-            "has_customizations": bool(custom_settings and custom_settings.get('treatment_settings')),
-            "last_updated": custom_settings.get('updated_at') if custom_settings else None
-        }
+        return JSONResponse(content=settings.to_response(), headers=headers)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error fetching treatment settings: {str(e)}")
         raise HTTPException(
@@ -1550,6 +1919,7 @@ async def save_treatment_settings(
         
         # Save only customized settings
         result = await supabase_service.save_treatment_settings(customized_settings, token)
+        _invalidate_effective_settings(token)
         
         if result:
             logger.info(f"Saved {len(customized_settings)} customized treatment settings")
@@ -1584,6 +1954,7 @@ async def reset_treatment_settings(
         
         # Clear the treatment_settings JSON field
         result = await supabase_service.clear_treatment_settings(token)
+        _invalidate_effective_settings(token)
         
         if result:
             return {
@@ -1643,30 +2014,38 @@ async def upload_clinic_logo(
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid authentication")
         
+        from services.image_ingest import InvalidImageError, LOGO_PROFILE, normalise_image, store_image_variants
+        
         # Read file contents
         file_contents = await file.read()
         
-        # Generate unique filename
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'png'
-        filename = f"clinic_logo_{user_id}_{int(datetime.now().timestamp())}.{file_extension}"
-        
-        # Upload to Supabase storage
-        logo_url = await supabase_service.upload_image(
-            file_contents,
-            f"clinic_logos/{filename}",
-            token
-        )
+        # Oriented, metadata-free PNG (transparency kept) plus display and thumbnail WebPs
+        try:
+            variants = await asyncio.to_thread(normalise_image, file_contents, LOGO_PROFILE)
+        except InvalidImageError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        if not logo_url:
+        # Upload to Supabase storage under the content hash of the original file
+        try:
+            urls = await store_image_variants(supabase_service, variants, f"clinic_logos/{user_id}", token)
+        except RuntimeError as e:
+            logger.error(f"❌ {str(e)}")
             raise HTTPException(status_code=500, detail="Failed to upload logo")
+        logo_url = urls["canonical"]
         
         logger.info(f"✅ Logo uploaded successfully: {logo_url}")
         
         return {
             "status": "success",
-            "logo_url": logo_url
+            "logo_url": logo_url,
+            "variants": {
+                "display": urls["display"],
+                "thumbnail": urls["thumbnail"]
+            }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading clinic logo: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to upload logo: {str(e)}")
@@ -2066,9 +2445,37 @@ async def process_image_ocr(
         raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
 
 # Insurance Verification Endpoints
+INSURANCE_BATCH_MAX = int(os.getenv("INSURANCE_BATCH_MAX", "200"))
+
+def _verification_request(request: InsuranceVerificationRequest):
+    from services.insurance_verification import VerificationRequest
+    return VerificationRequest(
+        patient_id=request.patient_id,
+        insurance_provider=request.insurance_provider,
+        policy_number=request.policy_number,
+        group_number=request.group_number,
+        subscriber_name=request.subscriber_name,
+        subscriber_relationship=request.subscriber_relationship,
+        date_of_birth=request.date_of_birth,
+        treatment_codes=request.treatment_codes
+    )
+
+def _verification_response(result) -> InsuranceVerificationResponse:
+    return InsuranceVerificationResponse(
+        verification_id=result.verification_id,
+        status=result.status,
+        coverage_details=result.coverage_details,
+        estimated_costs=result.estimated_costs,
+        verification_date=result.verification_date,
+        next_verification_due=result.next_verification_due,
+        notes=result.notes,
+        cached=result.cached
+    )
+
 @router.post("/insurance/verify", response_model=InsuranceVerificationResponse)
 async def verify_insurance(
     request: InsuranceVerificationRequest,
+    force_refresh: bool = False,
     token: str = Depends(get_auth_token)
 ):
     """
@@ -2077,35 +2484,59 @@ async def verify_insurance(
     try:
         logger.info(f"Starting insurance verification for patient: {request.patient_id}")
         
-        # Use the insurance verification service
-        from services.insurance_verification import VerificationRequest
-        
-        verification_request = VerificationRequest(
-            patient_id=request.patient_id,
-            insurance_provider=request.insurance_provider,
-            policy_number=request.policy_number,
-            group_number=request.group_number,
-            subscriber_name=request.subscriber_name,
-            subscriber_relationship=request.subscriber_relationship,
-            date_of_birth=request.date_of_birth,
-            treatment_codes=request.treatment_codes
-        )
+        result = await insurance_service.verify_insurance(_verification_request(request), force_refresh)
+        return _verification_response(result)
         
-        result = insurance_service.verify_insurance(verification_request)
+    except Exception as e:
+        logger.error(f"Insurance verification error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Insurance verification failed: {str(e)}")
+
+@router.post("/insurance/verify/batch", response_model=InsuranceBatchVerificationResponse)
+async def verify_insurance_batch(
+    request: InsuranceBatchVerificationRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Verify a day's appointment list at once
+    
+    Appointments are checked concurrently (bounded per provider) and members
+    verified recently are answered from the cache. Results are in request
+    order; a failed check is reported in its own result, not as an error.
+    """
+    try:
+        if len(request.appointments) > INSURANCE_BATCH_MAX:
+            raise HTTPException(
+                status_code=400,
+                detail=f"At most {INSURANCE_BATCH_MAX} appointments per batch"
+            )
+        logger.info(f"🔄 Verifying insurance for {len(request.appointments)} appointments")
         
-        return InsuranceVerificationResponse(
-            verification_id=result.verification_id,
-            status=result.status,
-            coverage_details=result.coverage_details,
-            estimated_costs=result.estimated_costs,
-            verification_date=result.verification_date,
-            next_verification_due=result.next_verification_due,
-            notes=result.notes
+        started = time.perf_counter()
+        results = await insurance_service.verify_batch(
+            [_verification_request(appointment) for appointment in request.appointments],
+            request.force_refresh
+        )
+        elapsed = time.perf_counter() - started
+        
+        completed = sum(result.status == "completed" for result in results)
+        summary = {
+            "total": len(results),
+            "completed": completed,
+            "failed": len(results) - completed,
+            "cached": sum(result.cached for result in results),
+            "elapsed_seconds": round(elapsed, 3)
+        }
+        logger.info(f"✅ Insurance batch verified: {summary}")
+        return InsuranceBatchVerificationResponse(
+            results=[_verification_response(result) for result in results],
+            summary=summary
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Insurance verification error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Insurance verification failed: {str(e)}")
+        logger.error(f"Insurance batch verification error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Insurance batch verification failed: {str(e)}")
 
 @router.post("/insurance/patient")
 async def save_patient_insurance(
@@ -2228,41 +2659,54 @@ class ToothMappingRequest(BaseModel):
     image_url: str
     detections: List[Dict[str, Any]]
     numbering_system: str = "FDI"  # Default to FDI, can be "FDI" or "Universal"
+    content_hash: Optional[str] = None  # Scan's upload hash, to reuse stored mappings
 
-@router.post("/tooth-mapping")
-async def map_teeth(
-    request: ToothMappingRequest,
-    token: str = Depends(get_auth_token)
-):
+async def _map_scan_teeth(image_url: str, raw_detections: List[Dict[str, Any]], numbering_system: str, token: str,
+                          content_hash: Optional[str] = None, segment=None) -> Tuple[Dict[str, Any], bool]:
     """
-    Map dental conditions to specific tooth numbers using ensemble AI approach
+    Tooth mapping for one scan, stored on its analysis record; returns (mapping result, reused)
+    `segment` overrides how the teeth segmentation is fetched (a batch shares one per image)
     """
-    try:
-        logger.info(f"Starting tooth mapping for {len(request.detections)} detections")
-        logger.info(f"User requested numbering system: {request.numbering_system}")
-        
-        # Convert detections to Detection objects
-        detections = [
-            Detection(
-                class_name=detection["class"],
-                confidence=detection["confidence"],
-                x=detection["x"],
-                y=detection["y"],
-                width=detection.get("width", 0),
-                height=detection.get("height", 0)
-            )
-            for detection in request.detections
-        ]
-        
+    # Convert detections to Detection objects
+    detections = [
+        Detection(
+            class_name=detection["class"],
+            confidence=detection["confidence"],
+            x=detection["x"],
+            y=detection["y"],
+            width=detection.get("width", 0),
+            height=detection.get("height", 0)
+        )
+        for detection in raw_detections
+    ]
+    
+    # Mappings of these exact detections are stored on the scan's analysis record
+    scan = await _open_scan(image_url, token, content_hash)
+    
+    if segment is None:
+        async def segment():
+            return await roboflow_service.segment_teeth(image_url)
+    
+    async def run_mapping():
         # Use provider switch; default to existing ensemble
         provider = os.getenv("TOOTH_MAPPING_PROVIDER", "ensemble").lower()
-        if provider == "april_vision":
+        
+        # A segmentation already stored for the scan calibrates the grid; only april_vision computes one
+        stored_segmentation = None
+        if scan is not None:
+            scan_store, user_id, image_hash = scan
+            stored_segmentation = (await scan_store.get(user_id, image_hash, token)).get("segmentation")
+        
+        if provider == "grid":
+            # Vectorised grid only, no GPT calls
+            result = tooth_mapping_service.map_teeth_grid(detections, numbering_system, stored_segmentation)
+        elif provider == "april_vision":
             # Call Roboflow condition detections already produced upstream; here we only have detections list
-            # For AprilVision flow we also need segmentation predictions
-            seg_json = await roboflow_service.segment_teeth(request.image_url)
+            # For AprilVision flow we also need segmentation predictions (shared with /image/overlay)
+            seg_json, _ = await _run_scan_stage(scan, "segmentation", segment, token, image_url)
             if not seg_json:
                 # fallback to existing implementation if segmentation unavailable
-                result = tooth_mapping_service.map_teeth_ensemble(request.image_url, detections, request.numbering_system)
+                result = await asyncio.to_thread(tooth_mapping_service.map_teeth_ensemble, image_url, detections, numbering_system)
             else:
                 # Build synthetic condition_detections payload from incoming detections
                 cond_json = {
@@ -2278,11 +2722,17 @@ async def map_teeth(
                         for d in detections
                     ]
                 }
+                # shapely is only loaded when the segmentation provider is actually used
+                from services.april_vision_mapper import map_with_segmentation
+                
                 # Image width is unknown here; AprilVision uses it to midline-correct if provided.
-                result = map_with_segmentation(None, cond_json, seg_json, request.numbering_system)
+                result = map_with_segmentation(None, cond_json, seg_json, numbering_system)
         else:
             # Perform ensemble tooth mapping with user's numbering system preference
-            result = tooth_mapping_service.map_teeth_ensemble(request.image_url, detections, request.numbering_system)
+            # (blocking GPT calls, so off the event loop)
+            result = await asyncio.to_thread(
+                tooth_mapping_service.map_teeth_ensemble, image_url, detections, numbering_system, stored_segmentation
+            )
         
         return {
             "success": True,
@@ -2302,12 +2752,116 @@ async def map_teeth(
             "processing_time": result.processing_time,
             "method_used": result.method_used
         }
+    
+    from services.scan_analysis import tooth_mapping_stage
+    
+    return await _run_scan_stage(
+        scan, tooth_mapping_stage(numbering_system, raw_detections), run_mapping,
+        token, image_url, cacheable=lambda result: bool(result["mappings"])
+    )
+
+
+@router.post("/tooth-mapping")
+async def map_teeth(
+    request: ToothMappingRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Map dental conditions to specific tooth numbers using ensemble AI approach
+    TOOTH_MAPPING_PROVIDER selects ensemble (default), april_vision or grid (vectorised grid only, no GPT)
+    """
+    try:
+        logger.info(f"Starting tooth mapping for {len(request.detections)} detections")
+        logger.info(f"User requested numbering system: {request.numbering_system}")
+        
+        mapping_result, reused = await _map_scan_teeth(
+            request.image_url, request.detections, request.numbering_system, token, request.content_hash
+        )
+        if reused:
+            logger.info("🔄 Reusing stored tooth mapping for these detections")
+        
+        return mapping_result
         
     except Exception as e:
         logger.error(f"Tooth mapping error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Tooth mapping failed: {str(e)}")
 
 
+class ToothMappingBatchScan(BaseModel):
+    image_url: str
+    detections: List[Dict[str, Any]]
+    content_hash: Optional[str] = None
+    scan_id: Optional[str] = None  # Echoed back so clients can match results (e.g. the AWS image id)
+
+class ToothMappingBatchRequest(BaseModel):
+    scans: List[ToothMappingBatchScan]
+    numbering_system: str = "FDI"
+
+# Shared by every batch in this process, so concurrent imports can't multiply the upstream load
+TOOTH_MAPPING_BATCH_MAX_SCANS = int(os.getenv('TOOTH_MAPPING_BATCH_MAX_SCANS', '500'))
+tooth_mapping_batch_slots = asyncio.Semaphore(int(os.getenv('TOOTH_MAPPING_BATCH_CONCURRENCY', '4')))
+
+@router.post("/tooth-mapping/batch")
+async def map_teeth_batch(
+    request: ToothMappingBatchRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Tooth mapping for many scans at once (e.g. a clinic's imported archive), streamed as NDJSON
+
+    Scans are mapped concurrently within TOOTH_MAPPING_BATCH_CONCURRENCY slots
+    shared across batches, and each image is segmented at most once however many
+    scans reference it. One line per scan is written as it finishes:
+    {index, scan_id, image_url, success, ...the /tooth-mapping response} or
+    {index, scan_id, image_url, success: false, error}, then a final
+    {done: true, total, succeeded, failed}.
+    """
+    from utils.ndjson import ndjson_line, ndjson_response
+    
+    if len(request.scans) > TOOTH_MAPPING_BATCH_MAX_SCANS:
+        raise HTTPException(status_code=400, detail=f"A batch can map at most {TOOTH_MAPPING_BATCH_MAX_SCANS} scans")
+    
+    logger.info(f"Starting batch tooth mapping for {len(request.scans)} scans")
+    segmentations: Dict[str, asyncio.Task] = {}
+    
+    def segment_once(image_url: str):
+        async def segment():
+            if image_url not in segmentations:
+                segmentations[image_url] = asyncio.create_task(roboflow_service.segment_teeth(image_url))
+            return await asyncio.shield(segmentations[image_url])
+        return segment
+    
+    async def map_one(index: int, item: ToothMappingBatchScan) -> Dict[str, Any]:
+        line = {"index": index, "scan_id": item.scan_id, "image_url": item.image_url}
+        try:
+            async with tooth_mapping_batch_slots:
+                mapping_result, reused = await _map_scan_teeth(
+                    item.image_url, item.detections, request.numbering_system, token,
+                    item.content_hash, segment_once(item.image_url)
+                )
+            return {**line, **mapping_result, "reused": reused}
+        except Exception as e:
+            logger.error(f"❌ Batch tooth mapping failed for scan {index} ({item.image_url}): {str(e)}")
+            return {**line, "success": False, "error": str(e)}
+    
+    async def lines():
+        tasks = [asyncio.create_task(map_one(index, item)) for index, item in enumerate(request.scans)]
+        succeeded = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                succeeded += bool(result.get("success"))
+                yield ndjson_line(result)
+            logger.info(f"✅ Batch tooth mapping finished: {succeeded}/{len(tasks)} scans mapped")
+            yield ndjson_line({"done": True, "total": len(tasks), "succeeded": succeeded, "failed": len(tasks) - succeeded})
+        finally:
+            # Client went away: stop the remaining scans and segmentations
+            for task in [*tasks, *segmentations.values()]:
+                task.cancel()
+    
+    return ndjson_response(lines())
+
+
 @router.post("/image/overlay")
 async def add_tooth_number_overlay(
     request: ToothNumberOverlayRequest,
@@ -2323,11 +2877,16 @@ async def add_tooth_number_overlay(
         # NEW: If cached segmentation data is provided, use it
         seg_json = request.cached_segmentation_data
         
-        # Otherwise, try to get fresh segmentation
+        # Otherwise use the scan's stored segmentation, segmenting only the first time
         if not seg_json:
             # Only call Roboflow if we have a real URL (not base64)
             if not request.image_url.startswith('data:image'):
-                seg_json = await roboflow_service.segment_teeth(request.image_url)
+                scan = await _open_scan(request.image_url, token, request.content_hash)
+                
+                async def segment():
+                    return await roboflow_service.segment_teeth(request.image_url)
+                
+                seg_json, _ = await _run_scan_stage(scan, "segmentation", segment, token, request.image_url)
             else:
                 logger.warning("Cannot segment base64 image - need cached segmentation data")
                 return {"image_url": request.image_url, "has_overlay": False}
@@ -2363,9 +2922,87 @@ async def add_tooth_number_overlay(
             return {"image_url": request.image_url, "has_overlay": False}
             
     except Exception as e:
-        logger.error(f"Tooth number overlay error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Tooth number overlay failed: {str(e)}")
-
+        logger.error(f"Tooth number overlay error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Tooth number overlay failed: {str(e)}")
+
+
+# ============================================================================
+# TREATMENT STAGING
+# ============================================================================
+
+class StagingPlanRequest(BaseModel):
+    treatments: List[Dict[str, Any]]
+    clinic_config: Optional[Dict[str, Any]] = None  # e.g. {"VISIT_TIME_BUDGET_MIN": 120}
+
+class StagingBatchItem(BaseModel):
+    patient_id: Optional[str] = None
+    treatments: List[Dict[str, Any]]
+    clinic_config: Optional[Dict[str, Any]] = None  # Applied on top of the batch config
+
+class StagingBatchRequest(BaseModel):
+    plans: List[StagingBatchItem]
+    clinic_config: Optional[Dict[str, Any]] = None
+
+@router.post("/staging/plan")
+async def create_staged_plan(
+    request: StagingPlanRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Stage a treatment plan server-side with StagingEngineV2
+    Plans are memoised by a hash of (treatments, merged clinic config)
+    """
+    try:
+        from services.staging_service import get_staging_service
+        
+        staging = get_staging_service()
+        if not staging:
+            raise HTTPException(status_code=503, detail="Staging service not available")
+        
+        result = staging.plan(request.treatments, request.clinic_config)
+        logger.info(f"🗓️ Staged {len(request.treatments)} treatments into {result['plan']['meta']['total_visits']} visits (cached: {result['cached']})")
+        
+        return {"status": "success", **result}
+    
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"❌ Staging error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to stage treatment plan: {str(e)}")
+
+@router.post("/staging/plan/batch")
+async def create_staged_plans_batch(
+    request: StagingBatchRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Stage many patients' treatment plans in one call
+    Used to restage a clinic's backlog after changing staging settings.
+    Per-patient failures are reported in the results instead of failing the batch.
+    """
+    try:
+        from services.staging_service import get_staging_service
+        
+        staging = get_staging_service()
+        if not staging:
+            raise HTTPException(status_code=503, detail="Staging service not available")
+        
+        result = await staging.plan_batch(
+            [item.model_dump() for item in request.plans],
+            request.clinic_config
+        )
+        
+        return {"status": "success", **result}
+    
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"❌ Batch staging error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to stage treatment plans: {str(e)}")
 
 @router.post("/billing/checkout")
 async def create_checkout_session(interval: str = "monthly", token: str = Depends(get_auth_token)):
@@ -2546,7 +3183,6 @@ async def verify_payment_public(request: Request):
 
 from fastapi import Request
 import json
-import stripe
 from datetime import datetime, timedelta
 
 @router.get("/stripe/webhook/test")
@@ -2600,245 +3236,46 @@ async def test_registration_webhook():
 
 @router.post("/stripe/webhook")
 async def stripe_webhook(request: Request):
-    """Handle Stripe webhooks for payment events"""
+    """
+    Handle Stripe webhooks for payment events
+    Only verifies and records the event, so Stripe gets its 200 straight away; registration and
+    subscription updates run once per event id on the webhook queue (services/stripe_webhook_queue.py)
+    """
+    from services.stripe_webhook_queue import WebhookSignatureError, get_stripe_webhook_queue, verify_webhook_event
+    
     try:
-        logger.info("🎯 Stripe webhook received")
-        logger.info("🔍 Webhook headers: %s", dict(request.headers))
-        logger.info("🔍 Webhook URL: %s", str(request.url))
-        
-        # Get the webhook payload
         payload = await request.body()
         sig_header = request.headers.get('stripe-signature')
+        logger.info(f"🎯 Stripe webhook received ({len(payload)} bytes, signature header present: {bool(sig_header)})")
         
-        logger.info(f"📝 Webhook payload size: {len(payload)} bytes")
-        logger.info(f"🔐 Signature header present: {bool(sig_header)}")
-        
-        # For now, skip signature verification and just process the event
-        # This helps us debug the actual webhook processing
-        webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
-        if webhook_secret and sig_header:
-            try:
-                event = stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
-                logger.info("✅ Webhook signature verified")
-            except Exception as e:
-                logger.error(f"❌ Webhook signature verification failed: {str(e)}")
-                # Continue without verification for debugging
-                event = json.loads(payload)
-        else:
-            logger.warning("⚠️ Processing webhook without signature verification")
-            event = json.loads(payload)
+        try:
+            event = verify_webhook_event(payload, sig_header)
+        except WebhookSignatureError as e:
+            logger.error(f"❌ Webhook signature verification failed: {str(e)}")
+            raise HTTPException(status_code=400, detail="Invalid Stripe webhook signature")
+        except ValueError as e:
+            logger.error(f"❌ Webhook payload is not valid JSON: {str(e)}")
+            raise HTTPException(status_code=400, detail="Invalid Stripe webhook payload")
+        
+        webhook_queue = get_stripe_webhook_queue()
+        if not webhook_queue:
+            raise HTTPException(status_code=503, detail="Stripe webhook queue unavailable")
         
         event_type = event.get('type', 'unknown')
-        logger.info(f"📨 Processing event type: {event_type}")
-        
-        # Handle the event
-        if event_type == 'checkout.session.completed':
-            session = event.get('data', {}).get('object', {})
-            metadata = session.get('metadata', {})
-            
-            logger.info(f"🎯 Processing checkout.session.completed event")
-            logger.info(f"🔍 Session metadata: {metadata}")
-            
-            # Check if this is a new registration  
-            if metadata.get('is_registration') == 'true':
-                logger.info("🆕 This is a NEW USER REGISTRATION - using StripeService handler")
-                
-                # Use StripeService to handle the registration (NEW system)
-                from services.stripe_service import get_stripe_service
-                stripe_service = get_stripe_service()
-                if not stripe_service:
-                    logger.error("❌ Stripe service unavailable")
-                    return {"status": "error", "message": "Stripe service unavailable"}
-                
-                # Call the new registration handler
-                user_id = stripe_service._handle_registration_webhook(session)
-                
-                if user_id:
-                    logger.info(f"✅ Registration completed successfully for user: {user_id}")
-                    return {"status": "success", "message": "Registration completed", "user_id": user_id}
-                else:
-                    logger.error("❌ Registration failed")
-                    return {"status": "error", "message": "Registration failed"}
-            
-            # OLD SYSTEM (remove this block) - keeping for reference but won't execute
-            elif False:  # This will never execute now
-                logger.info("🆕 This is a NEW USER REGISTRATION - processing...")
-                logger.info("🆕 Processing new user registration after payment")
-                
-                # Get registration ID from metadata
-                registration_id = metadata.get('registration_id')
-                
-                if not registration_id:
-                    logger.error("❌ No registration ID found in webhook metadata")
-                    return {"status": "error", "message": "Registration ID missing"}
-                
-                # Retrieve stored registration data
-                from api.routes import create_registration_checkout
-                if not hasattr(create_registration_checkout, 'pending_registrations'):
-                    logger.error("❌ No pending registrations found")
-                    return {"status": "error", "message": "No pending registrations"}
-                
-                stored_registration = create_registration_checkout.pending_registrations.get(registration_id)
-                if not stored_registration:
-                    logger.error(f"❌ Registration {registration_id} not found or expired")
-                    return {"status": "error", "message": "Registration not found or expired"}
-                
-                # Check if registration has expired
-                if datetime.utcnow() > stored_registration['expires_at']:
-                    logger.error(f"❌ Registration {registration_id} has expired")
-                    del create_registration_checkout.pending_registrations[registration_id]
-                    return {"status": "error", "message": "Registration expired"}
-                
-                # Extract user data from stored registration
-                user_data = stored_registration['user_data']
-                logger.info(f"👤 Registration data retrieved: {user_data.get('email')}")
-                logger.info(f"🔍 Full user data fields: {list(user_data.keys())}")
-                logger.info(f"🏥 Clinic name from form: {user_data.get('clinicName')}")
-                logger.info(f"🌐 Website from form: {user_data.get('clinicWebsite')}")
-                logger.info(f"🌍 Country from form: {user_data.get('country')}")
-                
-                try:
-                    # Create Supabase account
-                    logger.info("🔐 Creating Supabase account...")
-                    from services.supabase import get_supabase_service
-                    supabase_service = get_supabase_service()
-                    
-                    if not supabase_service:
-                        logger.error("❌ Supabase service not available")
-                        return {"status": "error", "message": "Supabase service unavailable"}
-                    
-                    # Get the password from the stored registration data
-                    password = user_data.get('password')
-                    
-                    if not password:
-                        logger.error("❌ No password found in stored registration data")
-                        return {"status": "error", "message": "Password missing from registration data"}
-                    
-                    # Create the user account
-                    created_user = await supabase_service.create_user_account(user_data, password)
-                    
-                    if created_user:
-                        logger.info(f"✅ Supabase account created: {created_user['email']}")
-                        
-                        # Create clinic branding record
-                        logger.info("🎨 Creating clinic branding record...")
-                        logger.info(f"🔍 User data keys available: {list(user_data.keys())}")
-                        logger.info(f"🏥 Clinic name value: {user_data.get('clinicName')}")
-                        logger.info(f"📧 Email value: {user_data.get('email')}")
-                        logger.info(f"🌐 Website value: {user_data.get('clinicWebsite')}")
-                        logger.info(f"🌍 Country value: {user_data.get('country')}")
-                        
-                        try:
-                            branding_data = {
-                                'user_id': created_user['id'],
-                                'clinic_name': user_data.get('clinicName', 'Unknown Clinic'),  # Frontend sends 'clinicName'
-                                'email': user_data.get('email'),
-                                'website': user_data.get('clinicWebsite'),  # Frontend sends 'clinicWebsite'
-                                'country': user_data.get('country'),
-                                'created_at': datetime.utcnow().isoformat(),
-                                'updated_at': datetime.utcnow().isoformat()
-                            }
-                            
-                            logger.info(f"🎯 Branding data to insert: {branding_data}")
-                            
-                            # Insert into clinic_branding table
-                            branding_result = await supabase_service.save_clinic_branding(branding_data)
-                            if branding_result:
-                                logger.info(f"✅ Clinic branding created: {branding_data['clinic_name']}")
-                            else:
-                                logger.warning("⚠️ Failed to create clinic branding record")
-                        except Exception as e:
-                            logger.warning(f"⚠️ Clinic branding creation failed: {str(e)}")
-                            import traceback
-                            logger.warning(f"📍 Clinic branding traceback: {traceback.format_exc()}")
-                        
-                        # Create S3 folder for the clinic using the new user ID
-                        clinic_name = user_data.get('clinicName', 'Unknown Clinic')  # Frontend sends 'clinicName'
-                        user_id = created_user['id']
-                        
-                        logger.info("☁️ Creating S3 folder...")
-                        from services.s3_service import get_s3_service
-                        s3_service = get_s3_service()
-                        
-                        if not s3_service:
-                            logger.error("❌ S3 service not available")
-                            return {"status": "error", "message": "S3 service unavailable"}
-                        
-                        s3_result = s3_service.create_clinic_folder(clinic_name, user_id)
-                        
-                        if s3_result and s3_result.get('success'):
-                            logger.info(f"✅ Successfully created S3 folder for clinic: {clinic_name}")
-                            logger.info(f"✅ User registration completed: {user_data.get('email')}")
-                            logger.info(f"🔑 User password: {password}")
-                            
-                            # Clean up stored registration data
-                            del create_registration_checkout.pending_registrations[registration_id]
-                        else:
-                            logger.error(f"❌ Failed to create S3 folder: {s3_result.get('error') if s3_result else 'Unknown error'}")
-                    else:
-                        logger.error("❌ Failed to create Supabase account")
-                        
-                except Exception as e:
-                    logger.error(f"💥 Error processing registration webhook: {str(e)}")
-                    import traceback
-                    logger.error(f"📍 Traceback: {traceback.format_exc()}")
-                    
-            else:
-                # Existing user payment - create S3 folder
-                user_id = metadata.get('user_id')
-                logger.info(f"💳 Checkout completed for existing user: {user_id}")
-                
-                if user_id:
-                    # Try to create S3 folder
-                    try:
-                        logger.info("🔍 Getting user details from Supabase...")
-                        from services.supabase import get_supabase_service
-                        supabase_service = get_supabase_service()
-                        
-                        if not supabase_service:
-                            logger.error("❌ Supabase service not available")
-                            return {"status": "error", "message": "Supabase service unavailable"}
-                        
-                        user_data = await supabase_service.get_user_by_id(user_id)
-                        
-                        if user_data:
-                            clinic_name = user_data.get('clinic_name', 'Unknown Clinic')
-                            logger.info(f"👥 Found user: {user_data.get('email')} - Clinic: {clinic_name}")
-                            
-                            # Create S3 folder for the clinic
-                            logger.info("☁️ Creating S3 folder...")
-                            from services.s3_service import get_s3_service
-                            s3_service = get_s3_service()
-                            
-                            if not s3_service:
-                                logger.error("❌ S3 service not available")
-                                return {"status": "error", "message": "S3 service unavailable"}
-                            
-                            s3_result = s3_service.create_clinic_folder(clinic_name, user_id)
-                            
-                            if s3_result and s3_result.get('success'):
-                                logger.info(f"✅ Successfully created S3 folder for clinic: {clinic_name}")
-                            else:
-                                logger.error(f"❌ Failed to create S3 folder: {s3_result.get('error') if s3_result else 'Unknown error'}")
-                        else:
-                            logger.error(f"❌ User data not found for ID: {user_id}")
-                            
-                    except Exception as e:
-                        logger.error(f"💥 Error processing webhook for user {user_id}: {str(e)}")
-                        import traceback
-                        logger.error(f"📍 Traceback: {traceback.format_exc()}")
-                else:
-                    logger.warning("⚠️ No user_id found in checkout session metadata")
+        queued = await webhook_queue.ingest(event)
+        if queued:
+            logger.info(f"📨 Queued {event_type} event {event.get('id')}")
         else:
-            logger.info(f"ℹ️ Ignoring event type: {event_type}")
+            logger.info(f"🔄 Ignoring redelivered {event_type} event {event.get('id')}")
         
-        return {"status": "success", "event_type": event_type}
+        return {"status": "success", "event_type": event_type, "event_id": event.get('id'), "duplicate": not queued}
         
+    except HTTPException:
+        raise
     except Exception as e:
+        # Not recorded: a 500 makes Stripe deliver the event again
         logger.error(f"💥 Webhook error: {str(e)}")
-        import traceback
-        logger.error(f"📍 Traceback: {traceback.format_exc()}")
-        return {"status": "error", "message": str(e)}, 400
+        raise HTTPException(status_code=500, detail=f"Failed to record webhook: {str(e)}")
 
 # AWS S3 Integration Endpoints - Real-time Processing
 
@@ -3558,6 +3995,57 @@ async def process_aws_image_background(
             "error": f"Critical error: {str(e)}"
         }
 
+def _report_email_user_id(token: str, auth_client) -> Optional[str]:
+    """The sending clinic's user id: from the JWT, else Supabase auth.get_user"""
+    user_id = None
+    # Derive user_id from JWT to avoid flaky auth.get_user responses in backend
+    try:
+        decoded_token = jwt.decode(token, options={"verify_signature": False})
+        user_id = decoded_token.get('sub')
+        logger.info(f"🔐 Decoded user_id from JWT: {user_id}")
+    except Exception as jwt_error:
+        logger.warning(f"JWT decode failed: {jwt_error}")
+
+    # Fallback to Supabase auth.get_user if needed
+    if not user_id:
+        try:
+            user_response = auth_client.auth.get_user()
+            user_id = getattr(getattr(user_response, 'user', None), 'id', None)
+        except Exception as get_user_error:
+            logger.warning(f"auth.get_user failed: {get_user_error}")
+    return user_id
+
+def _report_email_data(diagnosis: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': diagnosis.get('id'),
+        'patient_name': diagnosis.get('patient_name'),
+        'report_html': diagnosis.get('report_html'),
+        'annotated_image_url': diagnosis.get('annotated_image_url'),
+        'treatment_stages': diagnosis.get('treatment_stages', []),
+        'created_at': diagnosis.get('created_at'),
+        'video_url': diagnosis.get('video_url')
+    }
+
+def _report_clinic_branding(auth_client, user_id: str) -> Dict[str, Any]:
+    """The clinic's branding for report emails, with ScanWise defaults"""
+    clinic_branding_response = auth_client.table('clinic_branding').select("*").eq('user_id', user_id).execute()
+    
+    if clinic_branding_response.data:
+        clinic_branding = clinic_branding_response.data[0]
+        # Replace None values with defaults
+        if not clinic_branding.get('clinic_name'):
+            clinic_branding['clinic_name'] = 'ScanWise'
+        logger.info(f"✅ Found clinic branding: {clinic_branding.get('clinic_name', 'Unknown')}")
+    else:
+        # Fallback to default branding
+        clinic_branding = {
+            'clinic_name': 'ScanWise',
+            'phone': 'our office',
+            'website': 'our website'
+        }
+        logger.info(f"⚠️ Using default clinic branding: {clinic_branding}")
+    return clinic_branding
+
 # Email Report to Patient
 @router.post("/send-report-email")
 async def send_report_email(
@@ -3585,24 +4073,7 @@ async def send_report_email(
         # Create authenticated client
         auth_client = supabase_service._create_authenticated_client(token)
 
-        # Derive user_id from JWT to avoid flaky auth.get_user responses in backend
-        user_id = None
-        try:
-            import jwt
-            decoded_token = jwt.decode(token, options={"verify_signature": False})
-            user_id = decoded_token.get('sub')
-            logger.info(f"🔐 Decoded user_id from JWT: {user_id}")
-        except Exception as jwt_error:
-            logger.warning(f"JWT decode failed: {jwt_error}")
-
-        # Fallback to Supabase auth.get_user if needed
-        if not user_id:
-            try:
-                user_response = auth_client.auth.get_user()
-                user_id = getattr(getattr(user_response, 'user', None), 'id', None)
-            except Exception as get_user_error:
-                logger.warning(f"auth.get_user failed: {get_user_error}")
-
+        user_id = _report_email_user_id(token, auth_client)
         if not user_id:
             logger.error("❌ Authentication failed - no user_id available")
             return {
@@ -3624,15 +4095,7 @@ async def send_report_email(
                 }
             
             diagnosis = report_response.data[0]
-            report_data = {
-                'id': diagnosis.get('id'),
-                'patient_name': diagnosis.get('patient_name'),
-                'report_html': diagnosis.get('report_html'),
-                'annotated_image_url': diagnosis.get('annotated_image_url'),
-                'treatment_stages': diagnosis.get('treatment_stages', []),
-                'created_at': diagnosis.get('created_at'),
-                'video_url': diagnosis.get('video_url')
-            }
+            report_data = _report_email_data(diagnosis)
             
         except Exception as e:
             logger.error(f"❌ Error fetching report: {str(e)}")
@@ -3648,23 +4111,7 @@ async def send_report_email(
             from services.email_service import email_service
             
             # Get clinic branding information
-            clinic_branding_response = auth_client.table('clinic_branding').select("*").eq('user_id', user_id).execute()
-            clinic_branding = {}
-            
-            if clinic_branding_response.data:
-                clinic_branding = clinic_branding_response.data[0]
-                # Replace None values with defaults
-                if not clinic_branding.get('clinic_name'):
-                    clinic_branding['clinic_name'] = 'ScanWise'
-                logger.info(f"✅ Found clinic branding: {clinic_branding.get('clinic_name', 'Unknown')}")
-            else:
-                # Fallback to default branding
-                clinic_branding = {
-                    'clinic_name': 'ScanWise',
-                    'phone': 'our office',
-                    'website': 'our website'
-                }
-                logger.info(f"⚠️ Using default clinic branding: {clinic_branding}")
+            clinic_branding = _report_clinic_branding(auth_client, user_id)
             
             # Send the email with PDF attachment
             email_sent = await email_service.send_dental_report(
@@ -3722,9 +4169,7 @@ async def send_report_email(
                     
                     logger.info(f"📝 Inserting tracking data: {tracking_data}")
                     
-                    result = supabase_service.get_service_client().table('email_tracking')\
-                        .insert(tracking_data)\
-                        .execute()
+                    result = save_tracking_record(supabase_service.get_service_client(), tracking_data)
                     
                     logger.info(f"✅ Created email tracking record for report {report_id}: {result}")
                     
@@ -3765,6 +4210,99 @@ async def send_report_email(
             "error": f"Failed to send email: {str(e)}"
         }
 
+class ReportEmailRecipient(BaseModel):
+    report_id: str
+    patient_email: str
+
+class ReportEmailBatchRequest(BaseModel):
+    reports: List[ReportEmailRecipient]
+
+REPORT_EMAIL_BATCH_MAX = int(os.getenv('REPORT_EMAIL_BATCH_MAX', '200'))
+
+@router.post("/send-report-email/batch")
+async def send_report_email_batch(
+    request: ReportEmailBatchRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Email many saved reports at once (e.g. end-of-day sends), streamed as NDJSON
+
+    Every recipient is queued in the email outbox up front; PDFs render
+    concurrently and sends go out over pooled connections within the clinic's
+    rate limit. One line per recipient is written as it finishes:
+    {index, report_id, patient_email, status: "sent"|"failed"|"skipped", ...},
+    then a final {done: true, total, sent, failed}. Queued emails keep sending
+    if the client disconnects.
+    """
+    from utils.ndjson import ndjson_line, ndjson_response
+    from services.email_delivery import get_email_delivery_queue
+    
+    if len(request.reports) > REPORT_EMAIL_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"A batch can email at most {REPORT_EMAIL_BATCH_MAX} reports")
+    
+    try:
+        auth_client = supabase_service._create_authenticated_client(token)
+        user_id = _report_email_user_id(token, auth_client)
+        if not user_id:
+            raise HTTPException(status_code=401, detail="Authentication failed")
+        
+        delivery_queue = get_email_delivery_queue()
+        if not delivery_queue:
+            raise HTTPException(status_code=503, detail="Email delivery unavailable")
+        
+        logger.info(f"📧 Queueing {len(request.reports)} report emails for clinic {user_id}")
+        
+        # One query for every report (RLS limits it to this clinic's own)
+        report_ids = list({item.report_id for item in request.reports})
+        report_response = await asyncio.to_thread(
+            lambda: auth_client.table('patient_diagnosis').select("*").in_('id', report_ids).execute()
+        )
+        diagnoses = {row['id']: row for row in report_response.data or []}
+        clinic_branding = await asyncio.to_thread(_report_clinic_branding, auth_client, user_id)
+        
+        jobs, lines_by_index = [], {}
+        for index, item in enumerate(request.reports):
+            diagnosis = diagnoses.get(item.report_id)
+            if not diagnosis:
+                lines_by_index[index] = {"index": index, "report_id": item.report_id, "patient_email": item.patient_email,
+                                         "status": "failed", "error": "Report not found"}
+                continue
+            report_data = _report_email_data(diagnosis)
+            report_data['findings'] = diagnosis.get('findings', [])
+            jobs.append((index, {
+                'clinic_id': user_id,
+                'report_id': item.report_id,
+                'patient_email': item.patient_email,
+                'patient_name': report_data.get('patient_name') or 'Patient',
+                'report_data': report_data,
+                'clinic_branding': clinic_branding,
+            }))
+        
+        tasks = await delivery_queue.submit([job for _, job in jobs])
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error queueing report emails: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to queue report emails: {str(e)}")
+    
+    async def with_index(index: int, task: asyncio.Task) -> Dict[str, Any]:
+        return {"index": index, **await asyncio.shield(task)}
+    
+    async def lines():
+        sent = 0
+        for line in lines_by_index.values():
+            yield ndjson_line(line)
+        for finished in asyncio.as_completed([with_index(index, task) for (index, _), task in zip(jobs, tasks)]):
+            result = await finished
+            sent += result["status"] == "sent"
+            yield ndjson_line(result)
+        total = len(request.reports)
+        logger.info(f"✅ Report email batch finished: {sent}/{total} sent")
+        yield ndjson_line({"done": True, "total": total, "sent": sent, "failed": total - sent})
+    
+    return ndjson_response(lines())
+
 # Email Preview Report to Patient (from unsaved content)
 @router.post("/send-preview-report-email")
 async def send_preview_report_email(
@@ -3898,9 +4436,7 @@ async def send_preview_report_email(
                     
                     logger.info(f"📝 Inserting preview tracking data: {tracking_data}")
                     
-                    result = supabase_service.get_service_client().table('email_tracking')\
-                        .insert(tracking_data)\
-                        .execute()
+                    result = save_tracking_record(supabase_service.get_service_client(), tracking_data)
                     
                     logger.info(f"✅ Created email tracking record for preview email: {result}")
                     
@@ -3988,7 +4524,7 @@ async def match_to_master(
 ):
     """
     Step 2: Match extracted treatments to master database
-    Uses GPT-4 for intelligent matching with confidence scores
+    Matches locally with confidence scores; GPT-4 only settles low-confidence rows
     """
     try:
         logger.info(f"🔍 Matching {len(request.extracted_treatments)} treatments to master database")
@@ -4043,25 +4579,12 @@ async def bulk_update_treatment_prices(
 ):
     """
     Step 3: Bulk update treatment settings in Supabase
-    Applies all confirmed mappings at once
+    Validates every mapping, then applies them all in one atomic request
     """
     try:
         logger.info(f"💾 Bulk updating {len(request.mappings)} treatment prices")
         
-        # Create authenticated client
-        auth_client = supabase_service._create_authenticated_client(token)
-        
-        # Get or create clinic branding record (contains treatment settings)
-        branding_response = auth_client.table('clinic_branding').select("*").execute()
-        
-        if not branding_response.data:
-            raise HTTPException(status_code=404, detail="Clinic branding not found. Please set up clinic branding first.")
-        
-        branding_id = branding_response.data[0]['id']
-        
-        # Load current treatment settings (stored in branding_data or separate?)
-        # For now, we'll store in clinic_branding as JSONB
-        current_settings = branding_response.data[0].get('treatment_settings', {})
+        from services.treatment_import import ImportValidationError, apply_price_import, build_import_payload
         
         # Get user_id from token
         decoded_token = jwt.decode(token, options={"verify_signature": False})
@@ -4070,45 +4593,27 @@ async def bulk_update_treatment_prices(
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        # Update settings for each mapping
-        updated_count = 0
-        custom_count = 0
-        
-        for mapping in request.mappings:
-            if mapping.action == "update" and mapping.matched_code != "CUSTOM":
-                # Update existing master treatment with clinic price/duration
-                current_settings[mapping.matched_code] = {
-                    "price": mapping.clinic_price,
-                    "duration": mapping.clinic_duration,
-                    "clinic_name": mapping.clinic_name
-                }
-                updated_count += 1
-            elif mapping.action == "create_custom" or mapping.matched_code == "CUSTOM":
-                # ✅ Create ACTUAL custom treatment in database
-                try:
-                    auth_client.table('custom_treatments').insert({
-                        'user_id': user_id,
-                        'clinic_name': mapping.clinic_name,
-                        'display_name': mapping.clinic_name,
-                        'friendly_name': mapping.clinic_name,
-                        'category': 'general',
-                        'description': f'Custom treatment imported from price list',
-                        'price': mapping.clinic_price,
-                        'duration': mapping.clinic_duration or 30,
-                        'is_active': True
-                    }).execute()
-                    custom_count += 1
-                    logger.info(f"✅ Created custom treatment: {mapping.clinic_name}")
-                except Exception as custom_error:
-                    logger.warning(f"⚠️ Failed to create custom treatment {mapping.clinic_name}: {str(custom_error)}")
-                    # Continue with other mappings
-        
-        # Save updated settings back to database
-        auth_client.table('clinic_branding').update({
-            "treatment_settings": current_settings,
-            "updated_at": datetime.now().isoformat()
-        }).eq('id', branding_id).execute()
+        master_path = Path(__file__).parent.parent.parent / 'client' / 'src' / 'data' / 'treatments.au.json'
+        with open(master_path, 'r') as f:
+            master_codes = {t['code'] for t in json.load(f)}
+        
+        try:
+            settings, custom_rows = build_import_payload(
+                [mapping.dict() for mapping in request.mappings],
+                master_codes
+            )
+        except ImportValidationError as e:
+            raise HTTPException(status_code=400, detail={"message": str(e), "errors": e.errors})
         
+        auth_client = supabase_service._create_authenticated_client(token)
+        try:
+            result = await asyncio.to_thread(apply_price_import, auth_client, user_id, settings, custom_rows)
+        except LookupError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        _invalidate_effective_settings(token)
+        
+        updated_count = result.get('updated_count', 0)
+        custom_count = result.get('custom_count', 0)
         logger.info(f"✅ Bulk update complete: {updated_count} updated, {custom_count} custom")
         
         return {
@@ -4118,6 +4623,8 @@ async def bulk_update_treatment_prices(
             "total": len(request.mappings)
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error in bulk update: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to bulk update: {str(e)}")
@@ -4282,22 +4789,10 @@ class GenerateDescriptionRequest(BaseModel):
     treatment_name: str
     friendly_name: str
 
-@router.post("/treatments/generate-description")
-async def generate_treatment_description(
-    request: GenerateDescriptionRequest,
-    token: str = Depends(get_auth_token)
-):
-    """
-    Generate a comprehensive, patient-friendly treatment description using GPT-4o-mini
-    Used for treatments that don't have hard-coded descriptions
-    """
-    try:
-        logger.info(f"🤖 Generating description for: {request.treatment_name}")
-        
-        from services.openai_analysis import openai_service
-        
-        # Create prompt based on the 40 hard-coded examples
-        prompt = f"""You are a dental treatment explanation assistant. Generate a comprehensive, patient-friendly description for the following dental treatment.
+def _treatment_description_messages(request: GenerateDescriptionRequest) -> List[Dict]:
+    """Chat messages for a treatment description (shared by the JSON and streaming endpoints)"""
+    # Create prompt based on the 40 hard-coded examples
+    prompt = f"""You are a dental treatment explanation assistant. Generate a comprehensive, patient-friendly description for the following dental treatment.
 
 TREATMENT: {request.friendly_name}
 TECHNICAL NAME: {request.treatment_name}
@@ -4321,25 +4816,47 @@ EXAMPLE FORMAT (DO NOT copy these, just match the style):
 "Root canal treatment saves your tooth by removing the infected nerve inside. We carefully clean the canal, disinfect it, and prepare it for sealing. The procedure is done under local anesthesia so you won't feel pain. Most patients can return to normal activities the next day, though you may feel some tenderness for a few days. Avoid chewing on that tooth until it's fully restored with a filling or crown."
 
 Now generate a description for {request.friendly_name}:"""
+
+    return [
+        {
+            "role": "system",
+            "content": "You are a dental treatment explanation assistant. Generate comprehensive, patient-friendly treatment descriptions that are reassuring and easy to understand."
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+@router.post("/treatments/generate-description")
+async def generate_treatment_description(
+    request: GenerateDescriptionRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Generate a comprehensive, patient-friendly treatment description using GPT-4o-mini
+    Used for treatments that don't have hard-coded descriptions
+    """
+    try:
+        logger.info(f"🤖 Generating description for: {request.treatment_name}")
+        
+        from services.openai_analysis import openai_service
+        from services.completion_cache import cached_completion
         
         # Use GPT-4o-mini for cost efficiency
-        response = openai_service.client.chat.completions.create(
-            model="gpt-4o-mini",  # Cheaper model for this task
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a dental treatment explanation assistant. Generate comprehensive, patient-friendly treatment descriptions that are reassuring and easy to understand."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            max_tokens=300,
-            temperature=0.7
-        )
+        with track_stage("openai_treatment_description", model="gpt-4o-mini"):
+            description = cached_completion(
+                openai_service.client,
+                "treatment_description",
+                cache=True,
+                model="gpt-4o-mini",  # Cheaper model for this task
+                messages=_treatment_description_messages(request),
+                max_tokens=300,
+                temperature=0.7
+            )
         
-        description = response.choices[0].message.content.strip()
+        description = description.strip()
         
         logger.info(f"✅ Generated description ({len(description)} chars)")
         logger.info(f"💰 Estimated cost: ~$0.0001 (GPT-4o-mini)")
@@ -4356,6 +4873,48 @@ Now generate a description for {request.friendly_name}:"""
         raise HTTPException(status_code=500, detail=f"Failed to generate description: {str(e)}")
 
 
+@router.post("/treatments/generate-description/stream")
+async def generate_treatment_description_stream(
+    request: GenerateDescriptionRequest,
+    token: str = Depends(get_auth_token)
+):
+    """
+    Same as /treatments/generate-description, streamed as server-sent events
+
+    Events: token ({text}), done ({description, treatment_code, model_used})
+    or error ({detail}).
+    """
+    from services.openai_analysis import openai_service
+    from utils.sse import sse_event, sse_response
+
+    async def events():
+        try:
+            logger.info(f"🤖 Streaming description for: {request.treatment_name}")
+            parts = []
+            async for delta in openai_service.stream_chat(
+                "openai_treatment_description_stream",
+                "gpt-4o-mini",
+                _treatment_description_messages(request),
+                max_tokens=300,
+                temperature=0.7
+            ):
+                parts.append(delta)
+                yield sse_event("token", {"text": delta})
+
+            description = ''.join(parts).strip()
+            logger.info(f"✅ Streamed description ({len(description)} chars)")
+            yield sse_event("done", {
+                "description": description,
+                "treatment_code": request.treatment_code,
+                "model_used": "gpt-4o-mini"
+            })
+        except Exception as e:
+            logger.error(f"❌ Error streaming description: {str(e)}")
+            yield sse_event("error", {"detail": f"Failed to generate description: {str(e)}"})
+
+    return sse_response(events())
+
+
 # ============================================================================
 # EMAIL TRACKING & FOLLOW-UP SYSTEM
 # ============================================================================
@@ -4375,73 +4934,21 @@ async def handle_sendgrid_webhook(request: Request):
         events = await request.json()
         logger.info(f"📧 Received {len(events)} SendGrid webhook events")
         
-        for event in events:
-            event_type = event.get('event')
-            report_id = event.get('report_id')  # Custom arg from email sending
-            timestamp = event.get('timestamp')
-            
-            if not report_id:
-                logger.warning(f"⚠️ Email event missing report_id: {event_type}")
-                continue
-            
-            logger.info(f"📧 Processing {event_type} event for report {report_id}")
-            
-            # Convert Unix timestamp to ISO format
-            event_time = datetime.fromtimestamp(timestamp) if timestamp else datetime.now()
-            
-            if event_type == 'delivered':
-                # Email successfully delivered
-                supabase_service.get_service_client().table('email_tracking')\
-                    .update({'delivered_at': event_time.isoformat()})\
-                    .eq('report_id', report_id)\
-                    .execute()
-                logger.info(f"✅ Marked report {report_id} as delivered")
-                    
-            elif event_type == 'open':
-                # Email opened by recipient
-                # Get current tracking data
-                tracking_response = supabase_service.get_service_client().table('email_tracking')\
-                    .select('*')\
-                    .eq('report_id', report_id)\
-                    .single()\
-                    .execute()
-                
-                if tracking_response.data:
-                    tracking = tracking_response.data
-                    updates = {
-                        'last_opened_at': event_time.isoformat(),
-                        'open_count': (tracking.get('open_count') or 0) + 1
-                    }
-                    
-                    # Set first_opened_at if this is the first open
-                    if not tracking.get('first_opened_at'):
-                        updates['first_opened_at'] = event_time.isoformat()
-                        logger.info(f"🎉 First open for report {report_id}")
-                    
-                    supabase_service.get_service_client().table('email_tracking')\
-                        .update(updates)\
-                        .eq('report_id', report_id)\
-                        .execute()
-                    logger.info(f"✅ Updated open tracking for report {report_id} (count: {updates['open_count']})")
-                    
-            elif event_type == 'click':
-                # Link clicked in email (e.g., "View Report" button)
-                supabase_service.get_service_client().table('email_tracking')\
-                    .update({'clicked_at': event_time.isoformat()})\
-                    .eq('report_id', report_id)\
-                    .execute()
-                logger.info(f"✅ Link clicked in report {report_id}")
-            
-            # Log bounce and spam events but don't expose to clinics yet
-            elif event_type == 'bounce':
-                logger.warning(f"⚠️ Email bounced for report {report_id}: {event.get('reason')}")
-                # TODO: Internal notification to team
-                
-            elif event_type == 'spamreport':
-                logger.error(f"🚨 Spam report for report {report_id}")
-                # TODO: Internal notification to team
+        # Events are grouped per report and applied in one atomic, idempotent
+        # call (deduplicated on sg_event_id) - see services/email_event_ingest.py
+        from services.email_event_ingest import ingest_sendgrid_events
+        result = await asyncio.to_thread(
+            ingest_sendgrid_events,
+            supabase_service.get_service_client(),
+            events
+        )
         
-        return {"status": "ok", "processed": len(events)}
+        return {
+            "status": "ok",
+            "processed": len(events),
+            "new_events": result["new_events"],
+            "reports_updated": result["reports_updated"]
+        }
     
     except Exception as e:
         logger.error(f"❌ Error processing SendGrid webhook: {str(e)}")
@@ -4602,134 +5109,14 @@ async def check_and_send_followups(request: Request):
         
         # Try to import the follow-up services - they might not exist yet
         try:
-            from services.email_tracking_service import should_send_auto_followup, should_send_team_notification
-            from services.followup_email_service import followup_email_service
+            from services.followup_engine import get_followup_engine
         except ImportError as e:
             logger.warning(f"⚠️ Follow-up services not available yet: {str(e)}")
             return {"status": "ok", "message": "Follow-up services not deployed yet", "patient_followups_sent": 0, "team_notifications_sent": 0}
         
-        # Get all tracking records that haven't been opened and aren't completed
-        try:
-            response = supabase_service.get_service_client().table('email_tracking')\
-                .select('*, patient_diagnosis!inner(findings)')\
-                .is_('first_opened_at', 'null')\
-                .eq('follow_up_completed', False)\
-                .execute()
-        except Exception as e:
-            logger.warning(f"⚠️ Email tracking table not available: {str(e)}")
-            return {"status": "ok", "message": "Email tracking table not created yet", "patient_followups_sent": 0, "team_notifications_sent": 0}
-        
-        if not response.data:
-            logger.info("✅ No follow-ups needed")
-            return {"status": "ok", "patient_followups_sent": 0, "team_notifications_sent": 0}
-        
-        patient_followups_sent = 0
-        team_notifications_sent = 0
-        
-        for tracking in response.data:
-            report_id = tracking.get('report_id')
-            patient_email = tracking.get('patient_email')
-            patient_name = tracking.get('patient_name')
-            urgency_level = tracking.get('urgency_level')
-            
-            logger.info(f"📋 Checking report {report_id} (urgency: {urgency_level})")
-            
-            # Check if auto follow-up should be sent
-            if should_send_auto_followup(tracking):
-                try:
-                    logger.info(f"📧 Sending patient follow-up for report {report_id}")
-                    
-                    # Get clinic info
-                    user_id = tracking.get('user_id')
-                    clinic_response = supabase_service.client.table('clinic_branding')\
-                        .select('*')\
-                        .eq('user_id', user_id)\
-                        .single()\
-                        .execute()
-                    
-                    clinic_branding = clinic_response.data if clinic_response.data else {}
-                    clinic_name = clinic_branding.get('clinic_name', 'Your Dental Clinic')
-                    clinic_phone = clinic_branding.get('phone', 'our office')
-                    clinic_website = clinic_branding.get('website', 'our website')
-                    
-                    # Send follow-up email
-                    await followup_email_service.send_patient_followup(
-                        patient_email=patient_email,
-                        patient_name=patient_name,
-                        clinic_name=clinic_name,
-                        clinic_phone=clinic_phone,
-                        clinic_website=clinic_website,
-                        report_id=report_id,
-                        urgency_level=urgency_level,
-                        original_message_id=tracking.get('original_message_id')
-                    )
-                    
-                    # Update tracking record
-                    supabase_service.get_service_client().table('email_tracking')\
-                        .update({'auto_followup_sent_at': datetime.now().isoformat()})\
-                        .eq('report_id', report_id)\
-                        .execute()
-                    
-                    patient_followups_sent += 1
-                    logger.info(f"✅ Patient follow-up sent for report {report_id}")
-                    
-                except Exception as followup_error:
-                    logger.error(f"❌ Failed to send patient follow-up for {report_id}: {str(followup_error)}")
-            
-            # Check if team notification should be sent
-            if should_send_team_notification(tracking):
-                try:
-                    logger.info(f"📧 Sending team notification for report {report_id}")
-                    
-                    # Get user/clinic info
-                    user_id = tracking.get('user_id')
-                    user_response = supabase_service.client.table('users')\
-                        .select('email, clinic_name')\
-                        .eq('id', user_id)\
-                        .single()\
-                        .execute()
-                    
-                    if user_response.data:
-                        admin_email = user_response.data.get('email')
-                        clinic_name = user_response.data.get('clinic_name', 'Unknown Clinic')
-                        
-                        # Calculate hours since sent
-                        sent_at = tracking.get('sent_at')
-                        if isinstance(sent_at, str):
-                            sent_at = datetime.fromisoformat(sent_at.replace('Z', '+00:00'))
-                        hours_since_sent = (datetime.now() - sent_at).total_seconds() / 3600
-                        
-                        # Send team notification
-                        await followup_email_service.send_team_notification(
-                            clinic_admin_email=admin_email,
-                            patient_name=patient_name,
-                            patient_email=patient_email,
-                            clinic_name=clinic_name,
-                            report_id=report_id,
-                            urgency_level=urgency_level,
-                            hours_since_sent=hours_since_sent
-                        )
-                        
-                        # Update tracking record
-                        supabase_service.get_service_client().table('email_tracking')\
-                            .update({'team_notification_sent_at': datetime.now().isoformat()})\
-                            .eq('report_id', report_id)\
-                            .execute()
-                        
-                        team_notifications_sent += 1
-                        logger.info(f"✅ Team notification sent for report {report_id}")
-                    
-                except Exception as notification_error:
-                    logger.error(f"❌ Failed to send team notification for {report_id}: {str(notification_error)}")
-        
-        logger.info(f"✅ Follow-up check complete: {patient_followups_sent} patient emails, {team_notifications_sent} team notifications")
-        
-        return {
-            "status": "ok",
-            "patient_followups_sent": patient_followups_sent,
-            "team_notifications_sent": team_notifications_sent,
-            "total_checked": len(response.data)
-        }
+        # Due rows are prefiltered in SQL, clinic info is bulk-loaded and emails
+        # go out over shared sessions - see services/followup_engine.py
+        return await get_followup_engine().run()
     
     except HTTPException:
         raise
@@ -0,0 +1,565 @@
+"""
+Local stand-ins for the external APIs the backend talks to
+
+One FastAPI app serves all of them under separate prefixes so a single port
+is enough:
+
+    /roboflow/{project}/{version}          Roboflow hosted inference
+    /openai/v1/chat/completions            OpenAI chat completions (incl. stream)
+    /elevenlabs/v1/text-to-speech/{voice}  ElevenLabs TTS
+    /supabase/rest/v1/...                  PostgREST (in-memory tables)
+    /supabase/auth/v1/admin/users/{id}     GoTrue admin user lookup
+    /supabase/storage/v1/...               Supabase Storage
+    /s3/{bucket}/{key}                     S3 (path-style, in-memory)
+    /sendgrid/v3/mail/send                 SendGrid v3
+
+Every service has configurable latency, jitter and error injection so the
+benchmark can reproduce slow or flaky upstreams.
+"""
+
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import formatdate
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+SAMPLE_IMAGE_PATH = Path(__file__).parent.parent / "dental-xray.jpg"
+
+SERVICES = ["roboflow", "openai", "elevenlabs", "supabase", "s3", "sendgrid"]
+
+# Rough production medians, used when no latency is given on the command line
+DEFAULT_LATENCY_MS = {
+    "roboflow": 800,
+    "openai": 2500,
+    "elevenlabs": 1500,
+    "supabase": 60,
+    "s3": 40,
+    "sendgrid": 150,
+}
+
+
+@dataclass
+class UpstreamProfile:
+    """Latency and failure behaviour of one fake upstream"""
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+
+
+@dataclass
+class FakeConfig:
+    profiles: Dict[str, UpstreamProfile] = field(default_factory=dict)
+    seed: Optional[int] = None
+
+    def profile(self, service: str) -> UpstreamProfile:
+        return self.profiles.setdefault(service, UpstreamProfile())
+
+    @classmethod
+    def with_defaults(cls, scale: float = 1.0) -> "FakeConfig":
+        """Production-like latencies scaled by `scale` (0 for no latency)"""
+        return cls(profiles={
+            name: UpstreamProfile(latency_ms=ms * scale, jitter_ms=ms * scale * 0.2)
+            for name, ms in DEFAULT_LATENCY_MS.items()
+        })
+
+
+class UpstreamFailure(Exception):
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+
+class FakeState:
+    """In-memory data shared by the fake services"""
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.storage: Dict[Tuple[str, str], Tuple[bytes, str]] = {}
+        self.s3_objects: Dict[Tuple[str, str], Tuple[bytes, str, datetime]] = {}
+        self.rpc_handlers: Dict[str, Callable[["FakeState", Dict[str, Any]], Any]] = {}
+        self.calls: Dict[str, int] = {}
+        self.sent_emails: List[Dict[str, Any]] = []
+        self.sample_image = SAMPLE_IMAGE_PATH.read_bytes() if SAMPLE_IMAGE_PATH.exists() else b""
+
+    def table(self, name: str) -> List[Dict[str, Any]]:
+        return self.tables.setdefault(name, [])
+
+    def insert(self, name: str, row: Dict[str, Any]) -> Dict[str, Any]:
+        row = dict(row)
+        row.setdefault("id", str(uuid.uuid4()))
+        row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+        self.table(name).append(row)
+        return row
+
+    def add_auth_user(self, user_id: str, email: str, user_metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        return self.insert("auth.users", {
+            "id": user_id,
+            "aud": "authenticated",
+            "role": "authenticated",
+            "email": email,
+            "app_metadata": {"provider": "email"},
+            "user_metadata": user_metadata or {},
+        })
+
+    def put_s3_object(self, bucket: str, key: str, body: bytes, content_type: str = "image/jpeg") -> None:
+        self.s3_objects[(bucket, key)] = (body, content_type, datetime.now(timezone.utc))
+
+
+# ---------------------------------------------------------------------------
+# PostgREST filter handling (the subset supabase-py emits for this codebase)
+# ---------------------------------------------------------------------------
+
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+
+def _coerce(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return "" if value is None else str(value)
+
+
+def _matches(row: Dict[str, Any], column: str, expression: str) -> bool:
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    operator, _, operand = expression.partition(".")
+    value = row.get(column)
+
+    if operator == "eq":
+        result = _coerce(value) == operand
+    elif operator == "neq":
+        result = _coerce(value) != operand
+    elif operator == "is":
+        if operand == "null":
+            result = value is None
+        else:
+            result = _coerce(value) == operand
+    elif operator == "in":
+        options = [o.strip().strip('"') for o in operand.strip("()").split(",") if o]
+        result = _coerce(value) in options
+    elif operator in ("gt", "gte", "lt", "lte"):
+        if value is None:
+            result = False
+        else:
+            left, right = _coerce(value), operand
+            try:
+                left, right = float(left), float(right)
+            except ValueError:
+                pass
+            result = {
+                "gt": left > right, "gte": left >= right,
+                "lt": left < right, "lte": left <= right,
+            }[operator]
+    elif operator in ("like", "ilike"):
+        pattern = re.escape(operand).replace("\\*", ".*").replace("%", ".*")
+        flags = re.IGNORECASE if operator == "ilike" else 0
+        result = re.fullmatch(pattern, _coerce(value), flags) is not None
+    else:
+        result = True
+    return not result if negate else result
+
+
+def _filter_rows(rows: List[Dict[str, Any]], params: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+    filters = [(k, v) for k, v in params if k not in RESERVED_PARAMS and k != "or"]
+    return [row for row in rows if all(_matches(row, k, v) for k, v in filters)]
+
+
+def _order_and_page(rows: List[Dict[str, Any]], params: Dict[str, str]) -> List[Dict[str, Any]]:
+    order = params.get("order")
+    if order:
+        for clause in reversed(order.split(",")):
+            column, _, direction = clause.partition(".")
+            rows = sorted(rows, key=lambda r: _coerce(r.get(column)), reverse=direction.startswith("desc"))
+    offset = int(params.get("offset", 0))
+    limit = params.get("limit")
+    rows = rows[offset:]
+    if limit is not None:
+        rows = rows[:int(limit)]
+    return rows
+
+
+def _postgrest_response(request: Request, rows: List[Dict[str, Any]], total: Optional[int] = None,
+                        status_code: int = 200) -> Response:
+    headers = {}
+    if "count=" in request.headers.get("prefer", ""):
+        count = total if total is not None else len(rows)
+        headers["Content-Range"] = f"0-{max(count - 1, 0)}/{count}"
+
+    if "vnd.pgrst.object" in request.headers.get("accept", ""):
+        if len(rows) != 1:
+            return JSONResponse(
+                status_code=406,
+                content={
+                    "code": "PGRST116",
+                    "details": f"The result contains {len(rows)} rows",
+                    "hint": None,
+                    "message": "JSON object requested, multiple (or no) rows returned"
+                },
+                headers=headers
+            )
+        return JSONResponse(content=rows[0], status_code=status_code, headers=headers)
+
+    if "return=minimal" in request.headers.get("prefer", ""):
+        return Response(status_code=204 if status_code == 200 else status_code, headers=headers)
+    return JSONResponse(content=rows, status_code=status_code, headers=headers)
+
+
+# ---------------------------------------------------------------------------
+# Canned upstream payloads
+# ---------------------------------------------------------------------------
+
+def roboflow_detections(count: int = 6, width: int = 2048, height: int = 1024) -> Dict[str, Any]:
+    classes = ["caries", "filling", "periapical-lesion", "root-piece", "crown", "impacted-tooth"]
+    rng = random.Random(count)
+    predictions = []
+    for i in range(count):
+        predictions.append({
+            "x": rng.uniform(0.15, 0.85) * width,
+            "y": rng.uniform(0.3, 0.7) * height,
+            "width": rng.uniform(40, 120),
+            "height": rng.uniform(60, 160),
+            "confidence": round(rng.uniform(0.55, 0.97), 3),
+            "class": classes[i % len(classes)],
+            "class_id": i % len(classes),
+            "detection_id": str(uuid.UUID(int=i + 1)),
+        })
+    return {"time": 0.1, "image": {"width": width, "height": height}, "predictions": predictions}
+
+
+def roboflow_segmentation(width: int = 2048, height: int = 1024) -> Dict[str, Any]:
+    """32 tooth boxes laid out across both arches with FDI class names"""
+    predictions = []
+    quadrants = [(1, "upper", -1), (2, "upper", 1), (3, "lower", 1), (4, "lower", -1)]
+    tooth_width = width * 0.35 / 8
+    for quadrant, arch, direction in quadrants:
+        y = height * (0.38 if arch == "upper" else 0.62)
+        for position in range(1, 9):
+            x = width / 2 + direction * (position - 0.5) * tooth_width
+            w, h = tooth_width * 0.9, height * 0.18
+            predictions.append({
+                "x": x, "y": y, "width": w, "height": h,
+                "confidence": 0.9,
+                "class": str(quadrant * 10 + position),
+                "points": [
+                    {"x": x - w / 2, "y": y - h / 2}, {"x": x + w / 2, "y": y - h / 2},
+                    {"x": x + w / 2, "y": y + h / 2}, {"x": x - w / 2, "y": y + h / 2},
+                ],
+            })
+    return {"time": 0.1, "image": {"width": width, "height": height}, "predictions": predictions}
+
+
+# One JSON document that satisfies every parser in the codebase; each caller
+# only reads the keys it cares about.
+OPENAI_JSON_CONTENT = {
+    "summary": "Benchmark analysis summary.",
+    "ai_notes": "Generated by the local OpenAI stand-in.",
+    "treatment_stages": [
+        {
+            "stage": "Stage 1",
+            "focus": "Disease control",
+            "items": [{"tooth": "16", "condition": "caries", "recommended_treatment": "filling"}],
+        }
+    ],
+    "overall_summary": "Benchmark findings summary.",
+    "detailed_findings": [],
+    "total_detections": 0,
+    "high_confidence_count": 0,
+    "mappings": [],
+    "resolutions": [],
+    "matches": [],
+    "extracted_treatments": [],
+    "total_count": 0,
+    "currency": "AUD",
+}
+
+
+def openai_content(body: Dict[str, Any]) -> str:
+    response_format = (body.get("response_format") or {}).get("type")
+    messages = body.get("messages") or []
+    system_text = " ".join(str(m.get("content", "")) for m in messages if m.get("role") == "system").lower()
+
+    if response_format == "json_object" or "json" in system_text or not system_text:
+        return json.dumps(OPENAI_JSON_CONTENT)
+    if "html" in system_text:
+        return "<div class=\"report\"><p>Benchmark report content.</p></div>"
+    return "This is a benchmark narration script for the patient's treatment plan."
+
+
+def silent_wav(seconds: float = 1.0, sample_rate: int = 16000) -> bytes:
+    import io
+    import wave
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(b"\x00\x00" * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# App factory
+# ---------------------------------------------------------------------------
+
+def create_fake_app(config: Optional[FakeConfig] = None, state: Optional[FakeState] = None) -> FastAPI:
+    config = config or FakeConfig()
+    state = state or FakeState()
+    rng = random.Random(config.seed)
+    app = FastAPI(title="Scanwise upstream fakes", docs_url=None, redoc_url=None)
+    app.state.fake_state = state
+    app.state.fake_config = config
+
+    async def upstream(service: str) -> None:
+        """Apply latency/error injection for one upstream call"""
+        state.calls[service] = state.calls.get(service, 0) + 1
+        profile = config.profile(service)
+        delay_ms = profile.latency_ms
+        if profile.jitter_ms:
+            delay_ms += rng.uniform(-profile.jitter_ms, profile.jitter_ms)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+        if profile.error_rate and rng.random() < profile.error_rate:
+            raise UpstreamFailure(profile.error_status)
+
+    @app.exception_handler(UpstreamFailure)
+    async def upstream_failure_handler(request: Request, exc: UpstreamFailure):
+        return JSONResponse(status_code=exc.status_code, content={"error": "injected failure"})
+
+    # ---------------- Roboflow ----------------
+
+    @app.post("/roboflow/{project}/{version}")
+    async def roboflow_infer(project: str, version: str, request: Request):
+        await upstream("roboflow")
+        if request.query_params.get("format") == "image":
+            return Response(content=state.sample_image, media_type="image/jpeg")
+        if "seg" in project.lower():
+            return roboflow_segmentation()
+        return roboflow_detections()
+
+    # ---------------- OpenAI ----------------
+
+    @app.post("/openai/v1/chat/completions")
+    async def openai_chat(request: Request):
+        body = await request.json()
+        await upstream("openai")
+        content = openai_content(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "gpt-4o")
+
+        if body.get("stream"):
+            async def event_stream():
+                words = content.split(" ")
+                for index, word in enumerate(words):
+                    piece = word if index == 0 else " " + word
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created,
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                final = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created,
+                    "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(final)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 100, "completion_tokens": len(content) // 4, "total_tokens": 100 + len(content) // 4},
+        }
+
+    # ---------------- ElevenLabs ----------------
+
+    @app.post("/elevenlabs/v1/text-to-speech/{voice_id}")
+    async def elevenlabs_tts(voice_id: str):
+        await upstream("elevenlabs")
+        return Response(content=silent_wav(), media_type="audio/wav")
+
+    # ---------------- Supabase: PostgREST ----------------
+
+    @app.get("/supabase/rest/v1/{table}")
+    async def postgrest_select(table: str, request: Request):
+        await upstream("supabase")
+        params = list(request.query_params.multi_items())
+        rows = _filter_rows(state.table(table), params)
+        total = len(rows)
+        return _postgrest_response(request, _order_and_page(rows, dict(params)), total)
+
+    @app.head("/supabase/rest/v1/{table}")
+    async def postgrest_head(table: str, request: Request):
+        await upstream("supabase")
+        rows = _filter_rows(state.table(table), list(request.query_params.multi_items()))
+        return Response(headers={"Content-Range": f"0-{max(len(rows) - 1, 0)}/{len(rows)}"})
+
+    @app.post("/supabase/rest/v1/rpc/{function}")
+    async def postgrest_rpc(function: str, request: Request):
+        await upstream("supabase")
+        body = await request.body()
+        payload = json.loads(body) if body else {}
+        handler = state.rpc_handlers.get(function)
+        if handler is None:
+            return JSONResponse(status_code=404, content={
+                "code": "PGRST202",
+                "message": f"Could not find the function public.{function} in the schema cache",
+            })
+        return JSONResponse(content=handler(state, payload))
+
+    @app.post("/supabase/rest/v1/{table}")
+    async def postgrest_insert(table: str, request: Request):
+        await upstream("supabase")
+        payload = await request.json()
+        rows = payload if isinstance(payload, list) else [payload]
+        prefer = request.headers.get("prefer", "")
+        on_conflict = request.query_params.get("on_conflict")
+        upsert = "resolution=merge-duplicates" in prefer or "resolution=ignore-duplicates" in prefer
+        conflict_columns = on_conflict.split(",") if on_conflict else ["id"]
+
+        written = []
+        for row in rows:
+            existing = None
+            if upsert and all(c in row for c in conflict_columns):
+                existing = next(
+                    (r for r in state.table(table) if all(_coerce(r.get(c)) == _coerce(row[c]) for c in conflict_columns)),
+                    None
+                )
+            if existing is not None:
+                if "resolution=merge-duplicates" in prefer:
+                    existing.update(row)
+                written.append(existing)
+            else:
+                written.append(state.insert(table, row))
+        return _postgrest_response(request, written, status_code=201)
+
+    @app.patch("/supabase/rest/v1/{table}")
+    async def postgrest_update(table: str, request: Request):
+        await upstream("supabase")
+        updates = await request.json()
+        rows = _filter_rows(state.table(table), list(request.query_params.multi_items()))
+        for row in rows:
+            row.update(updates)
+        return _postgrest_response(request, rows)
+
+    @app.delete("/supabase/rest/v1/{table}")
+    async def postgrest_delete(table: str, request: Request):
+        await upstream("supabase")
+        rows = _filter_rows(state.table(table), list(request.query_params.multi_items()))
+        remaining = [r for r in state.table(table) if r not in rows]
+        state.tables[table] = remaining
+        return _postgrest_response(request, rows)
+
+    # ---------------- Supabase: Auth (admin) ----------------
+
+    @app.get("/supabase/auth/v1/admin/users/{user_id}")
+    async def auth_admin_get_user(user_id: str):
+        await upstream("supabase")
+        user = next((u for u in state.table("auth.users") if u["id"] == user_id), None)
+        if user is None:
+            return JSONResponse(status_code=404, content={"code": 404, "msg": "User not found"})
+        return user
+
+    # ---------------- Supabase: Storage ----------------
+
+    async def _read_upload(request: Request) -> Tuple[bytes, str]:
+        content_type = request.headers.get("content-type", "application/octet-stream")
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            for value in form.values():
+                if hasattr(value, "read"):
+                    return await value.read(), getattr(value, "content_type", None) or "application/octet-stream"
+            return b"", content_type
+        return await request.body(), content_type
+
+    @app.post("/supabase/storage/v1/object/{bucket}/{path:path}")
+    @app.put("/supabase/storage/v1/object/{bucket}/{path:path}")
+    async def storage_upload(bucket: str, path: str, request: Request):
+        await upstream("supabase")
+        body, content_type = await _read_upload(request)
+        state.storage[(bucket, unquote(path))] = (body, content_type)
+        return {"Key": f"{bucket}/{path}", "Id": str(uuid.uuid4())}
+
+    @app.get("/supabase/storage/v1/object/public/{bucket}/{path:path}")
+    async def storage_public(bucket: str, path: str):
+        stored = state.storage.get((bucket, unquote(path)))
+        if stored is None:
+            return JSONResponse(status_code=404, content={"error": "not_found"})
+        body, content_type = stored
+        return Response(content=body, media_type=content_type)
+
+    # ---------------- S3 (path-style) ----------------
+
+    @app.head("/s3/{bucket}")
+    async def s3_head_bucket(bucket: str):
+        await upstream("s3")
+        return Response(status_code=200)
+
+    @app.get("/s3/{bucket}")
+    async def s3_list_objects(bucket: str, request: Request):
+        await upstream("s3")
+        prefix = request.query_params.get("prefix", "")
+        max_keys = int(request.query_params.get("max-keys", 1000))
+        keys = sorted(k for (b, k) in state.s3_objects if b == bucket and k.startswith(prefix))[:max_keys]
+        contents = "".join(
+            f"<Contents><Key>{escape(k)}</Key>"
+            f"<LastModified>{state.s3_objects[(bucket, k)][2].strftime('%Y-%m-%dT%H:%M:%S.000Z')}</LastModified>"
+            f"<ETag>&quot;{uuid.uuid5(uuid.NAMESPACE_URL, k).hex}&quot;</ETag>"
+            f"<Size>{len(state.s3_objects[(bucket, k)][0])}</Size><StorageClass>STANDARD</StorageClass></Contents>"
+            for k in keys
+        )
+        xml = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>"
+            f"<KeyCount>{len(keys)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>"
+            f"<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>"
+        )
+        return Response(content=xml, media_type="application/xml")
+
+    @app.put("/s3/{bucket}/{key:path}")
+    async def s3_put_object(bucket: str, key: str, request: Request):
+        await upstream("s3")
+        body = await request.body()
+        state.put_s3_object(bucket, unquote(key), body, request.headers.get("content-type", "binary/octet-stream"))
+        return Response(status_code=200, headers={"ETag": f'"{uuid.uuid4().hex}"'})
+
+    @app.get("/s3/{bucket}/{key:path}")
+    async def s3_get_object(bucket: str, key: str):
+        await upstream("s3")
+        stored = state.s3_objects.get((bucket, unquote(key)))
+        if stored is None:
+            return Response(status_code=404, media_type="application/xml",
+                            content="<Error><Code>NoSuchKey</Code></Error>")
+        body, content_type, modified = stored
+        return Response(content=body, media_type=content_type,
+                        headers={"Last-Modified": formatdate(modified.timestamp(), usegmt=True)})
+
+    # ---------------- SendGrid ----------------
+
+    @app.post("/sendgrid/v3/mail/send")
+    async def sendgrid_send(request: Request):
+        await upstream("sendgrid")
+        state.sent_emails.append(await request.json())
+        return Response(status_code=202, headers={"X-Message-Id": uuid.uuid4().hex})
+
+    return app
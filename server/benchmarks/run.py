@@ -0,0 +1,347 @@
+"""
+Offline end-to-end benchmark for the API
+
+Boots the real FastAPI app against local fakes of Roboflow, OpenAI,
+ElevenLabs, Supabase, S3 and SendGrid, then drives the selected endpoints at a
+fixed concurrency and reports throughput and latency percentiles.
+
+Usage (from the server directory):
+    python -m benchmarks.run                                   # all scenarios
+    python -m benchmarks.run -s analyze-xray -s generate-pdf -c 8 -n 200
+    python -m benchmarks.run --latency openai=4000 --error-rate roboflow=0.05
+    python -m benchmarks.run --json results/baseline.json
+    python -m benchmarks.run --compare results/baseline.json --max-regression 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import jwt
+import uvicorn
+
+from benchmarks.fakes import SERVICES, FakeConfig, FakeState, UpstreamProfile, create_fake_app
+from benchmarks.scenarios import SCENARIOS, BenchContext, RequestSpec
+
+logger = logging.getLogger("benchmarks")
+
+S3_BUCKET = "scanwise-benchmark"
+STRIPE_WEBHOOK_SECRET = "whsec_benchmark"
+JWT_SECRET = "benchmark-secret"
+
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    duration_s: float
+    throughput_rps: float
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    status_codes: Dict[str, int] = field(default_factory=dict)
+
+
+# ---------------------------------------------------------------------------
+# Server helpers
+# ---------------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(app, port: int) -> Tuple[uvicorn.Server, threading.Thread]:
+    """Run a uvicorn server in a daemon thread and wait until it accepts requests"""
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    deadline = time.time() + 30
+    while not server.started:
+        if not thread.is_alive() or time.time() > deadline:
+            raise RuntimeError(f"Server on port {port} failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+
+def _signed_token(secret: str, **claims) -> str:
+    return jwt.encode(claims, secret, algorithm="HS256")
+
+
+def _configure_environment(fake_url: str) -> None:
+    """Point every external client at the fakes (must run before importing main)"""
+    anon_key = _signed_token(JWT_SECRET, role="anon", iss="supabase")
+    service_key = _signed_token(JWT_SECRET, role="service_role", iss="supabase")
+
+    os.environ.update({
+        "ENVIRONMENT": "benchmark",
+        "SUPABASE_URL": f"{fake_url}/supabase",
+        "SUPABASE_ANON_KEY": anon_key,
+        "SUPABASE_SERVICE_KEY": service_key,
+        "OPENAI_API_KEY": "sk-benchmark",
+        "OPENAI_BASE_URL": f"{fake_url}/openai/v1",
+        "ROBOFLOW_API_KEY": "benchmark",
+        "ROBOFLOW_API_URL": f"{fake_url}/roboflow",
+        "ROBOFLOW_PROJECT_ID": "dental-detection",
+        "ROBOFLOW_MODEL_VERSION": "1",
+        "ROBOFLOW_SEG_PROJECT_ID": "teeth-seg",
+        "ROBOFLOW_SEG_MODEL_VERSION": "1",
+        "ELEVENLABS_API_KEY": "benchmark",
+        "ELEVENLABS_API_URL": f"{fake_url}/elevenlabs",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_S3_BUCKET": S3_BUCKET,
+        # An IP endpoint makes boto3 use path-style addressing
+        "AWS_ENDPOINT_URL_S3": f"{fake_url}/s3",
+        "SENDGRID_API_KEY": "SG.benchmark",
+        "SENDGRID_API_HOST": f"{fake_url}/sendgrid",
+        "STRIPE_WEBHOOK_SECRET": STRIPE_WEBHOOK_SECRET,
+    })
+
+
+# ---------------------------------------------------------------------------
+# Load generation
+# ---------------------------------------------------------------------------
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def _send(client: httpx.AsyncClient, spec: RequestSpec) -> int:
+    response = await client.request(
+        spec.method, spec.path, json=spec.json, content=spec.content, headers=spec.headers
+    )
+    return response.status_code
+
+
+async def run_scenario(base_url: str, ctx: BenchContext, name: str, total: int,
+                       concurrency: int, warmup: int, timeout: float,
+                       verbose: bool = False) -> ScenarioResult:
+    """Send `total` requests for one scenario with `concurrency` workers"""
+    scenario = SCENARIOS[name]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        for i in range(warmup):
+            try:
+                await _send(client, scenario.build(ctx, -(i + 1)))
+            except httpx.HTTPError:
+                pass
+
+        latencies: List[float] = []
+        status_codes: Dict[str, int] = {}
+        errors = 0
+        counter = iter(range(total))
+
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                spec = scenario.build(ctx, i)
+                start_time = time.perf_counter()
+                try:
+                    status = str(await _send(client, spec))
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - start_time
+                latencies.append(elapsed)
+                status_codes[status] = status_codes.get(status, 0) + 1
+                if not status.isdigit() or int(status) >= 400:
+                    errors += 1
+                    if verbose:
+                        logger.warning(f"{name} request {i} failed: {status}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    to_ms = 1000.0
+    return ScenarioResult(
+        scenario=name,
+        concurrency=concurrency,
+        requests=len(latencies),
+        errors=errors,
+        duration_s=round(duration, 3),
+        throughput_rps=round(len(latencies) / duration, 2) if duration else 0.0,
+        mean_ms=round(statistics.fmean(ordered) * to_ms, 1) if ordered else 0.0,
+        p50_ms=round(_percentile(ordered, 50) * to_ms, 1),
+        p95_ms=round(_percentile(ordered, 95) * to_ms, 1),
+        p99_ms=round(_percentile(ordered, 99) * to_ms, 1),
+        max_ms=round(ordered[-1] * to_ms, 1) if ordered else 0.0,
+        status_codes=status_codes,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Reporting
+# ---------------------------------------------------------------------------
+
+def print_results(results: List[ScenarioResult]) -> None:
+    header = f"{'scenario':<16} {'conc':>4} {'reqs':>6} {'errs':>5} {'req/s':>8} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r.scenario:<16} {r.concurrency:>4} {r.requests:>6} {r.errors:>5} {r.throughput_rps:>8.2f} "
+              f"{r.mean_ms:>7.1f}ms {r.p50_ms:>7.1f}ms {r.p95_ms:>7.1f}ms {r.p99_ms:>7.1f}ms")
+
+
+def compare_results(results: List[ScenarioResult], baseline_path: str, max_regression: float) -> bool:
+    """Return False if any scenario's p95 or throughput regressed beyond the threshold"""
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+
+    ok = True
+    print("")
+    print(f"Comparison with {baseline_path} (max regression {max_regression:.0%})")
+    for r in results:
+        base = baseline.get(r.scenario)
+        if not base:
+            print(f"  {r.scenario:<16} no baseline")
+            continue
+        p95_change = (r.p95_ms - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+        rps_change = (base["throughput_rps"] - r.throughput_rps) / base["throughput_rps"] if base["throughput_rps"] else 0.0
+        regressed = p95_change > max_regression or rps_change > max_regression
+        ok = ok and not regressed
+        marker = "REGRESSION" if regressed else "ok"
+        print(f"  {r.scenario:<16} p95 {base['p95_ms']:.1f} -> {r.p95_ms:.1f}ms ({p95_change:+.0%}), "
+              f"req/s {base['throughput_rps']:.2f} -> {r.throughput_rps:.2f}  {marker}")
+    return ok
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def _parse_service_values(values: List[str], option: str) -> Dict[str, float]:
+    parsed = {}
+    for value in values:
+        service, _, number = value.partition("=")
+        if service not in SERVICES or not number:
+            raise SystemExit(f"{option} expects SERVICE=VALUE with SERVICE in {', '.join(SERVICES)}")
+        parsed[service] = float(number)
+    return parsed
+
+
+def build_fake_config(args: argparse.Namespace) -> FakeConfig:
+    config = FakeConfig.with_defaults(args.latency_scale)
+    config.seed = args.seed
+    for service, ms in _parse_service_values(args.latency, "--latency").items():
+        config.profiles[service] = UpstreamProfile(latency_ms=ms, jitter_ms=config.profile(service).jitter_ms)
+    for service, ms in _parse_service_values(args.jitter, "--jitter").items():
+        config.profile(service).jitter_ms = ms
+    for service, rate in _parse_service_values(args.error_rate, "--error-rate").items():
+        config.profile(service).error_rate = rate
+    return config
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline end-to-end API benchmark")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run (repeatable, default: all)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("-n", "--requests", type=int, default=50, help="Requests per scenario")
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured requests per scenario")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--latency", action="append", default=[], metavar="SERVICE=MS",
+                        help="Override upstream latency, e.g. openai=4000")
+    parser.add_argument("--jitter", action="append", default=[], metavar="SERVICE=MS")
+    parser.add_argument("--error-rate", action="append", default=[], metavar="SERVICE=P",
+                        help="Fraction of upstream calls that fail, e.g. roboflow=0.05")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Multiply the default upstream latencies (0 = no latency)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for jitter/error injection")
+    parser.add_argument("--with-video", action="store_true", help="Include video generation in analyze-xray")
+    parser.add_argument("--json", dest="json_path", help="Write results to this file")
+    parser.add_argument("--compare", help="Baseline results file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Allowed relative p95/throughput regression for --compare")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show app logs and failed requests")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+
+    state = FakeState()
+    fake_config = build_fake_config(args)
+    fake_port = _free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    _start_server(create_fake_app(fake_config, state), fake_port)
+    _configure_environment(fake_url)
+
+    # Imported only now so the services pick up the fake endpoints
+    from main import app
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    app_port = _free_port()
+    _start_server(app, app_port)
+    app_url = f"http://127.0.0.1:{app_port}"
+
+    user_id = str(uuid.uuid4())
+    ctx = BenchContext(
+        fake_url=fake_url,
+        token=_signed_token(JWT_SECRET, sub=user_id, email="clinic@example.com", role="authenticated",
+                            aud="authenticated", exp=int(time.time()) + 86400),
+        user_id=user_id,
+        s3_bucket=S3_BUCKET,
+        stripe_webhook_secret=STRIPE_WEBHOOK_SECRET,
+        seeded={"generate_video": args.with_video},
+    )
+
+    names = args.scenario or list(SCENARIOS)
+    for name in names:
+        if SCENARIOS[name].setup:
+            SCENARIOS[name].setup(state, ctx)
+
+    results = []
+    for name in names:
+        print(f"Running {name}: {SCENARIOS[name].description}", file=sys.stderr)
+        results.append(asyncio.run(run_scenario(
+            app_url, ctx, name, args.requests, args.concurrency, args.warmup, args.timeout, args.verbose
+        )))
+
+    print("")
+    print_results(results)
+    print("")
+    print("Upstream calls: " + ", ".join(f"{k}={v}" for k, v in sorted(state.calls.items())))
+
+    if args.json_path:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json_path)), exist_ok=True)
+        with open(args.json_path, "w") as f:
+            json.dump({
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "config": {name: asdict(profile) for name, profile in fake_config.profiles.items()},
+                "results": [asdict(r) for r in results],
+            }, f, indent=2)
+        print(f"Results written to {args.json_path}")
+
+    if args.compare and not compare_results(results, args.compare, args.max_regression):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""
+Benchmark scenarios - one per endpoint we track for regressions
+
+Each scenario seeds the fake upstream state it needs and builds the HTTP
+request to send. Request bodies mirror what the frontend actually sends.
+"""
+
+import hashlib
+import hmac
+import json
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.fakes import FakeState, roboflow_detections
+from services.email_tracking_service import aggregate_email_events, merge_email_aggregate
+
+
+@dataclass
+class BenchContext:
+    """Everything a scenario needs to build requests"""
+    fake_url: str
+    token: str
+    user_id: str
+    s3_bucket: str
+    stripe_webhook_secret: str
+    seeded: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def auth_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    @property
+    def sample_image_url(self) -> str:
+        return f"{self.fake_url}/supabase/storage/v1/object/public/xray-images/benchmarks/xray.jpg"
+
+
+@dataclass
+class RequestSpec:
+    method: str
+    path: str
+    json: Optional[Any] = None
+    content: Optional[bytes] = None
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    build: Callable[[BenchContext, int], RequestSpec]
+    setup: Optional[Callable[[FakeState, BenchContext], None]] = None
+
+
+def _seed_sample_image(state: FakeState, ctx: BenchContext) -> None:
+    state.storage[("xray-images", "benchmarks/xray.jpg")] = (state.sample_image, "image/jpeg")
+
+
+# ---------------------------------------------------------------------------
+# /analyze-xray
+# ---------------------------------------------------------------------------
+
+def _build_analyze_xray(ctx: BenchContext, i: int) -> RequestSpec:
+    return RequestSpec(
+        method="POST",
+        path="/api/v1/analyze-xray",
+        json={
+            "patient_name": f"Benchmark Patient {i}",
+            "image_url": ctx.sample_image_url,
+            "findings": [
+                {"tooth": "16", "condition": "caries", "treatment": "filling"},
+                {"tooth": "46", "condition": "root-piece", "treatment": "extraction"},
+            ],
+            "generate_video": ctx.seeded.get("generate_video", False),
+        },
+        headers=ctx.auth_headers,
+    )
+
+
+# ---------------------------------------------------------------------------
+# /tooth-mapping and /image/overlay
+# ---------------------------------------------------------------------------
+
+def _build_tooth_mapping(ctx: BenchContext, i: int) -> RequestSpec:
+    return RequestSpec(
+        method="POST",
+        path="/api/v1/tooth-mapping",
+        json={
+            "image_url": ctx.sample_image_url,
+            "detections": roboflow_detections()["predictions"],
+            "numbering_system": "FDI",
+        },
+        headers=ctx.auth_headers,
+    )
+
+
+def _build_image_overlay(ctx: BenchContext, i: int) -> RequestSpec:
+    return RequestSpec(
+        method="POST",
+        path="/api/v1/image/overlay",
+        json={
+            "image_url": ctx.sample_image_url,
+            "numbering_system": "FDI",
+            "show_numbers": True,
+            "text_size_multiplier": 1.0,
+        },
+        headers=ctx.auth_headers,
+    )
+
+
+# ---------------------------------------------------------------------------
+# /generate-pdf/{diagnosis_id}
+# ---------------------------------------------------------------------------
+
+REPORT_HTML = """<html><body>
+<h1>Dental Report</h1>
+<div class="condition-explanation">Tooth 16 shows decay that needs a filling to stop it spreading.</div>
+<div class="condition-explanation">Tooth 46 has a retained root that should be removed.</div>
+</body></html>"""
+
+
+def _setup_generate_pdf(state: FakeState, ctx: BenchContext) -> None:
+    diagnosis = state.insert("patient_diagnosis", {
+        "user_id": ctx.user_id,
+        "patient_name": "Benchmark Patient",
+        "report_html": REPORT_HTML,
+        "treatment_stages": [],
+    })
+    state.insert("clinic_branding", {"user_id": ctx.user_id, "clinic_name": "Benchmark Dental"})
+    ctx.seeded["diagnosis_id"] = diagnosis["id"]
+
+
+def _build_generate_pdf(ctx: BenchContext, i: int) -> RequestSpec:
+    return RequestSpec(
+        method="GET",
+        path=f"/api/v1/generate-pdf/{ctx.seeded['diagnosis_id']}",
+        headers=ctx.auth_headers,
+    )
+
+
+# ---------------------------------------------------------------------------
+# /aws/images
+# ---------------------------------------------------------------------------
+
+AWS_IMAGE_COUNT = 40
+
+
+def _setup_aws_images(state: FakeState, ctx: BenchContext) -> None:
+    for n in range(AWS_IMAGE_COUNT):
+        key = f"clinics/{ctx.user_id}/scan_{n:03d}.jpg"
+        state.put_s3_object(ctx.s3_bucket, key, state.sample_image)
+        # Half of the images already have a completed analysis
+        if n % 2 == 0:
+            state.insert("aws_image_analysis", {
+                "user_id": ctx.user_id,
+                "s3_key": key,
+                "status": "completed",
+                "detections": roboflow_detections()["predictions"],
+                "annotated_image_url": ctx.sample_image_url,
+            })
+
+
+def _build_aws_images(ctx: BenchContext, i: int) -> RequestSpec:
+    return RequestSpec(method="GET", path="/api/v1/aws/images", headers=ctx.auth_headers)
+
+
+# ---------------------------------------------------------------------------
+# Webhooks
+# ---------------------------------------------------------------------------
+
+EMAIL_WEBHOOK_BATCH = 50
+TRACKED_REPORTS = 20
+
+
+def _ingest_email_events(state: FakeState, payload: Dict[str, Any]) -> Dict[str, int]:
+    """In-memory equivalent of the ingest_email_events SQL function"""
+    seen = state.table("email_webhook_events")
+    seen_ids = {row["sg_event_id"] for row in seen}
+    new_rows = [row for row in payload["events"] if row["sg_event_id"] not in seen_ids]
+    seen.extend(new_rows)
+
+    reports_updated = 0
+    for report_id, agg in aggregate_email_events(new_rows).items():
+        for tracking in state.table("email_tracking"):
+            if tracking["report_id"] == report_id:
+                tracking.update(merge_email_aggregate(tracking, agg))
+                reports_updated += 1
+    return {"new_events": len(new_rows), "reports_updated": reports_updated}
+
+
+def _setup_email_webhook(state: FakeState, ctx: BenchContext) -> None:
+    state.rpc_handlers["ingest_email_events"] = _ingest_email_events
+    report_ids = []
+    for _ in range(TRACKED_REPORTS):
+        report_id = str(uuid.uuid4())
+        state.insert("email_tracking", {
+            "report_id": report_id,
+            "user_id": ctx.user_id,
+            "open_count": 0,
+            "click_count": 0,
+            "first_opened_at": None,
+        })
+        report_ids.append(report_id)
+    ctx.seeded["report_ids"] = report_ids
+
+
+def _build_email_webhook(ctx: BenchContext, i: int) -> RequestSpec:
+    report_ids: List[str] = ctx.seeded["report_ids"]
+    now = int(time.time())
+    event_types = ["delivered", "open", "open", "click", "open"]
+    events = [
+        {
+            "event": event_types[n % len(event_types)],
+            "report_id": report_ids[(i + n) % len(report_ids)],
+            "timestamp": now - n,
+            "sg_event_id": f"bench-{i}-{n}",
+            "email": "patient@example.com",
+        }
+        for n in range(EMAIL_WEBHOOK_BATCH)
+    ]
+    return RequestSpec(method="POST", path="/api/v1/email-webhook", json=events)
+
+
+def stripe_signature(payload: bytes, secret: str, timestamp: Optional[int] = None) -> str:
+    """Build a Stripe-Signature header the same way Stripe does"""
+    timestamp = timestamp or int(time.time())
+    signed_payload = f"{timestamp}.".encode() + payload
+    signature = hmac.new(secret.encode(), signed_payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def _setup_stripe_webhook(state: FakeState, ctx: BenchContext) -> None:
+    state.add_auth_user(ctx.user_id, "clinic@example.com", {"clinic_name": "Benchmark Dental"})
+
+
+def _build_stripe_webhook(ctx: BenchContext, i: int) -> RequestSpec:
+    event = {
+        "id": f"evt_bench_{i}_{uuid.uuid4().hex[:8]}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "created": int(time.time()),
+        "data": {
+            "object": {
+                "id": f"cs_bench_{i}",
+                "object": "checkout.session",
+                "customer": f"cus_bench_{i % 10}",
+                "subscription": f"sub_bench_{i % 10}",
+                "metadata": {"user_id": ctx.user_id},
+            }
+        },
+    }
+    payload = json.dumps(event).encode()
+    return RequestSpec(
+        method="POST",
+        path="/api/v1/stripe/webhook",
+        content=payload,
+        headers={
+            "Content-Type": "application/json",
+            "Stripe-Signature": stripe_signature(payload, ctx.stripe_webhook_secret),
+        },
+    )
+
+
+def _build_aws_webhook(ctx: BenchContext, i: int) -> RequestSpec:
+    return RequestSpec(
+        method="POST",
+        path="/api/v1/aws/webhook",
+        json={
+            "Records": [{
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": ctx.s3_bucket},
+                    "object": {"key": f"clinics/benchmark-dental-{ctx.user_id}/upload_{i}.jpg"},
+                },
+            }]
+        },
+    )
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    scenario.name: scenario
+    for scenario in [
+        Scenario("analyze-xray", "Roboflow + upload + GPT analysis + save (no video)",
+                 _build_analyze_xray, _seed_sample_image),
+        Scenario("tooth-mapping", "Ensemble tooth mapping (GPT vision + grid + referee)",
+                 _build_tooth_mapping, _seed_sample_image),
+        Scenario("image-overlay", "Segmentation + tooth number overlay render",
+                 _build_image_overlay, _seed_sample_image),
+        Scenario("generate-pdf", "HTML report to PDF",
+                 _build_generate_pdf, _setup_generate_pdf),
+        Scenario("aws-images", f"S3 listing with analysis lookups ({AWS_IMAGE_COUNT} images)",
+                 _build_aws_images, _setup_aws_images),
+        Scenario("email-webhook", f"SendGrid event batch ({EMAIL_WEBHOOK_BATCH} events)",
+                 _build_email_webhook, _setup_email_webhook),
+        Scenario("stripe-webhook", "Signed checkout.session.completed event",
+                 _build_stripe_webhook, _setup_stripe_webhook),
+        Scenario("aws-webhook", "S3 ObjectCreated notification",
+                 _build_aws_webhook),
+    ]
+}
@@ -10,7 +10,7 @@ This module provides intelligent treatment staging that respects:
 
 import logging
 from typing import Dict, List, Any, Tuple, Optional
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 import math
 
@@ -51,6 +51,35 @@ DEFAULT_CLINIC_CONFIG = {
     }
 }
 
+# Stages with at most this many treatments are packed with an exact search
+# (fewest visits); larger stages use first-fit-decreasing
+EXACT_PACKING_MAX_ITEMS = 12
+
+# Upper bound on search nodes so a pathological stage can't stall a request
+EXACT_PACKING_NODE_LIMIT = 200000
+
+# Display order for multi-quadrant visits
+QUADRANT_ORDER = ['UR', 'UL', 'LL', 'LR']
+QUADRANT_NAMES = {'UR': 'upper right', 'UL': 'upper left', 'LL': 'lower left', 'LR': 'lower right'}
+SIDE_ORDER = ['R', 'L']
+SIDE_NAMES = {'R': 'right', 'L': 'left'}
+
+
+def merge_clinic_config(base: Dict[str, Any], overrides: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge clinic overrides into a config
+
+    Dict-valued settings (PROCEDURE_TIME_MIN, PROCEDURE_DEPENDENCIES) are merged
+    key by key so overriding one procedure time keeps the other defaults.
+    """
+    merged = dict(base)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
 @dataclass
 class TreatmentItem:
     """Represents a single treatment item with all necessary metadata"""
@@ -95,6 +124,46 @@ class FutureTask:
     earliest_date_offset_weeks: int
     dependency_reason: str
 
+@dataclass
+class _VisitBin:
+    """A visit being packed: its treatments, booked time and quadrants/sides in use"""
+    treatments: List[TreatmentItem] = field(default_factory=list)
+    duration: int = 0
+    quadrants: Dict[str, int] = field(default_factory=dict)
+    sides: Dict[str, int] = field(default_factory=dict)
+
+    def fits(self, item: TreatmentItem, budget: int, max_quadrants: int, max_sides: int) -> bool:
+        # An empty visit takes anything, so over-budget procedures get their own visit
+        if self.treatments and self.duration + item.time_estimate_min > budget:
+            return False
+        if item.quadrant not in self.quadrants and len(self.quadrants) >= max_quadrants:
+            return False
+        if item.side not in self.sides and len(self.sides) >= max_sides:
+            return False
+        return True
+
+    def add(self, item: TreatmentItem) -> None:
+        self.treatments.append(item)
+        self.duration += item.time_estimate_min
+        self.quadrants[item.quadrant] = self.quadrants.get(item.quadrant, 0) + 1
+        self.sides[item.side] = self.sides.get(item.side, 0) + 1
+
+    def remove_last(self) -> None:
+        item = self.treatments.pop()
+        self.duration -= item.time_estimate_min
+        for counts, key in ((self.quadrants, item.quadrant), (self.sides, item.side)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+
+    def signature(self) -> Tuple[int, frozenset, frozenset]:
+        return (self.duration, frozenset(self.quadrants), frozenset(self.sides))
+
+
+class _SearchComplete(Exception):
+    """Raised to stop the exact search early (optimum found or node limit hit)"""
+
+
 @dataclass
 class StagedPlan:
     """Complete staged treatment plan"""
@@ -106,8 +175,8 @@ class StagingEngineV2:
     """Main staging engine implementing the V2 algorithm"""
     
     def __init__(self, clinic_config: Dict[str, Any] = None):
-        self.config = {**DEFAULT_CLINIC_CONFIG, **(clinic_config or {})}
-        logger.info(f"StagingEngineV2 initialized with config: {self.config}")
+        self.config = merge_clinic_config(DEFAULT_CLINIC_CONFIG, clinic_config)
+        logger.debug(f"StagingEngineV2 initialized with config: {self.config}")
     
     def build_staged_plan(self, treatments: List[Dict[str, Any]], clinic_config: Dict[str, Any] = None) -> StagedPlan:
         """
@@ -121,7 +190,7 @@ class StagingEngineV2:
             StagedPlan object with stages, visits, and future tasks
         """
         if clinic_config:
-            self.config.update(clinic_config)
+            self.config = merge_clinic_config(self.config, clinic_config)
         
         logger.info(f"Building staged plan for {len(treatments)} treatments")
         
@@ -210,7 +279,7 @@ class StagingEngineV2:
         try:
             tooth_num = int(tooth)
             
-            # FDI numbering system (1-32)
+            # Universal numbering system (1-32)
             if 1 <= tooth_num <= 32:
                 if tooth_num <= 16:  # Upper arch
                     arch = 'upper'
@@ -222,12 +291,12 @@ class StagingEngineV2:
                         quadrant = 'UL'
                 else:  # Lower arch
                     arch = 'lower'
-                    if tooth_num <= 24:  # Right side
-                        side = 'R'
-                        quadrant = 'LR'
-                    else:  # Left side
+                    if tooth_num <= 24:  # Left side (17 is the lower left third molar)
                         side = 'L'
                         quadrant = 'LL'
+                    else:  # Right side
+                        side = 'R'
+                        quadrant = 'LR'
             else:
                 # Unknown numbering system, default to right upper
                 side, arch, quadrant = 'R', 'upper', 'UR'
@@ -263,57 +332,36 @@ class StagingEngineV2:
         """Expand treatments to include required follow-up procedures"""
         expanded = treatments.copy()
         
+        # (tooth, procedure) index so each lookup is O(1) instead of a scan of the growing list
+        planned = {(t.tooth, t.procedure) for t in expanded}
+        procedure_times = self.config['PROCEDURE_TIME_MIN']
+        
+        def follow_up(treatment: TreatmentItem, procedure: str, condition: str) -> TreatmentItem:
+            planned.add((treatment.tooth, procedure))
+            return TreatmentItem(
+                tooth=treatment.tooth,
+                procedure=procedure,
+                stage_category=2,  # Definitive restorations
+                price=0,  # Will be calculated
+                condition=condition,
+                time_estimate_min=procedure_times.get(procedure, DEFAULT_CLINIC_CONFIG['PROCEDURE_TIME_MIN'][procedure]),
+                side=treatment.side,
+                arch=treatment.arch,
+                quadrant=treatment.quadrant,
+                dependencies=[],
+                follow_up_treatments=[]
+            )
+        
         for treatment in treatments:
             if treatment.procedure == 'root-canal-treatment':
                 # Add build-up if not present
-                if not any(t.procedure == 'build-up' and t.tooth == treatment.tooth for t in expanded):
-                    build_up = TreatmentItem(
-                        tooth=treatment.tooth,
-                        procedure='build-up',
-                        stage_category=2,  # Definitive restorations
-                        price=0,  # Will be calculated
-                        condition='post-rct-stabilization',
-                        time_estimate_min=self.config['PROCEDURE_TIME_MIN']['build-up'],
-                        side=treatment.side,
-                        arch=treatment.arch,
-                        quadrant=treatment.quadrant,
-                        dependencies=[],
-                        follow_up_treatments=[]
-                    )
-                    expanded.append(build_up)
+                if (treatment.tooth, 'build-up') not in planned:
+                    expanded.append(follow_up(treatment, 'build-up', 'post-rct-stabilization'))
                 
-                # Add crown-prep if not present
-                if not any(t.procedure == 'crown-prep' and t.tooth == treatment.tooth for t in expanded):
-                    crown_prep = TreatmentItem(
-                        tooth=treatment.tooth,
-                        procedure='crown-prep',
-                        stage_category=2,
-                        price=0,
-                        condition='post-rct-restoration',
-                        time_estimate_min=self.config['PROCEDURE_TIME_MIN']['crown-prep'],
-                        side=treatment.side,
-                        arch=treatment.arch,
-                        quadrant=treatment.quadrant,
-                        dependencies=[],
-                        follow_up_treatments=[]
-                    )
-                    expanded.append(crown_prep)
-                    
-                    # Add crown-seat with delay
-                    crown_seat = TreatmentItem(
-                        tooth=treatment.tooth,
-                        procedure='crown-seat',
-                        stage_category=2,
-                        price=0,
-                        condition='crown-finalization',
-                        time_estimate_min=self.config['PROCEDURE_TIME_MIN']['crown-seat'],
-                        side=treatment.side,
-                        arch=treatment.arch,
-                        quadrant=treatment.quadrant,
-                        dependencies=[],
-                        follow_up_treatments=[]
-                    )
-                    expanded.append(crown_seat)
+                # Add crown-prep if not present, with crown-seat after the lab delay
+                if (treatment.tooth, 'crown-prep') not in planned:
+                    expanded.append(follow_up(treatment, 'crown-prep', 'post-rct-restoration'))
+                    expanded.append(follow_up(treatment, 'crown-seat', 'crown-finalization'))
         
         return expanded
     
@@ -361,63 +409,140 @@ class StagingEngineV2:
         return stages
     
     def _create_visits_for_stage(self, treatments: List[TreatmentItem], stage_num: int) -> List[Visit]:
-        """Create visits for a stage respecting time budget and quadrant rules"""
+        """
+        Pack a stage's treatments into as few visits as possible
+        
+        Each visit stays within VISIT_TIME_BUDGET_MIN and spans at most
+        MAX_QUADRANTS_PER_VISIT quadrants and MAX_SIDES_PER_VISIT sides.
+        Small stages are solved exactly; larger ones use first-fit-decreasing
+        across all open visits.
+        """
+        position = {id(t): i for i, t in enumerate(treatments)}
+        
+        bins = self._pack_first_fit_decreasing(treatments, position)
+        if len(treatments) <= EXACT_PACKING_MAX_ITEMS:
+            exact_bins = self._pack_exact(treatments, position, len(bins))
+            if exact_bins is not None:
+                bins = exact_bins
+        
+        # Number visits in the order their treatments appear in the plan
+        bins.sort(key=lambda b: min(position[id(t)] for t in b.treatments))
+        
         visits = []
-        visit_counter = 1
+        for visit_num, visit_bin in enumerate(bins, start=1):
+            visit_treatments = sorted(visit_bin.treatments, key=lambda t: (-t.time_estimate_min, position[id(t)]))
+            side = '+'.join(s for s in SIDE_ORDER if s in visit_bin.sides)
+            quadrant = '+'.join(q for q in QUADRANT_ORDER if q in visit_bin.quadrants)
+            visits.append(self._create_visit(visit_treatments, stage_num, visit_num, side, quadrant))
         
-        # Group treatments by side and quadrant
-        side_quadrant_groups = {}
-        for treatment in treatments:
-            key = (treatment.side, treatment.quadrant)
-            if key not in side_quadrant_groups:
-                side_quadrant_groups[key] = []
-            side_quadrant_groups[key].append(treatment)
-        
-        # Process each side/quadrant group
-        for (side, quadrant), group_treatments in side_quadrant_groups.items():
-            # Sort treatments by duration (longest first for better packing)
-            group_treatments.sort(key=lambda x: x.time_estimate_min, reverse=True)
+        return visits
+    
+    def _packing_limits(self) -> Tuple[int, int, int]:
+        return (
+            self.config['VISIT_TIME_BUDGET_MIN'],
+            max(1, int(self.config.get('MAX_QUADRANTS_PER_VISIT') or 1)),
+            max(1, int(self.config.get('MAX_SIDES_PER_VISIT') or 1))
+        )
+    
+    def _pack_first_fit_decreasing(self, treatments: List[TreatmentItem], position: Dict[int, int]) -> List[_VisitBin]:
+        """Longest treatment first, into the first open visit it fits (preferring its own quadrant)"""
+        budget, max_quadrants, max_sides = self._packing_limits()
+        bins: List[_VisitBin] = []
+        
+        for item in sorted(treatments, key=lambda t: (-t.time_estimate_min, position[id(t)])):
+            target = None
+            for visit_bin in bins:
+                if not visit_bin.fits(item, budget, max_quadrants, max_sides):
+                    continue
+                if item.quadrant in visit_bin.quadrants:
+                    target = visit_bin
+                    break
+                target = target or visit_bin
             
-            current_visit_treatments = []
-            current_visit_duration = 0
+            if target is None:
+                target = _VisitBin()
+                bins.append(target)
+            target.add(item)
+        
+        return bins
+    
+    def _visit_lower_bound(self, treatments: List[TreatmentItem]) -> int:
+        """Minimum possible number of visits for a stage"""
+        budget, max_quadrants, max_sides = self._packing_limits()
+        oversized = sum(1 for t in treatments if t.time_estimate_min > budget)
+        regular_time = sum(t.time_estimate_min for t in treatments if t.time_estimate_min <= budget)
+        return max(
+            oversized + math.ceil(regular_time / budget),
+            math.ceil(len({t.quadrant for t in treatments}) / max_quadrants),
+            math.ceil(len({t.side for t in treatments}) / max_sides)
+        )
+    
+    def _pack_exact(self, treatments: List[TreatmentItem], position: Dict[int, int],
+                    upper_bound: int) -> Optional[List[_VisitBin]]:
+        """
+        Branch-and-bound search for the fewest visits
+        
+        Returns None when the first-fit-decreasing result (`upper_bound` visits)
+        is already optimal or no better packing was found within the node limit.
+        """
+        lower_bound = self._visit_lower_bound(treatments)
+        if upper_bound <= lower_bound:
+            return None
+        
+        budget, max_quadrants, max_sides = self._packing_limits()
+        items = sorted(treatments, key=lambda t: (-t.time_estimate_min, position[id(t)]))
+        bins: List[_VisitBin] = []
+        best: Dict[str, Any] = {'count': upper_bound, 'assignment': None}
+        nodes = 0
+        
+        def search(index: int) -> None:
+            nonlocal nodes
+            nodes += 1
+            if nodes > EXACT_PACKING_NODE_LIMIT:
+                raise _SearchComplete()
+            if len(bins) >= best['count']:
+                return
+            if index == len(items):
+                best['count'] = len(bins)
+                best['assignment'] = [list(b.treatments) for b in bins]
+                if len(bins) <= lower_bound:
+                    raise _SearchComplete()
+                return
             
-            for treatment in group_treatments:
-                # Check if adding this treatment would exceed time budget
-                if (current_visit_duration + treatment.time_estimate_min > 
-                    self.config['VISIT_TIME_BUDGET_MIN'] and current_visit_treatments):
-                    
-                    # Create visit with current treatments
-                    visit = self._create_visit(
-                        current_visit_treatments, 
-                        stage_num, 
-                        visit_counter, 
-                        side, 
-                        quadrant
-                    )
-                    visits.append(visit)
-                    visit_counter += 1
-                    
-                    # Start new visit
-                    current_visit_treatments = [treatment]
-                    current_visit_duration = treatment.time_estimate_min
-                else:
-                    # Add to current visit
-                    current_visit_treatments.append(treatment)
-                    current_visit_duration += treatment.time_estimate_min
+            item = items[index]
+            tried = set()
+            for visit_bin in bins:
+                # Visits with the same time and quadrants are interchangeable
+                signature = visit_bin.signature()
+                if signature in tried or not visit_bin.fits(item, budget, max_quadrants, max_sides):
+                    continue
+                tried.add(signature)
+                visit_bin.add(item)
+                search(index + 1)
+                visit_bin.remove_last()
             
-            # Create final visit for this group if there are treatments
-            if current_visit_treatments:
-                visit = self._create_visit(
-                    current_visit_treatments,
-                    stage_num,
-                    visit_counter,
-                    side,
-                    quadrant
-                )
-                visits.append(visit)
-                visit_counter += 1
+            if len(bins) + 1 < best['count']:
+                new_bin = _VisitBin()
+                new_bin.add(item)
+                bins.append(new_bin)
+                search(index + 1)
+                bins.pop()
         
-        return visits
+        try:
+            search(0)
+        except _SearchComplete:
+            pass
+        
+        if best['assignment'] is None:
+            return None
+        
+        packed = []
+        for assigned in best['assignment']:
+            visit_bin = _VisitBin()
+            for item in assigned:
+                visit_bin.add(item)
+            packed.append(visit_bin)
+        return packed
     
     def _create_visit(self, treatments: List[TreatmentItem], stage_num: int, 
                       visit_num: int, side: str, quadrant: str) -> Visit:
@@ -444,14 +569,15 @@ class StagingEngineV2:
     def _generate_explain_note(self, treatments: List[TreatmentItem], stage_num: int, 
                               visit_duration: int, side: str, quadrant: str) -> str:
         """Generate explanatory note for visit grouping"""
-        side_label = "right" if side == 'R' else "left"
-        quadrant_label = f"{'upper' if quadrant.startswith('U') else 'lower'} {side_label}"
+        sides = side.split('+')
+        side_label = " and ".join(SIDE_NAMES.get(s, s) for s in sides)
+        quadrant_label = " and ".join(QUADRANT_NAMES.get(q, q) for q in quadrant.split('+'))
         visit_time = f"{visit_duration} minutes"
         
         if stage_num == 1:
+            sides_note = " and avoided numbing both sides in one session" if len(sides) == 1 else ""
             return (f"Grouped urgent care on the {side_label} {quadrant_label} to control "
-                   f"infection and pain first. We kept this visit under {visit_time} and "
-                   f"avoided numbing both sides in one session.")
+                   f"infection and pain first. We kept this visit under {visit_time}{sides_note}.")
         
         elif stage_num == 2:
             rct_buildup_note = ""
@@ -473,10 +599,16 @@ class StagingEngineV2:
         """Generate future tasks based on dependencies and healing times"""
         future_tasks = []
         
+        # First replacement planned for each tooth
+        replacements_by_tooth = {}
+        for t in treatments:
+            if t.procedure in ('implant-placement', 'bridge', 'partial-denture'):
+                replacements_by_tooth.setdefault(t.tooth, t)
+        
         for treatment in treatments:
             if treatment.procedure == 'extraction':
                 # Check if there's a replacement treatment for this tooth
-                replacement_treatment = next((t for t in treatments if t.tooth == treatment.tooth and t.procedure in ['implant-placement', 'bridge', 'partial-denture']), None)
+                replacement_treatment = replacements_by_tooth.get(treatment.tooth)
                 
                 if replacement_treatment:
                     # Create future task for the replacement
@@ -1,17 +1,30 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from contextlib import asynccontextmanager
 import logging
 from dotenv import load_dotenv
 import os
+import sys
 import time
+import asyncio
 from datetime import datetime
 from utils.logging_config import setup_logging
+from utils.cleanup import cleanup_old_temp_files
+from utils.metrics import (
+    DEBUG_TIMING_HEADER,
+    begin_request,
+    finish_request,
+    metrics_authorized,
+    render_metrics,
+    resolve_endpoint_label,
+    server_timing_header,
+)
 
 # Import routers
 from api.routes import router
 from api.admin_routes import admin_router
+from services.registry import registry
 
 # Load environment variables
 load_dotenv()
@@ -28,6 +41,14 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Startup jobs, referenced so they aren't garbage collected while running
+background_tasks = set()
+
+def start_background_task(coro) -> None:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
 # Lifespan context manager for startup/shutdown events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -37,13 +58,36 @@ async def lifespan(app: FastAPI):
     logger.info(f"Environment: {os.getenv('ENVIRONMENT', 'development')}")
     logger.info(f"Supabase URL: {os.getenv('SUPABASE_URL', 'Not configured')}")
     logger.info(f"Docs available at: http://localhost:8000/docs")
-    logger.info("All services initialized")
+    logger.info("Services will be initialized on first use")
+    
+    # Clear stale video temp files off the event loop instead of at import time
+    asyncio.get_running_loop().run_in_executor(None, cleanup_old_temp_files)
+
+    # Pick up Stripe webhook events a previous run recorded but didn't finish
+    if os.getenv("STRIPE_SECRET_KEY"):
+        from services.stripe_webhook_queue import get_stripe_webhook_queue
+        webhook_queue = get_stripe_webhook_queue()
+        if webhook_queue:
+            start_background_task(webhook_queue.resume_pending())
+
+    # Finish report emails a previous run queued but didn't send
+    if os.getenv("SENDGRID_API_KEY") or os.getenv("GMAIL_EMAIL"):
+        from services.email_delivery import get_email_delivery_queue
+        delivery_queue = get_email_delivery_queue()
+        if delivery_queue:
+            start_background_task(delivery_queue.resume_pending())
     logger.info("=" * 50)
     
     yield
     
     # Shutdown
     logger.info("Shutting down SCANWISE AI Backend...")
+    if registry.is_initialized("staging"):
+        registry.get("staging").shutdown()
+    if registry.is_initialized("email_delivery"):
+        registry.get("email_delivery").shutdown()
+    from services.html_pdf_service import html_pdf_service
+    await html_pdf_service.close()
     logger.info("Cleanup completed")
 
 # Create FastAPI app
@@ -101,8 +145,16 @@ async def log_requests(request: Request, call_next):
         response.headers["Access-Control-Allow-Headers"] = "*"
         return response
     
+    # Collect per-stage spans for this request
+    timings, timings_token = begin_request()
+    
     # Process request
-    response = await call_next(request)
+    try:
+        response = await call_next(request)
+    except Exception:
+        finish_request(timings, timings_token, resolve_endpoint_label(request.scope),
+                       request.method, 500, time.time() - start_time)
+        raise
     
     # Log response
     process_time = time.time() - start_time
@@ -116,6 +168,13 @@ async def log_requests(request: Request, call_next):
     response.headers["X-Process-Time"] = str(process_time)
     response.headers["X-API-Version"] = "1.0.0"
     
+    # Optional per-stage breakdown for debugging slow requests
+    if timings.spans and (DEBUG_TIMING_HEADER or request.headers.get("X-Debug-Timing") == "1"):
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    
+    finish_request(timings, timings_token, resolve_endpoint_label(request.scope),
+                   request.method, response.status_code, process_time)
+    
     return response
 
 # Global exception handler
@@ -161,6 +220,15 @@ async def root():
         ]
     }
 
+# Prometheus metrics endpoint (scrape with `Authorization: Bearer $METRICS_TOKEN`)
+@app.get("/metrics", tags=["Monitoring"], include_in_schema=False)
+async def metrics(request: Request):
+    if not metrics_authorized(request.headers.get("authorization")):
+        # Don't reveal the endpoint to unauthenticated callers
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
 # API info endpoint
 @app.get("/api/info", tags=["Info"])
 async def api_info():
@@ -208,6 +276,12 @@ async def not_found_handler(request: Request, exc):
 
 # Main entry point
 if __name__ == "__main__":
+    # `python main.py --import-time` prints which imports dominate worker boot time
+    if "--import-time" in sys.argv:
+        from utils.import_timing import print_import_time_report
+        print_import_time_report("main")
+        sys.exit(0)
+    
     import uvicorn
     
     # Get configuration from environment
@@ -0,0 +1,13 @@
+-- Indexes for the batched follow-up cron (/cron/check-followups)
+
+-- One tracking row per report; lets the cron write all sent timestamps in a
+-- single upsert (ON CONFLICT (report_id)). Remove duplicate report_ids first
+-- if this fails.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_email_tracking_report_id
+ON email_tracking(report_id);
+
+-- The cron only looks at unopened, open-ended rows and filters them by
+-- urgency and sent_at, so a partial index keeps the scan small
+CREATE INDEX IF NOT EXISTS idx_email_tracking_followup_due
+ON email_tracking(urgency_level, sent_at)
+WHERE first_opened_at IS NULL AND follow_up_completed = false;
@@ -0,0 +1,61 @@
+-- Single-round-trip, atomic price-list import
+-- Used by POST /treatments/bulk-update via supabase.rpc('import_treatment_prices', ...)
+
+-- Re-importing a price list updates custom treatments instead of duplicating them.
+-- Existing duplicates must be removed first, e.g. keep the newest per name:
+--   DELETE FROM custom_treatments c USING custom_treatments d
+--   WHERE c.user_id = d.user_id AND c.clinic_name = d.clinic_name AND c.created_at < d.created_at;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_custom_treatments_user_clinic_name
+ON custom_treatments(user_id, clinic_name);
+
+-- Merge price overrides into the caller's treatment_settings and upsert custom
+-- treatments in one transaction. Runs as the caller, so RLS still applies.
+-- `settings` is a JSON object {treatment_code: {price, duration, clinic_name}};
+-- `custom` is a JSON array of custom_treatments rows without user_id.
+CREATE OR REPLACE FUNCTION import_treatment_prices(settings JSONB, custom JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY INVOKER
+SET search_path = public
+AS $$
+DECLARE
+    branding_id UUID;
+    custom_count INTEGER := 0;
+BEGIN
+    UPDATE clinic_branding
+    SET treatment_settings = COALESCE(treatment_settings, '{}'::jsonb) || COALESCE(settings, '{}'::jsonb),
+        updated_at = NOW()
+    WHERE user_id = auth.uid()
+    RETURNING id INTO branding_id;
+
+    IF branding_id IS NULL THEN
+        RAISE EXCEPTION 'Clinic branding not found';
+    END IF;
+
+    INSERT INTO custom_treatments (
+        user_id, clinic_name, display_name, friendly_name, category,
+        description, price, duration, is_active
+    )
+    SELECT
+        auth.uid(), c.clinic_name, c.display_name, c.friendly_name, COALESCE(c.category, 'general'),
+        c.description, c.price, COALESCE(c.duration, 30), COALESCE(c.is_active, true)
+    FROM jsonb_to_recordset(COALESCE(custom, '[]'::jsonb)) AS c(
+        clinic_name TEXT, display_name TEXT, friendly_name TEXT, category TEXT,
+        description TEXT, price NUMERIC, duration INTEGER, is_active BOOLEAN
+    )
+    ON CONFLICT (user_id, clinic_name) DO UPDATE SET
+        price = EXCLUDED.price,
+        duration = EXCLUDED.duration,
+        is_active = true,
+        updated_at = NOW();
+    GET DIAGNOSTICS custom_count = ROW_COUNT;
+
+    RETURN jsonb_build_object(
+        'updated_count', (SELECT COUNT(*) FROM jsonb_object_keys(COALESCE(settings, '{}'::jsonb))),
+        'custom_count', custom_count
+    );
+END;
+$$;
+
+REVOKE ALL ON FUNCTION import_treatment_prices(JSONB, JSONB) FROM PUBLIC, anon;
+GRANT EXECUTE ON FUNCTION import_treatment_prices(JSONB, JSONB) TO authenticated;
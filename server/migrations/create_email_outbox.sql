@@ -0,0 +1,34 @@
+-- Migration: Create email_outbox table for queued report email delivery
+-- Purpose: POST /send-report-email/batch records each recipient here; workers
+--          render and send the reports with per-clinic rate limits and retries,
+--          and unsent emails are resumed after a restart
+-- Date: 2026-10-19
+
+CREATE TABLE IF NOT EXISTS public.email_outbox (
+    id UUID PRIMARY KEY,
+    clinic_id UUID NOT NULL,
+    report_id UUID NOT NULL,
+    patient_email TEXT NOT NULL,
+    patient_name TEXT,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sending', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    sent_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Unsent emails are resumed on startup, oldest first
+CREATE INDEX IF NOT EXISTS idx_email_outbox_unsent
+ON public.email_outbox(created_at)
+WHERE status IN ('pending', 'failed');
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_clinic_id
+ON public.email_outbox(clinic_id, created_at DESC);
+
+-- Only the service role touches this table
+ALTER TABLE public.email_outbox ENABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE public.email_outbox IS 'Queued report emails and their delivery status';
+COMMENT ON COLUMN public.email_outbox.payload IS 'Render inputs (report_data, clinic_branding), so a resumed email can be rendered again';
@@ -0,0 +1,74 @@
+-- Atomic, idempotent ingestion of SendGrid webhook events
+-- Used by POST /email-webhook via supabase.rpc('ingest_email_events', ...)
+
+-- Every processed SendGrid event, keyed by sg_event_id so retried
+-- deliveries of the same batch are ignored
+CREATE TABLE IF NOT EXISTS email_webhook_events (
+    sg_event_id TEXT PRIMARY KEY,
+    report_id UUID NOT NULL,
+    event TEXT NOT NULL,
+    occurred_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_webhook_events_report_id
+ON email_webhook_events(report_id);
+
+-- Only the service role touches this table
+ALTER TABLE email_webhook_events ENABLE ROW LEVEL SECURITY;
+
+ALTER TABLE email_tracking
+ADD COLUMN IF NOT EXISTS click_count INTEGER DEFAULT 0;
+
+-- Record a batch of events and apply per-report aggregates in one statement.
+-- Events already in email_webhook_events are skipped, so counts never double.
+-- `events` is a JSON array of {sg_event_id, report_id, event, timestamp}.
+CREATE OR REPLACE FUNCTION ingest_email_events(events JSONB)
+RETURNS JSONB
+LANGUAGE sql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+    WITH new_events AS (
+        INSERT INTO email_webhook_events (sg_event_id, report_id, event, occurred_at)
+        SELECT
+            e->>'sg_event_id',
+            (e->>'report_id')::uuid,
+            e->>'event',
+            to_timestamp((e->>'timestamp')::double precision)
+        FROM jsonb_array_elements(events) AS e
+        ON CONFLICT (sg_event_id) DO NOTHING
+        RETURNING report_id, event, occurred_at
+    ),
+    aggregates AS (
+        SELECT
+            report_id,
+            MAX(occurred_at) FILTER (WHERE event = 'delivered') AS delivered_at,
+            MIN(occurred_at) FILTER (WHERE event = 'open') AS first_opened_at,
+            MAX(occurred_at) FILTER (WHERE event = 'open') AS last_opened_at,
+            COUNT(*) FILTER (WHERE event = 'open') AS open_count,
+            MAX(occurred_at) FILTER (WHERE event = 'click') AS clicked_at,
+            COUNT(*) FILTER (WHERE event = 'click') AS click_count
+        FROM new_events
+        GROUP BY report_id
+    ),
+    updated AS (
+        UPDATE email_tracking t SET
+            delivered_at = COALESCE(a.delivered_at, t.delivered_at),
+            first_opened_at = LEAST(t.first_opened_at, a.first_opened_at),
+            last_opened_at = GREATEST(t.last_opened_at, a.last_opened_at),
+            open_count = COALESCE(t.open_count, 0) + a.open_count,
+            clicked_at = GREATEST(t.clicked_at, a.clicked_at),
+            click_count = COALESCE(t.click_count, 0) + a.click_count
+        FROM aggregates a
+        WHERE t.report_id = a.report_id
+        RETURNING t.report_id
+    )
+    SELECT jsonb_build_object(
+        'new_events', (SELECT COUNT(*) FROM new_events),
+        'reports_updated', (SELECT COUNT(*) FROM updated)
+    );
+$$;
+
+REVOKE ALL ON FUNCTION ingest_email_events(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION ingest_email_events(JSONB) TO service_role;
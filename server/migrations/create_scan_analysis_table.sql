@@ -0,0 +1,58 @@
+-- Migration: Create scan_analysis table for sharing analysis stages between endpoints
+-- Purpose: /analyze-xray-immediate, /analyze-xray, /tooth-mapping and /image/overlay
+--          run each stage (Roboflow detection, segmentation, findings summary,
+--          tooth mapping) once per scan and reuse the stored output afterwards
+-- Date: 2026-10-19
+
+CREATE TABLE IF NOT EXISTS public.scan_analysis (
+    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+    user_id UUID NOT NULL,
+    image_hash TEXT NOT NULL,
+    image_url TEXT,
+    predictions JSONB,
+    annotated_image_url TEXT,
+    findings_summary JSONB,
+    segmentation JSONB,
+    tooth_mappings JSONB NOT NULL DEFAULT '{}'::jsonb,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    CONSTRAINT scan_analysis_user_id_fkey FOREIGN KEY (user_id) REFERENCES auth.users(id) ON DELETE CASCADE
+);
+
+-- One record per scan per clinic; stage outputs are upserted onto it
+CREATE UNIQUE INDEX IF NOT EXISTS idx_scan_analysis_user_image_hash
+ON public.scan_analysis(user_id, image_hash);
+
+-- Overlay and tooth-mapping requests usually reference the annotated image
+CREATE INDEX IF NOT EXISTS idx_scan_analysis_user_annotated_url
+ON public.scan_analysis(user_id, annotated_image_url);
+
+ALTER TABLE public.scan_analysis ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can view their own scan analysis"
+ON public.scan_analysis
+FOR SELECT
+USING (auth.uid() = user_id);
+
+CREATE POLICY "Users can insert their own scan analysis"
+ON public.scan_analysis
+FOR INSERT
+WITH CHECK (auth.uid() = user_id);
+
+CREATE POLICY "Users can update their own scan analysis"
+ON public.scan_analysis
+FOR UPDATE
+USING (auth.uid() = user_id);
+
+CREATE POLICY "Users can delete their own scan analysis"
+ON public.scan_analysis
+FOR DELETE
+USING (auth.uid() = user_id);
+
+COMMENT ON TABLE public.scan_analysis IS 'Per-scan analysis stage outputs, keyed by image content hash';
+COMMENT ON COLUMN public.scan_analysis.image_hash IS 'SHA-256 of the uploaded image (or of its URL and ETag/Last-Modified when the content hash is unknown)';
+COMMENT ON COLUMN public.scan_analysis.predictions IS 'Raw Roboflow condition detection response';
+COMMENT ON COLUMN public.scan_analysis.annotated_image_url IS 'Annotated image uploaded after detection';
+COMMENT ON COLUMN public.scan_analysis.findings_summary IS 'GPT findings summary generated from the predictions';
+COMMENT ON COLUMN public.scan_analysis.segmentation IS 'Roboflow teeth segmentation response';
+COMMENT ON COLUMN public.scan_analysis.tooth_mappings IS 'Tooth mapping results keyed by numbering system and detections hash';
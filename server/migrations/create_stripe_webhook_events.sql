@@ -0,0 +1,34 @@
+-- Migration: Create stripe_webhook_events table for queued, idempotent Stripe webhooks
+-- Purpose: POST /stripe/webhook records each verified event here and returns 200
+--          straight away; a worker applies it once (registration, subscription
+--          state) and retried deliveries of the same event id are ignored
+-- Date: 2026-10-19
+
+CREATE TABLE IF NOT EXISTS public.stripe_webhook_events (
+    event_id TEXT PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    customer_key TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'processed', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    stripe_created_at TIMESTAMP WITH TIME ZONE,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Unfinished events are resumed on startup, oldest first
+CREATE INDEX IF NOT EXISTS idx_stripe_webhook_events_unfinished
+ON public.stripe_webhook_events(received_at)
+WHERE status <> 'processed';
+
+CREATE INDEX IF NOT EXISTS idx_stripe_webhook_events_customer_key
+ON public.stripe_webhook_events(customer_key, received_at);
+
+-- Only the service role touches this table
+ALTER TABLE public.stripe_webhook_events ENABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE public.stripe_webhook_events IS 'Verified Stripe webhook events and their processing state, keyed by Stripe event id';
+COMMENT ON COLUMN public.stripe_webhook_events.customer_key IS 'Stripe customer (or registering email) - events with the same key are applied in order';
+COMMENT ON COLUMN public.stripe_webhook_events.payload IS 'Full Stripe event, replayable with stripe_webhook_replay.py --from-db; metadata.registration_data is redacted once processed';
@@ -16,6 +16,8 @@ class AnalyzeXrayRequest(BaseModel):
     # Optional pre-existing analysis data (for AWS images)
     pre_analyzed_detections: Optional[List[dict]] = None
     pre_analyzed_annotated_url: Optional[str] = None
+    # Upload content hash (from /upload-image); identifies the scan's shared analysis record
+    content_hash: Optional[str] = None
 
 class TreatmentItem(BaseModel):
     tooth: str
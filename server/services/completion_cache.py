@@ -0,0 +1,261 @@
+"""
+Completion Cache
+Content-hash cache for GPT chat completions shared by every prompt site
+
+Completions are keyed by (model, normalised messages, remaining params) and
+kept in an in-memory LRU backed by an optional SQLite file, both with a TTL.
+Call sites opt in per call (`cache=True`); truncated or filtered completions
+are never stored, and neither are ones the call site's `validate` rejects.
+Prompts carrying patient details pass `persist=False` so their completions
+stay in memory and never reach the SQLite file.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services.registry import lazy_service, registry
+from utils.metrics import record_cache_lookup
+
+logger = logging.getLogger(__name__)
+
+# Completions cut off or withheld by the API; caching them would pin the bad answer
+UNCACHEABLE_FINISH_REASONS = {'length', 'content_filter'}
+
+
+def _normalise_content(content: Any) -> Any:
+    if isinstance(content, str):
+        return '\n'.join(line.rstrip() for line in content.strip().splitlines())
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, dict) and part.get('type') == 'image_url':
+                url = (part.get('image_url') or {}).get('url', '')
+                if url.startswith('data:'):
+                    # Inline images are hashed so the canonical form stays small
+                    url = 'sha256:' + hashlib.sha256(url.encode()).hexdigest()
+                parts.append({'type': 'image_url', 'url': url})
+            elif isinstance(part, dict) and part.get('type') == 'text':
+                parts.append({'type': 'text', 'text': _normalise_content(part.get('text', ''))})
+            else:
+                parts.append(part)
+        return parts
+    return content
+
+
+def completion_key(model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+    """Canonical hash of a chat completion request"""
+    canonical = json.dumps(
+        {
+            "model": model,
+            "messages": [
+                {"role": m.get("role"), "content": _normalise_content(m.get("content"))}
+                for m in messages
+            ],
+            "params": params,
+        },
+        sort_keys=True,
+        separators=(',', ':'),
+        default=str
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self):
+        self.enabled = os.getenv('COMPLETION_CACHE_ENABLED', 'true').lower() == 'true'
+        self.memory_size = int(os.getenv('COMPLETION_CACHE_SIZE', '512'))
+        self.ttl_seconds = int(os.getenv('COMPLETION_CACHE_TTL_S', str(7 * 24 * 3600)))
+        # Empty path keeps the cache in memory only
+        self.db_path = os.getenv('COMPLETION_CACHE_DB', '/tmp/scanwise_completions.sqlite3')
+        self.db_max_rows = int(os.getenv('COMPLETION_CACHE_DB_MAX_ROWS', '20000'))
+
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # key -> (created_at, content)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._writes_since_prune = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled and self.db_path:
+            self._open_db()
+
+        logger.info(
+            f"Completion cache initialized (enabled: {self.enabled}, memory: {self.memory_size}, "
+            f"db: {self.db_path or 'none'}, ttl: {self.ttl_seconds}s)"
+        )
+
+    # ---------------- SQLite tier ----------------
+
+    def _open_db(self) -> None:
+        try:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, model TEXT, content TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)")
+        except sqlite3.Error as e:
+            logger.error(f"❌ Completion cache database unavailable, using memory only: {str(e)}")
+            self._db = None
+
+    def _db_get(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        if self._db is None:
+            return None
+        try:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT created_at, content FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if now - row[0] > self.ttl_seconds:
+                    self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                    return None
+                self._db.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Completion cache read failed: {str(e)}")
+            return None
+
+    def _db_put(self, key: str, model: str, content: str, now: float) -> None:
+        if self._db is None:
+            return
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions (key, model, content, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, model, content, now, now)
+                )
+                self._writes_since_prune += 1
+                if self._writes_since_prune >= 100:
+                    self._writes_since_prune = 0
+                    self._prune(now)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Completion cache write failed: {str(e)}")
+
+    def _prune(self, now: float) -> None:
+        """Drop expired rows, then the least recently used beyond the row limit (caller holds _db_lock)"""
+        self._db.execute("DELETE FROM completions WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._db.execute(
+            "DELETE FROM completions WHERE key IN ("
+            "SELECT key FROM completions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.db_max_rows,)
+        )
+
+    # ---------------- Lookup ----------------
+
+    def get(self, key: str) -> Tuple[Optional[str], str]:
+        """Cached content and where it came from ("memory", "disk" or "miss")"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], "memory"
+                del self._memory[key]
+
+        entry = self._db_get(key, now)
+        if entry is not None:
+            self._memory_put(key, entry)
+            with self._lock:
+                self.hits += 1
+            return entry[1], "disk"
+
+        with self._lock:
+            self.misses += 1
+        return None, "miss"
+
+    def _memory_put(self, key: str, entry: Tuple[float, str]) -> None:
+        if self.memory_size <= 0:
+            return
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def put(self, key: str, model: str, content: str, persist: bool = True) -> None:
+        now = time.time()
+        self._memory_put(key, (now, content))
+        if persist:
+            self._db_put(key, model, content, now)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "enabled": self.enabled,
+                "memory_size": len(self._memory),
+                "memory_max_size": self.memory_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+        if self._db is not None:
+            with self._db_lock:
+                stats["db_rows"] = self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        return stats
+
+    # ---------------- Completions ----------------
+
+    def complete(self, client, site: str, cache: bool = False, persist: bool = True,
+                 validate: Optional[Callable[[str], bool]] = None, **params) -> str:
+        """
+        `client.chat.completions.create(**params)` returning the message text
+
+        With `cache=True` an identical earlier request is answered from the
+        cache. `site` labels the hit/miss metrics (e.g. "findings_summary").
+        A new completion is only stored if `validate` (when given) accepts it,
+        and only in memory with `persist=False`.
+        """
+        model = params.get('model', '')
+        if not (cache and self.enabled) or params.get('stream'):
+            response = client.chat.completions.create(**params)
+            return response.choices[0].message.content
+
+        messages = params.get('messages', [])
+        rest = {k: v for k, v in params.items() if k not in ('model', 'messages')}
+        key = completion_key(model, messages, rest)
+
+        content, source = self.get(key)
+        record_cache_lookup(site, model, source)
+        if content is not None:
+            logger.info(f"✅ Completion cache hit ({site}, {source})")
+            return content
+
+        response = client.chat.completions.create(**params)
+        choice = response.choices[0]
+        content = choice.message.content
+        if (content and getattr(choice, 'finish_reason', None) not in UNCACHEABLE_FINISH_REASONS
+                and (validate is None or validate(content))):
+            self.put(key, model, content, persist=persist)
+        return content
+
+
+def cached_completion(client, site: str, cache: bool = False, persist: bool = True,
+                      validate: Optional[Callable[[str], bool]] = None, **params) -> str:
+    """`CompletionCache.complete` via the shared cache, calling the API directly if it failed to start"""
+    completion_cache_service = get_completion_cache()
+    if completion_cache_service is None:
+        response = client.chat.completions.create(**params)
+        return response.choices[0].message.content
+    return completion_cache_service.complete(client, site, cache=cache, persist=persist, validate=validate, **params)
+
+
+# Initialize service lazily on first use to keep imports cheap
+completion_cache = lazy_service("completion_cache", CompletionCache)
+
+
+def get_completion_cache():
+    return registry.get("completion_cache")
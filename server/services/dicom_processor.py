@@ -352,53 +352,7 @@ class DICOMProcessor:
                 temp_file_path = temp_file.name
             
             try:
-                # Read DICOM file
-                ds = pydicom.dcmread(temp_file_path)
-                
-                # Extract metadata
-                metadata = self._extract_metadata(ds)
-                
-                # Get pixel array
-                if not hasattr(ds, 'pixel_array'):
-                    logger.error("DICOM file has no pixel data")
-                    return None
-                
-                pixel_array = ds.pixel_array
-                
-                # Normalize pixel values to 0-255 range
-                pixel_array = pixel_array.astype(np.float32)
-                
-                # Handle photometric interpretation
-                if hasattr(ds, 'PhotometricInterpretation') and ds.PhotometricInterpretation == 'MONOCHROME1':
-                    pixel_array = np.max(pixel_array) - pixel_array
-                
-                # Normalize to 0-255
-                pixel_min = np.min(pixel_array)
-                pixel_max = np.max(pixel_array)
-                
-                if pixel_max > pixel_min:
-                    pixel_array = ((pixel_array - pixel_min) / (pixel_max - pixel_min)) * 255.0
-                else:
-                    pixel_array = np.zeros_like(pixel_array)
-                
-                pixel_array = pixel_array.astype(np.uint8)
-                
-                # Convert to PIL Image
-                if len(pixel_array.shape) == 2:
-                    image = Image.fromarray(pixel_array, mode='L').convert('RGB')
-                elif len(pixel_array.shape) == 3:
-                    image = Image.fromarray(pixel_array, mode='RGB')
-                else:
-                    logger.error(f"Unsupported pixel array shape: {pixel_array.shape}")
-                    return None
-                
-                # Convert to JPEG bytes
-                buffer = BytesIO()
-                image.save(buffer, format='JPEG', quality=95)
-                image_bytes = buffer.getvalue()
-                
-                return (image_bytes, metadata)
-                
+                return self.convert_dicom_file_to_image(temp_file_path)
             finally:
                 # Clean up temporary file
                 os.unlink(temp_file_path)
@@ -406,6 +360,68 @@ class DICOMProcessor:
         except Exception as e:
             self.logger.error(f"Error converting DICOM bytes to image: {str(e)}")
             return None
+    
+    def convert_dicom_file_to_image(self, dicom_path: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        """
+        Convert a DICOM file on disk (e.g. a spooled upload) to JPEG image format
+        
+        Args:
+            dicom_path: Path to the DICOM file
+            
+        Returns:
+            Tuple of (image_bytes, metadata) or None if conversion failed
+        """
+        try:
+            # Read DICOM file
+            ds = pydicom.dcmread(dicom_path)
+            
+            # Extract metadata
+            metadata = self._extract_metadata(ds)
+            
+            # Get pixel array
+            if not hasattr(ds, 'pixel_array'):
+                logger.error("DICOM file has no pixel data")
+                return None
+            
+            pixel_array = ds.pixel_array
+            
+            # Normalize pixel values to 0-255 range
+            pixel_array = pixel_array.astype(np.float32)
+            
+            # Handle photometric interpretation
+            if hasattr(ds, 'PhotometricInterpretation') and ds.PhotometricInterpretation == 'MONOCHROME1':
+                pixel_array = np.max(pixel_array) - pixel_array
+            
+            # Normalize to 0-255
+            pixel_min = np.min(pixel_array)
+            pixel_max = np.max(pixel_array)
+            
+            if pixel_max > pixel_min:
+                pixel_array = ((pixel_array - pixel_min) / (pixel_max - pixel_min)) * 255.0
+            else:
+                pixel_array = np.zeros_like(pixel_array)
+            
+            pixel_array = pixel_array.astype(np.uint8)
+            
+            # Convert to PIL Image
+            if len(pixel_array.shape) == 2:
+                image = Image.fromarray(pixel_array, mode='L').convert('RGB')
+            elif len(pixel_array.shape) == 3:
+                image = Image.fromarray(pixel_array, mode='RGB')
+            else:
+                logger.error(f"Unsupported pixel array shape: {pixel_array.shape}")
+                return None
+            
+            # Convert to JPEG bytes
+            buffer = BytesIO()
+            image.save(buffer, format='JPEG', quality=95)
+            image_bytes = buffer.getvalue()
+            
+            return (image_bytes, metadata)
+                
+        except Exception as e:
+            self.logger.error(f"Error converting DICOM file to image: {str(e)}")
+            return None
 
 # Create global instance
 dicom_processor = DICOMProcessor()
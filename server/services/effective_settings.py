@@ -0,0 +1,337 @@
+"""
+Effective Settings
+Per-clinic merged treatment price/duration table for GET /treatment-settings
+
+Three layers, later ones winning: the hardcoded defaults below, the
+`dental_treatments` master table, and the clinic's own customisations. The
+first two are the same for every clinic, so they are merged once and kept in
+memory (the master table is re-read after EFFECTIVE_SETTINGS_MASTER_TTL_S).
+Each clinic's merged table is cached against the `updated_at` of its
+customisations row, with an ETag over the response so an unchanged table
+costs the client a 304. Writes invalidate the clinic's entry explicitly too.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from services.registry import lazy_service, registry
+
+logger = logging.getLogger(__name__)
+
+# Hardcoded defaults as fallback (matching dental-data.ts exactly)
+# This ensures prices/durations work even if database is empty
+HARDCODED_DEFAULTS = {
+    # Legacy codes (for backwards compatibility)
+    'filling': {'duration': 30, 'price': 220},
+    'extraction': {'duration': 30, 'price': 250},
+    'root-canal-treatment': {'duration': 90, 'price': 1100},
+    'crown': {'duration': 60, 'price': 1800},
+    'bridge': {'duration': 120, 'price': 850},
+    'implant-placement': {'duration': 90, 'price': 2300},
+    'partial-denture': {'duration': 60, 'price': 1600},
+    'scale-and-clean': {'duration': 30, 'price': 190},
+    'periodontal-treatment': {'duration': 60, 'price': 280},
+    'veneer': {'duration': 60, 'price': 1500},
+    'fluoride-treatment': {'duration': 15, 'price': 40},
+    'composite-build-up': {'duration': 45, 'price': 200},
+    'surgical-extraction': {'duration': 45, 'price': 450},
+    'deep-cleaning': {'duration': 60, 'price': 280},
+    'complete-denture': {'duration': 90, 'price': 2500},
+    'inlay': {'duration': 60, 'price': 1400},
+    'onlay': {'duration': 60, 'price': 1400},
+    'whitening': {'duration': 60, 'price': 750},
+    'bonding': {'duration': 30, 'price': 150},
+    'sealant': {'duration': 15, 'price': 70},
+    'night-guard': {'duration': 30, 'price': 600},
+    'orthodontic-treatment': {'duration': 60, 'price': 4000},
+    'braces': {'duration': 60, 'price': 3500},
+    'invisalign': {'duration': 60, 'price': 4500},
+    'retainer': {'duration': 30, 'price': 200},
+    'space-maintainer': {'duration': 30, 'price': 180},
+    'apicoectomy': {'duration': 90, 'price': 950},
+    'bone-graft': {'duration': 90, 'price': 800},
+    'sinus-lift': {'duration': 120, 'price': 1200},
+    'gum-graft': {'duration': 90, 'price': 750},
+    
+    # NEW: Current dental codes (matching dental-data.ts)
+    # Examinations
+    'exam_emergency': {'duration': 20, 'price': 100},
+    'exam_comprehensive': {'duration': 40, 'price': 120},
+    'radiograph_intraoral': {'duration': 10, 'price': 45},
+    'radiograph_opg': {'duration': 15, 'price': 100},
+    
+    # Preventive
+    'scale_clean_polish': {'duration': 30, 'price': 190},
+    'fluoride_application': {'duration': 15, 'price': 40},
+    'fissure_sealant': {'duration': 15, 'price': 70},
+    'desensitising': {'duration': 15, 'price': 55},
+    'oh_instructions': {'duration': 15, 'price': 40},
+    'whitening_inchair': {'duration': 90, 'price': 750},
+    'whitening_takehome': {'duration': 20, 'price': 450},
+    
+    # Restorative - Composite
+    'resto_comp_one_surface_ant': {'duration': 30, 'price': 220},
+    'resto_comp_two_surface_ant': {'duration': 40, 'price': 280},
+    'resto_comp_three_plus_ant': {'duration': 50, 'price': 340},
+    'resto_comp_one_surface_post': {'duration': 35, 'price': 260},
+    'resto_comp_two_surface_post': {'duration': 45, 'price': 320},
+    'resto_comp_three_plus_post': {'duration': 55, 'price': 380},
+    'resto_glassionomer': {'duration': 25, 'price': 160},
+    'resto_amalgam_post': {'duration': 35, 'price': 290},
+    
+    # Crowns and indirect restorations
+    'crown_temp': {'duration': 30, 'price': 180},
+    'crown_full_tooth_coloured': {'duration': 60, 'price': 1800},
+    'crown_full_metal': {'duration': 60, 'price': 1650},
+    'onlay_inlay_indirect_tc': {'duration': 60, 'price': 1400},
+    'veneer_indirect': {'duration': 60, 'price': 1500},
+    'veneer_direct': {'duration': 45, 'price': 650},
+    
+    # Endodontic
+    'endo_direct_pulp_cap': {'duration': 30, 'price': 120},
+    'endo_indirect_pulp_cap': {'duration': 25, 'price': 120},
+    'endo_pulpotomy': {'duration': 35, 'price': 220},
+    'endo_extirpation': {'duration': 40, 'price': 180},
+    'endo_rct_single': {'duration': 90, 'price': 1100},
+    'endo_rct_multi': {'duration': 120, 'price': 1600},
+    'endo_retx': {'duration': 150, 'price': 1900},
+    'endo_apicectomy': {'duration': 90, 'price': 950},
+    'endo_rct_1_canal': {'duration': 90, 'price': 1100},
+    'endo_rct_2_canals': {'duration': 105, 'price': 1350},
+    'endo_rct_3_canals': {'duration': 120, 'price': 1650},
+    'endo_rct_4_canals': {'duration': 135, 'price': 1850},
+    'endo_retx_load': {'duration': 30, 'price': 300},
+    'endo_calcified_per_canal': {'duration': 20, 'price': 150},
+    'endo_remove_post': {'duration': 25, 'price': 180},
+    'endo_remove_root_filling_per_canal': {'duration': 15, 'price': 120},
+    'endo_additional_irrigation_visit': {'duration': 20, 'price': 120},
+    'endo_interim_therapeutic_fill': {'duration': 25, 'price': 180},
+    'endo_apicectomy_per_root': {'duration': 90, 'price': 950},
+    'endo_extirpation_emergency': {'duration': 40, 'price': 180},
+    
+    # Periodontal
+    'perio_scale_root_planing': {'duration': 60, 'price': 280},
+    'perio_curettage': {'duration': 60, 'price': 280},
+    'perio_flap_surgery': {'duration': 90, 'price': 950},
+    'perio_graft': {'duration': 90, 'price': 750},
+    'perio_crown_lengthening': {'duration': 90, 'price': 950},
+    'perio_guided_tissue_regen': {'duration': 120, 'price': 1100},
+    'perio_bone_graft': {'duration': 90, 'price': 950},
+    
+    # Surgical
+    'surg_simple_extraction': {'duration': 30, 'price': 250},
+    'surg_surgical_extraction': {'duration': 45, 'price': 450},
+    'surg_incision_drainage': {'duration': 30, 'price': 200},
+    'surg_replantation': {'duration': 60, 'price': 500},
+    'surg_frenectomy': {'duration': 45, 'price': 400},
+    'surg_biopsy': {'duration': 40, 'price': 350},
+    'surg_exposure_unerupted': {'duration': 60, 'price': 400},
+    'surg_alveoloplasty': {'duration': 60, 'price': 500},
+    'surg_tori_removal': {'duration': 90, 'price': 850},
+    'surg_minor_soft_tissue': {'duration': 45, 'price': 400},
+    'surg_apical_cystectomy': {'duration': 120, 'price': 1200},
+    
+    # Prosthodontic
+    'prost_partial_denture_resin': {'duration': 60, 'price': 1600},
+    'prost_partial_denture_cast': {'duration': 75, 'price': 2200},
+    'prost_full_denture_resin': {'duration': 90, 'price': 2500},
+    'prost_denture_reline': {'duration': 45, 'price': 550},
+    'prost_denture_repair': {'duration': 30, 'price': 300},
+    'prost_partial_denture_resin_1to3': {'duration': 55, 'price': 1450},
+    'prost_partial_denture_resin_4plus': {'duration': 65, 'price': 1700},
+    'prost_partial_denture_cast_1to3': {'duration': 70, 'price': 2100},
+    'prost_partial_denture_cast_4plus': {'duration': 80, 'price': 2400},
+    'prost_immediate_denture_partial': {'duration': 70, 'price': 1850},
+    'prost_immediate_denture_full': {'duration': 95, 'price': 2700},
+    'prost_full_denture_upper': {'duration': 90, 'price': 2500},
+    'prost_full_denture_lower': {'duration': 90, 'price': 2600},
+    'prost_add_to_denture': {'duration': 30, 'price': 300},
+    'prost_soft_reline': {'duration': 40, 'price': 380},
+    'prost_hard_reline_lab': {'duration': 50, 'price': 550},
+    'prost_denture_repair_fracture': {'duration': 30, 'price': 300},
+    'prost_denture_adjustment': {'duration': 20, 'price': 120},
+    'prost_resilient_lining': {'duration': 45, 'price': 400},
+    'prost_overdenture': {'duration': 120, 'price': 2800},
+    
+    # Posts and Bridges
+    'post_core_direct': {'duration': 40, 'price': 420},
+    'post_core_indirect': {'duration': 60, 'price': 650},
+    'bridge_temp': {'duration': 35, 'price': 220},
+    'bridge_pontic_indirect_tc': {'duration': 60, 'price': 1600},
+    'bridge_abutment_crown_tc': {'duration': 65, 'price': 1700},
+    'bridge_recement': {'duration': 25, 'price': 220},
+    'crown_recement': {'duration': 20, 'price': 180},
+    
+    # Implant Restorative
+    'crown_implant_supported_tc': {'duration': 70, 'price': 1950},
+    'abutment_custom': {'duration': 40, 'price': 420},
+    
+    # Functional
+    'splint_occlusal': {'duration': 30, 'price': 600},
+    'tmj_adjustment': {'duration': 30, 'price': 250},
+    
+    # Palliative/Sedation
+    'palliative_care': {'duration': 25, 'price': 120},
+    'postop_review_simple': {'duration': 15, 'price': 60},
+    'medication_prescription': {'duration': 10, 'price': 30},
+    'nitrous_sedation': {'duration': 30, 'price': 180},
+    'iv_sedation_inhouse': {'duration': 60, 'price': 800},
+    'mouthguard_custom': {'duration': 30, 'price': 220},
+    
+    # Trauma
+    'trauma_splinting': {'duration': 45, 'price': 350},
+    'trauma_pulpotomy_temp': {'duration': 30, 'price': 200},
+    
+    # Orthodontic
+    'ortho_removable_appliance': {'duration': 45, 'price': 750},
+    'ortho_clear_aligner_simple': {'duration': 60, 'price': 2500},
+    'ortho_retainer': {'duration': 30, 'price': 400},
+}
+
+
+@dataclass
+class EffectiveSettings:
+    treatment_data: Dict[str, Dict[str, Any]]
+    has_customizations: bool
+    last_updated: Optional[str]
+    etag: str
+
+    def to_response(self) -> Dict[str, Any]:
+        return {
+            "status": "success",
+            "treatment_data": self.treatment_data,
+            "has_customizations": self.has_customizations,
+            "last_updated": self.last_updated
+        }
+
+
+def settings_etag(treatment_data: Dict[str, Any], last_updated: Optional[str]) -> str:
+    """Strong ETag over the merged table, independent of dict ordering"""
+    canonical = json.dumps(
+        {"treatment_data": treatment_data, "last_updated": last_updated},
+        sort_keys=True,
+        separators=(',', ':'),
+        default=str
+    )
+    return '"' + hashlib.sha256(canonical.encode()).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header covers this ETag (weak comparison, as for GET)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class EffectiveSettingsService:
+    def __init__(self, fetch_master: Callable[[], Awaitable[List[Dict]]],
+                 fetch_custom: Callable[[str], Awaitable[Optional[Dict]]]):
+        self.fetch_master = fetch_master
+        self.fetch_custom = fetch_custom  # token -> clinic customisations row
+        self.master_ttl_seconds = int(os.getenv('EFFECTIVE_SETTINGS_MASTER_TTL_S', '600'))
+        self.max_clinics = int(os.getenv('EFFECTIVE_SETTINGS_MAX_CLINICS', '1000'))
+
+        self._base: Optional[Dict[str, Dict[str, Any]]] = None  # hardcoded defaults + master table
+        self._base_loaded_at = 0.0
+        self._base_version = 0
+        # user_id -> (customisations updated_at, base version, merged settings)
+        self._clinics: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        logger.info(f"Effective settings service initialized (master ttl: {self.master_ttl_seconds}s)")
+
+    async def _get_base(self) -> tuple:
+        """Defaults merged with the master table, reloaded after the TTL"""
+        with self._lock:
+            if self._base is not None and time.time() - self._base_loaded_at < self.master_ttl_seconds:
+                return self._base, self._base_version
+
+        master_treatments = await self.fetch_master()
+        base = dict(HARDCODED_DEFAULTS)
+        for treatment in master_treatments:
+            base[treatment['code']] = {
+                'duration': treatment['default_duration'],
+                'price': treatment['default_price']
+            }
+
+        with self._lock:
+            if base != self._base:
+                self._base_version += 1
+            self._base = base
+            self._base_loaded_at = time.time()
+            logger.info(f"✅ Master treatment layer loaded ({len(base)} treatments)")
+            return self._base, self._base_version
+
+    async def get(self, user_id: str, token: str) -> EffectiveSettings:
+        """The clinic's merged table, rebuilt only when its customisations or the master layer change"""
+        custom_settings = await self.fetch_custom(token)
+        updated_at = custom_settings.get('updated_at') if custom_settings else None
+        base, base_version = await self._get_base()
+
+        with self._lock:
+            cached = self._clinics.get(user_id)
+            if cached is not None and cached[0] == updated_at and cached[1] == base_version:
+                self._clinics.move_to_end(user_id)
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+
+        custom_data = (custom_settings or {}).get('treatment_settings') or {}
+        treatment_data = {**base, **custom_data}
+        settings = EffectiveSettings(
+            treatment_data=treatment_data,
+            has_customizations=bool(custom_data),
+            last_updated=updated_at,
+            etag=settings_etag(treatment_data, updated_at)
+        )
+
+        with self._lock:
+            self._clinics[user_id] = (updated_at, base_version, settings)
+            self._clinics.move_to_end(user_id)
+            while len(self._clinics) > self.max_clinics:
+                self._clinics.popitem(last=False)
+        return settings
+
+    def invalidate(self, user_id: str) -> None:
+        """Drop a clinic's merged table after its settings were written"""
+        with self._lock:
+            self._clinics.pop(user_id, None)
+
+    def invalidate_master(self) -> None:
+        """Force the master layer to be re-read on the next request"""
+        with self._lock:
+            self._base_loaded_at = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "clinics_cached": len(self._clinics),
+                "master_treatments": len(self._base or {}),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _create_effective_settings_service() -> EffectiveSettingsService:
+    from services.supabase import supabase_service
+    return EffectiveSettingsService(supabase_service.get_dental_treatments, supabase_service.get_treatment_settings)
+
+
+# Initialize service lazily on first use to keep imports cheap
+effective_settings = lazy_service("effective_settings", _create_effective_settings_service)
+
+
+def get_effective_settings():
+    return registry.get("effective_settings")
@@ -3,6 +3,8 @@ import logging
 import requests
 from typing import Optional
 from dotenv import load_dotenv
+from services.registry import lazy_service, registry
+from utils.metrics import timed_stage
 
 load_dotenv()
 
@@ -15,11 +17,13 @@ class ElevenLabsService:
         self.default_voice_id = os.getenv("ELEVENLABS_VOICE_ID", "EkK5I93UQWFDigLMpZcX")
         # Bulgarian voice
         self.bulgarian_voice_id = "13Cuh3NuYvWOVQtLbRN8"
+        self.api_url = os.getenv("ELEVENLABS_API_URL", "https://api.elevenlabs.io").rstrip("/")
         
         # Check if API key is configured
         if not self.api_key:
             logger.warning("ELEVENLABS_API_KEY not configured. Video generation will use text-to-speech fallback.")
         
+    @timed_stage("elevenlabs_tts")
     async def generate_voice(self, text: str, language: str = "english") -> Optional[bytes]:
         """Generate voice audio from text using ElevenLabs or fallback to silent audio"""
         try:
@@ -30,7 +34,7 @@ class ElevenLabsService:
             
             # Select voice ID based on language
             voice_id = self.bulgarian_voice_id if language.lower() == "bulgarian" else self.default_voice_id
-            api_url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+            api_url = f"{self.api_url}/v1/text-to-speech/{voice_id}"
             
             logger.info(f"🎙️ Language requested: '{language}'")
             logger.info(f"🎙️ Voice ID selected: {voice_id} ({'Bulgarian' if language.lower() == 'bulgarian' else 'English'})")
@@ -107,5 +111,8 @@ class ElevenLabsService:
             # Return minimal WAV file
             return b'RIFF$\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00D\xac\x00\x00\x88X\x01\x00\x02\x00\x10\x00data\x00\x00\x00\x00'
 
-# Create singleton instance
-elevenlabs_service = ElevenLabsService()
\ No newline at end of file
+# Initialize service lazily on first use to keep imports cheap
+elevenlabs_service = lazy_service("elevenlabs", ElevenLabsService)
+
+def get_elevenlabs_service():
+    return registry.get("elevenlabs")
@@ -0,0 +1,308 @@
+"""
+Email Delivery Queue
+Durable, rate-limited delivery of report emails
+
+POST /send-report-email/batch records one row per recipient in `email_outbox`
+(migrations/create_email_outbox.sql) and hands the jobs to workers in this
+process, which:
+
+- render report PDFs concurrently through HtmlPdfService's shared Chromium
+  (at most PDF_RENDER_CONCURRENCY pages at once)
+- send over EmailService's transports: pooled, logged-in SMTP sessions or one
+  shared SendGrid client, at most EMAIL_SEND_CONCURRENCY sends in flight
+- hold each clinic to EMAIL_CLINIC_RATE_PER_MINUTE sends (bursts of up to
+  EMAIL_CLINIC_BURST), so one clinic's end-of-day batch can't exhaust the
+  sender's quota for everyone else
+- retry failed sends with exponential backoff up to EMAIL_DELIVERY_MAX_ATTEMPTS,
+  then stamp email_sent_at and create the email_tracking record like
+  /send-report-email does
+
+A job stays `pending` while it waits for the clinic's rate limit and then
+renders its PDF (in that order, so a queued batch doesn't hold every PDF at
+once), and is claimed as `sending` (a compare-and-set on its status and
+attempts) only immediately before the send. Jobs a restart left pending (or
+failed with attempts left) are resumed on startup, and an instance can't claim
+a job another one has queued or is backing off on. A job caught in `sending`
+by a restart is not resumed, so a patient never gets the same report twice.
+Without the table, jobs are tracked in this process's memory only.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services.registry import lazy_service, registry
+
+logger = logging.getLogger(__name__)
+
+RESUMABLE_STATUSES = ['pending', 'failed']
+
+
+class ClinicRateLimiter:
+    """Token bucket: `rate_per_minute` sends with bursts of up to `burst`; waiters go in arrival order"""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class EmailDeliveryQueue:
+    def __init__(self):
+        self.max_attempts = int(os.getenv('EMAIL_DELIVERY_MAX_ATTEMPTS', '3'))
+        self.retry_base_s = float(os.getenv('EMAIL_DELIVERY_RETRY_BASE_S', '5'))
+        self.rate_per_minute = float(os.getenv('EMAIL_CLINIC_RATE_PER_MINUTE', '30'))
+        if self.rate_per_minute <= 0:
+            raise ValueError("EMAIL_CLINIC_RATE_PER_MINUTE must be greater than 0")
+        self.burst = int(os.getenv('EMAIL_CLINIC_BURST', '10'))
+        self.resume_window = timedelta(hours=float(os.getenv('EMAIL_OUTBOX_RESUME_HOURS', '24')))
+
+        self._send_slots = asyncio.Semaphore(int(os.getenv('EMAIL_SEND_CONCURRENCY', '4')))
+        self._limiters: Dict[str, ClinicRateLimiter] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.table_available = True
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+
+        logger.info(f"Email delivery queue initialized ({self.rate_per_minute:g}/min per clinic)")
+
+    # ---------------- Storage ----------------
+
+    def _table(self):
+        from services.supabase import supabase_service
+        return supabase_service.get_service_client().table('email_outbox')
+
+    def _db_call(self, operation: Callable[[], Any]) -> Any:
+        """Run a query; returns None when the table doesn't exist (memory-only), raises on other errors"""
+        if not self.table_available:
+            return None
+        try:
+            return operation()
+        except Exception as e:
+            if 'email_outbox' in str(e) and ('does not exist' in str(e) or 'schema cache' in str(e)):
+                logger.warning("⚠️ email_outbox table missing, queueing report emails in memory only")
+                self.table_available = False
+                return None
+            raise
+
+    async def _update(self, job_id: str, fields: Dict[str, Any], expected: Optional[Tuple[str, int]] = None) -> bool:
+        """
+        Update the job's row; True if it changed (or memory-only)
+
+        With `expected` (status, attempts) the update is a compare-and-set: it
+        only applies if the row is still exactly as this worker last saw it.
+        """
+        fields = {**fields, 'updated_at': datetime.utcnow().isoformat()}
+
+        def update():
+            query = self._table().update(fields).eq('id', job_id)
+            if expected:
+                query = query.eq('status', expected[0]).eq('attempts', expected[1])
+            return query.execute()
+
+        response = await asyncio.to_thread(self._db_call, update)
+        return response is None or bool(response.data)
+
+    # ---------------- Submission ----------------
+
+    async def submit(self, jobs: List[Dict[str, Any]]) -> List[asyncio.Task]:
+        """
+        Record report emails and start delivering them; returns one task per job, in order
+
+        Each job has clinic_id, report_id, patient_email, patient_name,
+        report_data and clinic_branding. A task resolves to the job's final
+        status line and keeps running if the caller stops waiting. Raises if
+        the jobs can't be recorded, so nothing is sent untracked.
+        """
+        rows = [{
+            'id': str(uuid.uuid4()),
+            'clinic_id': job['clinic_id'],
+            'report_id': job['report_id'],
+            'patient_email': job['patient_email'],
+            'patient_name': job['patient_name'],
+            'status': 'pending',
+            'attempts': 0,
+            'payload': {
+                'report_data': job['report_data'],
+                'clinic_branding': job['clinic_branding'],
+            },
+        } for job in jobs]
+        if rows:
+            # One insert for the whole batch
+            await asyncio.to_thread(self._db_call, lambda: self._table().insert(rows).execute())
+        self.queued += len(rows)
+        return [self._start(row) for row in rows]
+
+    def _start(self, row: Dict[str, Any]) -> asyncio.Task:
+        task = asyncio.create_task(self._deliver(row), name=f"email_delivery:{row['id']}")
+        self._tasks[row['id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(row['id'], None))
+        return task
+
+    async def resume_pending(self) -> int:
+        """Restart recent jobs left pending or failed (with attempts left) by a previous run"""
+        since = (datetime.utcnow() - self.resume_window).isoformat()
+        response = await asyncio.to_thread(self._db_call, lambda: self._table()
+                                           .select('*')
+                                           .in_('status', RESUMABLE_STATUSES)
+                                           .lt('attempts', self.max_attempts)
+                                           .gte('created_at', since)
+                                           .order('created_at')
+                                           .execute())
+        if response is None:
+            return 0
+
+        rows = [row for row in response.data or [] if row['id'] not in self._tasks]
+        for row in rows:
+            self._start(row)
+        if rows:
+            logger.info(f"🔄 Resuming {len(rows)} unsent report emails")
+        return len(rows)
+
+    # ---------------- Delivery ----------------
+
+    def _limiter(self, clinic_id: str) -> ClinicRateLimiter:
+        if clinic_id not in self._limiters:
+            self._limiters[clinic_id] = ClinicRateLimiter(self.rate_per_minute, self.burst)
+        return self._limiters[clinic_id]
+
+    async def _deliver(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        from services.email_service import email_service
+
+        job_id = row['id']
+        status, attempts = row.get('status') or 'pending', row.get('attempts') or 0
+        payload = row['payload']
+        line = {"job_id": job_id, "report_id": row['report_id'], "patient_email": row['patient_email']}
+        rendered = None
+        error = "not attempted"
+        other_errors = 0
+        try:
+            while attempts < self.max_attempts:
+                claimed = False
+                try:
+                    # Wait for the rate limit, then render, while the row is still pending/failed.
+                    # Rendering after the wait keeps a big batch from rendering every PDF up front
+                    await self._limiter(row['clinic_id']).acquire()
+                    if rendered is None:
+                        rendered = await email_service.render_report(
+                            row['patient_name'], payload['report_data'], payload['clinic_branding'])
+
+                    async with self._send_slots:
+                        # Claim the job right before sending, so no other worker or instance sends it too
+                        if not await self._update(job_id, {'status': 'sending', 'attempts': attempts + 1},
+                                                  expected=(status, attempts)):
+                            logger.info(f"ℹ️ Report email {job_id} already handled, skipping")
+                            return {**line, "status": "skipped", "attempts": attempts}
+                        claimed = True
+                        status, attempts = 'sending', attempts + 1
+
+                        delivered = await asyncio.to_thread(
+                            email_service.deliver_report, row['patient_email'], row['patient_name'],
+                            payload['clinic_branding'], rendered)
+                    if not delivered:
+                        raise Exception("Email provider rejected the message")
+                except Exception as e:
+                    error = str(e)
+                    logger.error(f"❌ Report email to {row['patient_email']} failed (attempt {attempts}/{self.max_attempts}): {error}")
+                    if claimed:
+                        try:
+                            if await self._update(job_id, {'status': 'failed', 'last_error': error[:1000]},
+                                                  expected=(status, attempts)):
+                                status = 'failed'
+                        except Exception as update_error:
+                            logger.warning(f"⚠️ Couldn't mark report email {job_id} failed: {str(update_error)}")
+                    else:
+                        # Rendering or the claim failed; the row is unchanged
+                        other_errors += 1
+                        if other_errors >= self.max_attempts:
+                            break
+                    if attempts < self.max_attempts:
+                        await asyncio.sleep(self.retry_base_s * 2 ** (max(attempts, other_errors) - 1))
+                    continue
+
+                sent_at = datetime.now().isoformat()
+                self.sent += 1
+                logger.info(f"✅ Report {row['report_id']} emailed to {row['patient_email']}")
+                try:
+                    await self._update(job_id, {'status': 'sent', 'last_error': None, 'sent_at': sent_at})
+                except Exception as e:
+                    # Sent already; never resend just because the status write failed
+                    logger.warning(f"⚠️ Couldn't mark report email {job_id} sent: {str(e)}")
+                await asyncio.to_thread(self._record_sent, row, sent_at)
+                return {**line, "status": "sent", "attempts": attempts, "sent_at": sent_at}
+
+            self.failed += 1
+            logger.error(f"🚨 Report email to {row['patient_email']} gave up after {attempts} attempts")
+            return {**line, "status": "failed", "attempts": attempts, "error": error}
+        finally:
+            if rendered is not None:
+                rendered.discard()
+
+    def _record_sent(self, row: Dict[str, Any], sent_at: str) -> None:
+        """Stamp email_sent_at (dashboard badge) and create the follow-up tracking record"""
+        from services.supabase import supabase_service
+        from services.email_tracking_service import calculate_urgency_level, save_tracking_record
+
+        client = supabase_service.get_service_client()
+        try:
+            client.table('patient_diagnosis').update({'email_sent_at': sent_at}).eq('id', row['report_id']).execute()
+        except Exception as e:
+            logger.error(f"❌ Failed to update email_sent_at for diagnosis {row['report_id']}: {str(e)}")
+
+        # Optional: tracking may fail if the table doesn't exist
+        try:
+            findings = row['payload']['report_data'].get('findings', [])
+            urgency_level, has_emergency = calculate_urgency_level(findings)
+            save_tracking_record(client, {
+                'report_id': row['report_id'],
+                'clinic_id': row['clinic_id'],
+                'user_id': row['clinic_id'],
+                'patient_email': row['patient_email'],
+                'patient_name': row['patient_name'],
+                'sent_at': sent_at,
+                'urgency_level': urgency_level,
+                'has_emergency_conditions': has_emergency,
+                'follow_up_completed': False
+            })
+        except Exception as e:
+            logger.error(f"❌ Email tracking record creation failed for report {row['report_id']}: {str(e)}")
+
+    def shutdown(self) -> None:
+        """Quit the pooled SMTP sessions"""
+        from services.email_service import email_service
+        email_service.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "table_available": self.table_available,
+            "queued": self.queued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "in_flight": len(self._tasks),
+            "clinics_rate_limited": len(self._limiters),
+        }
+
+
+# Initialize service lazily on first use to keep imports cheap
+email_delivery_queue = lazy_service("email_delivery", EmailDeliveryQueue)
+
+
+def get_email_delivery_queue():
+    return registry.get("email_delivery")
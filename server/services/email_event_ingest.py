@@ -0,0 +1,94 @@
+"""
+Email Event Ingest
+Applies SendGrid webhook batches to email_tracking
+
+Events are de-duplicated and normalized in memory, then applied in one call
+to the `ingest_email_events` SQL function
+(migrations/create_email_webhook_events.sql). That function records each
+sg_event_id and updates every affected report atomically, so bursts of opens
+can't race each other and SendGrid retries don't double-count.
+"""
+import logging
+from typing import Any, Dict, List
+
+from services.email_tracking_service import (
+    aggregate_email_events,
+    merge_email_aggregate,
+    normalize_sendgrid_events,
+)
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+IN_FILTER_CHUNK_SIZE = 150
+
+
+def _apply_without_rpc(client, rows: List[Dict]) -> Dict[str, Any]:
+    """
+    Fallback for databases without the ingest_email_events function
+
+    Still one read and one write per report rather than per event, but not
+    idempotent across retries.
+    """
+    aggregates = aggregate_email_events(rows)
+    report_ids = list(aggregates)
+
+    tracking_rows: Dict[str, Dict] = {}
+    for start in range(0, len(report_ids), IN_FILTER_CHUNK_SIZE):
+        response = client.table('email_tracking')\
+            .select('*')\
+            .in_('report_id', report_ids[start:start + IN_FILTER_CHUNK_SIZE])\
+            .execute()
+        for tracking in response.data or []:
+            tracking_rows[str(tracking['report_id'])] = tracking
+
+    reports_updated = 0
+    for report_id, agg in aggregates.items():
+        tracking = tracking_rows.get(report_id)
+        if not tracking:
+            continue
+        updates = merge_email_aggregate(tracking, agg)
+        if not updates:
+            continue
+        client.table('email_tracking')\
+            .update(updates)\
+            .eq('report_id', report_id)\
+            .execute()
+        reports_updated += 1
+
+    return {"new_events": len(rows), "reports_updated": reports_updated}
+
+
+def ingest_sendgrid_events(client, events: List[Dict]) -> Dict[str, Any]:
+    """
+    Apply a SendGrid webhook batch to email_tracking
+
+    Returns counts of events received, new (not previously seen) events and
+    reports updated.
+    """
+    # Bounce and spam events are logged but not exposed to clinics yet
+    for event in events:
+        if event.get('event') == 'bounce':
+            logger.warning(f"⚠️ Email bounced for report {event.get('report_id')}: {event.get('reason')}")
+        elif event.get('event') == 'spamreport':
+            logger.error(f"🚨 Spam report for report {event.get('report_id')}")
+
+    rows = normalize_sendgrid_events(events)
+    result = {"received": len(events), "new_events": 0, "reports_updated": 0}
+    if not rows:
+        return result
+
+    try:
+        with track_stage("supabase_ingest_email_events"):
+            response = client.rpc('ingest_email_events', {'events': rows}).execute()
+        result.update(response.data or {})
+    except Exception as e:
+        # Only a database without the function falls back; other errors reach the caller
+        if 'ingest_email_events' not in str(e) or ('PGRST202' not in str(e) and 'schema cache' not in str(e)):
+            raise
+        logger.warning(f"⚠️ ingest_email_events function missing, applying per report: {str(e)}")
+        with track_stage("supabase_ingest_email_events_fallback"):
+            result.update(_apply_without_rpc(client, rows))
+
+    logger.info(f"✅ Ingested {result['new_events']} new email events across {result['reports_updated']} reports")
+    return result
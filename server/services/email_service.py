@@ -1,6 +1,9 @@
+import asyncio
 import smtplib
 import os
 import base64
+import threading
+from dataclasses import dataclass
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
@@ -8,6 +11,8 @@ from email import encoders
 from datetime import datetime
 import logging
 
+from utils.metrics import timed_stage
+from utils.smtp_pool import SMTPConnectionPool
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import (
     Mail,
@@ -26,6 +31,22 @@ from sendgrid.helpers.mail import (
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass
+class RenderedReport:
+    """A report email ready to send: its PDF on disk and the message bodies"""
+    pdf_path: str
+    subject: str
+    text_content: str
+    html_body: str
+
+    def discard(self) -> None:
+        try:
+            os.unlink(self.pdf_path)
+        except OSError:
+            pass
+
+
 class EmailService:
     def __init__(self):
         self.smtp_server = "smtp.gmail.com"
@@ -34,13 +55,19 @@ class EmailService:
         self.app_password = os.getenv('GMAIL_APP_PASSWORD')
         self.sendgrid_api_key = os.getenv('SENDGRID_API_KEY')
         self.sendgrid_from_email = os.getenv('SENDGRID_FROM_EMAIL', self.sender_email or 'reports@scan-wise.com')
+        self.sendgrid_api_host = os.getenv('SENDGRID_API_HOST', 'https://api.sendgrid.com')
         self.use_sendgrid = bool(self.sendgrid_api_key)
+        self.smtp_pool_size = int(os.getenv('EMAIL_SMTP_CONNECTIONS', '3'))
+        self._smtp_pool: SMTPConnectionPool = None
+        self._sendgrid_client: SendGridAPIClient = None
+        self._transport_lock = threading.Lock()
         
         # Log email configuration (without exposing password)
         logger.info(f"Email service initialized. SMTP sender: {self.sender_email}")
         logger.info(f"App password configured: {'Yes' if self.app_password else 'No'}")
         logger.info(f"SendGrid configured: {'Yes' if self.use_sendgrid else 'No'}")
         
+    @timed_stage("email_send_report")
     async def send_dental_report(self, patient_email: str, patient_name: str, report_data: dict, clinic_branding: dict):
         """
         Send dental report to patient via email with PDF attachment
@@ -52,116 +79,146 @@ class EmailService:
             clinic_branding: Clinic branding information
         """
         try:
-            # Create message
-            msg = MIMEMultipart()
-            # Use ScanWise as default if clinic_name is None or empty
-            clinic_name = clinic_branding.get('clinic_name') or 'ScanWise'
-            msg['From'] = f"{clinic_name} <{self.sender_email}>"
-            msg['To'] = patient_email
-            msg['Subject'] = f"Dental Report - {patient_name}"
-            
-            # Create text content
-            text_content = self._create_email_text(patient_name, clinic_branding)
-            text_part = MIMEText(text_content, 'plain')
-            msg.attach(text_part)
-            
-            # Generate PDF using HTML-preserving renderer
-            html_body = None
+            rendered = await self.render_report(patient_name, report_data, clinic_branding)
             try:
-                from services.html_pdf_service import html_pdf_service
-                from jinja2 import Environment, FileSystemLoader, select_autoescape
-                from datetime import datetime
-
-                templates_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates')
-                env = Environment(
-                    loader=FileSystemLoader(templates_dir),
-                    autoescape=select_autoescape(['html'])
-                )
-                template = env.get_template('report.html')
+                # Sending blocks on SMTP/HTTP, so it runs off the event loop
+                return await asyncio.to_thread(self.deliver_report, patient_email, patient_name, clinic_branding, rendered)
+            finally:
+                # Clean up temporary PDF file
+                rendered.discard()
+            
+        except Exception as e:
+            logger.error(f"Error sending dental report email: {str(e)}")
+            raise e
+    
+    async def render_report(self, patient_name: str, report_data: dict, clinic_branding: dict) -> RenderedReport:
+        """Render the report PDF (HTML-preserving renderer, ReportLab fallback) and the email bodies"""
+        text_content = self._create_email_text(patient_name, clinic_branding)
+        
+        # Generate PDF using HTML-preserving renderer
+        html_body = None
+        try:
+            from services.html_pdf_service import html_pdf_service
+            from jinja2 import Environment, FileSystemLoader, select_autoescape
 
-                # Build legend if available (optional list of strings)
-                legend = report_data.get('legend', [])
+            templates_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates')
+            env = Environment(
+                loader=FileSystemLoader(templates_dir),
+                autoescape=select_autoescape(['html'])
+            )
+            template = env.get_template('report.html')
 
-                # Log the annotated image URL for debugging
-                annotated_url = report_data.get('annotated_image_url')
-                logger.info(f"Email service - annotated_image_url: {annotated_url}")
-                
-                # Get report HTML and log for debugging
-                report_html = report_data.get('report_html') or ''
-                logger.info(f"📄 Report HTML length: {len(report_html)} characters")
-                logger.info(f"📄 Report HTML starts with: {report_html[:100] if report_html else 'EMPTY'}")
-                
-                html = template.render(
-                    clinic_name=clinic_branding.get('clinic_name') or 'ScanWise',
-                    address=clinic_branding.get('address'),
-                    phone=clinic_branding.get('phone'),
-                    email=clinic_branding.get('email'),
-                    website=clinic_branding.get('website'),
-                    primary_color=clinic_branding.get('primary_color') or '#1e88e5',
-                    patient_name=report_data.get('patient_name') or 'Patient',
-                    report_date=report_data.get('created_at') or datetime.now().isoformat(),
-                    report_html=report_html,
-                    annotated_image_url=annotated_url,
-                    legend=legend,
-                    video_url=report_data.get('video_url'),
-                    consultation_url=report_data.get('consultation_url'),
-                )
-                
-                logger.info(f"📧 Final rendered HTML length: {len(html)} characters")
-                logger.info(f"📧 Final HTML starts with: {html[:150]}")
-                html_body = html
+            # Build legend if available (optional list of strings)
+            legend = report_data.get('legend', [])
 
-                pdf_path = await html_pdf_service.render_html_to_pdf(html)
-            except Exception as html_err:
-                logger.warning(f"HTML PDF render failed ({html_err}); falling back to ReportLab.")
-                from services.pdf_generator import pdf_generator
-                pdf_path = pdf_generator.generate_dental_report_pdf(report_data, clinic_branding)
-                if not html_body:
-                    html_body = f"<pre>{self._create_email_text(patient_name, clinic_branding)}</pre>"
+            # Log the annotated image URL for debugging
+            annotated_url = report_data.get('annotated_image_url')
+            logger.info(f"Email service - annotated_image_url: {annotated_url}")
             
-            # Attach PDF
-            with open(pdf_path, 'rb') as pdf_file:
-                pdf_attachment = MIMEBase('application', 'pdf')
-                pdf_attachment.set_payload(pdf_file.read())
-                encoders.encode_base64(pdf_attachment)
-                pdf_attachment.add_header(
-                    'Content-Disposition',
-                    'attachment',
-                    filename=f"dental_report_{patient_name.replace(' ', '_')}.pdf"
-                )
-                msg.attach(pdf_attachment)
+            # Get report HTML and log for debugging
+            report_html = report_data.get('report_html') or ''
+            logger.info(f"📄 Report HTML length: {len(report_html)} characters")
+            logger.info(f"📄 Report HTML starts with: {report_html[:100] if report_html else 'EMPTY'}")
             
-            clinic_name = clinic_branding.get('clinic_name') or 'ScanWise'
-            subject = f"Dental Report - {patient_name}"
-            if not html_body:
-                html_body = report_data.get('report_html') or text_content.replace('\n', '<br />')
-            text_content = self._create_email_text(patient_name, clinic_branding)
+            html = template.render(
+                clinic_name=clinic_branding.get('clinic_name') or 'ScanWise',
+                address=clinic_branding.get('address'),
+                phone=clinic_branding.get('phone'),
+                email=clinic_branding.get('email'),
+                website=clinic_branding.get('website'),
+                primary_color=clinic_branding.get('primary_color') or '#1e88e5',
+                patient_name=report_data.get('patient_name') or 'Patient',
+                report_date=report_data.get('created_at') or datetime.now().isoformat(),
+                report_html=report_html,
+                annotated_image_url=annotated_url,
+                legend=legend,
+                video_url=report_data.get('video_url'),
+                consultation_url=report_data.get('consultation_url'),
+            )
             
-            # Send email (SendGrid preferred, SMTP fallback)
-            if self.use_sendgrid:
-                result = self._send_via_sendgrid(
-                    patient_email=patient_email,
-                    clinic_name=clinic_name,
-                    subject=subject,
-                    text_content=text_content,
-                    html_content=html_body,
-                    pdf_path=pdf_path
+            logger.info(f"📧 Final rendered HTML length: {len(html)} characters")
+            logger.info(f"📧 Final HTML starts with: {html[:150]}")
+            html_body = html
+
+            pdf_path = await html_pdf_service.render_html_to_pdf(html)
+        except Exception as html_err:
+            logger.warning(f"HTML PDF render failed ({html_err}); falling back to ReportLab.")
+            from services.pdf_generator import pdf_generator
+            pdf_path = await asyncio.to_thread(pdf_generator.generate_dental_report_pdf, report_data, clinic_branding)
+            if not html_body:
+                html_body = f"<pre>{text_content}</pre>"
+        
+        if not html_body:
+            html_body = report_data.get('report_html') or text_content.replace('\n', '<br />')
+        return RenderedReport(
+            pdf_path=pdf_path,
+            subject=f"Dental Report - {patient_name}",
+            text_content=text_content,
+            html_body=html_body
+        )
+    
+    def deliver_report(self, patient_email: str, patient_name: str, clinic_branding: dict,
+                       rendered: RenderedReport) -> bool:
+        """Send a rendered report (SendGrid preferred, pooled SMTP fallback); blocking and thread-safe"""
+        # Use ScanWise as default if clinic_name is None or empty
+        clinic_name = clinic_branding.get('clinic_name') or 'ScanWise'
+        if self.use_sendgrid:
+            return self._send_via_sendgrid(
+                patient_email=patient_email,
+                clinic_name=clinic_name,
+                subject=rendered.subject,
+                text_content=rendered.text_content,
+                html_content=rendered.html_body,
+                pdf_path=rendered.pdf_path
+            )
+        
+        # Create message
+        msg = MIMEMultipart()
+        msg['From'] = f"{clinic_name} <{self.sender_email}>"
+        msg['To'] = patient_email
+        msg['Subject'] = rendered.subject
+        msg.attach(MIMEText(rendered.text_content, 'plain'))
+        
+        # Attach PDF
+        with open(rendered.pdf_path, 'rb') as pdf_file:
+            pdf_attachment = MIMEBase('application', 'pdf')
+            pdf_attachment.set_payload(pdf_file.read())
+            encoders.encode_base64(pdf_attachment)
+            pdf_attachment.add_header(
+                'Content-Disposition',
+                'attachment',
+                filename=f"dental_report_{patient_name.replace(' ', '_')}.pdf"
+            )
+            msg.attach(pdf_attachment)
+        return self._send_via_smtp(msg)
+    
+    @property
+    def smtp_pool(self) -> SMTPConnectionPool:
+        """Logged-in Gmail sessions kept open between reports"""
+        with self._transport_lock:
+            if self._smtp_pool is None:
+                self._smtp_pool = SMTPConnectionPool(
+                    self.smtp_server,
+                    self.smtp_port,
+                    self.sender_email,
+                    self.app_password,
+                    size=self.smtp_pool_size
                 )
-            else:
-                msg['Subject'] = subject
-                result = self._send_via_smtp(msg)
-            
-            # Clean up temporary PDF file
-            try:
-                os.unlink(pdf_path)
-            except:
-                pass
-            
-            return result
-            
-        except Exception as e:
-            logger.error(f"Error sending dental report email: {str(e)}")
-            raise e
+            return self._smtp_pool
+    
+    @property
+    def sendgrid_client(self) -> SendGridAPIClient:
+        with self._transport_lock:
+            if self._sendgrid_client is None:
+                self._sendgrid_client = SendGridAPIClient(self.sendgrid_api_key, host=self.sendgrid_api_host)
+            return self._sendgrid_client
+    
+    def close(self) -> None:
+        """Quit the pooled SMTP sessions (on shutdown)"""
+        with self._transport_lock:
+            pool, self._smtp_pool = self._smtp_pool, None
+        if pool is not None:
+            pool.close()
     
     def _create_email_text(self, patient_name: str, clinic_branding: dict) -> str:
         """
@@ -193,7 +250,7 @@ This email was sent automatically. Please do not reply to this email.
         Send email using SendGrid (with tracking)
         """
         try:
-            sg = SendGridAPIClient(self.sendgrid_api_key)
+            sg = self.sendgrid_client
             
             from_email = Email(self.sendgrid_from_email, clinic_name)
             to_email = To(patient_email)
@@ -234,27 +291,10 @@ This email was sent automatically. Please do not reply to this email.
     
     def _send_via_smtp(self, msg):
         """
-        Send email using Gmail SMTP
+        Send email using Gmail SMTP over a pooled, already logged-in session
         """
         try:
-            # Create SMTP session
-            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-            server.starttls()
-            
-            # Login
-            if not self.sender_email or not self.app_password:
-                raise Exception("Email credentials not configured")
-            server.login(self.sender_email, self.app_password)
-            
-            # Send email
-            text = msg.as_string()
-            server.sendmail(self.sender_email, msg['To'], text)
-            
-            # Close connection
-            server.quit()
-            
-            logger.info(f"Email sent successfully to {msg['To']}")
-            return True
+            return self.smtp_pool.send(msg)
             
         except Exception as e:
             logger.error(f"Failed to send email: {str(e)}")
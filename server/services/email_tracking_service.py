@@ -2,9 +2,11 @@
 Email Tracking Service
 Handles urgency calculation and email tracking logic
 """
+import hashlib
 import logging
+import uuid
 from typing import Dict, List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +40,20 @@ EMERGENCY_CONDITIONS = [
     'root-piece',  # Broken root fragments
 ]
 
+# Hours after sending before the patient gets an automated follow-up
+AUTO_FOLLOWUP_THRESHOLD_HOURS = {
+    'high': 24,
+    'medium': 48,
+    'low': 72,
+}
+
+# Hours after sending before the clinic team is notified
+TEAM_NOTIFICATION_THRESHOLD_HOURS = {
+    'high': 48,
+    'medium': 96,
+    'low': 168,
+}
+
 # Complex treatments indicating medium urgency
 COMPLEX_TREATMENTS = [
     'endo_rct_prep_1',
@@ -93,6 +109,26 @@ def calculate_urgency_level(findings: List[Dict]) -> tuple[str, bool]:
     return ('low', False)
 
 
+def parse_timestamp(value) -> Optional[datetime]:
+    """Parse a Supabase timestamp as an aware UTC datetime (naive values are treated as UTC)"""
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def hours_since(timestamp, now: Optional[datetime] = None) -> Optional[float]:
+    """Hours elapsed since a timestamp, or None if it is missing"""
+    timestamp = parse_timestamp(timestamp)
+    if timestamp is None:
+        return None
+    now = now or datetime.now(timezone.utc)
+    return (now - timestamp).total_seconds() / 3600
+
+
 def should_send_auto_followup(tracking: Dict) -> bool:
     """
     Determine if automatic follow-up email should be sent
@@ -119,26 +155,16 @@ def should_send_auto_followup(tracking: Dict) -> bool:
         return False
     
     # Calculate hours since sent
-    sent_at = tracking.get('sent_at')
-    if not sent_at:
+    hours_since_sent = hours_since(tracking.get('sent_at'))
+    if hours_since_sent is None:
         return False
     
-    if isinstance(sent_at, str):
-        sent_at = datetime.fromisoformat(sent_at.replace('Z', '+00:00'))
-    
-    hours_since_sent = (datetime.now() - sent_at).total_seconds() / 3600
-    
-    urgency = tracking.get('urgency_level', 'low')
+    urgency = tracking.get('urgency_level') or 'low'
+    threshold = AUTO_FOLLOWUP_THRESHOLD_HOURS.get(urgency)
     
     # Check thresholds
-    if urgency == 'high' and hours_since_sent >= 24:
-        logger.info(f"⏰ High urgency: {hours_since_sent:.1f}h since sent (threshold: 24h)")
-        return True
-    elif urgency == 'medium' and hours_since_sent >= 48:
-        logger.info(f"⏰ Medium urgency: {hours_since_sent:.1f}h since sent (threshold: 48h)")
-        return True
-    elif urgency == 'low' and hours_since_sent >= 72:
-        logger.info(f"⏰ Low urgency: {hours_since_sent:.1f}h since sent (threshold: 72h)")
+    if threshold is not None and hours_since_sent >= threshold:
+        logger.info(f"⏰ {urgency.capitalize()} urgency: {hours_since_sent:.1f}h since sent (threshold: {threshold}h)")
         return True
     
     return False
@@ -170,26 +196,16 @@ def should_send_team_notification(tracking: Dict) -> bool:
         return False
     
     # Calculate hours since sent
-    sent_at = tracking.get('sent_at')
-    if not sent_at:
+    hours_since_sent = hours_since(tracking.get('sent_at'))
+    if hours_since_sent is None:
         return False
     
-    if isinstance(sent_at, str):
-        sent_at = datetime.fromisoformat(sent_at.replace('Z', '+00:00'))
-    
-    hours_since_sent = (datetime.now() - sent_at).total_seconds() / 3600
-    
-    urgency = tracking.get('urgency_level', 'low')
+    urgency = tracking.get('urgency_level') or 'low'
+    threshold = TEAM_NOTIFICATION_THRESHOLD_HOURS.get(urgency)
     
     # Check thresholds
-    if urgency == 'high' and hours_since_sent >= 48:
-        logger.info(f"📧 High urgency team notification: {hours_since_sent:.1f}h since sent (threshold: 48h)")
-        return True
-    elif urgency == 'medium' and hours_since_sent >= 96:
-        logger.info(f"📧 Medium urgency team notification: {hours_since_sent:.1f}h since sent (threshold: 96h)")
-        return True
-    elif urgency == 'low' and hours_since_sent >= 168:
-        logger.info(f"📧 Low urgency team notification: {hours_since_sent:.1f}h since sent (threshold: 168h)")
+    if threshold is not None and hours_since_sent >= threshold:
+        logger.info(f"📧 {urgency.capitalize()} urgency team notification: {hours_since_sent:.1f}h since sent (threshold: {threshold}h)")
         return True
     
     return False
@@ -209,10 +225,8 @@ def format_time_since(timestamp: Optional[str]) -> str:
     if not timestamp:
         return "Unknown"
     
-    if isinstance(timestamp, str):
-        timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-    
-    delta = datetime.now() - timestamp
+    timestamp = parse_timestamp(timestamp)
+    delta = datetime.now(timezone.utc) - timestamp
     
     if delta.days > 0:
         return f"{delta.days} day{'s' if delta.days != 1 else ''} ago"
@@ -224,3 +238,121 @@ def format_time_since(timestamp: Optional[str]) -> str:
     minutes = (delta.seconds % 3600) // 60
     return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
 
+
+
+def save_tracking_record(client, tracking_data: Dict):
+    """
+    Create or refresh the email_tracking row for a sent report
+
+    email_tracking has one row per report (unique report_id, see
+    migrations/add_email_tracking_followup_indexes.sql), so re-sending a report
+    upserts its row. Until that migration is applied there's no constraint to
+    conflict on and the row is inserted instead.
+    """
+    try:
+        return client.table('email_tracking')\
+            .upsert(tracking_data, on_conflict='report_id')\
+            .execute()
+    except Exception as e:
+        if '42P10' not in str(e) and 'ON CONFLICT' not in str(e):
+            raise
+        logger.warning("⚠️ email_tracking.report_id isn't unique yet, inserting tracking record")
+        return client.table('email_tracking').insert(tracking_data).execute()
+
+
+# SendGrid events that update email_tracking
+TRACKED_EMAIL_EVENTS = ('delivered', 'open', 'click')
+
+
+def sendgrid_event_id(event: Dict) -> str:
+    """
+    Idempotency key for a SendGrid event
+
+    SendGrid sets sg_event_id on every event; derive a stable key from the
+    event contents for the rare payload without one so retries still dedupe.
+    """
+    if event.get('sg_event_id'):
+        return str(event['sg_event_id'])
+    raw = f"{event.get('sg_message_id')}|{event.get('report_id')}|{event.get('event')}|{event.get('timestamp')}"
+    return 'derived-' + hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def normalize_sendgrid_events(events: List[Dict]) -> List[Dict]:
+    """
+    Compact, de-duplicated rows for the tracked event types
+
+    Returns dicts with sg_event_id, report_id, event and a unix timestamp.
+    Events without a valid report_id are dropped (report_id is a
+    patient_diagnosis UUID).
+    """
+    rows: Dict[str, Dict] = {}
+    for event in events:
+        event_type = event.get('event')
+        if event_type not in TRACKED_EMAIL_EVENTS:
+            continue
+
+        report_id = event.get('report_id')
+        try:
+            report_id = str(uuid.UUID(str(report_id)))
+        except (TypeError, ValueError):
+            logger.warning(f"⚠️ Email event missing or invalid report_id: {event_type}")
+            continue
+
+        key = sendgrid_event_id(event)
+        rows[key] = {
+            'sg_event_id': key,
+            'report_id': report_id,
+            'event': event_type,
+            'timestamp': event.get('timestamp') or datetime.now(timezone.utc).timestamp()
+        }
+    return list(rows.values())
+
+
+def aggregate_email_events(rows: List[Dict]) -> Dict[str, Dict]:
+    """
+    Fold normalized events into one set of changes per report
+
+    Mirrors the ingest_email_events SQL function: earliest/latest open, open
+    and click counts, and the latest delivered/click time.
+    """
+    aggregates: Dict[str, Dict] = {}
+    for row in rows:
+        occurred_at = datetime.fromtimestamp(float(row['timestamp']), tz=timezone.utc)
+        agg = aggregates.setdefault(row['report_id'], {
+            'delivered_at': None,
+            'first_opened_at': None,
+            'last_opened_at': None,
+            'open_count': 0,
+            'clicked_at': None,
+            'click_count': 0,
+        })
+
+        if row['event'] == 'delivered':
+            agg['delivered_at'] = max(filter(None, [agg['delivered_at'], occurred_at]))
+        elif row['event'] == 'open':
+            agg['first_opened_at'] = min(filter(None, [agg['first_opened_at'], occurred_at]))
+            agg['last_opened_at'] = max(filter(None, [agg['last_opened_at'], occurred_at]))
+            agg['open_count'] += 1
+        elif row['event'] == 'click':
+            agg['clicked_at'] = max(filter(None, [agg['clicked_at'], occurred_at]))
+            agg['click_count'] += 1
+    return aggregates
+
+
+def merge_email_aggregate(tracking: Dict, agg: Dict) -> Dict:
+    """Column updates that apply an aggregate on top of an existing tracking row"""
+    updates = {}
+    if agg['delivered_at']:
+        updates['delivered_at'] = agg['delivered_at'].isoformat()
+    if agg['open_count']:
+        first_opened_at = parse_timestamp(tracking.get('first_opened_at'))
+        last_opened_at = parse_timestamp(tracking.get('last_opened_at'))
+        updates['first_opened_at'] = min(filter(None, [first_opened_at, agg['first_opened_at']])).isoformat()
+        updates['last_opened_at'] = max(filter(None, [last_opened_at, agg['last_opened_at']])).isoformat()
+        updates['open_count'] = (tracking.get('open_count') or 0) + agg['open_count']
+    if agg['click_count']:
+        clicked_at = parse_timestamp(tracking.get('clicked_at'))
+        updates['clicked_at'] = max(filter(None, [clicked_at, agg['clicked_at']])).isoformat()
+        if 'click_count' in tracking:
+            updates['click_count'] = (tracking.get('click_count') or 0) + agg['click_count']
+    return updates
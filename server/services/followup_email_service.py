@@ -2,13 +2,18 @@
 Follow-up Email Service
 Handles automated follow-up emails and team notifications for unopened reports
 """
+import asyncio
 import smtplib
 import os
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.utils import parseaddr
 from datetime import datetime
+from typing import List, Optional
 import logging
 
+from utils.smtp_pool import SMTPConnectionPool
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,6 +24,13 @@ class FollowUpEmailService:
         self.sender_email = os.getenv('GMAIL_EMAIL')
         self.app_password = os.getenv('GMAIL_APP_PASSWORD')
         self.team_notification_email = os.getenv('TEAM_NOTIFICATION_EMAIL', 'team@scan-wise.com')
+        self.sendgrid_api_key = os.getenv('SENDGRID_API_KEY')
+        self.sendgrid_from_email = os.getenv('SENDGRID_FROM_EMAIL', self.sender_email or 'reports@scan-wise.com')
+        self.sendgrid_api_host = os.getenv('SENDGRID_API_HOST', 'https://api.sendgrid.com')
+        
+        # Batch sends (follow-up cron) share sessions instead of reconnecting per message
+        self.batch_concurrency = int(os.getenv('FOLLOWUP_SEND_CONCURRENCY', '4'))
+        self.smtp_pool_size = int(os.getenv('FOLLOWUP_SMTP_CONNECTIONS', '3'))
         
         logger.info(f"Follow-up email service initialized with sender: {self.sender_email}")
     
@@ -47,35 +59,16 @@ class FollowUpEmailService:
             original_message_id: Message-ID from original email for threading
         """
         try:
-            msg = MIMEMultipart()
-            msg['From'] = f"{clinic_name} <{self.sender_email}>"
-            msg['To'] = patient_email
-            
-            # Set subject based on urgency
-            if urgency_level == 'high':
-                msg['Subject'] = f"URGENT: Your Dental Treatment Plan - {patient_name}"
-            elif urgency_level == 'medium':
-                msg['Subject'] = f"Follow-up: Your Dental Treatment Plan - {patient_name}"
-            else:
-                msg['Subject'] = f"Reminder: Your Dental Treatment Plan - {patient_name}"
-            
-            # Thread with original email if we have message ID
-            if original_message_id:
-                msg['In-Reply-To'] = original_message_id
-                msg['References'] = original_message_id
-            
-            # Create email content based on urgency
-            text_content = self._create_followup_text(
+            msg = self.build_patient_followup(
+                patient_email,
                 patient_name,
                 clinic_name,
                 clinic_phone,
                 clinic_website,
-                urgency_level
+                urgency_level,
+                original_message_id
             )
             
-            text_part = MIMEText(text_content, 'plain')
-            msg.attach(text_part)
-            
             # Send email
             result = self._send_email(msg)
             
@@ -111,27 +104,16 @@ class FollowUpEmailService:
             hours_since_sent: Hours since report was sent
         """
         try:
-            msg = MIMEMultipart()
-            msg['From'] = f"ScanWise Follow-Ups <{self.sender_email}>"
-            msg['To'] = clinic_admin_email
-            
-            # Set subject based on urgency
-            urgency_emoji = {'high': '🔴', 'medium': '🟡', 'low': '🟢'}.get(urgency_level, '⚪')
-            msg['Subject'] = f"{urgency_emoji} Follow-Up Needed: {patient_name} hasn't opened their report"
-            
-            # Create notification content
-            text_content = self._create_team_notification_text(
+            msg = self.build_team_notification(
+                clinic_admin_email,
                 patient_name,
                 patient_email,
                 clinic_name,
+                report_id,
                 urgency_level,
-                hours_since_sent,
-                report_id
+                hours_since_sent
             )
             
-            text_part = MIMEText(text_content, 'plain')
-            msg.attach(text_part)
-            
             # Send email
             result = self._send_email(msg)
             
@@ -144,6 +126,82 @@ class FollowUpEmailService:
             logger.error(f"❌ Error sending team notification: {str(e)}")
             raise e
     
+    def build_patient_followup(
+        self,
+        patient_email: str,
+        patient_name: str,
+        clinic_name: str,
+        clinic_phone: str,
+        clinic_website: str,
+        urgency_level: str,
+        original_message_id: str = None
+    ) -> MIMEMultipart:
+        """Build the patient follow-up message without sending it"""
+        msg = MIMEMultipart()
+        msg['From'] = f"{clinic_name} <{self.sender_email}>"
+        msg['To'] = patient_email
+        
+        # Set subject based on urgency
+        if urgency_level == 'high':
+            msg['Subject'] = f"URGENT: Your Dental Treatment Plan - {patient_name}"
+        elif urgency_level == 'medium':
+            msg['Subject'] = f"Follow-up: Your Dental Treatment Plan - {patient_name}"
+        else:
+            msg['Subject'] = f"Reminder: Your Dental Treatment Plan - {patient_name}"
+        
+        # Thread with original email if we have message ID
+        if original_message_id:
+            msg['In-Reply-To'] = original_message_id
+            msg['References'] = original_message_id
+        
+        # Create email content based on urgency
+        text_content = self._create_followup_text(
+            patient_name,
+            clinic_name,
+            clinic_phone,
+            clinic_website,
+            urgency_level
+        )
+        
+        text_part = MIMEText(text_content, 'plain')
+        msg.attach(text_part)
+        
+        return msg
+    
+    def build_team_notification(
+        self,
+        clinic_admin_email: str,
+        patient_name: str,
+        patient_email: str,
+        clinic_name: str,
+        report_id: str,
+        urgency_level: str,
+        hours_since_sent: float
+    ) -> MIMEMultipart:
+        """Build the clinic team notification message without sending it"""
+        msg = MIMEMultipart()
+        msg['From'] = f"ScanWise Follow-Ups <{self.sender_email}>"
+        msg['To'] = clinic_admin_email
+        
+        # Set subject based on urgency
+        urgency_emoji = {'high': '🔴', 'medium': '🟡', 'low': '🟢'}.get(urgency_level, '⚪')
+        msg['Subject'] = f"{urgency_emoji} Follow-Up Needed: {patient_name} hasn't opened their report"
+        
+        # Create notification content
+        text_content = self._create_team_notification_text(
+            patient_name,
+            patient_email,
+            clinic_name,
+            urgency_level,
+            hours_since_sent,
+            report_id
+        )
+        
+        text_part = MIMEText(text_content, 'plain')
+        msg.attach(text_part)
+        
+        return msg
+    
     def _create_followup_text(
         self,
         patient_name: str,
@@ -244,7 +302,7 @@ Reach us at: {clinic_phone}
         }.get(urgency_level, 'Follow-up needed')
         
         days_since = hours_since_sent / 24
-        days_text = f"{days_since:.1f} days" if days_since >= 1 else f"{hours_since:.0f} hours"
+        days_text = f"{days_since:.1f} days" if days_since >= 1 else f"{hours_since_sent:.0f} hours"
         
         return f"""Follow-Up Needed
 
@@ -292,6 +350,77 @@ This is an automated notification from ScanWise
             logger.error(f"Failed to send email: {str(e)}")
             raise e
 
+    async def send_batch(self, messages: List[MIMEMultipart]) -> List[Optional[Exception]]:
+        """
+        Send many messages over shared sessions with bounded concurrency
+
+        Uses one SendGrid client when SENDGRID_API_KEY is set, otherwise a
+        pool of logged-in Gmail SMTP sessions, so a batch pays the
+        connect/STARTTLS/login cost once per session rather than per message.
+
+        Returns one entry per message: None on success, the exception on failure.
+        """
+        if not messages:
+            return []
+
+        if self.sendgrid_api_key:
+            from sendgrid import SendGridAPIClient
+            sg = SendGridAPIClient(self.sendgrid_api_key, host=self.sendgrid_api_host)
+            send_one = lambda msg: self._send_via_sendgrid(sg, msg)
+            pool = None
+            concurrency = self.batch_concurrency
+        else:
+            pool = SMTPConnectionPool(
+                self.smtp_server,
+                self.smtp_port,
+                self.sender_email,
+                self.app_password,
+                size=self.smtp_pool_size
+            )
+            send_one = pool.send
+            concurrency = min(self.batch_concurrency, self.smtp_pool_size)
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def send(msg) -> Optional[Exception]:
+            async with semaphore:
+                try:
+                    await asyncio.to_thread(send_one, msg)
+                    return None
+                except Exception as e:
+                    logger.error(f"Failed to send email to {msg['To']}: {str(e)}")
+                    return e
+
+        try:
+            return await asyncio.gather(*(send(msg) for msg in messages))
+        finally:
+            if pool is not None:
+                await asyncio.to_thread(pool.close)
+
+    def _send_via_sendgrid(self, sg, msg: MIMEMultipart) -> bool:
+        """Send a message built by the build_* helpers through SendGrid"""
+        from sendgrid.helpers.mail import Email, Header, Mail, To
+
+        from_name, _ = parseaddr(msg['From'])
+        text_content = msg.get_payload()[0].get_payload(decode=True).decode('utf-8')
+
+        message = Mail(
+            from_email=Email(self.sendgrid_from_email, from_name or None),
+            to_emails=To(msg['To']),
+            subject=msg['Subject'],
+            plain_text_content=text_content
+        )
+        for header in ('In-Reply-To', 'References'):
+            if msg[header]:
+                message.header = Header(header, msg[header])
+
+        response = sg.send(message)
+        if response.status_code not in (200, 202):
+            raise Exception(f"SendGrid returned status {response.status_code}")
+
+        logger.info(f"Email sent successfully to {msg['To']}")
+        return True
+
 
 # Create global instance
 followup_email_service = FollowUpEmailService()
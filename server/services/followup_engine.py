@@ -0,0 +1,265 @@
+"""
+Follow-up Engine
+Batched version of the hourly follow-up check for unopened reports
+
+Instead of scanning every unopened report and querying clinic/user info per
+row, the engine:
+- asks the database only for rows whose urgency-specific threshold has passed
+- loads clinic branding and clinic admin users in one query each
+- sends all emails over shared SMTP/SendGrid sessions with bounded concurrency
+- writes every tracking update in one batched upsert
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from services.email_tracking_service import (
+    AUTO_FOLLOWUP_THRESHOLD_HOURS,
+    TEAM_NOTIFICATION_THRESHOLD_HOURS,
+    hours_since,
+)
+from services.followup_email_service import followup_email_service
+from services.registry import lazy_service, registry
+from services.supabase import supabase_service
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+# Columns written by the tracking upsert - everything the original insert sets
+# plus the two follow-up timestamps, so the insert half satisfies NOT NULL columns
+UPSERT_COLUMNS = (
+    'report_id', 'clinic_id', 'user_id', 'patient_email', 'patient_name', 'sent_at',
+    'urgency_level', 'has_emergency_conditions', 'follow_up_completed',
+    'auto_followup_sent_at', 'team_notification_sent_at',
+)
+
+# Keep `in.(...)` filters well under proxy URL limits
+IN_FILTER_CHUNK_SIZE = 150
+
+
+def _chunks(items: List[Any], size: int) -> Iterable[List[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _pg_timestamp(value: datetime) -> str:
+    # Quoted because ':' is reserved inside PostgREST logic trees
+    return f'"{value.strftime("%Y-%m-%dT%H:%M:%SZ")}"'
+
+
+def build_due_filter(now: datetime) -> str:
+    """
+    PostgREST `or` filter matching rows with a follow-up or team notification due
+
+    One branch per (urgency, action), each with that urgency's cutoff, so the
+    database only returns rows past their threshold. Rows without an urgency
+    level are treated as low, like `should_send_auto_followup` does.
+    """
+    clauses = []
+    for urgency in ("high", "medium", "low"):
+        if urgency == "low":
+            urgency_clause = "or(urgency_level.eq.low,urgency_level.is.null)"
+        else:
+            urgency_clause = f"urgency_level.eq.{urgency}"
+
+        auto_cutoff = _pg_timestamp(now - timedelta(hours=AUTO_FOLLOWUP_THRESHOLD_HOURS[urgency]))
+        team_cutoff = _pg_timestamp(now - timedelta(hours=TEAM_NOTIFICATION_THRESHOLD_HOURS[urgency]))
+        clauses.append(f"and({urgency_clause},auto_followup_sent_at.is.null,sent_at.lte.{auto_cutoff})")
+        clauses.append(f"and({urgency_clause},team_notification_sent_at.is.null,sent_at.lte.{team_cutoff})")
+    return ",".join(clauses)
+
+
+class FollowUpEngine:
+    def __init__(self):
+        self.page_size = int(os.getenv('FOLLOWUP_PAGE_SIZE', '1000'))
+        self.email_service = followup_email_service
+
+    def fetch_due(self, client, now: datetime) -> List[Dict]:
+        """Unopened, open-ended tracking rows with at least one action due"""
+        due_filter = build_due_filter(now)
+        rows: List[Dict] = []
+        offset = 0
+
+        while True:
+            # patient_diagnosis!inner keeps the old behaviour of skipping orphaned rows
+            response = client.table('email_tracking')\
+                .select('*, patient_diagnosis!inner(id)')\
+                .is_('first_opened_at', 'null')\
+                .eq('follow_up_completed', False)\
+                .or_(due_filter)\
+                .order('sent_at')\
+                .range(offset, offset + self.page_size - 1)\
+                .execute()
+
+            page = response.data or []
+            rows.extend(page)
+            if len(page) < self.page_size:
+                break
+            offset += self.page_size
+
+        for row in rows:
+            row.pop('patient_diagnosis', None)
+        return rows
+
+    def load_clinic_branding(self, client, user_ids: List[str]) -> Dict[str, Dict]:
+        branding: Dict[str, Dict] = {}
+        for chunk in _chunks(user_ids, IN_FILTER_CHUNK_SIZE):
+            response = client.table('clinic_branding')\
+                .select('user_id, clinic_name, phone, website')\
+                .in_('user_id', chunk)\
+                .execute()
+            for row in response.data or []:
+                branding[row['user_id']] = row
+        return branding
+
+    def load_users(self, client, user_ids: List[str]) -> Dict[str, Dict]:
+        users: Dict[str, Dict] = {}
+        for chunk in _chunks(user_ids, IN_FILTER_CHUNK_SIZE):
+            response = client.table('users')\
+                .select('id, email, clinic_name')\
+                .in_('id', chunk)\
+                .execute()
+            for row in response.data or []:
+                users[row['id']] = row
+        return users
+
+    def write_updates(self, client, updates: List[Dict]) -> None:
+        """
+        Persist sent timestamps for every processed report
+
+        One upsert on report_id (see migrations/add_email_tracking_followup_indexes.sql).
+        If the unique index isn't there yet, fall back to one UPDATE per report.
+        """
+        if not updates:
+            return
+
+        try:
+            client.table('email_tracking')\
+                .upsert(updates, on_conflict='report_id')\
+                .execute()
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Batched tracking upsert failed, updating rows individually: {str(e)}")
+
+        for update in updates:
+            try:
+                client.table('email_tracking')\
+                    .update({
+                        'auto_followup_sent_at': update['auto_followup_sent_at'],
+                        'team_notification_sent_at': update['team_notification_sent_at'],
+                    })\
+                    .eq('report_id', update['report_id'])\
+                    .execute()
+            except Exception as e:
+                logger.error(f"❌ Failed to update tracking for report {update['report_id']}: {str(e)}")
+
+    async def run(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        now = now or datetime.now(timezone.utc)
+        client = supabase_service.get_service_client()
+
+        try:
+            with track_stage("followup_fetch_due"):
+                rows = await asyncio.to_thread(self.fetch_due, client, now)
+        except Exception as e:
+            logger.warning(f"⚠️ Email tracking table not available: {str(e)}")
+            return {"status": "ok", "message": "Email tracking table not created yet", "patient_followups_sent": 0, "team_notifications_sent": 0}
+
+        if not rows:
+            logger.info("✅ No follow-ups needed")
+            return {"status": "ok", "patient_followups_sent": 0, "team_notifications_sent": 0, "total_checked": 0}
+
+        # Decide which actions are due per row (the SQL filter only guarantees at least one)
+        followups, notifications = [], []
+        for row in rows:
+            hours_since_sent = hours_since(row.get('sent_at'), now)
+            if hours_since_sent is None:
+                continue
+            urgency = row.get('urgency_level') or 'low'
+            if not row.get('auto_followup_sent_at') and hours_since_sent >= AUTO_FOLLOWUP_THRESHOLD_HOURS.get(urgency, float('inf')):
+                followups.append(row)
+            if not row.get('team_notification_sent_at') and hours_since_sent >= TEAM_NOTIFICATION_THRESHOLD_HOURS.get(urgency, float('inf')):
+                notifications.append((row, hours_since_sent))
+
+        logger.info(f"📋 {len(rows)} reports due: {len(followups)} patient follow-ups, {len(notifications)} team notifications")
+
+        # Bulk-load clinic info for everything we're about to send
+        with track_stage("followup_load_clinics"):
+            branding, users = await asyncio.gather(
+                asyncio.to_thread(self.load_clinic_branding, client, sorted({r['user_id'] for r in followups if r.get('user_id')})),
+                asyncio.to_thread(self.load_users, client, sorted({r['user_id'] for r, _ in notifications if r.get('user_id')}))
+            )
+
+        messages = []
+        actions = []  # (row, tracking column) per message
+        for row in followups:
+            clinic_branding = branding.get(row.get('user_id'), {})
+            messages.append(self.email_service.build_patient_followup(
+                patient_email=row.get('patient_email'),
+                patient_name=row.get('patient_name'),
+                clinic_name=clinic_branding.get('clinic_name') or 'Your Dental Clinic',
+                clinic_phone=clinic_branding.get('phone') or 'our office',
+                clinic_website=clinic_branding.get('website') or 'our website',
+                urgency_level=row.get('urgency_level'),
+                original_message_id=row.get('original_message_id')
+            ))
+            actions.append((row, 'auto_followup_sent_at'))
+
+        for row, hours_since_sent in notifications:
+            user = users.get(row.get('user_id'))
+            if not user or not user.get('email'):
+                logger.warning(f"⚠️ No clinic admin email for report {row.get('report_id')}, skipping team notification")
+                continue
+            messages.append(self.email_service.build_team_notification(
+                clinic_admin_email=user['email'],
+                patient_name=row.get('patient_name'),
+                patient_email=row.get('patient_email'),
+                clinic_name=user.get('clinic_name') or 'Unknown Clinic',
+                report_id=row.get('report_id'),
+                urgency_level=row.get('urgency_level'),
+                hours_since_sent=hours_since_sent
+            ))
+            actions.append((row, 'team_notification_sent_at'))
+
+        with track_stage("followup_send"):
+            results = await self.email_service.send_batch(messages)
+
+        # Merge successful sends into one update row per report
+        sent_at = datetime.now(timezone.utc).isoformat()
+        updates: Dict[str, Dict] = {}
+        patient_followups_sent = 0
+        team_notifications_sent = 0
+        for (row, column), error in zip(actions, results):
+            report_id = row.get('report_id')
+            if error is not None:
+                logger.error(f"❌ Failed to send {column.replace('_sent_at', '')} for {report_id}: {str(error)}")
+                continue
+            update = updates.setdefault(report_id, {
+                key: row.get(key) for key in UPSERT_COLUMNS
+            })
+            update[column] = sent_at
+            if column == 'auto_followup_sent_at':
+                patient_followups_sent += 1
+            else:
+                team_notifications_sent += 1
+
+        with track_stage("followup_write_tracking"):
+            await asyncio.to_thread(self.write_updates, client, list(updates.values()))
+
+        logger.info(f"✅ Follow-up check complete: {patient_followups_sent} patient emails, {team_notifications_sent} team notifications")
+
+        return {
+            "status": "ok",
+            "patient_followups_sent": patient_followups_sent,
+            "team_notifications_sent": team_notifications_sent,
+            "total_checked": len(rows)
+        }
+
+
+# Initialize service lazily on first use to keep imports cheap
+followup_engine = lazy_service("followup_engine", FollowUpEngine)
+
+
+def get_followup_engine():
+    return registry.get("followup_engine")
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import tempfile
 import logging
@@ -5,18 +6,35 @@ import base64
 import mimetypes
 import re
 from typing import Optional
+from utils.metrics import timed_stage
 
 logger = logging.getLogger(__name__)
 
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+]
+
 
 class HtmlPdfService:
     """Render HTML (with CSS) to PDF.
 
     Primary renderer: Playwright (Chromium) for full-fidelity HTML/CSS.
     Fallback: xhtml2pdf if Playwright is unavailable in the environment.
+
+    Renders share one Chromium process, launched on first use and relaunched
+    if it dies, with at most PDF_RENDER_CONCURRENCY pages open at once, so a
+    batch of reports doesn't start a browser per PDF.
     """
 
     def __init__(self) -> None:
+        self.render_concurrency = max(1, int(os.getenv('PDF_RENDER_CONCURRENCY', '3')))
+        self._playwright = None
+        self._browser = None
+        self._browser_loop = None
+        self._browser_lock: Optional[asyncio.Lock] = None
+        self._render_slots: Optional[asyncio.Semaphore] = None
         self._playwright_available = False
         try:
             # Lazy import check so environments without Playwright still work
@@ -41,6 +59,7 @@ class HtmlPdfService:
             logger.warning("💡 After install, verify logs show: '✅ Using Playwright for PDF'")
             logger.warning("=" * 80)
 
+    @timed_stage("pdf_render")
     async def render_html_to_pdf(self, html: str, base_url: Optional[str] = None) -> str:
         """Render given HTML string to a temporary PDF file and return its path."""
         logger.info(f"🎨 Starting PDF generation. HTML length: {len(html)} chars")
@@ -48,7 +67,8 @@ class HtmlPdfService:
         
         # Convert local file paths in img src attributes to data URLs
         # This must happen BEFORE writing to temp file to ensure images are embedded
-        html = self._convert_local_images_to_data_urls(html)
+        # (image downloads block, so they run off the event loop)
+        html = await asyncio.to_thread(self._convert_local_images_to_data_urls, html)
         
         # Write HTML to a temp file for deterministic base URL handling
         html_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".html", mode='w', encoding='utf-8')
@@ -70,10 +90,10 @@ class HtmlPdfService:
                     logger.error(f"❌ Falling back to xhtml2pdf (LIMITED CSS SUPPORT - WILL BE UGLY)")
                     import traceback
                     logger.error(f"❌ Traceback: {traceback.format_exc()}")
-                    return self._render_with_xhtml2pdf(html)
+                    return await asyncio.to_thread(self._render_with_xhtml2pdf, html)
             else:
                 logger.warning("⚠️ Playwright NOT available, using xhtml2pdf fallback (LIMITED CSS SUPPORT)")
-                return self._render_with_xhtml2pdf(html)
+                return await asyncio.to_thread(self._render_with_xhtml2pdf, html)
         finally:
             try:
                 os.unlink(html_tmp.name)
@@ -88,34 +108,75 @@ class HtmlPdfService:
         pdf_tmp.close()
 
         logger.info("Rendering PDF with Playwright (async)…")
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(args=[
-                "--no-sandbox",
-                "--disable-gpu",
-                "--disable-dev-shm-usage",
-            ])
-            try:
-                page = await browser.new_page()
-                file_url = f"file://{html_path}"
-                logger.info(f"📄 Loading HTML from: {file_url}")
-                
-                # Wait for the page to fully load including all resources
-                await page.goto(file_url, wait_until="networkidle", timeout=60000)
-                
-                # Give any dynamic content a moment to render
-                await page.wait_for_timeout(1000)
-                
-                logger.info("📄 Generating PDF from loaded page...")
-                await page.pdf(path=pdf_path, print_background=True, format="A4", margin={
-                    "top": "14mm", "bottom": "14mm", "left": "14mm", "right": "14mm"
-                })
-                
-                logger.info(f"✅ PDF generated successfully: {pdf_path}")
-            finally:
-                await browser.close()
+        loop = asyncio.get_running_loop()
+        if self._browser_loop not in (None, loop):
+            # Called from a private event loop (e.g. a worker thread); the shared browser belongs to the main one
+            async with async_playwright() as p:
+                browser = await p.chromium.launch(args=CHROMIUM_ARGS)
+                try:
+                    await self._print_page(browser, html_path, pdf_path)
+                finally:
+                    await browser.close()
+        else:
+            async with self._slots():
+                browser = await self._shared_browser()
+                await self._print_page(browser, html_path, pdf_path)
         logger.info(f"PDF written: {pdf_path}")
         return pdf_path
 
+    def _slots(self) -> asyncio.Semaphore:
+        if self._render_slots is None:
+            self._render_slots = asyncio.Semaphore(self.render_concurrency)
+        return self._render_slots
+
+    async def _shared_browser(self):
+        """The shared Chromium, launched on first use and relaunched if it has died"""
+        from playwright.async_api import async_playwright  # type: ignore
+
+        if self._browser_lock is None:
+            self._browser_lock = asyncio.Lock()
+        async with self._browser_lock:
+            if self._browser is None or not self._browser.is_connected():
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
+                self._browser = await self._playwright.chromium.launch(args=CHROMIUM_ARGS)
+                self._browser_loop = asyncio.get_running_loop()
+                logger.info("🔄 Launched shared Chromium for PDF rendering")
+            return self._browser
+
+    async def _print_page(self, browser, html_path: str, pdf_path: str) -> None:
+        page = await browser.new_page()
+        try:
+            file_url = f"file://{html_path}"
+            logger.info(f"📄 Loading HTML from: {file_url}")
+            
+            # Wait for the page to fully load including all resources
+            await page.goto(file_url, wait_until="networkidle", timeout=60000)
+            
+            # Give any dynamic content a moment to render
+            await page.wait_for_timeout(1000)
+            
+            logger.info("📄 Generating PDF from loaded page...")
+            await page.pdf(path=pdf_path, print_background=True, format="A4", margin={
+                "top": "14mm", "bottom": "14mm", "left": "14mm", "right": "14mm"
+            })
+            
+            logger.info(f"✅ PDF generated successfully: {pdf_path}")
+        finally:
+            await page.close()
+
+    async def close(self) -> None:
+        """Close the shared browser (on shutdown)"""
+        if self._browser is not None:
+            try:
+                await self._browser.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Couldn't close shared Chromium: {str(e)}")
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
     def _convert_local_images_to_data_urls(self, html: str) -> str:
         """Convert local file paths and HTTP URLs in img src attributes to data URLs."""
         import requests
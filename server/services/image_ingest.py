@@ -0,0 +1,194 @@
+"""
+Image Ingest
+Decodes an uploaded image once and stores normalised renditions
+
+Uploads arrive as arbitrary-size JPEG/PNG/TIFF with EXIF orientation and
+metadata. `normalise_image` decodes the file once, applies and strips the
+orientation, flattens 16-bit X-rays to 8-bit and renders:
+
+- canonical: analysis-resolution JPEG for Roboflow, GPT vision, overlays and
+  PDFs (PNG with transparency kept for logos)
+- display:   WebP for the browser
+- thumbnail: small WebP for lists and galleries
+
+`store_image_variants` uploads them under a key derived from the SHA-256 of
+the original bytes, so re-uploading the same file lands on the same objects.
+"""
+import hashlib
+import logging
+import os
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Optional, Tuple, Union
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidImageError(ValueError):
+    """The upload could not be decoded as an image"""
+
+
+@dataclass(frozen=True)
+class ImageProfile:
+    name: str
+    canonical_format: str  # JPEG or PNG
+    canonical_max_edge: int
+    display_max_edge: int
+    thumbnail_max_edge: int
+
+
+XRAY_PROFILE = ImageProfile(
+    name="xray",
+    canonical_format="JPEG",
+    canonical_max_edge=int(os.getenv('IMAGE_ANALYSIS_MAX_EDGE', '2048')),
+    display_max_edge=int(os.getenv('IMAGE_DISPLAY_MAX_EDGE', '1600')),
+    thumbnail_max_edge=int(os.getenv('IMAGE_THUMBNAIL_MAX_EDGE', '320')),
+)
+
+# Logos keep their transparency and go into PDFs, which need PNG rather than WebP
+LOGO_PROFILE = ImageProfile(
+    name="logo",
+    canonical_format="PNG",
+    canonical_max_edge=1024,
+    display_max_edge=512,
+    thumbnail_max_edge=128,
+)
+
+JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '90'))
+WEBP_QUALITY = int(os.getenv('IMAGE_WEBP_QUALITY', '80'))
+
+VARIANT_FILES = {
+    "canonical": {"JPEG": ("analysis.jpg", "image/jpeg"), "PNG": ("analysis.png", "image/png")},
+    "display": ("display.webp", "image/webp"),
+    "thumbnail": ("thumb.webp", "image/webp"),
+}
+
+
+@dataclass
+class ImageVariants:
+    content_hash: str
+    width: int
+    height: int
+    renditions: Dict[str, Tuple[bytes, str, str]]  # variant -> (bytes, file name, MIME type)
+
+
+def _to_8bit(image: Image.Image) -> Image.Image:
+    """16-bit and float greyscale (common for TIFF X-rays) scaled into 8-bit"""
+    if image.mode in ('I;16', 'I;16B', 'I;16L', 'I'):
+        image = image.convert('I')
+        low, high = image.getextrema()
+        scale = 255.0 / (high - low) if high > low else 1.0
+        return image.point(lambda value: (value - low) * scale).convert('L')
+    if image.mode == 'F':
+        low, high = image.getextrema()
+        scale = 255.0 / (high - low) if high > low else 1.0
+        return image.point(lambda value: (value - low) * scale).convert('L')
+    return image
+
+
+def _fit(image: Image.Image, max_edge: int) -> Image.Image:
+    if max(image.size) <= max_edge:
+        return image
+    resized = image.copy()
+    resized.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    return resized
+
+
+def _encode(image: Image.Image, image_format: str) -> bytes:
+    buffer = BytesIO()
+    if image_format == "JPEG":
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif image_format == "WEBP":
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        image.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def normalise_image(source: Union[bytes, str], profile: ImageProfile = XRAY_PROFILE,
+                    content_hash: Optional[str] = None) -> ImageVariants:
+    """
+    Decode once, orient, strip metadata and render the canonical, display and thumbnail variants
+
+    `source` is the image bytes or the path of a spooled upload; pass the
+    upload's `content_hash` to avoid hashing the file again.
+    """
+    if content_hash is None:
+        if isinstance(source, bytes):
+            content_hash = hashlib.sha256(source).hexdigest()
+        else:
+            digest = hashlib.sha256()
+            with open(source, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            content_hash = digest.hexdigest()
+    try:
+        with track_stage("image_normalise"), \
+                Image.open(BytesIO(source) if isinstance(source, bytes) else source) as opened:
+            image = opened
+            if image.format == "JPEG":
+                # Let libjpeg decode at a reduced scale when the original is far larger
+                image.draft(image.mode, (profile.canonical_max_edge, profile.canonical_max_edge))
+            image.load()  # first frame of multi-page TIFFs
+            image = ImageOps.exif_transpose(image)
+            image = _to_8bit(image)
+
+            has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+            if image.mode == 'P':
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+            elif image.mode not in ('L', 'RGB', 'RGBA', 'LA'):
+                image = image.convert('RGB')
+            if profile.canonical_format == "JPEG" and image.mode in ('RGBA', 'LA'):
+                # Flatten onto white rather than letting JPEG turn transparency black
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image.convert('RGBA'), mask=image.getchannel('A'))
+                image = background
+            # Metadata (EXIF, ICC, text chunks) is not carried into the renditions
+            image.info = {}
+
+            canonical = _fit(image, profile.canonical_max_edge)
+            display = _fit(canonical, profile.display_max_edge)
+            thumbnail = _fit(display, profile.thumbnail_max_edge)
+
+            canonical_name, canonical_type = VARIANT_FILES["canonical"][profile.canonical_format]
+            renditions = {
+                "canonical": (_encode(canonical, profile.canonical_format), canonical_name, canonical_type),
+                "display": (_encode(display, "WEBP"), *VARIANT_FILES["display"]),
+                "thumbnail": (_encode(thumbnail, "WEBP"), *VARIANT_FILES["thumbnail"]),
+            }
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise InvalidImageError(f"Could not decode image: {str(e)}")
+
+    logger.info(
+        f"✅ Normalised {profile.name} image {content_hash[:12]}: {canonical.size[0]}x{canonical.size[1]}, "
+        + ", ".join(f"{name} {len(rendition[0])}B" for name, rendition in renditions.items())
+    )
+    return ImageVariants(content_hash, canonical.size[0], canonical.size[1], renditions)
+
+
+async def store_image_variants(storage, variants: ImageVariants, folder: str, access_token: str) -> Dict[str, str]:
+    """
+    Upload every rendition under `<folder>/<content hash>/` and return their URLs
+
+    `storage` is the SupabaseService. Raises RuntimeError if any upload fails.
+    """
+    urls = {}
+    for name, (data, file_name, content_type) in variants.renditions.items():
+        url = await storage.upload_image(
+            data,
+            f"{folder}/{variants.content_hash}/{file_name}",
+            access_token,
+            content_type=content_type
+        )
+        if not url:
+            raise RuntimeError(f"Failed to upload {name} rendition")
+        urls[name] = url
+    return urls
@@ -4,6 +4,8 @@ from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
 from typing import Dict, List, Optional, Tuple, Union
 import base64
+from services.registry import lazy_service, registry
+from utils.metrics import timed_stage
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +20,7 @@ class ImageOverlayService:
         # Condition-based styling
         self.condition_font_size_multiplier = 1.5  # Teeth with conditions get 1.5x larger text
         
+    @timed_stage("image_overlay")
     async def add_tooth_number_overlay(
         self, 
         image_url: str, 
@@ -427,20 +430,9 @@ class ImageOverlayService:
         except ValueError:
             return fdi_number
 
-# Create singleton instance
-# Initialize service lazily to avoid import-time errors
-_image_overlay_service = None
+# Initialize service lazily on first use to keep imports cheap
+image_overlay_service = lazy_service("image_overlay", ImageOverlayService)
 
 def get_image_overlay_service():
-    global _image_overlay_service
-    if _image_overlay_service is None:
-        try:
-            _image_overlay_service = ImageOverlayService()
-        except Exception as e:
-            logger.error(f"Failed to initialize ImageOverlay service: {e}")
-            return None
-    return _image_overlay_service
-
-# For backward compatibility
-image_overlay_service = get_image_overlay_service()
+    return registry.get("image_overlay")
 
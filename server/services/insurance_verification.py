@@ -1,11 +1,35 @@
+"""
+Insurance Verification
+Async eligibility checks with cached results and batch verification
+
+Eligibility comes from a pluggable provider adapter: `simulator` (the local
+stand-in, optionally with INSURANCE_SIMULATOR_LATENCY_MS of fake latency) or
+`http` (the provider's eligibility API, used for providers with an
+INSURANCE_<PROVIDER>_API_KEY). INSURANCE_ADAPTER forces one for every provider.
+
+Coverage is cached per (provider, policy, member) until the result's
+next_verification_due date, and concurrent checks of the same member share
+one call. Cost estimates are recomputed from the cached coverage for each
+request's treatment codes. `verify_batch` checks a day's appointment list
+concurrently, with at most INSURANCE_PROVIDER_CONCURRENCY calls in flight
+per provider across the whole process.
+"""
+import asyncio
+import hashlib
 import logging
-import requests
-import json
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 import os
 from dataclasses import dataclass
 
+import httpx
+
+from services.registry import lazy_service, registry
+from utils.metrics import track_stage
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -37,15 +61,155 @@ class VerificationResult:
     estimated_costs: Optional[Dict] = None
     next_verification_due: Optional[str] = None
     notes: Optional[str] = None
+    cached: bool = False
+
+
+def _mock_coverage(provider: InsuranceProvider) -> Dict:
+    """Simulated eligibility response for a provider"""
+    # Mock response based on provider
+    base_coverage = {
+        "delta_dental": {"preventive": 100, "basic": 80, "major": 50},
+        "metlife": {"preventive": 100, "basic": 80, "major": 50},
+        "aetna": {"preventive": 100, "basic": 80, "major": 60},
+        "cigna": {"preventive": 100, "basic": 80, "major": 50},
+        "united_healthcare": {"preventive": 100, "basic": 80, "major": 50}
+    }
+    
+    return {
+        "eligibility_status": "Active",
+        "coverage_period": {
+            "start_date": "2024-01-01",
+            "end_date": "2024-12-31"
+        },
+        "benefits": {
+            "preventive": {"coverage": base_coverage[provider.id]["preventive"], "frequency": "2x/year"},
+            "basic": {"coverage": base_coverage[provider.id]["basic"], "frequency": "unlimited"},
+            "major": {"coverage": base_coverage[provider.id]["major"], "frequency": "unlimited"}
+        },
+        "deductible": {
+            "individual": 50.0,
+            "family": 150.0,
+            "remaining": 25.0
+        },
+        "annual_maximum": 2000.0,
+        "copay": {
+            "preventive": 0.0,
+            "basic": 20.0,
+            "major": 50.0
+        },
+        "provider_info": {
+            "name": provider.name,
+            "phone": provider.phone,
+            "website": provider.website
+        }
+    }
+
+
+class EligibilityAdapter(ABC):
+    """Fetches coverage details for one member from one provider"""
+    name = "base"
+
+    @abstractmethod
+    async def check_eligibility(self, request: VerificationRequest, provider: InsuranceProvider) -> Dict:
+        ...
+
+
+class SimulatedEligibilityAdapter(EligibilityAdapter):
+    """Local stand-in for provider APIs, for development and front-desk demos"""
+    name = "simulator"
+
+    def __init__(self):
+        self.latency_s = float(os.getenv('INSURANCE_SIMULATOR_LATENCY_MS', '0')) / 1000
+
+    async def check_eligibility(self, request: VerificationRequest, provider: InsuranceProvider) -> Dict:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        return _mock_coverage(provider)
+
+
+class HttpEligibilityAdapter(EligibilityAdapter):
+    """Provider eligibility API: POST {api_endpoint}/eligibility, returning coverage details"""
+    name = "http"
+
+    def __init__(self):
+        self.timeout_s = float(os.getenv('INSURANCE_API_TIMEOUT_S', '15'))
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # One pooled client so batches reuse connections to each provider
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout_s)
+        return self._client
+
+    async def check_eligibility(self, request: VerificationRequest, provider: InsuranceProvider) -> Dict:
+        response = await self.client.post(
+            f"{provider.api_endpoint}/eligibility",
+            headers={"Authorization": f"Bearer {provider.api_key}"},
+            json={
+                "policy_number": request.policy_number,
+                "group_number": request.group_number,
+                "subscriber_name": request.subscriber_name,
+                "date_of_birth": request.date_of_birth,
+                "relationship": request.subscriber_relationship
+            }
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+def member_key(request: VerificationRequest) -> Tuple[str, str, str]:
+    """Cache key: (provider, policy, member), normalised so formatting differences share an entry"""
+    member = "|".join(
+        (value or "").strip().lower()
+        for value in (request.subscriber_name, request.date_of_birth, request.subscriber_relationship)
+    )
+    policy = "".join((request.policy_number or "").split()).upper()
+    return request.insurance_provider, policy, hashlib.sha256(member.encode()).hexdigest()[:16]
+
 
 class InsuranceVerificationService:
     def __init__(self):
         self.providers = self._load_providers()
-        self.session = requests.Session()
+        self.adapters: Dict[str, EligibilityAdapter] = {}
+        self.register_adapter(SimulatedEligibilityAdapter())
+        self.register_adapter(HttpEligibilityAdapter())
+        self.adapter_override = os.getenv('INSURANCE_ADAPTER', '').lower() or None
+        self.validity = timedelta(days=int(os.getenv('INSURANCE_VERIFICATION_VALID_DAYS', '30')))
+        
+        # (provider, policy, member) -> (next_verification_due, verification_date, coverage_details)
+        self.cache_size = int(os.getenv('INSURANCE_CACHE_SIZE', '5000'))
+        self._cache: "OrderedDict[Tuple[str, str, str], Tuple[datetime, str, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Tuple[str, str, str], asyncio.Task] = {}
+        self.provider_concurrency = int(os.getenv('INSURANCE_PROVIDER_CONCURRENCY', '5'))
+        self._provider_slots: Dict[str, asyncio.Semaphore] = {}
+        self.cache_hits = 0
+        self.provider_calls = 0
+        
+        logger.info(f"Insurance verification service initialized (adapter: {self.adapter_override or 'auto'})")
+    
+    def register_adapter(self, adapter: EligibilityAdapter) -> None:
+        """Add or replace an eligibility adapter, selectable by name via INSURANCE_ADAPTER"""
+        self.adapters[adapter.name] = adapter
+    
+    def adapter_for(self, provider: InsuranceProvider) -> EligibilityAdapter:
+        if self.adapter_override:
+            adapter = self.adapters.get(self.adapter_override)
+            if not adapter:
+                raise ValueError(f"Unknown insurance adapter: {self.adapter_override}")
+            return adapter
+        return self.adapters["http" if provider.api_key else "simulator"]
+    
+    def _provider_slot(self, provider_id: str) -> asyncio.Semaphore:
+        if provider_id not in self._provider_slots:
+            limit = int(os.getenv(f'INSURANCE_{provider_id.upper()}_CONCURRENCY', str(self.provider_concurrency)))
+            self._provider_slots[provider_id] = asyncio.Semaphore(limit)
+        return self._provider_slots[provider_id]
         
     def _load_providers(self) -> Dict[str, InsuranceProvider]:
         """Load insurance providers configuration"""
-        return {
+        providers = {
             "delta_dental": InsuranceProvider(
                 id="delta_dental",
                 name="Delta Dental",
@@ -82,23 +246,82 @@ class InsuranceVerificationService:
                 website="https://www.uhcdental.com"
             )
         }
+        for provider in providers.values():
+            provider.api_key = os.getenv(f"INSURANCE_{provider.id.upper()}_API_KEY")
+        return providers
+    
+    def _cached_coverage(self, key: Tuple[str, str, str]) -> Optional[Tuple[datetime, str, Dict]]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= datetime.now():
+                # Past next_verification_due, so the provider is asked again
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry
+    
+    def _store_coverage(self, key: Tuple[str, str, str], entry: Tuple[datetime, str, Dict]) -> None:
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    async def _fetch_coverage(self, request: VerificationRequest, provider: InsuranceProvider) -> Tuple[datetime, str, Dict]:
+        adapter = self.adapter_for(provider)
+        async with self._provider_slot(provider.id):
+            self.provider_calls += 1
+            with track_stage(f"insurance_eligibility_{adapter.name}"):
+                coverage_details = await adapter.check_eligibility(request, provider)
+        verified_at = datetime.now()
+        return verified_at + self.validity, verified_at.isoformat(), coverage_details
+    
+    async def _coverage(self, request: VerificationRequest, provider: InsuranceProvider,
+                        force_refresh: bool) -> Tuple[Tuple[datetime, str, Dict], bool]:
+        """Coverage for the member, from the cache until it is due again; returns (entry, cached)"""
+        key = member_key(request)
+        if not force_refresh:
+            entry = self._cached_coverage(key)
+            if entry is not None:
+                self.cache_hits += 1
+                return entry, True
+        
+        # Concurrent checks of the same member (e.g. two family appointments) share one call.
+        # It runs as its own task, so a cancelled caller doesn't cancel it for the others.
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_and_store(key, request, provider))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish_in_flight(key, done))
+        return await asyncio.shield(task), False
+    
+    def _finish_in_flight(self, key: Tuple[str, str, str], task: asyncio.Task) -> None:
+        self._in_flight.pop(key, None)
+        # Mark a failure retrieved in case every caller had already given up waiting
+        if not task.cancelled():
+            task.exception()
+    
+    async def _fetch_and_store(self, key: Tuple[str, str, str], request: VerificationRequest,
+                               provider: InsuranceProvider) -> Tuple[datetime, str, Dict]:
+        entry = await self._fetch_coverage(request, provider)
+        self._store_coverage(key, entry)
+        return entry
     
-    def verify_insurance(self, request: VerificationRequest) -> VerificationResult:
+    async def verify_insurance(self, request: VerificationRequest, force_refresh: bool = False) -> VerificationResult:
         """Verify insurance coverage for a patient"""
+        # Generate verification ID
+        verification_id = f"VERIFY-{datetime.now().strftime('%Y%m%d')}-{request.patient_id[:8]}"
         try:
             logger.info(f"Starting insurance verification for patient: {request.patient_id}")
             
-            # Generate verification ID
-            verification_id = f"VERIFY-{datetime.now().strftime('%Y%m%d')}-{request.patient_id[:8]}"
-            
             # Get provider configuration
             provider = self.providers.get(request.insurance_provider)
             if not provider:
                 raise ValueError(f"Unknown insurance provider: {request.insurance_provider}")
             
-            # In production, this would make real API calls to insurance providers
-            # For now, we'll simulate the verification process
-            coverage_details = self._simulate_verification(request, provider)
+            (next_due, verification_date, coverage_details), cached = await self._coverage(request, provider, force_refresh)
             estimated_costs = self._calculate_cost_estimates(request, coverage_details)
             
             return VerificationResult(
@@ -106,72 +329,34 @@ class InsuranceVerificationService:
                 status="completed",
                 coverage_details=coverage_details,
                 estimated_costs=estimated_costs,
-                verification_date=datetime.now().isoformat(),
-                next_verification_due=(datetime.now() + timedelta(days=30)).isoformat(),
-                notes="Insurance verification completed successfully"
+                verification_date=verification_date,
+                next_verification_due=next_due.isoformat(),
+                notes=("Using verification from " + verification_date[:10]) if cached
+                      else "Insurance verification completed successfully",
+                cached=cached
             )
             
         except Exception as e:
             logger.error(f"Insurance verification failed: {str(e)}")
             return VerificationResult(
-                verification_id=verification_id if 'verification_id' in locals() else "VERIFY-ERROR",
+                verification_id=verification_id,
                 status="failed",
                 verification_date=datetime.now().isoformat(),
-                notes=f"Verification failed: {str(e)}"
+                notes=f"Verification failed: {str(e) or type(e).__name__}"
             )
     
-    def _simulate_verification(self, request: VerificationRequest, provider: InsuranceProvider) -> Dict:
-        """Simulate insurance verification (replace with real API calls)"""
-        # This would be replaced with actual API calls to insurance providers
-        # Example API call structure:
-        # response = self.session.post(
-        #     f"{provider.api_endpoint}/eligibility",
-        #     headers={"Authorization": f"Bearer {provider.api_key}"},
-        #     json={
-        #         "policy_number": request.policy_number,
-        #         "group_number": request.group_number,
-        #         "subscriber_name": request.subscriber_name,
-        #         "date_of_birth": request.date_of_birth,
-        #         "relationship": request.subscriber_relationship
-        #     }
-        # )
-        
-        # Mock response based on provider
-        base_coverage = {
-            "delta_dental": {"preventive": 100, "basic": 80, "major": 50},
-            "metlife": {"preventive": 100, "basic": 80, "major": 50},
-            "aetna": {"preventive": 100, "basic": 80, "major": 60},
-            "cigna": {"preventive": 100, "basic": 80, "major": 50},
-            "united_healthcare": {"preventive": 100, "basic": 80, "major": 50}
-        }
-        
+    async def verify_batch(self, requests: List[VerificationRequest], force_refresh: bool = False) -> List[VerificationResult]:
+        """Verify a list of appointments concurrently; results are in request order"""
+        return await asyncio.gather(*(self.verify_insurance(request, force_refresh) for request in requests))
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            cached_members = len(self._cache)
         return {
-            "eligibility_status": "Active",
-            "coverage_period": {
-                "start_date": "2024-01-01",
-                "end_date": "2024-12-31"
-            },
-            "benefits": {
-                "preventive": {"coverage": base_coverage[provider.id]["preventive"], "frequency": "2x/year"},
-                "basic": {"coverage": base_coverage[provider.id]["basic"], "frequency": "unlimited"},
-                "major": {"coverage": base_coverage[provider.id]["major"], "frequency": "unlimited"}
-            },
-            "deductible": {
-                "individual": 50.0,
-                "family": 150.0,
-                "remaining": 25.0
-            },
-            "annual_maximum": 2000.0,
-            "copay": {
-                "preventive": 0.0,
-                "basic": 20.0,
-                "major": 50.0
-            },
-            "provider_info": {
-                "name": provider.name,
-                "phone": provider.phone,
-                "website": provider.website
-            }
+            "cached_members": cached_members,
+            "cache_hits": self.cache_hits,
+            "provider_calls": self.provider_calls,
+            "in_flight": len(self._in_flight),
         }
     
     def _calculate_cost_estimates(self, request: VerificationRequest, coverage_details: Dict) -> Dict:
@@ -282,19 +467,8 @@ class InsuranceVerificationService:
             "last_verified": datetime.now().isoformat()
         }
 
-# Global instance
-# Initialize service lazily to avoid import-time errors
-_insurance_service = None
+# Initialize service lazily on first use to keep imports cheap
+insurance_service = lazy_service("insurance", InsuranceVerificationService)
 
 def get_insurance_service():
-    global _insurance_service
-    if _insurance_service is None:
-        try:
-            _insurance_service = InsuranceVerificationService()
-        except Exception as e:
-            logger.error(f"Failed to initialize InsuranceVerification service: {e}")
-            return None
-    return _insurance_service
-
-# For backward compatibility
-insurance_service = get_insurance_service()
+    return registry.get("insurance")
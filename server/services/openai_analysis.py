@@ -1,15 +1,24 @@
+import asyncio
+import threading
 import os
 import json
 import logging
-from typing import Dict, List
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from openai import OpenAI
 from dotenv import load_dotenv
 from models.analyze import TreatmentStage, TreatmentItem
+from services.completion_cache import cached_completion
+from services.registry import lazy_service, registry
+from utils.html_stream import HtmlSectionStream
+from utils.metrics import timed_stage, track_stage
+from utils.report_validation import BoxDiagnostic, ReportValidation, replace_boxes, validate_report_html
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+HTML_REPORT_RETRY_INSTRUCTION = "\n\nIMPORTANT: If you hit token limits, prioritize complete descriptions over length. Each description must be complete."
+
 class OpenAIService:
     def __init__(self):
         self.api_key = os.getenv("OPENAI_API_KEY")
@@ -26,6 +35,7 @@ class OpenAIService:
         self.model_summary = os.getenv("OPENAI_MODEL_SUMMARY", "gpt-4o")
         self.model_script = os.getenv("OPENAI_MODEL_SCRIPT", "gpt-4o")
     
+    @timed_stage("openai_analysis", model_attr="model_analysis")
     async def analyze_dental_conditions(self, roboflow_predictions: Dict, patient_findings: List[Dict]) -> Dict:
         """
         Use GPT to analyze Roboflow predictions and generate treatment plan
@@ -116,7 +126,10 @@ Keep the tone professional, educational, and reassuring. Avoid clinical jargon u
             
             Please provide a comprehensive analysis and treatment plan with staged treatments."""
             
-            response = self.client.chat.completions.create(
+            content = cached_completion(
+                self.client,
+                "dental_analysis",
+                cache=True,
                 model=self.model_analysis,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -125,7 +138,7 @@ Keep the tone professional, educational, and reassuring. Avoid clinical jargon u
                 response_format={"type": "json_object"}
             )
             
-            result = json.loads(response.choices[0].message.content)
+            result = json.loads(content)
             
             # Add the raw detections with confidence scores to the result
             result['detections'] = detections['automated']
@@ -173,6 +186,58 @@ Keep the tone professional, educational, and reassuring. Avoid clinical jargon u
             'manual': manual
         }
 
+    @timed_stage("openai_plan_prose", model_attr="model_summary")
+    async def write_plan_prose(self, treatment_stages: List[Dict], unmapped_conditions: List[str]) -> Dict:
+        """
+        Write the summary and dentist notes for an already-built treatment plan
+
+        The plan itself comes from the rule-based planner; GPT only rewords it.
+        Raises on failure so the caller can keep its templated prose.
+        """
+        system_prompt = """You are an expert dental AI assistant. You will receive a staged dental treatment plan
+that has already been decided. Do not add, remove or change any treatments, teeth, prices or stages.
+
+Return a JSON response with the following structure:
+{
+    "summary": "Brief plain-language summary of the detected conditions and the plan",
+    "ai_notes": "Professional notes for the dentist: priorities, sequencing considerations, anything to confirm clinically"
+}"""
+
+        plan = [
+            {
+                'stage': stage.get('stage'),
+                'focus': stage.get('focus'),
+                'items': [
+                    {key: item.get(key) for key in ('tooth', 'condition', 'recommended_treatment', 'quantity')}
+                    for item in stage.get('items', [])
+                ]
+            }
+            for stage in treatment_stages
+        ]
+        user_prompt = f"""Treatment plan:
+{json.dumps(plan, indent=2)}
+
+Conditions with no standard treatment (flag for manual review): {json.dumps(unmapped_conditions)}"""
+
+        content = await asyncio.to_thread(
+            cached_completion,
+            self.client,
+            "plan_prose",
+            cache=True,
+            model=self.model_summary,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            response_format={"type": "json_object"}
+        )
+
+        result = json.loads(content)
+        return {
+            'summary': result.get('summary', ''),
+            'ai_notes': result.get('ai_notes', '')
+        }
+
     def _get_urgency_level(self, condition: str) -> str:
         """Determine urgency level based on hard-coded clinical logic"""
         # Normalize condition name
@@ -197,16 +262,15 @@ Keep the tone professional, educational, and reassuring. Avoid clinical jargon u
             # LOW URGENCY (Existing dental work or other conditions)
             return 'low'
     
-    async def generate_video_script(self, treatment_stages: List[Dict], annotated_image_base64: str, patient_name: str = None, language: str = "english") -> str:
-        """Generate video voiceover script for patient education using vision model"""
-        try:
-            # Determine language-specific instructions
-            language_name = "Bulgarian" if language.lower() == "bulgarian" else "English"
-            language_instruction = ""
-            if language.lower() == "bulgarian":
-                language_instruction = "\n\n**CRITICAL: Generate the ENTIRE script in Bulgarian language. Use proper Bulgarian grammar, dental terminology, and natural phrasing. Do NOT use English.**\n"
-            
-            system_prompt = f"""You are a **professional dental education specialist** creating a **clear, concise, and easy-to-understand** voiceover script for **dental patient education** based on a panoramic x-ray.{language_instruction}
+    def _video_script_prompts(self, treatment_stages: List[Dict], patient_name: str = None, language: str = "english"):
+        """System prompt, user prompt and language name for the patient video script"""
+        # Determine language-specific instructions
+        language_name = "Bulgarian" if language.lower() == "bulgarian" else "English"
+        language_instruction = ""
+        if language.lower() == "bulgarian":
+            language_instruction = "\n\n**CRITICAL: Generate the ENTIRE script in Bulgarian language. Use proper Bulgarian grammar, dental terminology, and natural phrasing. Do NOT use English.**\n"
+
+        system_prompt = f"""You are a **professional dental education specialist** creating a **clear, concise, and easy-to-understand** voiceover script for **dental patient education** based on a panoramic x-ray.{language_instruction}
 
 This is for **professional dental practice communication** - a standard educational video that shows an **annotated dental x-ray** with **color-coded highlights** for patient understanding.
 
@@ -296,68 +360,68 @@ For each color/condition present, generate one paragraph following this structur
 - Keep sentences short and clear.
 - Do **not** include an outro — stop after the final relevant paragraph."""
 
-            # Extract findings from treatment stages
-            findings = []
-            for stage in treatment_stages:
-                for item in stage.get('items', []):
-                    findings.append({
-                        'tooth': item.get('tooth', ''),
-                        'condition': item.get('condition', ''),
-                        'treatment': item.get('recommended_treatment', '')
-                    })
-
-            # Identify existing dental work conditions
-            EXISTING_WORK_CONDITIONS = {
-                'filling': 'bright red',
-                'crown': 'magenta pink',
-                'implant': 'lime green',
-                'root-canal-treatment': 'bright red',
-                'root canal treatment': 'bright red',
-                'post': 'turquoise'
-            }
-            
-            # Check which existing dental work is actually present
-            existing_work_found = []
-            for finding in findings:
-                condition = finding.get('condition', '').lower()
-                if condition in EXISTING_WORK_CONDITIONS:
-                    color = EXISTING_WORK_CONDITIONS[condition]
-                    # Format condition name nicely
-                    condition_display = condition.replace('-', ' ').replace('root canal treatment', 'root canal treatment')
-                    existing_work_found.append({
-                        'condition': condition_display,
-                        'color': color
-                    })
-            
-            # Remove duplicates
-            seen = set()
-            unique_existing_work = []
-            for work in existing_work_found:
-                key = (work['condition'], work['color'])
-                if key not in seen:
-                    seen.add(key)
-                    unique_existing_work.append(work)
-            
-            logger.info(f"🦷 Existing dental work found: {unique_existing_work}")
+        # Extract findings from treatment stages
+        findings = []
+        for stage in treatment_stages:
+            for item in stage.get('items', []):
+                findings.append({
+                    'tooth': item.get('tooth', ''),
+                    'condition': item.get('condition', ''),
+                    'treatment': item.get('recommended_treatment', '')
+                })
 
-            # Prepare patient name for greeting
-            greeting_name = patient_name if patient_name else None
-            name_instruction = f"Use the patient name '{patient_name}' in the opening greeting." if greeting_name else "Use 'Hi there' in the opening greeting since no patient name was provided."
-            
-            # Language-specific instruction
-            language_reminder = ""
-            if language.lower() == "bulgarian":
-                language_reminder = "\n\n**REMINDER: Write the ENTIRE script in Bulgarian language, not English.**"
-
-            # Build existing dental work instruction if applicable
-            existing_work_instruction = ""
-            if unique_existing_work:
-                work_descriptions = []
-                for work in unique_existing_work:
-                    work_descriptions.append(f"{work['color']} ({work['condition']})")
-                
-                work_list = ", ".join(work_descriptions)
-                existing_work_instruction = f"""
+        # Identify existing dental work conditions
+        EXISTING_WORK_CONDITIONS = {
+            'filling': 'bright red',
+            'crown': 'magenta pink',
+            'implant': 'lime green',
+            'root-canal-treatment': 'bright red',
+            'root canal treatment': 'bright red',
+            'post': 'turquoise'
+        }
+
+        # Check which existing dental work is actually present
+        existing_work_found = []
+        for finding in findings:
+            condition = finding.get('condition', '').lower()
+            if condition in EXISTING_WORK_CONDITIONS:
+                color = EXISTING_WORK_CONDITIONS[condition]
+                # Format condition name nicely
+                condition_display = condition.replace('-', ' ').replace('root canal treatment', 'root canal treatment')
+                existing_work_found.append({
+                    'condition': condition_display,
+                    'color': color
+                })
+
+        # Remove duplicates
+        seen = set()
+        unique_existing_work = []
+        for work in existing_work_found:
+            key = (work['condition'], work['color'])
+            if key not in seen:
+                seen.add(key)
+                unique_existing_work.append(work)
+
+        logger.info(f"🦷 Existing dental work found: {unique_existing_work}")
+
+        # Prepare patient name for greeting
+        greeting_name = patient_name if patient_name else None
+        name_instruction = f"Use the patient name '{patient_name}' in the opening greeting." if greeting_name else "Use 'Hi there' in the opening greeting since no patient name was provided."
+
+        # Language-specific instruction
+        language_reminder = ""
+        if language.lower() == "bulgarian":
+            language_reminder = "\n\n**REMINDER: Write the ENTIRE script in Bulgarian language, not English.**"
+
+        # Build existing dental work instruction if applicable
+        existing_work_instruction = ""
+        if unique_existing_work:
+            work_descriptions = []
+            for work in unique_existing_work:
+                work_descriptions.append(f"{work['color']} ({work['condition']})")
+
+            work_list = ", ".join(work_descriptions)
+            existing_work_instruction = f"""
 
 **IMPORTANT - EXISTING DENTAL WORK:**
 The patient has the following existing dental work that should be mentioned at the END of the script:
@@ -366,13 +430,13 @@ The patient has the following existing dental work that should be mentioned at t
 Include a final paragraph like: "You'll also see some existing dental work — like the [list colors] areas — showing your [list conditions, e.g. fillings and root canal treatments]. Everything there looks stable and functioning well."
 
 Use the actual colors and conditions from the list above."""
-            else:
-                existing_work_instruction = """
+        else:
+            existing_work_instruction = """
 
 **IMPORTANT - NO EXISTING DENTAL WORK:**
 Do NOT include any paragraph about existing dental work, as none is present in this case."""
 
-            user_prompt = f"""Based on this dental X-ray analysis, create a concise, grouped-by-condition voiceover script IN {language_name.upper()}.
+        user_prompt = f"""Based on this dental X-ray analysis, create a concise, grouped-by-condition voiceover script IN {language_name.upper()}.
 
 {name_instruction}{language_reminder}
 
@@ -385,35 +449,65 @@ Please analyze the uploaded annotated X-ray image as well, and use it to identif
 {existing_work_instruction}
 
 Generate a short, friendly script IN {language_name.upper()} following the structure in the system prompt."""
+        return system_prompt, user_prompt, language_name
 
-            # Use vision-capable model (gpt-4o or gpt-4o-mini)
-            response = self.client.chat.completions.create(
-                model="gpt-4o",  # Vision-capable model
-                messages=[
-                    {"role": "system", "content": system_prompt},
+    @staticmethod
+    def _video_script_messages(system_prompt: str, user_prompt: str, annotated_image_base64: str) -> List[Dict]:
+        return [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": user_prompt},
                     {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": user_prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{annotated_image_base64}"
-                                }
-                            }
-                        ]
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/png;base64,{annotated_image_base64}"
+                        }
                     }
-                ],
+                ]
+            }
+        ]
+
+    @staticmethod
+    def _is_refusal(script: str) -> bool:
+        """OpenAI's safety filter answers with an apology instead of a script"""
+        return "sorry" in script.lower() and ("can't" in script.lower() or "cannot" in script.lower())
+
+    @timed_stage("openai_video_script", model="gpt-4o")
+    async def generate_video_script(self, treatment_stages: List[Dict], annotated_image_base64: str, patient_name: str = None,
+                                    language: str = "english", force_refresh: bool = False) -> str:
+        """
+        Generate video voiceover script for patient education using vision model
+
+        `force_refresh` skips the completion cache so a regenerated video gets a new script.
+        """
+        try:
+            system_prompt, user_prompt, language_name = self._video_script_prompts(treatment_stages, patient_name, language)
+
+            # Use vision-capable model (gpt-4o or gpt-4o-mini). The prompt names the
+            # patient, so the script is cached in memory only; refusals aren't cached
+            script = cached_completion(
+                self.client,
+                "video_script",
+                cache=not force_refresh,
+                persist=False,
+                validate=lambda content: not self._is_refusal(content),
+                model="gpt-4o",  # Vision-capable model
+                messages=self._video_script_messages(system_prompt, user_prompt, annotated_image_base64),
                 max_completion_tokens=1500  # Increased for more detailed vision-based analysis
             )
-            
-            script = response.choices[0].message.content.strip()
+            script = script.strip()
             
             # Check if OpenAI refused the request (safety filter)
-            if "sorry" in script.lower() and ("can't" in script.lower() or "cannot" in script.lower()):
+            if self._is_refusal(script):
                 logger.warning("⚠️ OpenAI safety filter detected - falling back to text-only script generation")
                 # Fallback: generate script without image analysis
-                fallback_response = self.client.chat.completions.create(
+                script = cached_completion(
+                    self.client,
+                    "video_script_text_only",
+                    cache=not force_refresh,
+                    persist=False,
                     model="gpt-4o",
                     messages=[
                         {"role": "system", "content": system_prompt},
@@ -421,7 +515,7 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
                     ],
                     max_completion_tokens=1500
                 )
-                script = fallback_response.choices[0].message.content.strip()
+                script = script.strip()
                 logger.info("✅ Generated fallback script without image")
             
             logger.info(f"✅ Successfully generated video script in {language_name} using vision model")
@@ -433,12 +527,9 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
             logger.error(f"Error generating video script: {str(e)}")
             raise
     
-    async def generate_immediate_findings_summary(self, roboflow_predictions: Dict) -> Dict:
-        """
-        Generate immediate findings summary for dentist reference
-        """
-        try:
-            system_prompt = """You are an expert dental AI assistant analyzing panoramic X-ray results. 
+    def _findings_summary_prompts(self, roboflow_predictions: Dict):
+        """System and user prompts for the immediate findings summary"""
+        system_prompt = """You are an expert dental AI assistant analyzing panoramic X-ray results. 
             Your task is to provide a comprehensive summary of detected conditions to help the dentist 
             understand what the AI has found and use this information to fill out their findings.
 
@@ -476,30 +567,42 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
             - LOW URGENCY: All other conditions (existing dental work like crown, filling, implant, post, root-canal-treatment)
             
             Always use the exact condition name from the detection for urgency determination."""
-            
-            # Format detections for analysis
-            detections = []
-            if roboflow_predictions and 'predictions' in roboflow_predictions:
-                for pred in roboflow_predictions['predictions']:
-                    detections.append({
-                        'class': pred.get('class', 'Unknown'),
-                        'confidence': pred.get('confidence', 0),
-                        'location': {
-                            'x': pred.get('x', 0),
-                            'y': pred.get('y', 0),
-                            'width': pred.get('width', 0),
-                            'height': pred.get('height', 0)
-                        }
-                    })
-            
-            user_prompt = f"""Analyze these AI-detected dental conditions from the panoramic X-ray:
+
+        # Format detections for analysis
+        detections = []
+        if roboflow_predictions and 'predictions' in roboflow_predictions:
+            for pred in roboflow_predictions['predictions']:
+                detections.append({
+                    'class': pred.get('class', 'Unknown'),
+                    'confidence': pred.get('confidence', 0),
+                    'location': {
+                        'x': pred.get('x', 0),
+                        'y': pred.get('y', 0),
+                        'width': pred.get('width', 0),
+                        'height': pred.get('height', 0)
+                    }
+                })
+
+        user_prompt = f"""Analyze these AI-detected dental conditions from the panoramic X-ray:
 
             Detections:
             {json.dumps(detections, indent=2)}
 
             Please provide a comprehensive clinical summary to assist the dentist in their assessment."""
-            
-            response = self.client.chat.completions.create(
+        return system_prompt, user_prompt
+
+    @timed_stage("openai_findings_summary", model_attr="model_summary")
+    async def generate_immediate_findings_summary(self, roboflow_predictions: Dict) -> Dict:
+        """
+        Generate immediate findings summary for dentist reference
+        """
+        try:
+            system_prompt, user_prompt = self._findings_summary_prompts(roboflow_predictions)
+
+            content = cached_completion(
+                self.client,
+                "findings_summary",
+                cache=True,
                 model=self.model_summary,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -508,7 +611,7 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
                 response_format={"type": "json_object"}
             )
             
-            result = json.loads(response.choices[0].message.content)
+            result = json.loads(content)
             logger.info("Successfully generated immediate findings summary")
             return result
             
@@ -522,12 +625,27 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
                 "areas_needing_attention": []
             }
 
-    async def generate_html_report_content(self, patient_findings: List[Dict], patient_name: str) -> str:
-        """
-        Generate HTML report content directly from dentist findings using GPT
-        """
-        try:
-            system_prompt = """You are an expert dental AI assistant creating a comprehensive treatment report. 
+    @staticmethod
+    def _strip_code_fences(html_content: str) -> str:
+        """Clean up any markdown code fences that might wrap the HTML"""
+        html_content = html_content.strip()
+        if html_content.startswith("```html"):
+            html_content = html_content[7:]  # Remove ```html
+            if html_content.endswith("```"):
+                html_content = html_content[:-3]  # Remove trailing ```
+        elif html_content.startswith("```"):
+            # Remove generic code fences
+            lines = html_content.split('\n')
+            if lines[0].strip() == '```' or lines[0].strip().startswith('```'):
+                lines = lines[1:]
+            if lines and (lines[-1].strip() == '```' or lines[-1].strip().endswith('```')):
+                lines = lines[:-1]
+            html_content = '\n'.join(lines)
+        return html_content.strip()
+
+    def _html_report_prompts(self, patient_findings: List[Dict], patient_name: str):
+        """System and user prompts for the GPT-written HTML report"""
+        system_prompt = """You are an expert dental AI assistant creating a comprehensive treatment report. 
             Your task is to generate a complete HTML report based on the dentist's confirmed findings.
 
             Generate a professional, patient-friendly HTML report with the following sections:
@@ -576,25 +694,41 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
             - LOW URGENCY: All other conditions (existing dental work like crown, filling, implant, post, root-canal-treatment)
 
             Return the complete HTML report as a single string. Ensure every description is complete and comprehensive."""
-            
-            # Format findings for the prompt
-            findings_text = ""
-            for i, finding in enumerate(patient_findings, 1):
-                findings_text += f"""
+
+        # Format findings for the prompt
+        findings_text = ""
+        for i, finding in enumerate(patient_findings, 1):
+            findings_text += f"""
                 Finding {i}:
                 - Tooth: {finding.get('tooth', 'N/A')}
                 - Condition: {finding.get('condition', 'N/A')}
                 - Treatment: {finding.get('treatment', 'N/A')}
                 """
-            
-            user_prompt = f"""Generate a complete HTML treatment report for patient: {patient_name}
+
+        user_prompt = f"""Generate a complete HTML treatment report for patient: {patient_name}
 
             Dentist's Confirmed Findings:
             {findings_text}
 
             Please generate a comprehensive HTML report with treatment overview table, plan summary, and detailed condition explanations."""
-            
-            response = self.client.chat.completions.create(
+        return system_prompt, user_prompt
+
+    @timed_stage("openai_html_report", model_attr="model_html")
+    async def generate_html_report_content(self, patient_findings: List[Dict], patient_name: str) -> str:
+        """
+        Generate HTML report content directly from dentist findings using GPT
+        """
+        try:
+            system_prompt, user_prompt = self._html_report_prompts(patient_findings, patient_name)
+
+            # The prompt names the patient, so the report is cached in memory only,
+            # and only when it passes validation as generated
+            content = cached_completion(
+                self.client,
+                "html_report",
+                cache=True,
+                persist=False,
+                validate=lambda content: validate_report_html(self._strip_code_fences(content)).ok,
                 model=self.model_html,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -603,47 +737,36 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
                 max_completion_tokens=4000
             )
             
-            html_content = response.choices[0].message.content.strip()
-            
-            # Clean up any markdown code fences that might wrap the HTML
-            if html_content.startswith("```html"):
-                html_content = html_content[7:]  # Remove ```html
-                if html_content.endswith("```"):
-                    html_content = html_content[:-3]  # Remove trailing ```
-            elif html_content.startswith("```"):
-                # Remove generic code fences
-                lines = html_content.split('\n')
-                if lines[0].strip() == '```' or lines[0].strip().startswith('```'):
-                    lines = lines[1:]
-                if lines and (lines[-1].strip() == '```' or lines[-1].strip().endswith('```')):
-                    lines = lines[:-1]
-                html_content = '\n'.join(lines)
-            
-            html_content = html_content.strip()
+            html_content = self._strip_code_fences(content)
             logger.info("Successfully generated HTML report content")
             
-            # Validate that all descriptions are complete (no truncated sentences)
-            if self._has_truncated_descriptions(html_content):
-                logger.warning(f"Detected truncated descriptions in HTML, regenerating with higher token limit")
+            # Validate that all descriptions are complete, regenerating just the flagged boxes
+            complete_html = await self._complete_report(html_content, patient_findings)
+            if complete_html is None:
+                logger.warning(f"Regenerating whole report with higher token limit")
                 # Try again with higher token limit
-                response = self.client.chat.completions.create(
+                content = cached_completion(
+                    self.client,
+                    "html_report_retry",
+                    cache=False,
                     model=self.model_html,
                     messages=[
-                        {"role": "system", "content": system_prompt + "\n\nIMPORTANT: If you hit token limits, prioritize complete descriptions over length. Each description must be complete."},
+                        {"role": "system", "content": system_prompt + HTML_REPORT_RETRY_INSTRUCTION},
                         {"role": "user", "content": user_prompt}
                     ],
                     max_completion_tokens=6000  # Increase token limit for complete descriptions
                 )
-                html_content = response.choices[0].message.content.strip()
+                html_content = self._strip_code_fences(content)
                 logger.info("Regenerated HTML content with higher token limit")
                 
                 # Check again after regeneration
-                if self._has_truncated_descriptions(html_content):
+                complete_html = await self._complete_report(html_content, patient_findings)
+                if complete_html is None:
                     logger.warning(f"Still detecting truncated descriptions after regeneration, using fallback system")
                     fallback_html = self._generate_fallback_descriptions(patient_findings)
                     return fallback_html
             
-            return html_content
+            return complete_html
             
         except Exception as e:
             logger.error(f"Error generating HTML report content: {str(e)}")
@@ -651,92 +774,77 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
             fallback_html = self._generate_fallback_descriptions(patient_findings)
             return fallback_html
 
-    def _has_truncated_descriptions(self, html_content: str) -> bool:
+    async def _repair_condition_boxes(self, html_content: str, validation: ReportValidation,
+                                      patient_findings: List[Dict]) -> Optional[str]:
         """
-        Checks if any condition explanation box in the HTML content has a truncated description.
-        Looks for incomplete sentences, missing content, or cut-off text.
+        Regenerate only the condition boxes the validator flagged and splice them in
+
+        Returns None if any replacement still fails validation, so the caller
+        can fall back to regenerating the whole report.
         """
-        # Check for common truncation patterns
-        truncation_indicators = [
-            # Incomplete sentences that end abruptly
-            '...',
-            '..',
-            '. .',
-            # Common incomplete phrases
-            'This condition',
-            'The treatment',
-            'Without treatment',
-            'Early treatment',
-            'Delaying treatment',
-            # Check if any "What This Means" sections are too short
-            'What This Means:</strong><br>',
-            'Recommended Treatment:</strong><br>',
-            'Urgency:</strong><br>'
-        ]
-        
-        for indicator in truncation_indicators:
-            if indicator in html_content:
-                logger.warning(f"Found potential truncation indicator: {indicator}")
-                return True
-        
-        # Check if any condition explanation boxes have very short content
-        # Look for the pattern: <div class="condition-explanation">...content...</div>
-        import re
-        condition_boxes = re.findall(r'<div class="condition-explanation">(.*?)</div>', html_content, re.DOTALL)
-        
-        for box in condition_boxes:
-            # Remove HTML tags to get plain text
-            import re
-            plain_text = re.sub(r'<[^>]+>', '', box)
-            plain_text = re.sub(r'&[^;]+;', '', plain_text)  # Remove HTML entities
-            
-            # Check if the text is too short (likely truncated) - REDUCED THRESHOLD
-            if len(plain_text.strip()) < 150:  # Increased from 100 to catch more incomplete descriptions
-                logger.warning(f"Found suspiciously short condition description: {plain_text.strip()[:100]}...")
-                return True
-            
-            # Check for incomplete sentences (sentences that don't end with proper punctuation)
-            sentences = plain_text.split('.')
-            for sentence in sentences:
-                sentence = sentence.strip()
-                if sentence and not sentence.endswith(('.', '!', '?')) and len(sentence) > 20:
-                    # Long sentence without proper ending - likely truncated
-                    logger.warning(f"Found incomplete sentence: {sentence[:100]}...")
-                    return True
-            
-            # Specific check for incomplete caries descriptions
-            if 'caries' in plain_text.lower() and len(plain_text.strip()) < 200:
-                logger.warning(f"Found incomplete caries description: {plain_text.strip()[:100]}...")
-                return True
-            
-            # Check for the specific incomplete description that appeared in the report
-            if 'caries is a dental condition that requires professional treatment' in plain_text.lower():
-                logger.warning(f"Found the exact incomplete caries description from the report")
-                return True
-            
-            # Check for generic/unhelpful descriptions
-            generic_phrases = [
-                'is a dental condition that requires professional treatment',
-                'requires professional treatment',
-                'needs to be treated by a dentist',
-                'should be addressed by a dental professional'
-            ]
-            
-            for phrase in generic_phrases:
-                if phrase in plain_text.lower():
-                    logger.warning(f"Found generic/unhelpful description: {phrase}")
-                    return True
-            
-            # Check for descriptions that lack proper explanation
-            if 'what this means' in plain_text.lower():
-                what_means_section = plain_text.lower().split('what this means')[1] if 'what this means' in plain_text.lower() else ''
-                if what_means_section:
-                    # Check if the "What This Means" section is too short or generic
-                    if len(what_means_section.strip()) < 100 or any(phrase in what_means_section for phrase in generic_phrases):
-                        logger.warning(f"Found inadequate 'What This Means' section: {what_means_section[:100]}...")
-                        return True
-        
-        return False
+        system_prompt = """You complete condition explanation boxes in a dental patient report.
+You are given one box whose text is incomplete, too short or generic. Rewrite it so every section is complete:
+what the condition is, its causes and symptoms, what the treatment involves, and the urgency/risks if untreated (use 🔴 for risks).
+Each "What This Means" section must be 3-5 full sentences. Every sentence must be finished.
+Keep the box's HTML structure, header title and inline styles. Return ONLY the box's HTML, no markdown."""
+        findings_text = json.dumps(
+            [{key: f.get(key) for key in ('tooth', 'condition', 'treatment')} for f in patient_findings],
+            indent=2
+        )
+
+        def regenerate(box: BoxDiagnostic) -> str:
+            # A repair must ask again rather than reuse an earlier (possibly rejected) answer
+            return cached_completion(
+                self.client,
+                "html_report_box",
+                cache=False,
+                model=self.model_html,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": f"""Dentist's confirmed findings:
+{findings_text}
+
+Problems found: {', '.join(box.issues)}
+
+Box to rewrite:
+{html_content[box.start:box.end]}"""}
+                ],
+                max_completion_tokens=1500
+            )
+
+        flagged = validation.flagged
+        with track_stage("openai_html_report_boxes", model=self.model_html):
+            outputs = await asyncio.gather(*(asyncio.to_thread(regenerate, box) for box in flagged))
+
+        replacements = {}
+        for box, output in zip(flagged, outputs):
+            fragment = self._strip_code_fences(output or '')
+            fragment_validation = validate_report_html(fragment)
+            if len(fragment_validation.boxes) != 1 or not fragment_validation.ok:
+                logger.warning(f"Regenerated box '{box.title}' still incomplete: {fragment_validation.summary()}")
+                return None
+            replacements[box.index] = fragment
+
+        return replace_boxes(html_content, validation, replacements)
+
+    async def _complete_report(self, html_content: str, patient_findings: List[Dict]) -> Optional[str]:
+        """The report if it validates (repairing flagged boxes if needed), otherwise None"""
+        validation = validate_report_html(html_content)
+        if validation.ok:
+            return html_content
+
+        logger.warning(f"Detected truncated descriptions in HTML: {validation.summary()}")
+        if not validation.repairable:
+            return None
+
+        try:
+            repaired = await self._repair_condition_boxes(html_content, validation, patient_findings)
+        except Exception as e:
+            logger.error(f"Error regenerating condition boxes: {str(e)}")
+            return None
+        if repaired is not None:
+            logger.info(f"✅ Regenerated {len(validation.flagged)} of {len(validation.boxes)} condition boxes")
+        return repaired
 
     def _generate_fallback_descriptions(self, patient_findings: List[Dict]) -> str:
         """
@@ -841,19 +949,181 @@ Generate a short, friendly script IN {language_name.upper()} following the struc
         
         return fallback_html
 
-# Create singleton instance
-# Initialize service lazily to avoid import-time errors
-_openai_service = None
+    # ---------------- Streaming ----------------
 
-def get_openai_service():
-    global _openai_service
-    if _openai_service is None:
+    async def stream_chat(self, stage: str, model: str, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        """
+        Stream a chat completion's text deltas
+
+        The OpenAI client is synchronous, so the stream is read in a worker
+        thread and handed over through a queue. Time to first token is
+        recorded as `<stage>_first_token`. If the consumer stops early (e.g. the
+        client disconnected) the OpenAI stream is closed, so generation and
+        billing stop with it.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        finished = object()
+        stop = threading.Event()
+        streams = []
+
+        def consume():
+            try:
+                stream = self.client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+                streams.append(stream)
+                try:
+                    for chunk in stream:
+                        if stop.is_set():
+                            return
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            loop.call_soon_threadsafe(queue.put_nowait, chunk.choices[0].delta.content)
+                finally:
+                    stream.close()
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+            except Exception as e:
+                if not stop.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        with track_stage(stage, model=model):
+            worker = asyncio.ensure_future(asyncio.to_thread(consume))
+            try:
+                with track_stage(f"{stage}_first_token", model=model):
+                    item = await queue.get()
+                while item is not finished:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                    item = await queue.get()
+            finally:
+                stop.set()
+                # Unblock a worker waiting on the next chunk
+                for stream in streams:
+                    try:
+                        stream.close()
+                    except Exception:
+                        pass
+                await worker
+
+    async def stream_html_report_content(self, patient_findings: List[Dict], patient_name: str) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Streaming `generate_html_report_content`
+
+        Yields ("section", html) for each top-level block as soon as it is
+        complete, ("reset", reason) if the report has to be regenerated, and
+        finally ("done", html) with the same checks and fallbacks as the
+        non-streaming version.
+        """
+        system_prompt, user_prompt = self._html_report_prompts(patient_findings, patient_name)
+        attempts = [
+            (system_prompt, 4000),
+            (system_prompt + HTML_REPORT_RETRY_INSTRUCTION, 6000),
+        ]
         try:
-            _openai_service = OpenAIService()
+            for attempt, (prompt, max_tokens) in enumerate(attempts):
+                splitter = HtmlSectionStream()
+                parts = []
+                async for delta in self.stream_chat(
+                    "openai_html_report_stream",
+                    self.model_html,
+                    [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    max_completion_tokens=max_tokens
+                ):
+                    parts.append(delta)
+                    for section in splitter.push(delta):
+                        yield "section", section
+
+                html_content = self._strip_code_fences(''.join(parts))
+                complete_html = await self._complete_report(html_content, patient_findings)
+                if complete_html is not None:
+                    if complete_html != html_content:
+                        yield "reset", "Completed condition descriptions"
+                    logger.info("Successfully streamed HTML report content")
+                    yield "done", complete_html
+                    return
+
+                if attempt == 0:
+                    logger.warning("Regenerating whole report with higher token limit")
+                    yield "reset", "Regenerating report with complete descriptions"
+
+            logger.warning("Still detecting truncated descriptions after regeneration, using fallback system")
+            yield "reset", "Using standard condition descriptions"
         except Exception as e:
-            logger.error(f"Failed to initialize OpenAI service: {e}")
-            return None
-    return _openai_service
+            logger.error(f"Error streaming HTML report content: {str(e)}")
+            yield "reset", "Using standard condition descriptions"
+
+        yield "done", self._generate_fallback_descriptions(patient_findings)
+
+    async def stream_video_script(self, treatment_stages: List[Dict], annotated_image_base64: str,
+                                  patient_name: str = None, language: str = "english") -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Streaming `generate_video_script`
+
+        Yields ("token", text) deltas, ("reset", reason) if the vision model
+        refuses and the text-only fallback is streamed instead, then ("done", script).
+        """
+        system_prompt, user_prompt, language_name = self._video_script_prompts(treatment_stages, patient_name, language)
+        attempts = [
+            self._video_script_messages(system_prompt, user_prompt, annotated_image_base64),
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+        ]
+        for attempt, messages in enumerate(attempts):
+            parts = []
+            async for delta in self.stream_chat("openai_video_script_stream", "gpt-4o", messages, max_completion_tokens=1500):
+                parts.append(delta)
+                yield "token", delta
+
+            script = ''.join(parts).strip()
+            if attempt == 0 and self._is_refusal(script):
+                logger.warning("⚠️ OpenAI safety filter detected - falling back to text-only script generation")
+                yield "reset", "Regenerating script without image analysis"
+                continue
+            break
 
-# For backward compatibility
-openai_service = get_openai_service()
\ No newline at end of file
+        logger.info(f"✅ Streamed video script in {language_name} ({len(script)} characters)")
+        yield "done", script
+
+    async def stream_immediate_findings_summary(self, roboflow_predictions: Dict) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Streaming `generate_immediate_findings_summary`
+
+        Yields raw JSON ("token", text) deltas, then ("done", summary) parsed
+        (or the usual error summary if the output isn't valid JSON).
+        """
+        system_prompt, user_prompt = self._findings_summary_prompts(roboflow_predictions)
+        parts = []
+        try:
+            async for delta in self.stream_chat(
+                "openai_findings_summary_stream",
+                self.model_summary,
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                response_format={"type": "json_object"}
+            ):
+                parts.append(delta)
+                yield "token", delta
+            result = json.loads(''.join(parts))
+        except Exception as e:
+            logger.error(f"Error streaming immediate findings summary: {str(e)}")
+            result = {
+                "overall_summary": "Error processing AI analysis",
+                "detailed_findings": [],
+                "total_detections": 0,
+                "high_confidence_count": 0,
+                "areas_needing_attention": []
+            }
+        yield "done", result
+
+
+# Initialize service lazily on first use to keep imports cheap
+openai_service = lazy_service("openai", OpenAIService)
+
+def get_openai_service():
+    return registry.get("openai")
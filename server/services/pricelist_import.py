@@ -1,19 +1,237 @@
+import asyncio
 import os
 import json
 import logging
 import base64
-from typing import Dict, List, Optional
+import hashlib
+import re
+from typing import Any, Dict, List, Optional, Tuple
 from openai import OpenAI
 from dotenv import load_dotenv
-import PyPDF2
 import io
-import pandas as pd
-from PIL import Image
+from services.completion_cache import cached_completion
+from services.registry import lazy_service, registry
+from services.treatment_matcher import TreatmentMatcher
+from utils.metrics import track_stage
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+TEXT_EXTRACTION_PROMPT = """You are a dental pricing extraction assistant. Extract ALL dental treatments and their prices from the provided text.
+
+IMPORTANT RULES:
+1. Extract EVERY treatment you can see
+2. Include price (required), duration (if visible), insurance code (if visible)
+3. Preserve the exact treatment name as written
+4. Remove currency symbols from prices
+5. Convert durations to minutes (integer)
+6. Group by category if clearly separated
+
+Return a JSON object with this exact structure:
+{
+  "extracted_treatments": [
+    {
+      "name": "Root Canal Treatment - 1 canal",
+      "price": 500,
+      "duration": 60,
+      "insurance_code": "415",
+      "category": "Endodontics"
+    }
+  ],
+  "total_count": 45,
+  "currency": "AUD",
+  "notes": "Any important observations"
+}"""
+
+# Header cells that identify spreadsheet columns (matched against lowercased header
+# text, in this order so "Treatment Code" is a code and "Treatment Type" a category)
+COLUMN_KEYWORDS = {
+    'insurance_code': ('item no', 'item number', 'item code', 'item #', 'ada', 'code'),
+    'duration': ('duration', 'minutes', 'mins', 'time'),
+    'category': ('category', 'section', 'group', 'type'),
+    'price': ('price', 'fee', 'cost', 'amount', 'charge', '$'),
+    'name': ('treatment', 'description', 'service', 'procedure', 'name'),
+}
+# Rows scanned for a header row (title rows often sit above it)
+HEADER_SCAN_ROWS = 10
+# Share of numeric-looking prices that must parse for a sheet to count as tabular
+MIN_PRICE_PARSE_RATIO = 0.8
+
+PRICE_PATTERN = re.compile(r'^\s*(?:[A-Z]{3}\s*)?[$€£]?\s*(\d{1,3}(?:,\d{3})+|\d+)(\.\d+)?\s*(?:[A-Z]{3})?\s*$')
+DURATION_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(h|hr|hrs|hour|hours|m|min|mins|minute|minutes)?\s*$', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ''
+    text = str(value).strip()
+    return '' if text.lower() == 'nan' else text
+
+
+def parse_price(value: Any) -> Optional[float]:
+    """"$1,200.00" / "AUD 95" / "95" -> float; ranges and free text -> None"""
+    match = PRICE_PATTERN.match(_cell(value))
+    if not match:
+        return None
+    return float(match.group(1).replace(',', '') + (match.group(2) or ''))
+
+
+def parse_duration(value: Any) -> Optional[int]:
+    """"30", "30min", "1.5 hours" -> minutes"""
+    match = DURATION_PATTERN.match(_cell(value))
+    if not match:
+        return None
+    amount = float(match.group(1))
+    if (match.group(2) or '').lower().startswith('h'):
+        amount *= 60
+    return int(round(amount))
+
+
+def _match_columns(row: List[Any]) -> Dict[str, int]:
+    """Map field -> column index for a candidate header row"""
+    columns: Dict[str, int] = {}
+    for index, value in enumerate(row):
+        header = _cell(value).lower()
+        if not header:
+            continue
+        for field, keywords in COLUMN_KEYWORDS.items():
+            if field == 'insurance_code' and header == 'item':
+                columns.setdefault(field, index)
+                break
+            if field not in columns and any(keyword in header for keyword in keywords):
+                columns[field] = index
+                break
+    return columns
+
+
+def parse_tabular_pricelist(rows: List[List[Any]], default_category: Optional[str] = None) -> Optional[Dict]:
+    """
+    Parse an obviously tabular sheet (name and price columns) without GPT
+
+    Returns None when no header with name and price columns is found, or when
+    too few prices parse, so the caller can fall back to GPT extraction. Rows
+    with a name but no price are treated as category headings.
+    """
+    for header_index, row in enumerate(rows[:HEADER_SCAN_ROWS]):
+        columns = _match_columns(row)
+        if 'name' in columns and 'price' in columns and columns['name'] != columns['price']:
+            break
+    else:
+        return None
+
+    treatments = []
+    unparsed_prices = 0
+    category = default_category
+    for row in rows[header_index + 1:]:
+        cells = [_cell(value) for value in row]
+        name = cells[columns['name']] if columns['name'] < len(cells) else ''
+        price_text = cells[columns['price']] if columns['price'] < len(cells) else ''
+        if not name:
+            filled = [cell for cell in cells if cell]
+            if len(filled) == 1 and parse_price(filled[0]) is None:
+                category = filled[0]  # section heading in another column
+            continue
+
+        price = parse_price(price_text)
+        if price is None:
+            if not any(cell for i, cell in enumerate(cells) if i != columns['name']):
+                category = name  # heading row
+            elif re.search(r'\d', price_text):
+                unparsed_prices += 1  # ranges, "from $90", ... need GPT
+            continue  # "POA", "Quote": no price to import
+
+        treatment = {
+            "name": WHITESPACE.sub(' ', name),
+            "price": price,
+            "duration": None,
+            "insurance_code": None,
+            "category": category,
+        }
+        if 'duration' in columns and columns['duration'] < len(cells):
+            treatment["duration"] = parse_duration(cells[columns['duration']])
+        if 'insurance_code' in columns and columns['insurance_code'] < len(cells):
+            treatment["insurance_code"] = cells[columns['insurance_code']] or None
+        if 'category' in columns and columns['category'] < len(cells):
+            treatment["category"] = cells[columns['category']] or category
+        treatments.append(treatment)
+
+    if not treatments or len(treatments) < MIN_PRICE_PARSE_RATIO * (len(treatments) + unparsed_prices):
+        return None
+
+    return {
+        "extracted_treatments": treatments,
+        "total_count": len(treatments),
+        "currency": "AUD",
+        "notes": "",
+        "extraction_method": "deterministic",
+    }
+
+
+def _treatment_key(treatment: Dict) -> Tuple[str, Any, str]:
+    return (
+        WHITESPACE.sub(' ', str(treatment.get('name', ''))).strip().lower(),
+        treatment.get('price'),
+        str(treatment.get('insurance_code') or '').strip(),
+    )
+
+
+def _boundary_overlap(previous: List[Tuple], current: List[Tuple]) -> int:
+    """Length of the longest run at the start of `current` that repeats the end of `previous`"""
+    for size in range(min(len(previous), len(current)), 0, -1):
+        if previous[-size:] == current[:size]:
+            return size
+    return 0
+
+
+def find_header_row(rows: List[List[Any]]) -> Optional[int]:
+    """Index of the row (within HEADER_SCAN_ROWS) naming the most columns, if any names two"""
+    header_index, most_columns = None, 1
+    for index, row in enumerate(rows[:HEADER_SCAN_ROWS]):
+        matched = len(_match_columns(row))
+        if matched > most_columns:
+            header_index, most_columns = index, matched
+    return header_index
+
+
+def merge_extractions(results: List[Dict], overlapping: bool = True) -> Dict:
+    """
+    Concatenate extraction results in order
+
+    With `overlapping` the results are adjacent chunks of one document, and
+    treatments at the start of a chunk that repeat the end of the previous
+    chunk (a row read on both sides of the boundary) are dropped. Repeats
+    anywhere else are real rows and kept. `failed_chunks` from the inputs are
+    carried through.
+    """
+    treatments, failed_chunks = [], []
+    previous_keys: List[Tuple] = []
+    currency = None
+    notes = []
+    for result in results:
+        currency = currency or result.get('currency')
+        note = (result.get('notes') or '').strip()
+        if note and note not in notes:
+            notes.append(note)
+        chunk = result.get('extracted_treatments', [])
+        keys = [_treatment_key(treatment) for treatment in chunk]
+        repeated = _boundary_overlap(previous_keys, keys) if overlapping else 0
+        treatments.extend(chunk[repeated:])
+        previous_keys = keys
+        failed_chunks.extend(result.get('failed_chunks', []))
+
+    merged = {
+        "extracted_treatments": treatments,
+        "total_count": len(treatments),
+        "currency": currency or "AUD",
+        "notes": " ".join(notes),
+    }
+    if failed_chunks:
+        merged["failed_chunks"] = failed_chunks
+    return merged
+
+
 class PricelistImportService:
     def __init__(self):
         self.api_key = os.getenv("OPENAI_API_KEY")
@@ -22,6 +240,17 @@ class PricelistImportService:
         
         self.client = OpenAI(api_key=self.api_key)
         self.model = os.getenv("OPENAI_MODEL_ANALYSIS", "gpt-4o")
+        self.pages_per_chunk = int(os.getenv("PRICELIST_PAGES_PER_CHUNK", "3"))
+        self.rows_per_chunk = int(os.getenv("PRICELIST_ROWS_PER_CHUNK", "80"))
+        self.chunk_char_limit = int(os.getenv("PRICELIST_CHUNK_CHARS", "12000"))
+        self.max_concurrency = int(os.getenv("PRICELIST_MAX_CONCURRENCY", "4"))
+        # Local matches at or above this confidence skip GPT; below custom_below they become CUSTOM
+        self.match_accept = float(os.getenv("PRICELIST_MATCH_ACCEPT", "0.85"))
+        self.match_custom_below = float(os.getenv("PRICELIST_MATCH_CUSTOM_BELOW", "0.70"))
+        self.match_top_k = int(os.getenv("PRICELIST_MATCH_TOP_K", "5"))
+        self.match_batch_size = int(os.getenv("PRICELIST_MATCH_BATCH_SIZE", "40"))
+        self._matcher: Optional[TreatmentMatcher] = None
+        self._matcher_key: Optional[str] = None
     
     async def extract_from_file(self, file_content: bytes, filename: str, mime_type: str) -> Dict:
         """
@@ -58,7 +287,10 @@ class PricelistImportService:
             base64_image = base64.b64encode(image_bytes).decode('utf-8')
             
             # Construct the vision prompt
-            response = self.client.chat.completions.create(
+            content = cached_completion(
+                self.client,
+                "pricelist_image",
+                cache=True,
                 model="gpt-4o",  # gpt-4o supports vision
                 messages=[
                     {
@@ -109,7 +341,7 @@ Return a JSON object with this exact structure:
                 response_format={"type": "json_object"}
             )
             
-            result = json.loads(response.choices[0].message.content)
+            result = json.loads(content)
             logger.info(f"✅ Extracted {result.get('total_count', 0)} treatments from image")
             
             return result
@@ -120,26 +352,27 @@ Return a JSON object with this exact structure:
     
     async def _extract_from_pdf(self, pdf_bytes: bytes) -> Dict:
         """
-        Extract text from PDF and use GPT-4 to structure it
+        Extract text from PDF page by page and use GPT-4 to structure it in page chunks
         """
         try:
             logger.info("📄 Extracting text from PDF...")
             
-            # Read PDF
-            pdf_file = io.BytesIO(pdf_bytes)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            
-            # Extract text from all pages
-            text_content = ""
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text_content += page.extract_text() + "\n\n"
-            
-            logger.info(f"📝 Extracted {len(text_content)} characters from PDF")
+            import PyPDF2
+
+            def read_pages() -> List[str]:
+                pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+                return [(page.extract_text() or '') for page in pdf_reader.pages]
+
+            pages = await asyncio.to_thread(read_pages)
+            total_chars = sum(len(page) for page in pages)
+            logger.info(f"📝 Extracted {total_chars} characters from {len(pages)} PDF pages")
             
             # If text extraction worked, use GPT-4 text
-            if len(text_content.strip()) > 100:
-                return await self._extract_from_text(text_content)
+            if sum(len(page.strip()) for page in pages) > 100:
+                chunks = []
+                for i in range(0, len(pages), self.pages_per_chunk):
+                    chunks.extend(self._split_text('\n\n'.join(pages[i:i + self.pages_per_chunk])))
+                return await self._extract_chunks(chunks, "PDF")
             else:
                 # PDF might be scanned image - fall back to vision
                 logger.warning("⚠️ PDF has minimal text, might be scanned. Consider using image extraction.")
@@ -151,53 +384,81 @@ Return a JSON object with this exact structure:
     
     async def _extract_from_text(self, text_content: str) -> Dict:
         """
-        Use GPT-4 to extract structured pricing from text
+        Use GPT-4 to extract structured pricing from text (chunked for long documents)
+        """
+        return await self._extract_chunks(self._split_text(text_content), "text")
+
+    def _split_text(self, text_content: str) -> List[str]:
+        """Split text on line boundaries into chunks of at most chunk_char_limit characters"""
+        chunks, current, size = [], [], 0
+        for line in text_content.splitlines():
+            if current and size + len(line) + 1 > self.chunk_char_limit:
+                chunks.append('\n'.join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            chunks.append('\n'.join(current))
+        return [chunk for chunk in chunks if chunk.strip()]
+
+    def _extract_text_chunk(self, text_content: str) -> Dict:
+        """One GPT-4 extraction call (runs in a worker thread)"""
+        content = cached_completion(
+            self.client,
+            "pricelist_text",
+            cache=True,
+            model=self.model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": TEXT_EXTRACTION_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": f"Extract all dental treatments and prices from this text:\n\n{text_content}"
+                }
+            ],
+            max_tokens=4000,
+            response_format={"type": "json_object"}
+        )
+        return json.loads(content)
+
+    async def _extract_chunks(self, chunks: List[str], source: str) -> Dict:
+        """
+        Extract every chunk concurrently (at most max_concurrency GPT calls at once) and merge
+
+        A failed chunk is reported in `failed_chunks` instead of failing the
+        whole import, unless every chunk fails.
         """
         try:
-            logger.info("🤖 Using GPT-4 to structure text content...")
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """You are a dental pricing extraction assistant. Extract ALL dental treatments and their prices from the provided text.
+            logger.info(f"🤖 Using GPT-4 to structure {source} content in {len(chunks)} chunk(s)...")
+            semaphore = asyncio.Semaphore(self.max_concurrency)
 
-IMPORTANT RULES:
-1. Extract EVERY treatment you can see
-2. Include price (required), duration (if visible), insurance code (if visible)
-3. Preserve the exact treatment name as written
-4. Remove currency symbols from prices
-5. Convert durations to minutes (integer)
-6. Group by category if clearly separated
+            async def extract(chunk: str) -> Dict:
+                async with semaphore:
+                    return await asyncio.to_thread(self._extract_text_chunk, chunk)
 
-Return a JSON object with this exact structure:
-{
-  "extracted_treatments": [
-    {
-      "name": "Root Canal Treatment - 1 canal",
-      "price": 500,
-      "duration": 60,
-      "insurance_code": "415",
-      "category": "Endodontics"
-    }
-  ],
-  "total_count": 45,
-  "currency": "AUD",
-  "notes": "Any important observations"
-}"""
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Extract all dental treatments and prices from this text:\n\n{text_content}"
-                    }
-                ],
-                max_tokens=4000,
-                response_format={"type": "json_object"}
-            )
-            
-            result = json.loads(response.choices[0].message.content)
-            logger.info(f"✅ Extracted {result.get('total_count', 0)} treatments from text")
+            with track_stage("openai_pricelist_extract", model=self.model):
+                results = await asyncio.gather(*(extract(chunk) for chunk in chunks), return_exceptions=True)
+
+            extractions, failed = [], []
+            for index, result in enumerate(results):
+                if isinstance(result, Exception):
+                    logger.error(f"❌ Chunk {index + 1}/{len(chunks)} extraction failed: {str(result)}")
+                    failed.append(index)
+                    # Empty placeholder, so the chunks either side aren't treated as adjacent
+                    extractions.append({})
+                else:
+                    extractions.append(result)
+            if len(failed) == len(chunks):
+                raise ValueError(f"All {len(chunks)} chunks failed to extract")
+
+            result = merge_extractions(extractions)
+            result["extraction_method"] = "gpt"
+            result["chunks"] = len(chunks)
+            if failed:
+                result["failed_chunks"] = failed
+            logger.info(f"✅ Extracted {result['total_count']} treatments from {source} ({len(chunks)} chunks, {len(failed)} failed)")
             
             return result
         
@@ -208,58 +469,142 @@ Return a JSON object with this exact structure:
     async def _extract_from_spreadsheet(self, file_bytes: bytes, mime_type: str) -> Dict:
         """
         Extract pricing from Excel/CSV spreadsheet
+
+        Sheets with recognisable name and price columns are parsed directly;
+        anything else is sent to GPT in row blocks that repeat the header row.
         """
         try:
             logger.info("📊 Extracting from spreadsheet...")
             
-            # Read spreadsheet
-            if mime_type == 'text/csv':
-                df = pd.read_csv(io.BytesIO(file_bytes))
-            else:
-                df = pd.read_excel(io.BytesIO(file_bytes))
-            
-            logger.info(f"📈 Loaded spreadsheet with {len(df)} rows and {len(df.columns)} columns")
-            logger.info(f"Columns: {df.columns.tolist()}")
-            
-            # Convert to text representation for GPT
-            text_content = df.to_string(index=False)
+            import pandas as pd
+
+            def read_sheets() -> Dict[str, "pd.DataFrame"]:
+                if mime_type == 'text/csv':
+                    return {'': pd.read_csv(io.BytesIO(file_bytes), header=None, dtype=str)}
+                return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, header=None, dtype=str)
+
+            sheets = await asyncio.to_thread(read_sheets)
             
-            # Use GPT to intelligently parse the spreadsheet
-            return await self._extract_from_text(text_content)
+            parsed, chunks = [], []
+            for sheet_name, df in sheets.items():
+                df = df.dropna(how='all').dropna(axis=1, how='all')
+                if df.empty:
+                    continue
+                logger.info(f"📈 Loaded sheet '{sheet_name}' with {len(df)} rows and {len(df.columns)} columns")
+
+                result = parse_tabular_pricelist(df.values.tolist(), default_category=sheet_name or None)
+                if result is not None:
+                    parsed.append(result)
+                    continue
+
+                # Convert to text representation for GPT, repeating the header row (if found) in later blocks
+                rows = df.fillna('').astype(str).values.tolist()
+                header_index = find_header_row(rows)
+                header = [rows[header_index]] if header_index is not None else []
+                for i in range(0, len(rows), self.rows_per_chunk):
+                    block = rows[i:i + self.rows_per_chunk] if i == 0 else header + rows[i:i + self.rows_per_chunk]
+                    chunks.append('\n'.join(' | '.join(cell for cell in row) for row in block))
+
+            if chunks:
+                parsed.append(await self._extract_chunks(chunks, "spreadsheet"))
+            if not parsed:
+                raise ValueError("Spreadsheet is empty")
+
+            # Sheets aren't chunks of one another, so nothing is dropped between them
+            result = merge_extractions(parsed, overlapping=False)
+            result["extraction_method"] = "+".join(sorted({r.get("extraction_method", "gpt") for r in parsed}))
+            logger.info(f"✅ Extracted {result['total_count']} treatments from spreadsheet ({result['extraction_method']})")
+            return result
         
         except Exception as e:
             logger.error(f"❌ Error extracting from spreadsheet: {str(e)}")
             raise
     
+    def _get_matcher(self, master_treatments: List[Dict]) -> TreatmentMatcher:
+        """Matcher for this catalogue, rebuilt only when the catalogue changes"""
+        key = hashlib.sha256(json.dumps(master_treatments, sort_keys=True, default=str).encode()).hexdigest()
+        if self._matcher is None or self._matcher_key != key:
+            self._matcher = TreatmentMatcher(master_treatments)
+            self._matcher_key = key
+        return self._matcher
+
+    def _match_row(self, treatment: Dict, code: Optional[str], name: Optional[str], confidence: float,
+                   method: str, reasoning: str, candidates: List[Tuple[str, str, float]]) -> Dict:
+        if code is None or confidence < self.match_custom_below:
+            code, name = "CUSTOM", None
+        return {
+            "clinic_name": treatment.get('name'),
+            "clinic_price": treatment.get('price'),
+            "clinic_duration": treatment.get('duration'),
+            "matched_code": code,
+            "matched_name": name,
+            "confidence": round(confidence, 3),
+            "reasoning": reasoning,
+            "requires_review": code == "CUSTOM" or confidence < self.match_accept,
+            "match_method": method,
+            "candidates": [{"code": c, "name": n, "score": score} for c, n, score in candidates],
+        }
+
     async def match_to_master_database(self, extracted_treatments: List[Dict], master_treatments: List[Dict]) -> List[Dict]:
         """
-        Use GPT-4 to intelligently match extracted treatments to master database
+        Match extracted treatments to the whole master database
         Returns matches with confidence scores
+
+        Rows are matched locally (insurance code, exact name, fuzzy similarity);
+        only low-confidence or ambiguous rows go to GPT, each with its top
+        candidates.
         """
         try:
             logger.info(f"🔍 Matching {len(extracted_treatments)} treatments to master database...")
             
-            # Prepare master database summary for GPT
-            master_summary = "\n".join([
-                f"- {t['code']}: {t['displayName']} ({t.get('friendlyPatientName', '')})"
-                for t in master_treatments[:100]  # Limit to prevent token overflow
-            ])
+            matcher = self._get_matcher(master_treatments)
+            matches, residual = [], []
+            with track_stage("pricelist_local_match"):
+                for index, treatment in enumerate(extracted_treatments):
+                    result = matcher.match(treatment.get('name', ''), treatment.get('insurance_code'), top_k=self.match_top_k)
+                    reasoning = {
+                        'insurance_code': f"Insurance code {treatment.get('insurance_code')} matches",
+                        'exact_name': "Name matches the master treatment",
+                        'fuzzy': f"Closest name match ({result.confidence:.2f})",
+                    }.get(result.method, "No similar master treatment")
+                    matches.append(self._match_row(
+                        treatment, result.matched_code, result.matched_name, result.confidence,
+                        result.method, reasoning, result.candidates
+                    ))
+                    if result.candidates and (result.confidence < self.match_accept or result.ambiguous):
+                        residual.append(index)
+
+            logger.info(f"⚡ Matched {len(matches) - len(residual)} locally, {len(residual)} sent to GPT")
+            if residual:
+                await self._resolve_residual_matches(extracted_treatments, matches, residual)
             
-            # Prepare extracted treatments summary with full details
-            extracted_summary = "\n".join([
-                f"- {t['name']}: ${t.get('price', 0)} | Duration: {t.get('duration', 'N/A')} mins | Code: {t.get('insurance_code', 'N/A')}"
-                for t in extracted_treatments
-            ])
+            logger.info(f"✅ Matched {len(matches)} treatments")
+            logger.info(f"📊 Auto-matched: {sum(1 for m in matches if not m.get('requires_review', False))}")
+            logger.info(f"⚠️ Needs review: {sum(1 for m in matches if m.get('requires_review', False))}")
             
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": f"""You are a dental treatment matching assistant. Match clinic treatments to the master database.
+            return matches
+        
+        except Exception as e:
+            logger.error(f"❌ Error matching treatments: {str(e)}")
+            raise
 
-MASTER DATABASE:
-{master_summary}
+    def _match_residual_batch(self, rows: List[Tuple[int, Dict, Dict]]) -> List[Dict]:
+        """One GPT call choosing among each row's candidates (runs in a worker thread)"""
+        rows_text = "\n".join(
+            f"{index}. {t.get('name')} (${t.get('price', 0)}, code: {t.get('insurance_code') or 'N/A'})\n"
+            + "\n".join(f"   - {c['code']}: {c['name']}" for c in match['candidates'])
+            for index, t, match in rows
+        )
+        content = cached_completion(
+            self.client,
+            "pricelist_match",
+            cache=True,
+            model=self.model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": """You are a dental treatment matching assistant. Each clinic treatment below is listed with its candidate master treatments.
+Pick the candidate that is the same procedure, or "CUSTOM" if none is.
 
 MATCHING RULES:
 1. Consider synonyms (e.g., "RCT" = "Root Canal Treatment")
@@ -269,46 +614,72 @@ MATCHING RULES:
    - 0.95-1.0: Exact or near-exact match
    - 0.80-0.94: Strong match with minor differences
    - 0.70-0.79: Probable match, needs review
-   - <0.70: No good match, flag as CUSTOM
-
-Return JSON array:
-[
-  {{
-    "clinic_name": "RCT 1 canal",
-    "clinic_price": 500,
-    "clinic_duration": 60,
-    "matched_code": "endo_rct_prep_1",
-    "matched_name": "Chemo-mechanical Preparation — 1 Canal",
-    "confidence": 0.95,
-    "reasoning": "RCT = Root Canal Treatment, 1 canal matches prep",
-    "requires_review": false
-  }}
-]
-
-If confidence < 0.70, set matched_code to "CUSTOM" and requires_review to true."""
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Match these clinic treatments:\n\n{extracted_summary}"
-                    }
-                ],
-                max_tokens=4000,
-                response_format={"type": "json_object"}
-            )
-            
-            result = json.loads(response.choices[0].message.content)
-            matches = result.get('matches', [])
-            
-            logger.info(f"✅ Matched {len(matches)} treatments")
-            logger.info(f"📊 Auto-matched: {sum(1 for m in matches if not m.get('requires_review', False))}")
-            logger.info(f"⚠️ Needs review: {sum(1 for m in matches if m.get('requires_review', False))}")
-            
-            return matches
-        
-        except Exception as e:
-            logger.error(f"❌ Error matching treatments: {str(e)}")
-            raise
+   - <0.70: No good match, use CUSTOM
+
+Return JSON:
+{"matches": [{"index": 0, "matched_code": "endo_rct_prep_1", "confidence": 0.9, "reasoning": "RCT = Root Canal Treatment, 1 canal matches prep"}]}"""
+                },
+                {
+                    "role": "user",
+                    "content": f"Match these clinic treatments:\n\n{rows_text}"
+                }
+            ],
+            max_tokens=4000,
+            response_format={"type": "json_object"}
+        )
+        return json.loads(content).get('matches', [])
+
+    async def _resolve_residual_matches(self, extracted_treatments: List[Dict], matches: List[Dict], residual: List[int]) -> None:
+        """Let GPT settle low-confidence rows in place; rows it can't settle keep the local guess, flagged for review"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        batches = [residual[i:i + self.match_batch_size] for i in range(0, len(residual), self.match_batch_size)]
+
+        async def resolve(batch: List[int]) -> List[Dict]:
+            async with semaphore:
+                rows = [(index, extracted_treatments[index], matches[index]) for index in batch]
+                return await asyncio.to_thread(self._match_residual_batch, rows)
+
+        with track_stage("openai_pricelist_match", model=self.model):
+            results = await asyncio.gather(*(resolve(batch) for batch in batches), return_exceptions=True)
+
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.error(f"❌ GPT matching failed for {len(batch)} rows, keeping local matches: {str(result)}")
+                for index in batch:
+                    matches[index]["requires_review"] = True
+                continue
+
+            answered = {}
+            for answer in result:
+                try:
+                    answered[int(answer.get('index'))] = answer
+                except (TypeError, ValueError):
+                    continue
+            for index in batch:
+                match = matches[index]
+                answer = answered.get(index)
+                candidates = {c['code']: c['name'] for c in match['candidates']}
+                code = answer.get('matched_code') if answer else None
+                if code != "CUSTOM" and code not in candidates:
+                    match["requires_review"] = True
+                    continue
+                try:
+                    confidence = min(max(float(answer.get('confidence', 0)), 0.0), 1.0)
+                except (TypeError, ValueError):
+                    confidence = 0.0
+                matches[index] = self._match_row(
+                    extracted_treatments[index],
+                    None if code == "CUSTOM" else code,
+                    candidates.get(code),
+                    confidence,
+                    "gpt",
+                    answer.get('reasoning', ''),
+                    [(c['code'], c['name'], c['score']) for c in match['candidates']]
+                )
+
+# Initialize service lazily on first use to keep imports cheap
+pricelist_import_service = lazy_service("pricelist_import", PricelistImportService)
 
-# Singleton instance
-pricelist_import_service = PricelistImportService()
+def get_pricelist_import_service():
+    return registry.get("pricelist_import")
 
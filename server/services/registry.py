@@ -0,0 +1,131 @@
+"""
+Service Registry - lazy, thread-safe construction of shared service singletons
+
+Service modules register a factory instead of building their singleton at
+import time. The real instance is created on first use (double-checked under a
+lock so concurrent requests never build two), which keeps `import api.routes`
+cheap and lets uvicorn workers boot without touching the network.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceRegistry:
+    """Holds service factories and the instances built from them"""
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._init_times_ms: Dict[str, float] = {}
+        self._last_errors: Dict[str, str] = {}
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        """Register a zero-argument factory for a named service"""
+        with self._lock:
+            self._factories[name] = factory
+
+    def get(self, name: str) -> Optional[Any]:
+        """
+        Get the named service, constructing it on first use
+
+        Returns None if construction fails so callers can keep using the
+        existing `if not service:` checks. A failed construction is retried on
+        the next call, matching the behaviour of the old module-level getters.
+        """
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is not None:
+                return instance
+
+            factory = self._factories.get(name)
+            if factory is None:
+                raise KeyError(f"Service '{name}' is not registered")
+
+            start_time = time.perf_counter()
+            try:
+                instance = factory()
+            except Exception as e:
+                self._last_errors[name] = str(e)
+                logger.error(f"Failed to initialize {name} service: {e}")
+                return None
+
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            self._instances[name] = instance
+            self._init_times_ms[name] = elapsed_ms
+            self._last_errors.pop(name, None)
+            logger.info(f"⚙️ Initialized {name} service in {elapsed_ms:.1f}ms")
+            return instance
+
+    def is_initialized(self, name: str) -> bool:
+        return name in self._instances
+
+    def reset(self, name: str) -> None:
+        """Drop a cached instance so the next call rebuilds it"""
+        with self._lock:
+            self._instances.pop(name, None)
+            self._init_times_ms.pop(name, None)
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """Initialization state of every registered service (for health checks)"""
+        with self._lock:
+            return {
+                name: {
+                    "initialized": name in self._instances,
+                    "init_time_ms": round(self._init_times_ms[name], 1) if name in self._init_times_ms else None,
+                    "last_error": self._last_errors.get(name),
+                }
+                for name in sorted(self._factories)
+            }
+
+
+registry = ServiceRegistry()
+
+
+class LazyService:
+    """
+    Module-level stand-in for a registered service
+
+    Attribute access is forwarded to the real instance, which is built on the
+    first access. Truthiness reflects whether the service could be constructed,
+    so `if not stripe_service:` keeps working as before.
+    """
+
+    __slots__ = ("_service_name",)
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_service_name", name)
+
+    def _resolve(self) -> Any:
+        instance = registry.get(self._service_name)
+        if instance is None:
+            raise RuntimeError(f"{self._service_name} service is not available")
+        return instance
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._resolve(), attr)
+
+    def __setattr__(self, attr: str, value: Any) -> None:
+        setattr(self._resolve(), attr, value)
+
+    def __bool__(self) -> bool:
+        return registry.get(self._service_name) is not None
+
+    def __repr__(self) -> str:
+        state = "initialized" if registry.is_initialized(self._service_name) else "pending"
+        return f"<LazyService {self._service_name} ({state})>"
+
+
+def lazy_service(name: str, factory: Callable[[], Any]) -> LazyService:
+    """Register a factory and return a lazy module-level handle for it"""
+    registry.register(name, factory)
+    return LazyService(name)
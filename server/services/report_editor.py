@@ -0,0 +1,417 @@
+"""
+Report Editor
+Applies a dentist's change request to a report by editing only the sections it touches
+
+The report HTML is split into addressable sections (patient summary, titled
+sections, condition/stage boxes, table rows) with their exact character
+offsets. GPT first picks the sections a change applies to from a compact
+outline, then rewrites just those fragments, which are validated and spliced
+back into the original document. Everything outside the targets is returned
+byte-for-byte unchanged.
+
+Reports with no recognisable sections, or edits GPT says need the whole
+document, fall back to the original full-document rewrite.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from services.openai_analysis import openai_service
+from services.registry import lazy_service, registry
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'source', 'track', 'wbr',
+}
+CONTAINER_TAGS = {'div', 'section', 'article'}
+HEADER_TAGS = {'strong', 'b', 'h4', 'h5', 'h6', 'span'}
+
+FULL_EDIT_SYSTEM_PROMPT = """You are an expert dental assistant AI and HTML editor. You will receive:
+
+1. An existing HTML dental treatment plan report, already formatted with inline styles and condition blocks.
+2. A plain-text change request written by a dentist, describing edits they'd like made to the content.
+
+Your task is to carefully update the HTML to reflect these requested changes.
+
+Instructions:
+- Maintain the full structure and inline styles of the HTML exactly as-is.
+- Only modify the **text content inside HTML elements** when explicitly instructed.
+- If the dentist asks to remove a condition entirely, you may delete that entire <div> block.
+- Do not reword, reformat, or reorder any part of the document unless the change request specifies it.
+- Do not add or alter colors, classes, or structure.
+- The output must be a valid, continuous HTML string (starting with <div and ending with </div>).
+- Do not include markdown, code fences, or JSON formatting.
+- Accuracy is critical. This output will be used in patient-facing medical documents."""
+
+SELECT_SYSTEM_PROMPT = """You route edits to parts of a dental treatment report. You will receive an outline of
+the report's sections (id, kind, parent id, title and a short text preview) and a dentist's change request.
+
+Return JSON: {"scope": "sections", "section_ids": ["s3", "s7"]}
+- List every section whose content must change, including totals or summaries that depend on it.
+- Prefer the smallest sections that contain the change (a table row over the whole table).
+- If the change needs new content that doesn't belong inside any existing section, or restructures
+  the whole report, return {"scope": "document", "section_ids": []}."""
+
+EDIT_SYSTEM_PROMPT = """You are an expert dental assistant AI and HTML editor. You will receive some HTML
+fragments from a patient-facing dental treatment report, each with an id, and a dentist's change request.
+
+Apply the change to these fragments only. Return JSON: {"sections": [{"id": "s3", "html": "..."}]}
+- Return every fragment you were given, edited or not.
+- Each returned fragment must be one complete element with the same outer tag as the original.
+- Keep inline styles, classes and structure exactly as-is; change only the text the request asks for.
+- To delete a fragment entirely (e.g. remove a condition or a table row), return "html": "".
+- Never leave sentences incomplete. Accuracy is critical."""
+
+
+class ReportEditError(Exception):
+    """The section edit can't be applied; the caller falls back to a full rewrite"""
+
+
+@dataclass
+class ReportSection:
+    id: str
+    kind: str  # summary | section | box | row
+    tag: str
+    title: str
+    start: int
+    end: int
+    parent: Optional[str] = None
+    preview: str = ""
+
+
+@dataclass
+class _Node:
+    tag: str
+    start: int
+    end: Optional[int] = None
+    children: List["_Node"] = field(default_factory=list)
+
+    def elements(self) -> List["_Node"]:
+        return [c for c in self.children if isinstance(c, _Node)]
+
+    def full_text(self) -> str:
+        parts = []
+        for child in self.children:
+            parts.append(child if isinstance(child, str) else child.full_text())
+        return re.sub(r'\s+', ' ', ' '.join(parts)).strip()
+
+
+class _OffsetParser(HTMLParser):
+    """Builds an element tree with start/end character offsets into the source"""
+
+    def __init__(self, html: str):
+        super().__init__(convert_charrefs=True)
+        self.html = html
+        self.line_starts = [0]
+        for match in re.finditer('\n', html):
+            self.line_starts.append(match.end())
+        self.root = _Node('#root', 0)
+        self.stack = [self.root]
+        self.unclosed = 0
+
+    def _offset(self) -> int:
+        line, col = self.getpos()
+        return self.line_starts[line - 1] + col
+
+    def handle_starttag(self, tag, attrs):
+        start = self._offset()
+        node = _Node(tag, start)
+        self.stack[-1].children.append(node)
+        if tag in VOID_ELEMENTS:
+            node.end = start + len(self.get_starttag_text() or '')
+        else:
+            self.stack.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        start = self._offset()
+        node = _Node(tag, start, end=start + len(self.get_starttag_text() or ''))
+        self.stack[-1].children.append(node)
+
+    def handle_endtag(self, tag):
+        if not any(node.tag == tag for node in self.stack[1:]):
+            return  # stray end tag
+        pos = self._offset()
+        close = self.html.find('>', pos)
+        end = close + 1 if close != -1 else len(self.html)
+        while len(self.stack) > 1:
+            node = self.stack.pop()
+            if node.tag == tag:
+                node.end = end
+                break
+            node.end = pos  # implicitly closed (e.g. <p> without </p>)
+
+    def handle_data(self, data):
+        if data.strip():
+            self.stack[-1].children.append(data)
+
+    def finish(self) -> _Node:
+        self.close()
+        while len(self.stack) > 1:
+            self.stack.pop().end = len(self.html)
+            self.unclosed += 1
+        self.root.end = len(self.html)
+        return self.root
+
+
+def _strip_code_fences(content: str) -> str:
+    content = (content or '').strip()
+    if content.startswith("```html"):
+        content = content[7:]
+        if content.endswith("```"):
+            content = content[:-3]
+    elif content.startswith("```"):
+        content = content.split("\n", 1)[1].rsplit("\n", 1)[0] if "\n" in content else ''
+    return content.strip()
+
+
+def _header_text(node: _Node) -> Optional[str]:
+    """Title of a box whose first child is a header bar (<div><strong>Title</strong></div>)"""
+    elements = node.elements()
+    if not elements or elements[0].tag not in CONTAINER_TAGS:
+        return None
+    header = elements[0]
+    header_elements = header.elements()
+    if len(header_elements) == 1 and header_elements[0].tag in HEADER_TAGS and len(node.elements()) > 1:
+        return header.full_text()
+    return None
+
+
+def parse_sections(html: str) -> List[ReportSection]:
+    """Addressable sections of a report, in document order"""
+    parser = _OffsetParser(html)
+    parser.feed(html)
+    root = parser.finish()
+
+    sections: List[ReportSection] = []
+
+    def add(node: _Node, kind: str, title: str, parent: Optional[str]) -> str:
+        section_id = f"s{len(sections) + 1}"
+        text = node.full_text()
+        sections.append(ReportSection(
+            id=section_id, kind=kind, tag=node.tag, title=title[:120],
+            start=node.start, end=node.end, parent=parent, preview=text[:160]
+        ))
+        return section_id
+
+    def walk(node: _Node, parent: Optional[str]) -> None:
+        for child in node.elements():
+            section_id = None
+            if child.tag == 'tr':
+                cells = [c.full_text() for c in child.elements() if c.tag in ('td', 'th')]
+                section_id = add(child, 'row', ' | '.join(cells), parent)
+            elif child.tag in CONTAINER_TAGS:
+                headings = [c for c in child.elements() if c.tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')]
+                box_title = _header_text(child)
+                if headings and headings[0].tag == 'h1':
+                    section_id = add(child, 'summary', headings[0].full_text(), parent)
+                elif headings and headings[0].tag in ('h2', 'h3'):
+                    section_id = add(child, 'section', headings[0].full_text(), parent)
+                elif headings or box_title:
+                    section_id = add(child, 'box', box_title or headings[0].full_text(), parent)
+            walk(child, section_id or parent)
+
+    walk(root, None)
+    return sections
+
+
+def _validate_fragment(original_tag: str, fragment: str) -> None:
+    if fragment == '':
+        return
+    parser = _OffsetParser(fragment)
+    parser.feed(fragment)
+    root = parser.finish()
+    elements = root.elements()
+    stray_text = [c for c in root.children if isinstance(c, str)]
+    if len(elements) != 1 or stray_text or elements[0].tag != original_tag:
+        raise ReportEditError(f"Edited fragment is not a single <{original_tag}> element")
+    if parser.unclosed or elements[0].end != len(fragment):
+        raise ReportEditError(f"Edited <{original_tag}> fragment is not closed")
+
+
+def splice(html: str, sections: List[ReportSection], replacements: Dict[str, str]) -> str:
+    """Replace section spans with new fragments (outermost wins when they nest)"""
+    by_id = {s.id: s for s in sections}
+    chosen = sorted((by_id[sid] for sid in replacements), key=lambda s: (s.start, -s.end))
+    spans: List[Tuple[ReportSection, str]] = []
+    for section in chosen:
+        if spans and section.start < spans[-1][0].end:
+            continue  # nested inside an already-replaced section
+        spans.append((section, replacements[section.id]))
+
+    parts = []
+    cursor = 0
+    for section, fragment in spans:
+        parts.append(html[cursor:section.start])
+        parts.append(fragment)
+        cursor = section.end
+    parts.append(html[cursor:])
+    return ''.join(parts)
+
+
+class ReportEditor:
+    def __init__(self):
+        self.max_sections_per_edit = int(os.getenv('REPORT_EDIT_MAX_SECTIONS', '12'))
+
+    async def _complete(self, stage: str, messages: List[Dict], json_mode: bool, max_tokens: int) -> str:
+        kwargs: Dict[str, Any] = {
+            "model": openai_service.model_edit,
+            "messages": messages,
+            "temperature": 0.3,
+            "max_tokens": max_tokens,
+        }
+        if json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        with track_stage(stage, model=openai_service.model_edit):
+            response = await asyncio.to_thread(openai_service.client.chat.completions.create, **kwargs)
+        return response.choices[0].message.content or ''
+
+    # ---------------- Full-document edit (fallback) ----------------
+
+    async def edit_full_document(self, html: str, change_request: str) -> str:
+        user_prompt = f"""Here is the current HTML version of the treatment report:
+{html}
+
+Here is the dentist's change request (typed or dictated):
+{change_request}
+
+Please apply the change exactly as described, keeping the HTML structure intact and updating only the necessary content."""
+
+        # Dynamic based on input size
+        max_tokens_needed = min(8000, max(4000, len(html) // 2))
+        content = await self._complete(
+            "openai_edit_report",
+            [
+                {"role": "system", "content": FULL_EDIT_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            json_mode=False,
+            max_tokens=max_tokens_needed
+        )
+        return _strip_code_fences(content)
+
+    # ---------------- Section edit ----------------
+
+    async def select_sections(self, sections: List[ReportSection], change_request: str) -> Optional[List[str]]:
+        """Ids of the sections to edit, or None when the change needs the whole document"""
+        outline = [
+            {"id": s.id, "kind": s.kind, "parent": s.parent, "title": s.title, "preview": s.preview}
+            for s in sections
+        ]
+        content = await self._complete(
+            "openai_edit_select",
+            [
+                {"role": "system", "content": SELECT_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Outline:\n{json.dumps(outline, ensure_ascii=False)}\n\nChange request:\n{change_request}"}
+            ],
+            json_mode=True,
+            max_tokens=300
+        )
+        result = json.loads(content)
+        known = {s.id for s in sections}
+        ids = [sid for sid in result.get('section_ids') or [] if sid in known]
+        if result.get('scope') == 'document' or not ids:
+            return None
+
+        # Drop sections nested inside another selected section
+        by_id = {s.id: s for s in sections}
+        selected = set(ids)
+        outermost = []
+        for sid in ids:
+            parent = by_id[sid].parent
+            while parent and parent not in selected:
+                parent = by_id[parent].parent
+            if parent is None and sid not in outermost:
+                outermost.append(sid)
+        if len(outermost) > self.max_sections_per_edit:
+            return None
+        return outermost
+
+    async def edit_sections(self, html: str, sections: List[ReportSection], target_ids: List[str],
+                            change_request: str) -> Dict[str, str]:
+        by_id = {s.id: s for s in sections}
+        fragments = [
+            {"id": sid, "kind": by_id[sid].kind, "title": by_id[sid].title, "html": html[by_id[sid].start:by_id[sid].end]}
+            for sid in target_ids
+        ]
+        fragment_chars = sum(len(f["html"]) for f in fragments)
+        content = await self._complete(
+            "openai_edit_sections",
+            [
+                {"role": "system", "content": EDIT_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Fragments:\n{json.dumps(fragments, ensure_ascii=False)}\n\nChange request:\n{change_request}"}
+            ],
+            json_mode=True,
+            max_tokens=min(8000, max(1000, fragment_chars // 2))
+        )
+
+        returned = {item.get('id'): item.get('html') for item in json.loads(content).get('sections') or []}
+        replacements = {}
+        for sid in target_ids:
+            if sid not in returned or returned[sid] is None:
+                raise ReportEditError(f"No edit returned for section {sid}")
+            fragment = _strip_code_fences(returned[sid])
+            _validate_fragment(by_id[sid].tag, fragment)
+            replacements[sid] = fragment
+        return replacements
+
+    # ---------------- Entry points ----------------
+
+    async def apply_changes_stream(self, html: str, change_request: str) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Apply a change request, yielding (event, payload) progress updates
+
+        Events: parsed, targets, section (one per edited fragment), fallback,
+        done (with updated_html and the mode used).
+        """
+        with track_stage("report_parse_sections"):
+            sections = parse_sections(html)
+        yield "parsed", {"sections": len(sections)}
+
+        if sections:
+            try:
+                target_ids = await self.select_sections(sections, change_request)
+                if target_ids:
+                    by_id = {s.id: s for s in sections}
+                    yield "targets", {"sections": [{"id": sid, "kind": by_id[sid].kind, "title": by_id[sid].title} for sid in target_ids]}
+
+                    replacements = await self.edit_sections(html, sections, target_ids, change_request)
+                    for sid, fragment in replacements.items():
+                        yield "section", {"id": sid, "title": by_id[sid].title, "deleted": fragment == '', "html": fragment}
+
+                    updated_html = splice(html, sections, replacements)
+                    logger.info(f"✅ Applied change to {len(replacements)} of {len(sections)} report sections")
+                    yield "done", {"updated_html": updated_html, "mode": "sections", "sections_edited": len(replacements)}
+                    return
+                reason = "change spans the whole document"
+            except (ReportEditError, json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+                reason = str(e)
+            logger.warning(f"⚠️ Section edit not possible, rewriting full report: {reason}")
+        else:
+            reason = "no addressable sections in report"
+
+        yield "fallback", {"reason": reason}
+        updated_html = await self.edit_full_document(html, change_request)
+        yield "done", {"updated_html": updated_html, "mode": "document", "sections_edited": 0}
+
+    async def apply_changes(self, html: str, change_request: str) -> str:
+        updated_html = html
+        async for event, payload in self.apply_changes_stream(html, change_request):
+            if event == "done":
+                updated_html = payload["updated_html"]
+        return updated_html
+
+
+# Initialize service lazily on first use to keep imports cheap
+report_editor = lazy_service("report_editor", ReportEditor)
+
+
+def get_report_editor():
+    return registry.get("report_editor")
@@ -4,6 +4,8 @@ import logging
 from typing import Dict, Tuple, Optional
 from dotenv import load_dotenv
 import base64
+from services.registry import lazy_service, registry
+from utils.metrics import returned_none, timed_stage
 
 load_dotenv()
 
@@ -26,8 +28,11 @@ class RoboflowService:
         if not all([self.project_id, self.model_version]):
             raise ValueError("Roboflow condition detection model ID and version must be set")
 
-        self.base_url = f"https://detect.roboflow.com/{self.project_id}/{self.model_version}"
+        # Overridable so benchmarks can point at a local stand-in
+        self.api_url = os.getenv("ROBOFLOW_API_URL", "https://detect.roboflow.com").rstrip("/")
+        self.base_url = f"{self.api_url}/{self.project_id}/{self.model_version}"
     
+    @timed_stage("roboflow_detect", failed=lambda result: result[0] is None)
     async def detect_conditions(self, image_url: str) -> Tuple[Optional[Dict], Optional[bytes]]:
         """
         Send image to Roboflow for detection
@@ -72,6 +77,7 @@ class RoboflowService:
             logger.error(f"Error in Roboflow detection: {str(e)}")
             return None, None
         
+    @timed_stage("roboflow_segment", failed=returned_none)
     async def segment_teeth(self, image_url: str) -> Optional[Dict]:
         """
         Call a separate Roboflow model for teeth segmentation to obtain per‑tooth polygons/bboxes.
@@ -105,7 +111,7 @@ class RoboflowService:
                     # Roboflow expects base64 as the "image" field directly in params with a special format
                     # Try sending it as form data instead of JSON
                     seg_response = await client.post(
-                        f"https://detect.roboflow.com/{self.seg_project_id}/{self.seg_model_version}",
+                        f"{self.api_url}/{self.seg_project_id}/{self.seg_model_version}",
                         params={
                             "api_key": self.api_key,
                         },
@@ -118,7 +124,7 @@ class RoboflowService:
                     logger.info(f"Sending URL to Roboflow segmentation (via query param): {image_url[:100]}...")
                     
                     seg_response = await client.post(
-                        f"https://detect.roboflow.com/{self.seg_project_id}/{self.seg_model_version}",
+                        f"{self.api_url}/{self.seg_project_id}/{self.seg_model_version}",
                         params={
                             "api_key": self.api_key,
                             "image": image_url,
@@ -144,19 +150,8 @@ class RoboflowService:
             logger.error(f"Error in Roboflow teeth segmentation: {str(e)}")
             return None
 
-# Create singleton instance
-# Initialize service lazily to avoid import-time errors
-_roboflow_service = None
+# Initialize service lazily on first use to keep imports cheap
+roboflow_service = lazy_service("roboflow", RoboflowService)
 
 def get_roboflow_service():
-    global _roboflow_service
-    if _roboflow_service is None:
-        try:
-            _roboflow_service = RoboflowService()
-        except Exception as e:
-            logger.error(f"Failed to initialize Roboflow service: {e}")
-            return None
-    return _roboflow_service
-
-# For backward compatibility
-roboflow_service = get_roboflow_service()
\ No newline at end of file
+    return registry.get("roboflow")
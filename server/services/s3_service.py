@@ -315,12 +315,12 @@
 # s3_service = None
 # services/s3_service.py
 
-import boto3
 import os
 import logging
 from typing import Optional, Dict, List
-from botocore.exceptions import ClientError
 from datetime import datetime
+from services.registry import registry
+from utils.metrics import timed_stage
 
 logger = logging.getLogger(__name__)
 
@@ -340,6 +340,8 @@ class S3Service:
             return
         
         try:
+            import boto3
+            
             self.s3_client = boto3.client(
                 's3',
                 aws_access_key_id=self.aws_access_key,
@@ -371,6 +373,7 @@ class S3Service:
             logger.error(f"Error generating presigned URL: {e}")
             return None
     
+    @timed_stage("s3_list_images")
     def list_user_images(self, user_id: str) -> List[Dict]:
         """List all images for a specific user with presigned URLs"""
         try:
@@ -403,6 +406,7 @@ class S3Service:
             logger.error(f"Error listing user images: {e}")
             return []
     
+    @timed_stage("s3_upload_image")
     def upload_image(self, user_id: str, filename: str, file_content: bytes, content_type: str = 'image/jpeg') -> Dict:
         """Upload an image to user's folder"""
         try:
@@ -431,6 +435,52 @@ class S3Service:
                 'error': str(e)
             }
     
+    @timed_stage("s3_upload_file")
+    def upload_file(self, user_id: str, filename: str, local_path: str, content_type: str = 'application/octet-stream',
+                    metadata: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        Upload a file from disk to user's folder
+
+        Above S3_MULTIPART_THRESHOLD_MB this becomes a multipart upload with
+        S3_MULTIPART_CONCURRENCY parts in flight, each read from disk as it is
+        sent, so memory is bounded by part size x concurrency.
+        """
+        try:
+            from boto3.s3.transfer import TransferConfig
+
+            key = f"clinics/{user_id}/{filename}"
+            mb = 1024 * 1024
+            transfer_config = TransferConfig(
+                multipart_threshold=int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '16')) * mb,
+                multipart_chunksize=int(os.getenv('S3_MULTIPART_PART_MB', '8')) * mb,
+                max_concurrency=int(os.getenv('S3_MULTIPART_CONCURRENCY', '4')),
+                use_threads=True
+            )
+
+            self.s3_client.upload_file(
+                local_path,
+                self.bucket_name,
+                key,
+                ExtraArgs={'ContentType': content_type, 'Metadata': metadata or {}},
+                Config=transfer_config
+            )
+
+            # Generate presigned URL for the uploaded file
+            presigned_url = self.generate_presigned_url(key)
+
+            return {
+                'success': True,
+                'key': key,
+                'url': presigned_url
+            }
+
+        except Exception as e:
+            logger.error(f"Error uploading file: {e}")
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
     def create_user_folder(self, user_id: str) -> Dict:
         """
         Create a new clinic folder in S3 for a new user
@@ -447,7 +497,9 @@ class S3Service:
                 'success': False,
                 'error': 'S3 not configured'
             }
-        
+
+        from botocore.exceptions import ClientError
+
         try:
             # Create folder path: clinics/{user_id}/
             folder_key = f"clinics/{user_id}/"
@@ -512,6 +564,12 @@ class S3Service:
             logger.error(f"Error checking user folder: {e}")
             return False
 
+registry.register("s3", S3Service)
+
 def get_s3_service() -> Optional[S3Service]:
-    """Get or create S3 service instance"""
-    return S3Service()
\ No newline at end of file
+    """Get the shared S3 service instance (the bucket is verified once, not per request)"""
+    s3_service = registry.get("s3")
+    if s3_service is not None and not s3_service.is_configured:
+        # Don't pin an unconfigured client - retry initialisation on the next call
+        registry.reset("s3")
+    return s3_service
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""
+Scan Analysis
+One persisted record per scan so each analysis stage runs once
+
+The immediate analysis, the full analysis, tooth mapping and the overlay all
+start from the same image. Their expensive stages (Roboflow detection plus the
+annotated upload, the GPT findings summary, teeth segmentation and tooth
+mapping) are stored on a `scan_analysis` row keyed by (user, image hash), so
+whichever endpoint runs a stage first does the work and the rest reuse it.
+
+The image hash is the upload's content hash (passed explicitly or read from the
+`xrays/<sha256>/` storage path). Other URLs are keyed by the URL plus the
+object's ETag (or Last-Modified), so an object overwritten in place, such as
+S3's `clinics/<user>/<filename>`, starts a new record; scans whose URL gives
+neither aren't recorded. Requests that only know the annotated image URL are
+matched to their scan through it.
+Concurrent requests for the same stage wait for the first instead of
+duplicating it. Without the table (migrations/create_scan_analysis_table.sql)
+records live only in this process's memory.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from services.registry import lazy_service, registry
+
+logger = logging.getLogger(__name__)
+
+CONTENT_HASH_IN_URL = re.compile(r'/([0-9a-f]{64})/')
+
+# Stage name -> columns holding its output
+STAGE_FIELDS = {
+    'detection': ('predictions', 'annotated_image_url'),
+    'findings_summary': ('findings_summary',),
+    'segmentation': ('segmentation',),
+}
+TOOTH_MAPPING_PREFIX = 'tooth_mapping:'
+
+
+def image_key(image_url: str, content_hash: Optional[str] = None, version: Optional[str] = None) -> Optional[str]:
+    """
+    Content hash of the scan if known, else a hash of its URL (without the query
+    string) and the object's `version` (ETag or Last-Modified)
+
+    Inline data: URIs hash their contents. None if the scan can't be told
+    apart from a later object at the same URL.
+    """
+    if content_hash:
+        return content_hash.lower()
+    match = CONTENT_HASH_IN_URL.search(image_url or '')
+    if match:
+        return match.group(1)
+    if (image_url or '').startswith('data:'):
+        return hashlib.sha256(image_url.encode()).hexdigest()
+    if not version:
+        return None
+    return 'url:' + hashlib.sha256(f"{(image_url or '').split('?')[0]}|{version}".encode()).hexdigest()
+
+
+async def fetch_object_version(image_url: str) -> Optional[str]:
+    """ETag (or Last-Modified) of the object behind a URL, from a one-byte ranged GET"""
+    import httpx
+
+    try:
+        async with httpx.AsyncClient(timeout=10.0, follow_redirects=True) as client:
+            # GET rather than HEAD: presigned S3 URLs are only signed for GET
+            response = await client.get(image_url, headers={"Range": "bytes=0-0"})
+            response.raise_for_status()
+        return response.headers.get('etag') or response.headers.get('last-modified')
+    except Exception as e:
+        logger.warning(f"⚠️ Couldn't read the scan's version, not recording its analysis: {str(e)}")
+        return None
+
+
+def tooth_mapping_stage(numbering_system: str, detections: Any) -> str:
+    """Stage name for a mapping of these exact detections (the dentist can edit them)"""
+    canonical = json.dumps(detections, sort_keys=True, separators=(',', ':'), default=str)
+    return f"{TOOTH_MAPPING_PREFIX}{numbering_system}:{hashlib.sha256(canonical.encode()).hexdigest()[:16]}"
+
+
+def _stage_value(record: Dict[str, Any], stage: str) -> Any:
+    if stage.startswith(TOOTH_MAPPING_PREFIX):
+        return (record.get('tooth_mappings') or {}).get(stage[len(TOOTH_MAPPING_PREFIX):])
+    fields = STAGE_FIELDS[stage]
+    if any(record.get(field) is None for field in fields):
+        return None
+    return {field: record[field] for field in fields} if len(fields) > 1 else record[fields[0]]
+
+
+def _stage_update(record: Dict[str, Any], stage: str, value: Any) -> Dict[str, Any]:
+    if stage.startswith(TOOTH_MAPPING_PREFIX):
+        return {'tooth_mappings': {**(record.get('tooth_mappings') or {}), stage[len(TOOTH_MAPPING_PREFIX):]: value}}
+    fields = STAGE_FIELDS[stage]
+    return {field: value[field] for field in fields} if len(fields) > 1 else {fields[0]: value}
+
+
+class ScanAnalysisStore:
+    def __init__(self):
+        self.memory_size = int(os.getenv('SCAN_ANALYSIS_CACHE_SIZE', '256'))
+        self._records: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._annotated: Dict[Tuple[str, str], str] = {}  # (user, annotated url) -> image hash
+        self._lock = threading.Lock()
+        self._stage_locks: Dict[Tuple[str, str, str], asyncio.Lock] = {}
+        self.table_available = True
+        self.stage_hits = 0
+        self.stage_runs = 0
+
+        logger.info(f"Scan analysis store initialized (memory: {self.memory_size} scans)")
+
+    # ---------------- Records ----------------
+
+    def _remember(self, user_id: str, image_hash: str, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self._records[(user_id, image_hash)] = record
+            self._records.move_to_end((user_id, image_hash))
+            if record.get('annotated_image_url'):
+                self._annotated[(user_id, record['annotated_image_url'])] = image_hash
+            while len(self._records) > self.memory_size:
+                (old_user, _), old = self._records.popitem(last=False)
+                self._annotated.pop((old_user, old.get('annotated_image_url')), None)
+
+    def _table(self, token: str):
+        from services.supabase import supabase_service
+        return supabase_service._create_authenticated_client(token).table('scan_analysis')
+
+    def _db_call(self, operation: Callable[[], Any]) -> Any:
+        """Run a query, switching to memory-only if the table doesn't exist"""
+        if not self.table_available:
+            return None
+        try:
+            return operation()
+        except Exception as e:
+            if 'scan_analysis' in str(e) and ('does not exist' in str(e) or 'schema cache' in str(e)):
+                logger.warning("⚠️ scan_analysis table missing, keeping scan analysis in memory only")
+                self.table_available = False
+            else:
+                logger.warning(f"⚠️ Scan analysis query failed: {str(e)}")
+            return None
+
+    async def resolve_key(self, user_id: str, image_url: str, token: str,
+                          content_hash: Optional[str] = None) -> Optional[str]:
+        """Image hash for a request, following annotated image URLs back to their scan; None if it can't be keyed"""
+        key = image_key(image_url, content_hash)
+        if key:
+            return key
+
+        with self._lock:
+            known = self._annotated.get((user_id, image_url))
+        if known:
+            return known
+
+        response = await asyncio.to_thread(self._db_call, lambda: self._table(token)
+                                           .select('*').eq('annotated_image_url', image_url).limit(1).execute())
+        if response is not None and response.data:
+            record = response.data[0]
+            self._remember(user_id, record['image_hash'], record)
+            return record['image_hash']
+        return image_key(image_url, version=await fetch_object_version(image_url))
+
+    async def get(self, user_id: str, image_hash: str, token: str) -> Dict[str, Any]:
+        with self._lock:
+            record = self._records.get((user_id, image_hash))
+            if record is not None:
+                self._records.move_to_end((user_id, image_hash))
+                return record
+
+        response = await asyncio.to_thread(self._db_call, lambda: self._table(token)
+                                           .select('*').eq('image_hash', image_hash).limit(1).execute())
+        record = response.data[0] if response is not None and response.data else {}
+        if record:
+            self._remember(user_id, image_hash, record)
+        return record
+
+    async def save(self, user_id: str, image_hash: str, token: str, image_url: Optional[str] = None,
+                   **fields: Any) -> Dict[str, Any]:
+        """Merge stage outputs into the scan's record and upsert it"""
+        record = {**await self.get(user_id, image_hash, token), **fields}
+        record.update({'user_id': user_id, 'image_hash': image_hash, 'updated_at': datetime.utcnow().isoformat()})
+        if image_url and not record.get('image_url'):
+            record['image_url'] = image_url
+        self._remember(user_id, image_hash, record)
+
+        row = {key: value for key, value in record.items() if key not in ('id', 'created_at')}
+        await asyncio.to_thread(self._db_call, lambda: self._table(token)
+                                .upsert(row, on_conflict='user_id,image_hash').execute())
+        return record
+
+    # ---------------- Stages ----------------
+
+    async def run_stage(self, user_id: str, image_hash: str, token: str, stage: str,
+                        compute: Callable[[], Awaitable[Any]], image_url: Optional[str] = None,
+                        cacheable: Optional[Callable[[Any], bool]] = None) -> Tuple[Any, bool]:
+        """
+        The stored output of `stage` for this scan, computing and storing it on first use
+
+        Returns (value, reused). Results that are falsy, or rejected by
+        `cacheable` (e.g. an error placeholder), are returned but not stored,
+        so a failed stage is retried next time.
+        """
+        value = _stage_value(await self.get(user_id, image_hash, token), stage)
+        if value is not None:
+            self.stage_hits += 1
+            logger.info(f"✅ Reusing {stage.split(':')[0]} for scan {image_hash[:12]}")
+            return value, True
+
+        lock_key = (user_id, image_hash, stage)
+        with self._lock:
+            stage_lock = self._stage_locks.setdefault(lock_key, asyncio.Lock())
+        try:
+            async with stage_lock:
+                # Another request may have finished the stage while we waited
+                record = await self.get(user_id, image_hash, token)
+                value = _stage_value(record, stage)
+                if value is not None:
+                    self.stage_hits += 1
+                    return value, True
+
+                self.stage_runs += 1
+                value = await compute()
+                if value and (cacheable is None or cacheable(value)):
+                    await self.save(user_id, image_hash, token, image_url, **_stage_update(record, stage, value))
+                return value, False
+        finally:
+            with self._lock:
+                if self._stage_locks.get(lock_key) is stage_lock and not stage_lock.locked():
+                    del self._stage_locks[lock_key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "scans_cached": len(self._records),
+                "table_available": self.table_available,
+                "stage_hits": self.stage_hits,
+                "stage_runs": self.stage_runs,
+            }
+
+
+# Initialize service lazily on first use to keep imports cheap
+scan_analysis = lazy_service("scan_analysis", ScanAnalysisStore)
+
+
+def get_scan_analysis():
+    return registry.get("scan_analysis")
@@ -0,0 +1,69 @@
+"""
+Scan Storage
+Stores large spooled uploads (CBCT volumes, DICOM series, archives)
+
+S3 is used when configured, as a managed multipart upload with concurrent
+parts into the clinic's `clinics/<user_id>/` folder (where /aws/images lists
+from); otherwise the file goes to Supabase Storage through the resumable
+endpoint under its content hash. Either way the file is streamed from disk.
+"""
+import asyncio
+import logging
+import mimetypes
+import os
+import re
+from typing import Any, Dict, List
+
+from utils.upload_spool import SpooledUpload
+
+logger = logging.getLogger(__name__)
+
+SCAN_UPLOAD_CONCURRENCY = int(os.getenv('SCAN_UPLOAD_CONCURRENCY', '3'))
+UNSAFE_FILENAME = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+def safe_filename(filename: str) -> str:
+    """Basename with anything outside [A-Za-z0-9._-] replaced"""
+    name = UNSAFE_FILENAME.sub('_', os.path.basename(filename or '')).strip('._')
+    return name or 'upload'
+
+
+async def store_spooled_upload(upload: SpooledUpload, user_id: str, access_token: str) -> Dict[str, Any]:
+    """Upload one spooled file; returns storage, key, url, size and content_hash"""
+    from services.s3_service import get_s3_service
+    from services.supabase import supabase_service
+
+    filename = safe_filename(upload.filename)
+    content_type = upload.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    result = {"filename": filename, "size": upload.size, "content_hash": upload.content_hash}
+
+    s3_service = get_s3_service()
+    if s3_service and s3_service.is_configured:
+        stored = await asyncio.to_thread(
+            s3_service.upload_file, user_id, filename, upload.path, content_type,
+            {'sha256': upload.content_hash}
+        )
+        if not stored.get('success'):
+            raise RuntimeError(f"S3 upload failed for {filename}: {stored.get('error')}")
+        return {**result, "storage": "s3", "key": stored['key'], "url": stored['url']}
+
+    key = f"scans/{user_id}/{upload.content_hash}/{filename}"
+    url = await supabase_service.upload_file_resumable(upload.path, key, access_token, content_type=content_type)
+    if not url:
+        raise RuntimeError(f"Supabase upload failed for {filename}")
+    return {**result, "storage": "supabase", "key": key, "url": url}
+
+
+async def store_spooled_uploads(uploads: List[SpooledUpload], user_id: str, access_token: str) -> List[Dict[str, Any]]:
+    """Upload several files at once, SCAN_UPLOAD_CONCURRENCY at a time; failures are reported per file"""
+    semaphore = asyncio.Semaphore(SCAN_UPLOAD_CONCURRENCY)
+
+    async def store(upload: SpooledUpload) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                return {"status": "success", **await store_spooled_upload(upload, user_id, access_token)}
+            except Exception as e:
+                logger.error(f"❌ Failed to store {upload.filename}: {str(e)}")
+                return {"status": "error", "filename": upload.filename, "error": str(e)}
+
+    return await asyncio.gather(*(store(upload) for upload in uploads))
@@ -0,0 +1,232 @@
+"""
+Staging Service
+Server-side treatment staging (StagingEngineV2) with memoised plans and a
+process pool for batch restaging
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from lib.stagingV2 import DEFAULT_CLINIC_CONFIG, build_staged_plan_v2, merge_clinic_config
+from services.registry import lazy_service, registry
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+
+def _build_plan_chunk(jobs: List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Worker-process entry point: stage several plans, capturing per-plan errors"""
+    results = []
+    for treatments, config in jobs:
+        try:
+            results.append({"plan": build_staged_plan_v2(treatments, config)})
+        except Exception as e:
+            results.append({"error": str(e)})
+    return results
+
+
+class StagingService:
+    def __init__(self):
+        self.cache_size = int(os.getenv('STAGING_PLAN_CACHE_SIZE', '1024'))
+        self.max_workers = int(os.getenv('STAGING_WORKERS', str(min(4, os.cpu_count() or 1))))
+        # Batches smaller than this are staged in-process; IPC would cost more than it saves
+        self.pool_min_batch = int(os.getenv('STAGING_POOL_MIN_BATCH', '32'))
+        self.pool_chunk_size = int(os.getenv('STAGING_POOL_CHUNK_SIZE', '16'))
+        self.max_batch_size = int(os.getenv('STAGING_BATCH_MAX_PLANS', '500'))
+
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        logger.info(f"Staging service initialized (cache: {self.cache_size} plans, workers: {self.max_workers})")
+
+    # ---------------- Config and cache ----------------
+
+    @staticmethod
+    def resolve_config(*overrides: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Defaults merged with each override in turn, validated"""
+        config = DEFAULT_CLINIC_CONFIG
+        for override in overrides:
+            config = merge_clinic_config(config, override)
+
+        budget = config.get('VISIT_TIME_BUDGET_MIN')
+        if not isinstance(budget, (int, float)) or isinstance(budget, bool) or budget <= 0:
+            raise ValueError("VISIT_TIME_BUDGET_MIN must be a positive number")
+        for key in ('MAX_QUADRANTS_PER_VISIT', 'MAX_SIDES_PER_VISIT'):
+            value = config.get(key)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError(f"{key} must be a positive integer")
+        return config
+
+    @staticmethod
+    def plan_key(treatments: List[Dict[str, Any]], config: Dict[str, Any]) -> str:
+        """Canonical hash of (treatments, merged clinic config)"""
+        canonical = json.dumps(
+            {"treatments": treatments, "config": config},
+            sort_keys=True,
+            separators=(',', ':'),
+            default=str
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._cache_lock:
+            plan = self._cache.get(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(plan)
+
+    def _cache_put(self, key: str, plan: Dict[str, Any]) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = copy.deepcopy(plan)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        with self._cache_lock:
+            return {"size": len(self._cache), "max_size": self.cache_size, "hits": self.hits, "misses": self.misses}
+
+    # ---------------- Single plan ----------------
+
+    def plan(self, treatments: List[Dict[str, Any]], clinic_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Stage one patient's treatments, reusing a memoised plan when inputs match"""
+        config = self.resolve_config(clinic_config)
+        key = self.plan_key(treatments, config)
+
+        plan = self._cache_get(key)
+        if plan is not None:
+            return {"plan": plan, "cache_key": key, "cached": True}
+
+        with track_stage("staging_plan"):
+            plan = build_staged_plan_v2(treatments, config)
+        self._cache_put(key, plan)
+        return {"plan": plan, "cache_key": key, "cached": False}
+
+    # ---------------- Batch ----------------
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._pool
+
+    def _reset_pool(self) -> None:
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def _run_jobs(self, jobs: List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        if len(jobs) < self.pool_min_batch or self.max_workers <= 1:
+            return await asyncio.to_thread(_build_plan_chunk, jobs)
+
+        loop = asyncio.get_running_loop()
+        chunks = [jobs[i:i + self.pool_chunk_size] for i in range(0, len(jobs), self.pool_chunk_size)]
+        try:
+            pool = self._get_pool()
+            chunk_results = await asyncio.gather(
+                *(loop.run_in_executor(pool, _build_plan_chunk, chunk) for chunk in chunks)
+            )
+        except BrokenProcessPool as e:
+            logger.error(f"❌ Staging worker pool failed, staging in-process: {str(e)}")
+            self._reset_pool()
+            return await asyncio.to_thread(_build_plan_chunk, jobs)
+
+        return [result for chunk in chunk_results for result in chunk]
+
+    async def plan_batch(self, items: List[Dict[str, Any]],
+                         clinic_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Stage many patients at once
+
+        `items` are dicts with `treatments` plus optional `patient_id` and a
+        per-patient `clinic_config` applied on top of the shared one. Cached
+        plans are returned directly; identical uncached inputs are staged once;
+        the rest run in the worker pool.
+        """
+        if len(items) > self.max_batch_size:
+            raise ValueError(f"Batch too large: {len(items)} plans (max {self.max_batch_size})")
+
+        start_time = time.perf_counter()
+        results: List[Dict[str, Any]] = [{} for _ in items]
+        pending: "OrderedDict[str, Tuple[List[Dict[str, Any]], Dict[str, Any]]]" = OrderedDict()
+        pending_indexes: Dict[str, List[int]] = {}
+        cached = 0
+
+        for index, item in enumerate(items):
+            result = results[index]
+            result["patient_id"] = item.get("patient_id")
+            try:
+                config = self.resolve_config(clinic_config, item.get("clinic_config"))
+            except ValueError as e:
+                result["error"] = str(e)
+                continue
+
+            key = self.plan_key(item["treatments"], config)
+            result["cache_key"] = key
+            plan = self._cache_get(key)
+            if plan is not None:
+                result.update({"plan": plan, "cached": True})
+                cached += 1
+                continue
+
+            pending.setdefault(key, (item["treatments"], config))
+            pending_indexes.setdefault(key, []).append(index)
+
+        if pending:
+            with track_stage("staging_plan_batch"):
+                computed = await self._run_jobs(list(pending.values()))
+
+            for key, outcome in zip(pending.keys(), computed):
+                if "plan" in outcome:
+                    self._cache_put(key, outcome["plan"])
+                for n, index in enumerate(pending_indexes[key]):
+                    if "plan" in outcome:
+                        # Duplicates within the batch share one computation
+                        results[index].update({"plan": outcome["plan"] if n == 0 else copy.deepcopy(outcome["plan"]), "cached": n > 0})
+                    else:
+                        results[index]["error"] = outcome["error"]
+
+        failed = sum(1 for r in results if "error" in r)
+        duration_ms = (time.perf_counter() - start_time) * 1000
+        logger.info(f"🗓️ Staged {len(items)} plans in {duration_ms:.0f}ms ({cached} cached, {len(pending)} computed, {failed} failed)")
+
+        return {
+            "results": results,
+            "stats": {
+                "total": len(items),
+                "cached": cached,
+                "computed": len(pending),
+                "failed": failed,
+                "duration_ms": round(duration_ms, 1)
+            }
+        }
+
+    def shutdown(self) -> None:
+        self._reset_pool()
+
+
+# Initialize service lazily on first use to keep imports cheap
+staging_service = lazy_service("staging", StagingService)
+
+
+def get_staging_service():
+    return registry.get("staging")
@@ -9,6 +9,7 @@ import stripe
 import jwt
 
 from services.supabase import supabase_service
+from services.registry import lazy_service, registry
 
 logger = logging.getLogger(__name__)
 
@@ -295,83 +296,99 @@ class StripeService:
             return None
 
     def handle_webhook(self, payload: bytes, sig_header: str) -> str:
-        webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
-        event = None
+        """Verify and apply a webhook inline; /stripe/webhook queues events instead (services/stripe_webhook_queue.py)"""
+        from services.stripe_webhook_queue import verify_webhook_event
 
+        self.process_event(verify_webhook_event(payload, sig_header))
+        return "ok"
+
+    def _create_user_folder(self, user_id: str) -> None:
+        """S3 folder for a paying clinic; failures are logged, not retried"""
         try:
-            if webhook_secret:
-                event = stripe.Webhook.construct_event(
-                    payload, sig_header, webhook_secret
-                )
+            from services.s3_service import get_s3_service
+            s3_service = get_s3_service()
+
+            if s3_service and s3_service.is_configured:
+                s3_result = s3_service.create_user_folder(user_id)
+                if s3_result['success']:
+                    logger.info(f"✅ S3 folder ready for user {user_id}: {s3_result['folder_key']}")
+                else:
+                    logger.error(f"❌ Failed to create S3 folder for user {user_id}: {s3_result.get('error')}")
             else:
-                event = json.loads(payload.decode("utf-8"))
+                logger.warning(f"⚠️ S3 service not configured, skipping folder creation for {user_id}")
         except Exception as e:
-            logger.error(f"Webhook verification failed: {e}")
-            raise
+            logger.error(f"❌ Error creating S3 folder for user {user_id}: {e}")
 
+    def process_event(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Apply a verified Stripe event: register new users, set up S3 for paying
+        clinics and persist subscription state. Raises when the event should be retried.
+        """
         event_type = event.get("type")
         data_object = event.get("data", {}).get("object", {})
 
-        if event_type in ("checkout.session.completed", "customer.subscription.updated", "customer.subscription.deleted"):
-            try:
-                if event_type == "checkout.session.completed":
-                    logger.info("💳 Processing checkout.session.completed event")
-                    metadata = data_object.get("metadata", {}) or {}
-                    customer_id = data_object.get("customer")
-                    status = "active"
-                    
-                    logger.info(f"🔍 Checking if registration: is_registration = {metadata.get('is_registration')}")
-                    
-                    # Check if this is a registration session
-                    if metadata.get("is_registration") == "true":
-                        logger.info("🆕 This is a NEW USER registration - calling registration handler")
-                        # Handle new user registration
-                        user_id = self._handle_registration_webhook(data_object)
-                        logger.info(f"🆕 Registration handler returned user_id: {user_id}")
-                    else:
-                        logger.info("👤 This is an existing user subscription")
-                        # Handle existing user subscription
-                        user_id = metadata.get("user_id")
-                else:
-                    user_id = (data_object.get("metadata") or {}).get("user_id")
-                    customer_id = data_object.get("customer")
-                    status = data_object.get("status", "active")
+        if event_type not in ("checkout.session.completed", "customer.subscription.updated", "customer.subscription.deleted"):
+            logger.info(f"ℹ️ Ignoring event type: {event_type}")
+            return {"status": "ignored", "event_type": event_type}
 
-                if not user_id:
-                    user_id = (data_object.get("metadata") or {}).get("userId")
+        if event_type == "checkout.session.completed":
+            logger.info("💳 Processing checkout.session.completed event")
+            metadata = data_object.get("metadata", {}) or {}
+            customer_id = data_object.get("customer")
+            status = "active"
+            registered = False
 
+            # Check if this is a registration session
+            if metadata.get("is_registration") == "true":
+                logger.info("🆕 This is a NEW USER registration - calling registration handler")
+                # Handle new user registration (also creates the S3 folder and clinic branding)
+                user_id = self._handle_registration_webhook(data_object)
+                if not user_id:
+                    raise RuntimeError("Registration failed")
+                registered = True
+            else:
+                logger.info("👤 This is an existing user subscription")
+                user_id = metadata.get("user_id")
                 if user_id:
-                    auth_client = supabase_service.client
-                    auth_client.table("subscriptions").upsert({
-                        "user_id": user_id,
-                        "stripe_customer_id": customer_id,
-                        "status": status
-                    }, on_conflict="user_id").execute()
-                    plan = "pro" if status in ("active", "trialing") else "free"
-                    auth_client.table("profiles").upsert({
-                        "user_id": user_id,
-                        "plan": plan,
-                        "status": status
-                    }, on_conflict="user_id").execute()
-            except Exception as e:
-                logger.error(f"Failed to persist subscription state: {e}")
-                raise
+                    self._create_user_folder(user_id)
+        else:
+            user_id = (data_object.get("metadata") or {}).get("user_id")
+            customer_id = data_object.get("customer")
+            status = data_object.get("status", "active")
+            registered = False
 
-        return "ok"
+        if not user_id:
+            user_id = (data_object.get("metadata") or {}).get("userId")
 
-# Initialize service lazily to avoid import-time errors
-_stripe_service = None
+        if not user_id:
+            logger.warning(f"⚠️ No user_id found for {event_type} event")
+            return {"status": "skipped", "event_type": event_type}
 
-def get_stripe_service():
-    global _stripe_service
-    if _stripe_service is None:
         try:
-            _stripe_service = StripeService()
+            auth_client = supabase_service.get_service_client()
+            auth_client.table("subscriptions").upsert({
+                "user_id": user_id,
+                "stripe_customer_id": customer_id,
+                "status": status
+            }, on_conflict="user_id").execute()
+            plan = "pro" if status in ("active", "trialing") else "free"
+            auth_client.table("profiles").upsert({
+                "user_id": user_id,
+                "plan": plan,
+                "status": status
+            }, on_conflict="user_id").execute()
         except Exception as e:
-            logger.error(f"Failed to initialize Stripe service: {e}")
-            return None
-    return _stripe_service
+            logger.error(f"Failed to persist subscription state: {e}")
+            if not registered:
+                raise
+            # The account now exists, so a retry would fail at sign-up; keep the registration and report the error
+            return {"status": "processed", "event_type": event_type, "user_id": user_id, "subscription_error": str(e)}
+
+        return {"status": "processed", "event_type": event_type, "user_id": user_id}
 
-# For backward compatibility
-stripe_service = get_stripe_service()
+# Initialize service lazily on first use to keep imports cheap
+stripe_service = lazy_service("stripe", StripeService)
+
+def get_stripe_service():
+    return registry.get("stripe")
 
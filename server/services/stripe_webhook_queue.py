@@ -0,0 +1,342 @@
+"""
+Stripe Webhook Queue
+Durable, idempotent processing of Stripe webhook events
+
+POST /stripe/webhook only verifies the signature and records the event in
+`stripe_webhook_events` (migrations/create_stripe_webhook_events.sql), keyed by
+Stripe's event id, then returns 200. A worker in this process applies the
+event through StripeService.process_event:
+
+- a redelivered event id is acknowledged and ignored, so Stripe retries can't
+  register the same clinic twice
+- an event is claimed (pending/failed -> processing) before it runs, so it is
+  applied at most once even if a redelivery races a retry
+- events for the same customer run one at a time in the order received;
+  different customers run concurrently, up to STRIPE_WEBHOOK_WORKERS
+- failures are retried with exponential backoff up to STRIPE_WEBHOOK_MAX_ATTEMPTS,
+  and events a restart left unfinished are resumed on startup
+
+Registration checkouts carry the new user's details, password included, in
+`metadata.registration_data`. The stored payload keeps it only until the
+event is processed (or given up on); recordings never contain it. Replaying a
+registration therefore needs a fresh payload.
+
+Without the table, events are de-duplicated in this process's memory only.
+Setting STRIPE_WEBHOOK_RECORD_DIR also writes each (redacted) payload to disk
+for replaying with stripe_webhook_replay.py.
+"""
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from services.registry import lazy_service, registry
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED_STATUSES = ['pending', 'processing', 'failed']
+REDACTED = '[redacted]'
+
+
+class WebhookSignatureError(ValueError):
+    """The Stripe-Signature header doesn't match the payload"""
+
+
+def verify_webhook_event(payload: bytes, sig_header: Optional[str]) -> Dict[str, Any]:
+    """
+    Parse a webhook payload, verifying its signature when STRIPE_WEBHOOK_SECRET is set
+
+    Without a secret (local development) the payload is accepted unverified.
+    """
+    webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
+    if not webhook_secret:
+        logger.warning("⚠️ STRIPE_WEBHOOK_SECRET not set, accepting webhook without signature verification")
+        return json.loads(payload)
+
+    import stripe
+    try:
+        # Only verifies; the StripeObject it builds isn't kept
+        stripe.Webhook.construct_event(payload, sig_header or '', webhook_secret)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        raise WebhookSignatureError(str(e)) from e
+    # Plain dicts from here on, so events serialise and process the same however they arrived
+    return json.loads(payload)
+
+
+def customer_key(event: Dict[str, Any]) -> str:
+    """Events sharing this key are applied in order: the customer, else the registering email"""
+    data_object = event.get('data', {}).get('object', {}) or {}
+    metadata = data_object.get('metadata') or {}
+    customer = data_object.get('customer') if isinstance(data_object.get('customer'), str) else None
+    return (customer
+            or metadata.get('user_id')
+            or metadata.get('user_email')
+            or data_object.get('customer_email')
+            or f"event:{event.get('id')}")
+
+
+def redact_event(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """A copy of the event without registration credentials, or None if it had none"""
+    metadata = (event.get('data', {}).get('object', {}) or {}).get('metadata') or {}
+    if not metadata.get('registration_data') or metadata['registration_data'] == REDACTED:
+        return None
+    redacted = copy.deepcopy(event)
+    redacted['data']['object']['metadata']['registration_data'] = REDACTED
+    return redacted
+
+
+class StripeWebhookQueue:
+    def __init__(self):
+        self.max_attempts = int(os.getenv('STRIPE_WEBHOOK_MAX_ATTEMPTS', '5'))
+        self.retry_base_s = float(os.getenv('STRIPE_WEBHOOK_RETRY_BASE_S', '2'))
+        self.stale_after = timedelta(seconds=float(os.getenv('STRIPE_WEBHOOK_STALE_S', '300')))
+        self.record_dir = os.getenv('STRIPE_WEBHOOK_RECORD_DIR')
+        self.memory_size = int(os.getenv('STRIPE_WEBHOOK_MEMORY_SIZE', '10000'))
+
+        self._slots = asyncio.Semaphore(int(os.getenv('STRIPE_WEBHOOK_WORKERS', '4')))
+        self._lanes: Dict[str, Deque[Dict[str, Any]]] = {}
+        self._lane_tasks: Dict[str, asyncio.Task] = {}
+        self._seen: "OrderedDict[str, str]" = OrderedDict()  # event id -> status
+        self._lock = threading.Lock()
+        self.table_available = True
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+
+        logger.info(f"Stripe webhook queue initialized (max attempts: {self.max_attempts})")
+
+    # ---------------- Storage ----------------
+
+    def _table(self):
+        from services.supabase import supabase_service
+        return supabase_service.get_service_client().table('stripe_webhook_events')
+
+    def _db_call(self, operation: Callable[[], Any]) -> Any:
+        """Run a query; returns None when the table doesn't exist (memory-only), raises on other errors"""
+        if not self.table_available:
+            return None
+        try:
+            return operation()
+        except Exception as e:
+            if 'stripe_webhook_events' in str(e) and ('does not exist' in str(e) or 'schema cache' in str(e)):
+                logger.warning("⚠️ stripe_webhook_events table missing, de-duplicating webhooks in memory only")
+                self.table_available = False
+                return None
+            raise
+
+    def _set_seen(self, event_id: str, status: str) -> None:
+        with self._lock:
+            self._seen[event_id] = status
+            self._seen.move_to_end(event_id)
+            while len(self._seen) > self.memory_size:
+                self._seen.popitem(last=False)
+
+    def _record_payload(self, event_id: str, event: Dict[str, Any]) -> None:
+        try:
+            directory = Path(self.record_dir)
+            directory.mkdir(parents=True, exist_ok=True)
+            (directory / f"{event_id}.json").write_text(json.dumps(redact_event(event) or event, indent=2))
+        except Exception as e:
+            logger.warning(f"⚠️ Couldn't record Stripe webhook payload {event_id}: {str(e)}")
+
+    # ---------------- Ingestion ----------------
+
+    async def ingest(self, event: Dict[str, Any]) -> bool:
+        """
+        Record a verified event and queue it; returns False for an event id already seen
+
+        Raises if the event can't be recorded, so the webhook fails and Stripe redelivers it.
+        """
+        event_id = event.get('id')
+        if not event_id:
+            raise ValueError("Stripe event has no id")
+        self.received += 1
+
+        # Check and mark in one step so concurrent deliveries of the same event can't both pass
+        with self._lock:
+            seen = event_id in self._seen
+            if not seen:
+                self._seen[event_id] = 'recording'
+        if seen:
+            self.duplicates += 1
+            return False
+
+        if self.record_dir:
+            await asyncio.to_thread(self._record_payload, event_id, event)
+
+        created = event.get('created')
+        row = {
+            'event_id': event_id,
+            'event_type': event.get('type', 'unknown'),
+            'customer_key': customer_key(event),
+            'payload': event,
+            'status': 'pending',
+            'attempts': 0,
+            'stripe_created_at': datetime.fromtimestamp(created, timezone.utc).isoformat() if created else None,
+        }
+        try:
+            response = await asyncio.to_thread(self._db_call, lambda: self._table()
+                                               .upsert(row, on_conflict='event_id', ignore_duplicates=True).execute())
+        except Exception:
+            # Not recorded, so let Stripe's redelivery try again
+            with self._lock:
+                self._seen.pop(event_id, None)
+            raise
+
+        # A conflicting (already recorded) row isn't returned
+        if response is not None and not response.data:
+            self.duplicates += 1
+            self._set_seen(event_id, 'recorded')
+            return False
+
+        self._set_seen(event_id, 'pending')
+        self._enqueue(event, 'pending', attempts=0)
+        return True
+
+    def _enqueue(self, event: Dict[str, Any], status: str, attempts: int) -> None:
+        key = customer_key(event)
+        self._lanes.setdefault(key, deque()).append({'event': event, 'status': status, 'attempts': attempts})
+        if key not in self._lane_tasks:
+            self._lane_tasks[key] = asyncio.create_task(self._drain(key), name=f"stripe_webhook:{key}")
+
+    async def resume_pending(self) -> int:
+        """Queue events left unfinished by a previous run (events still processing are left alone until stale)"""
+        response = await asyncio.to_thread(self._db_call, lambda: self._table()
+                                           .select('*')
+                                           .in_('status', UNFINISHED_STATUSES)
+                                           .lt('attempts', self.max_attempts)
+                                           .order('received_at')
+                                           .execute())
+        if response is None:
+            return 0
+
+        stale_before = datetime.utcnow() - self.stale_after
+        resumed = 0
+        for row in response.data or []:
+            updated_at = datetime.fromisoformat(str(row.get('updated_at') or row['received_at']).replace('Z', '+00:00'))
+            if row['status'] == 'processing' and updated_at.replace(tzinfo=None) > stale_before:
+                continue
+            self._set_seen(row['event_id'], row['status'])
+            self._enqueue(row['payload'], row['status'], attempts=row.get('attempts') or 0)
+            resumed += 1
+
+        if resumed:
+            logger.info(f"🔄 Resuming {resumed} unfinished Stripe webhook events")
+        return resumed
+
+    # ---------------- Processing ----------------
+
+    async def _drain(self, key: str) -> None:
+        """Apply one customer's events in order"""
+        lane = self._lanes[key]
+        try:
+            while lane:
+                item = lane[0]
+                await self._process(item['event'], item['status'], item['attempts'])
+                lane.popleft()
+        finally:
+            self._lanes.pop(key, None)
+            self._lane_tasks.pop(key, None)
+
+    async def _update(self, event_id: str, fields: Dict[str, Any], expected: Optional[Tuple[str, int]] = None) -> bool:
+        """
+        Update the event's row; True if it changed (or memory-only)
+
+        With `expected` (status, attempts) the update is a compare-and-set: it
+        only applies if the row is still exactly as this worker last saw it.
+        """
+        fields = {**fields, 'updated_at': datetime.utcnow().isoformat()}
+
+        def update():
+            query = self._table().update(fields).eq('event_id', event_id)
+            if expected:
+                query = query.eq('status', expected[0]).eq('attempts', expected[1])
+            return query.execute()
+
+        response = await asyncio.to_thread(self._db_call, update)
+        return response is None or bool(response.data)
+
+    async def _process(self, event: Dict[str, Any], status: str, attempts: int) -> None:
+        """Apply the event, starting from the row's last known (status, attempts)"""
+        event_id = event['id']
+        # Once done either way, the stored payload no longer needs registration credentials
+        redacted = redact_event(event)
+        done_fields = {'payload': redacted} if redacted else {}
+        claim_errors = 0
+        while attempts < self.max_attempts:
+            try:
+                # Claim the event so no other delivery, worker or instance applies it too
+                claimed = await self._update(event_id, {'status': 'processing', 'attempts': attempts + 1},
+                                             expected=(status, attempts))
+                if not claimed:
+                    logger.info(f"ℹ️ Stripe event {event_id} already handled, skipping")
+                    return
+                status, attempts = 'processing', attempts + 1
+
+                from services.stripe_service import get_stripe_service
+                stripe_service = get_stripe_service()
+                if not stripe_service:
+                    raise RuntimeError("Stripe service unavailable")
+
+                async with self._slots:
+                    result = await asyncio.to_thread(stripe_service.process_event, event)
+            except Exception as e:
+                logger.error(f"❌ Stripe event {event_id} failed (attempt {attempts}/{self.max_attempts}): {str(e)}")
+                if status == 'processing':
+                    final = attempts >= self.max_attempts
+                    try:
+                        if await self._update(event_id, {'status': 'failed', 'last_error': str(e)[:1000],
+                                                         **(done_fields if final else {})},
+                                              expected=(status, attempts)):
+                            status = 'failed'
+                    except Exception as update_error:
+                        logger.warning(f"⚠️ Couldn't mark Stripe event {event_id} failed: {str(update_error)}")
+                else:
+                    # The claim itself errored, so the row is unchanged; retry the claim
+                    claim_errors += 1
+                    if claim_errors >= self.max_attempts:
+                        break
+                self._set_seen(event_id, 'failed')
+                if attempts < self.max_attempts:
+                    await asyncio.sleep(self.retry_base_s * 2 ** (max(attempts, claim_errors) - 1))
+                continue
+
+            self._set_seen(event_id, 'processed')
+            self.processed += 1
+            logger.info(f"✅ Stripe event {event_id} ({event.get('type')}) {result.get('status')}")
+            try:
+                await self._update(event_id, {'status': 'processed', 'last_error': None,
+                                              'processed_at': datetime.utcnow().isoformat(), **done_fields})
+            except Exception as e:
+                # Applied already; never retry it just because the status write failed
+                logger.warning(f"⚠️ Couldn't mark Stripe event {event_id} processed: {str(e)}")
+            return
+
+        self.failed += 1
+        logger.error(f"🚨 Stripe event {event_id} gave up after {attempts} attempts")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "table_available": self.table_available,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "processed": self.processed,
+            "failed": self.failed,
+            "queued": sum(len(lane) for lane in self._lanes.values()),
+            "active_customers": len(self._lane_tasks),
+        }
+
+
+# Initialize service lazily on first use to keep imports cheap
+stripe_webhook_queue = lazy_service("stripe_webhooks", StripeWebhookQueue)
+
+
+def get_stripe_webhook_queue():
+    return registry.get("stripe_webhooks")
@@ -1,8 +1,11 @@
 import os
+import mimetypes
 from supabase import create_client, Client
 from dotenv import load_dotenv
 from typing import Optional
 import logging
+from services.registry import lazy_service, registry
+from utils.metrics import returned_none, timed_stage
 
 load_dotenv()
 
@@ -67,13 +70,17 @@ class SupabaseService:
         except Exception as e:
             logger.info(f"ensure_schema skipped or failed (expected on limited keys): {e}")
     
-    async def upload_image(self, file_data: bytes, file_path: str, access_token: str, bucket: str = "xray-images") -> Optional[str]:
+    @timed_stage("supabase_upload_image", failed=returned_none)
+    async def upload_image(self, file_data: bytes, file_path: str, access_token: str, bucket: str = "xray-images",
+                           content_type: Optional[str] = None) -> Optional[str]:
         try:
+            # Infer the MIME type from the extension unless the caller knows it
+            content_type = content_type or mimetypes.guess_type(file_path)[0] or "image/jpeg"
             auth_client = self._create_authenticated_client(access_token)
             response = auth_client.storage.from_(bucket).upload(
                 file_path,
                 file_data,
-                file_options={"content-type": "image/jpeg", "upsert": "true"}
+                file_options={"content-type": content_type, "upsert": "true"}
             )
             public_url = self.client.storage.from_(bucket).get_public_url(file_path)
             logger.info(f"Successfully uploaded image: {file_path}")
@@ -81,7 +88,80 @@ class SupabaseService:
         except Exception as e:
             logger.error(f"Error uploading image: {str(e)}")
             return None
-    
+
+    @timed_stage("supabase_upload_resumable", failed=returned_none)
+    async def upload_file_resumable(self, local_path: str, file_path: str, access_token: str, bucket: str = "xray-images",
+                                    content_type: Optional[str] = None) -> Optional[str]:
+        """
+        Upload a file from disk with Supabase Storage's resumable (TUS) endpoint
+
+        Reads and sends one 6 MB chunk at a time (the chunk size Supabase requires),
+        so memory stays flat for large scans. A failed chunk is retried from the
+        offset the server reports.
+        """
+        import asyncio
+        import base64
+        import httpx
+
+        chunk_size = 6 * 1024 * 1024
+        content_type = content_type or mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        size = os.path.getsize(local_path)
+        metadata = ",".join(
+            f"{key} {base64.b64encode(value.encode()).decode()}"
+            for key, value in (("bucketName", bucket), ("objectName", file_path),
+                               ("contentType", content_type), ("cacheControl", "3600"))
+        )
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "apikey": self.anon_key,
+            "Tus-Resumable": "1.0.0",
+        }
+
+        try:
+            async with httpx.AsyncClient(timeout=120.0) as client:
+                created = await client.post(
+                    f"{self.url}/storage/v1/upload/resumable",
+                    headers={**headers, "Upload-Length": str(size), "Upload-Metadata": metadata, "x-upsert": "true"}
+                )
+                created.raise_for_status()
+                location = created.headers["Location"]
+
+                offset, attempts = 0, 0
+                with open(local_path, 'rb') as f:
+                    def read_chunk(start: int) -> bytes:
+                        f.seek(start)
+                        return f.read(chunk_size)
+
+                    while offset < size:
+                        # Disk reads run off the event loop
+                        chunk = await asyncio.to_thread(read_chunk, offset)
+                        try:
+                            response = await client.patch(
+                                location,
+                                content=chunk,
+                                headers={**headers, "Upload-Offset": str(offset),
+                                         "Content-Type": "application/offset+octet-stream"}
+                            )
+                            response.raise_for_status()
+                            offset = int(response.headers.get("Upload-Offset", offset + len(chunk)))
+                            attempts = 0
+                        except httpx.HTTPError as e:
+                            attempts += 1
+                            if attempts > 3:
+                                raise
+                            logger.warning(f"⚠️ Resumable upload chunk at {offset} failed, resuming: {str(e)}")
+                            head = await client.head(location, headers=headers)
+                            head.raise_for_status()
+                            offset = int(head.headers.get("Upload-Offset", offset))
+
+            public_url = self.client.storage.from_(bucket).get_public_url(file_path)
+            logger.info(f"✅ Resumable upload complete: {file_path} ({size} bytes)")
+            return public_url
+        except Exception as e:
+            logger.error(f"❌ Error in resumable upload: {str(e)}")
+            return None
+
+    @timed_stage("supabase_save_diagnosis")
     async def save_diagnosis(self, diagnosis_data: dict, access_token: str) -> dict:
         try:
             auth_client = self._create_authenticated_client(access_token)
@@ -119,6 +199,7 @@ class SupabaseService:
             logger.error(f"Error saving diagnosis: {str(e)}")
             raise
     
+    @timed_stage("supabase_update_diagnosis")
     async def update_diagnosis(self, diagnosis_id: str, update_data: dict, access_token: str) -> dict:
         """Update an existing diagnosis record"""
         try:
@@ -131,6 +212,7 @@ class SupabaseService:
             logger.error(f"Error updating diagnosis {diagnosis_id}: {str(e)}")
             raise
     
+    @timed_stage("supabase_upload_video", failed=returned_none)
     async def upload_video(self, file_data: bytes, file_path: str, access_token: str, bucket: str = "patient-videos") -> Optional[str]:
         try:
             try:
@@ -150,6 +232,7 @@ class SupabaseService:
             logger.error(f"Error uploading video: {str(e)}")
             return None
 
+    @timed_stage("supabase_upload_pdf", failed=returned_none)
     async def upload_pdf(self, file_data: bytes, file_path: str, access_token: str, bucket: str = "patient-reports") -> Optional[str]:
         try:
             try:
@@ -480,8 +563,9 @@ class SupabaseService:
             logger.error(f"Error fetching dental conditions: {str(e)}")
             raise
 
-    def get_supabase_service():
-        """Get the global Supabase service instance"""
-        return supabase_service
+# Initialize service lazily on first use to keep imports cheap
+supabase_service = lazy_service("supabase", SupabaseService)
 
-supabase_service = SupabaseService()
\ No newline at end of file
+def get_supabase_service():
+    """Get the global Supabase service instance"""
+    return registry.get("supabase")
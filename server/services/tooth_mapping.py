@@ -2,11 +2,16 @@ import logging
 import json
 import math
 import base64
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional
 from dataclasses import dataclass
+import numpy as np
 import openai
 import os
 from datetime import datetime
+from services.completion_cache import cached_completion
+from services.grid_mapper import GridCalibration, is_degenerate, map_grid
+from services.registry import lazy_service, registry
+from utils.metrics import timed_stage
 
 logger = logging.getLogger(__name__)
 
@@ -43,9 +48,11 @@ class ToothMappingService:
         # Allow overriding the vision model
         self.model_vision = os.getenv("OPENAI_MODEL_VISION", "gpt-5-vision")
         
-    def map_teeth_ensemble(self, image_url: str, detections: List[Detection], numbering_system: str = "FDI") -> MappingResult:
+    def map_teeth_ensemble(self, image_url: str, detections: List[Detection], numbering_system: str = "FDI",
+                           segmentation: Optional[Dict] = None) -> MappingResult:
         """
         Ensemble tooth mapping using GPT-4 Vision + Grid + GPT Referee
+        The grid is calibrated from `segmentation` (the scan's teeth segmentation) when given
         """
         start_time = datetime.now()
         
@@ -56,7 +63,7 @@ class ToothMappingService:
             gpt_result = self._map_teeth_gpt4(image_url, detections, numbering_system)
             
             # Step 2: Grid-based Analysis
-            grid_result = self._map_teeth_grid(detections, numbering_system)
+            grid_result = self._map_teeth_grid(detections, numbering_system, segmentation)
             
             # Step 3: GPT Referee for final decision
             final_result = self._gpt_referee(image_url, gpt_result, grid_result, numbering_system)
@@ -73,7 +80,7 @@ class ToothMappingService:
         except Exception as e:
             logger.error(f"Ensemble mapping failed: {str(e)}")
             # Fallback to grid-only mapping
-            grid_result = self._map_teeth_grid(detections, numbering_system)
+            grid_result = self._map_teeth_grid(detections, numbering_system, segmentation)
             processing_time = (datetime.now() - start_time).total_seconds()
             
             return MappingResult(
@@ -83,6 +90,7 @@ class ToothMappingService:
                 method_used="grid_fallback"
             )
     
+    @timed_stage("openai_tooth_mapping", model_attr="model_vision")
     def _map_teeth_gpt4(self, image_url: str, detections: List[Detection], numbering_system: str = "FDI") -> List[ToothMapping]:
         """
         Use GPT-4 Vision to map teeth based on visual analysis with reference image
@@ -99,7 +107,10 @@ class ToothMappingService:
             if not os.path.exists(reference_image_path):
                 logger.warning(f"Reference image not found: {reference_image_path}, proceeding without reference")
                 # Fallback to original method without reference image
-                response = self.openai_client.chat.completions.create(
+                content = cached_completion(
+                    self.openai_client,
+                    "tooth_mapping",
+                    cache=True,
                     model=self.model_vision,
                     messages=[
                         {
@@ -123,7 +134,10 @@ class ToothMappingService:
                 )
             else:
                 # Include reference image in the API call
-                response = self.openai_client.chat.completions.create(
+                content = cached_completion(
+                    self.openai_client,
+                    "tooth_mapping",
+                    cache=True,
                     model=self.model_vision,
                     messages=[
                         {
@@ -153,87 +167,61 @@ class ToothMappingService:
                 )
             
             # Parse GPT-4 response
-            content = response.choices[0].message.content
             return self._parse_gpt4_response(content, detections, numbering_system)
             
         except Exception as e:
             logger.error(f"GPT-4 mapping failed: {str(e)}")
             raise
     
-    def _map_teeth_grid(self, detections: List[Detection], numbering_system: str = "FDI") -> List[ToothMapping]:
+    def map_teeth_grid(self, detections: List[Detection], numbering_system: str = "FDI",
+                       segmentation: Optional[Dict] = None) -> MappingResult:
         """
-        Grid-based tooth mapping using coordinate analysis
+        Grid-only tooth mapping, the fast path (no GPT calls)
+        Calibrated to the scan's tooth centroids when its segmentation is available
         """
-        mappings = []
-        
-        # Check if all detections have the same coordinates (which would cause all to map to same tooth)
-        unique_coordinates = set()
-        for detection in detections:
-            unique_coordinates.add((detection.x, detection.y))
-        
-        if len(unique_coordinates) == 1:
-            logger.warning(f"All {len(detections)} detections have the same coordinates: {list(unique_coordinates)[0]}")
-            # Use simple sequential mapping as fallback
-            return self._map_teeth_simple(detections, numbering_system)
+        start_time = datetime.now()
+        grid_result = self._map_teeth_grid(detections, numbering_system, segmentation)
+        return MappingResult(
+            mappings=grid_result,
+            overall_confidence=sum(m.confidence for m in grid_result) / len(grid_result) if grid_result else 0.0,
+            processing_time=(datetime.now() - start_time).total_seconds(),
+            method_used="grid"
+        )
+    
+    @timed_stage("grid_tooth_mapping")
+    def _map_teeth_grid(self, detections: List[Detection], numbering_system: str = "FDI",
+                        segmentation: Optional[Dict] = None) -> List[ToothMapping]:
+        """
+        Grid-based tooth mapping using coordinate analysis, vectorised over all detections
+        """
+        xs = np.fromiter((detection.x for detection in detections), dtype=np.float64, count=len(detections))
+        ys = np.fromiter((detection.y for detection in detections), dtype=np.float64, count=len(detections))
         
-        # Also check if coordinates are all zeros or invalid
-        all_zero_coords = all(detection.x == 0 and detection.y == 0 for detection in detections)
-        if all_zero_coords:
-            logger.warning(f"All {len(detections)} detections have zero coordinates - using simple mapping")
+        # All-zero or identical coordinates would map every detection to the same tooth
+        if is_degenerate(xs, ys):
+            logger.warning(f"All {len(detections)} detections have zero or identical coordinates - using simple mapping")
             return self._map_teeth_simple(detections, numbering_system)
         
-        # Check if all coordinates are the same value (not just zeros)
-        first_x, first_y = detections[0].x, detections[0].y
-        all_same_coords = all(detection.x == first_x and detection.y == first_y for detection in detections)
-        if all_same_coords and len(detections) > 1:
-            logger.warning(f"All {len(detections)} detections have identical coordinates ({first_x}, {first_y}) - using simple mapping")
-            return self._map_teeth_simple(detections, numbering_system)
+        calibration = GridCalibration.from_segmentation(segmentation) if segmentation else None
+        grid = map_grid(xs, ys, [detection.class_name for detection in detections], calibration)
+        logger.info(f"Grid mapped {len(detections)} detections ({calibration.source if calibration else 'default'} calibration)")
         
-        for i, detection in enumerate(detections):
-            # Debug: Log original coordinates
-            logger.info(f"Detection {i}: original x={detection.x}, y={detection.y}, class={detection.class_name}")
-            
-            # Log the actual data type and range of coordinates
-            logger.info(f"Detection {i}: x_type={type(detection.x)}, y_type={type(detection.y)}")
-            logger.info(f"Detection {i}: x_range={'0-1' if 0 <= detection.x <= 1 else '0-100' if 0 <= detection.x <= 100 else 'other'}")
-            logger.info(f"Detection {i}: y_range={'0-1' if 0 <= detection.y <= 1 else '0-100' if 0 <= detection.y <= 100 else 'other'}")
-            
-            # RoboFlow returns coordinates in PIXELS, not normalized values
-            # Based on your sample data, coordinates are in pixel values (e.g., x:1720.5, y:737.5)
-            # Typical panoramic X-ray dimensions are around 2000x1000 pixels
-            # Use a reasonable estimate for normalization
-            estimated_image_width = 2000  # Typical panoramic X-ray width
-            estimated_image_height = 1000  # Typical panoramic X-ray height
-            
-            # Normalize pixel coordinates to 0-1 range
-            normalized_x = max(0.0, min(1.0, detection.x / estimated_image_width))
-            normalized_y = max(0.0, min(1.0, detection.y / estimated_image_height))
-            
-            logger.info(f"Detection {i}: pixel_x={detection.x}, pixel_y={detection.y}, normalized_x={normalized_x:.3f}, normalized_y={normalized_y:.3f}")
-            
-            # Debug: Check if all coordinates are the same
-            logger.info(f"Detection {i}: raw_x={detection.x}, raw_y={detection.y}, normalized_x={normalized_x:.3f}, normalized_y={normalized_y:.3f}")
-            
-            logger.info(f"Detection {i}: normalized x={normalized_x:.3f}, y={normalized_y:.3f}")
-            
-            # Map to tooth number based on position
-            fdi_number, universal_number, confidence, reasoning = self._grid_to_tooth(normalized_x, normalized_y, detection.class_name)
-            
-            # Use the preferred numbering system
-            final_tooth_number = universal_number if numbering_system == "Universal" else fdi_number
-            
-            mappings.append(ToothMapping(
+        # Use the preferred numbering system
+        tooth_numbers = grid.universal if numbering_system == "Universal" else grid.fdi
+        return [
+            ToothMapping(
                 detection_id=i,
-                tooth_number=final_tooth_number,
-                universal_number=universal_number,
-                confidence=confidence,
+                tooth_number=str(tooth_numbers[i]),
+                universal_number=str(grid.universal[i]),
+                confidence=float(grid.confidence[i]),
                 method="grid",
-                reasoning=reasoning,
-                grid_prediction=final_tooth_number
-            ))
-        
-        return mappings
+                reasoning=grid.reasoning(i),
+                grid_prediction=str(tooth_numbers[i])
+            )
+            for i in range(len(detections))
+        ]
     
+    @timed_stage("openai_tooth_referee", model_attr="model_vision")
     def _gpt_referee(self, image_url: str, gpt_result: List[ToothMapping], grid_result: List[ToothMapping], numbering_system: str = "FDI") -> List[ToothMapping]:
         """
         Use GPT-4 as referee to resolve conflicts between GPT and Grid predictions with reference image
@@ -250,7 +238,10 @@ class ToothMappingService:
             if not os.path.exists(reference_image_path):
                 logger.warning(f"Reference image not found for referee: {reference_image_path}, proceeding without reference")
                 # Fallback to original method without reference image
-                response = self.openai_client.chat.completions.create(
+                content = cached_completion(
+                    self.openai_client,
+                    "tooth_referee",
+                    cache=True,
                     model=self.model_vision,
                     messages=[
                         {
@@ -274,7 +265,10 @@ class ToothMappingService:
                 )
             else:
                 # Include reference image in the referee API call
-                response = self.openai_client.chat.completions.create(
+                content = cached_completion(
+                    self.openai_client,
+                    "tooth_referee",
+                    cache=True,
                     model=self.model_vision,
                     messages=[
                         {
@@ -304,7 +298,6 @@ class ToothMappingService:
                 )
             
             # Parse referee response
-            content = response.choices[0].message.content
             return self._parse_referee_response(content, gpt_result, grid_result, numbering_system)
             
         except Exception as e:
@@ -529,92 +522,6 @@ Provide detailed reasoning for each final decision based on the reference image.
             # Fallback to GPT result
             return gpt_result
 
-    def _grid_to_tooth(self, normalized_x: float, normalized_y: float, condition: str) -> Tuple[str, str, float, str]:
-        """
-        Map normalized coordinates to tooth number using grid-based logic.
-        Returns (fdi_number, universal_number, confidence, reasoning)
-        """
-        # Add debugging
-        logger.info(f"Grid mapping: x={normalized_x:.3f}, y={normalized_y:.3f}, condition={condition}")
-        logger.info(f"Coordinate analysis: x_range={'left' if normalized_x < 0.45 else 'right' if normalized_x > 0.55 else 'center'}, y_range={'upper' if normalized_y < 0.4 else 'lower' if normalized_y > 0.6 else 'middle'}")
-        
-        # Determine arch (upper/lower) with more precise boundaries
-        if normalized_y < 0.4:  # Upper arch (adjusted boundary)
-            arch = "upper"
-            arch_center = 0.2
-        elif normalized_y > 0.6:  # Lower arch (adjusted boundary)
-            arch = "lower"
-            arch_center = 0.8
-        else:  # Middle area - determine based on condition type
-            if condition.lower() in ["caries", "fracture"]:
-                arch = "upper"
-                arch_center = 0.2
-            else:
-                arch = "lower"
-                arch_center = 0.8
-        
-        # Determine quadrant with more precise boundaries
-        if normalized_x < 0.45:  # Left side (patient's right)
-            if arch == "upper":
-                # Upper left in the image corresponds to Universal 9-16 range
-                universal_base = 9
-            else:
-                # Lower left: Universal 17-24
-                universal_base = 17
-        elif normalized_x > 0.55:  # Right side
-            if arch == "upper":
-                # Upper right: Universal 1-8
-                universal_base = 1
-            else:
-                # Lower right: Universal 25-32
-                universal_base = 25
-        else:  # Center area - default to central incisors of respective arch
-            universal_base = 8 if arch == "upper" else 24
-        
-        # Calculate position within quadrant (0-7)
-        if normalized_x < 0.45:  # Left side
-            quadrant_x = normalized_x
-            position_in_quadrant = int(quadrant_x * 8)
-        elif normalized_x > 0.55:  # Right side
-            quadrant_x = normalized_x - 0.55
-            position_in_quadrant = int(quadrant_x * 8)
-        else:  # Center area
-            position_in_quadrant = 0
-        
-        position_in_quadrant = max(0, min(7, position_in_quadrant))
-        
-        # Universal tooth number first, then convert to FDI
-        universal_number_int = universal_base + position_in_quadrant
-        universal_number = str(universal_number_int)
-        fdi_number = self._universal_to_fdi(universal_number)
-        
-        logger.info(f"Grid result: arch={arch}, universal_base={universal_base}, position={position_in_quadrant}, universal={universal_number}, fdi={fdi_number}")
-        
-        # Calculate confidence
-        arch_distance = abs(normalized_y - arch_center)
-        arch_confidence = max(0, 1 - (arch_distance / 0.2))
-        if normalized_x < 0.45:
-            quadrant_center = 0.225
-        elif normalized_x > 0.55:
-            quadrant_center = 0.775
-        else:
-            quadrant_center = 0.5
-        quadrant_distance = abs(normalized_x - quadrant_center)
-        quadrant_confidence = max(0, 1 - (quadrant_distance / 0.225))
-        confidence = (arch_confidence + quadrant_confidence) / 2
-        condition_confidence_boost = {
-            "caries": 0.1,
-            "fracture": 0.05,
-            "missing-tooth": 0.15,
-            "periapical-lesion": 0.0,
-        }
-        confidence += condition_confidence_boost.get(condition.lower(), 0.0)
-        confidence = max(0.1, min(confidence, 0.95))
-        
-        reasoning = f"Grid mapping: {arch} arch, position {position_in_quadrant} (x={normalized_x:.2f}, y={normalized_y:.2f})"
-        
-        return fdi_number, universal_number, confidence, reasoning
-
     def _universal_to_fdi(self, universal_number: str) -> str:
         """Convert Universal (1-32) to FDI (11-18, 21-28, 31-38, 41-48)."""
         try:
@@ -710,19 +617,8 @@ Provide detailed reasoning for each final decision based on the reference image.
             logger.error(f"Reference image not found for encoding: {image_path}")
             return ""
 
-# Global instance
-# Initialize service lazily to avoid import-time errors
-_tooth_mapping_service = None
+# Initialize service lazily on first use to keep imports cheap
+tooth_mapping_service = lazy_service("tooth_mapping", ToothMappingService)
 
 def get_tooth_mapping_service():
-    global _tooth_mapping_service
-    if _tooth_mapping_service is None:
-        try:
-            _tooth_mapping_service = ToothMappingService()
-        except Exception as e:
-            logger.error(f"Failed to initialize ToothMapping service: {e}")
-            return None
-    return _tooth_mapping_service
-
-# For backward compatibility
-tooth_mapping_service = get_tooth_mapping_service()
+    return registry.get("tooth_mapping")
@@ -0,0 +1,145 @@
+"""
+Treatment Import
+Applies confirmed price-list mappings to a clinic in one round trip
+
+Mappings are validated up front, then sent together to the
+`import_treatment_prices` SQL function
+(migrations/add_treatment_import_bulk_upsert.sql). In one transaction it
+merges the price overrides into `clinic_branding.treatment_settings` (JSONB
+`||`) and upserts every custom treatment on (user_id, clinic_name), so an
+import either fully applies or not at all.
+"""
+import logging
+import math
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+VALID_ACTIONS = {"update", "create_custom"}
+DEFAULT_CUSTOM_DURATION = 30
+
+
+class ImportValidationError(ValueError):
+    """One or more mappings are invalid; nothing was written"""
+
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__(f"{len(errors)} invalid mapping(s)")
+        self.errors = errors
+
+
+def build_import_payload(mappings: List[Dict[str, Any]],
+                         master_codes: Optional[Iterable[str]] = None) -> Tuple[Dict[str, Dict], List[Dict]]:
+    """
+    Validate every mapping and split them into settings overrides and custom rows
+
+    Raises ImportValidationError listing every bad row. Later rows win when a
+    master code or custom clinic name repeats.
+    """
+    known_codes = set(master_codes) if master_codes is not None else None
+    settings: Dict[str, Dict] = {}
+    custom: Dict[str, Dict] = {}
+    errors: List[Dict[str, Any]] = []
+
+    for index, mapping in enumerate(mappings):
+        clinic_name = (mapping.get('clinic_name') or '').strip()
+        code = mapping.get('matched_code')
+        action = mapping.get('action')
+        price = mapping.get('clinic_price')
+        duration = mapping.get('clinic_duration')
+
+        problems = []
+        if not clinic_name:
+            problems.append("clinic_name is required")
+        if action not in VALID_ACTIONS:
+            problems.append(f"action must be one of {sorted(VALID_ACTIONS)}")
+        if not isinstance(price, (int, float)) or isinstance(price, bool) or not math.isfinite(price) or price < 0:
+            problems.append("clinic_price must be a non-negative number")
+        if duration is not None and (not isinstance(duration, int) or isinstance(duration, bool) or duration <= 0):
+            problems.append("clinic_duration must be a positive integer")
+
+        is_custom = action == "create_custom" or code == "CUSTOM"
+        if not is_custom and known_codes is not None and code not in known_codes:
+            problems.append(f"unknown treatment code '{code}'")
+
+        if problems:
+            errors.append({"index": index, "clinic_name": clinic_name, "errors": problems})
+            continue
+
+        if is_custom:
+            custom[clinic_name] = {
+                'clinic_name': clinic_name,
+                'display_name': clinic_name,
+                'friendly_name': clinic_name,
+                'category': 'general',
+                'description': 'Custom treatment imported from price list',
+                'price': price,
+                'duration': duration or DEFAULT_CUSTOM_DURATION,
+                'is_active': True
+            }
+        else:
+            settings[code] = {
+                "price": price,
+                "duration": duration,
+                "clinic_name": clinic_name
+            }
+
+    if errors:
+        raise ImportValidationError(errors)
+    return settings, list(custom.values())
+
+
+def _apply_without_rpc(client, user_id: str, settings: Dict[str, Dict], custom_rows: List[Dict]) -> Dict[str, Any]:
+    """
+    Fallback for databases without the import_treatment_prices function
+
+    Three requests instead of one per row, but not atomic: the custom rows can
+    land even if the settings write then fails.
+    """
+    branding_response = client.table('clinic_branding').select("id, treatment_settings").execute()
+    if not branding_response.data:
+        raise LookupError("Clinic branding not found. Please set up clinic branding first.")
+    branding = branding_response.data[0]
+
+    if custom_rows:
+        rows = [{**row, 'user_id': user_id} for row in custom_rows]
+        try:
+            client.table('custom_treatments').upsert(rows, on_conflict='user_id,clinic_name').execute()
+        except Exception as e:
+            # No unique index on (user_id, clinic_name) yet: plain batched insert
+            logger.warning(f"⚠️ custom_treatments upsert unavailable, inserting: {str(e)}")
+            client.table('custom_treatments').insert(rows).execute()
+
+    if settings:
+        merged = {**(branding.get('treatment_settings') or {}), **settings}
+        client.table('clinic_branding').update({
+            "treatment_settings": merged,
+            "updated_at": datetime.now().isoformat()
+        }).eq('id', branding['id']).execute()
+
+    return {"updated_count": len(settings), "custom_count": len(custom_rows)}
+
+
+def apply_price_import(client, user_id: str, settings: Dict[str, Dict], custom_rows: List[Dict]) -> Dict[str, Any]:
+    """Write validated overrides and custom treatments; returns updated/custom counts"""
+    try:
+        with track_stage("supabase_import_treatment_prices"):
+            response = client.rpc('import_treatment_prices', {
+                'settings': settings,
+                'custom': custom_rows
+            }).execute()
+        result = response.data or {}
+    except Exception as e:
+        if 'Clinic branding not found' in str(e):
+            raise LookupError("Clinic branding not found. Please set up clinic branding first.")
+        # Only a database without the function falls back; other errors reach the caller
+        if 'import_treatment_prices' not in str(e) or ('PGRST202' not in str(e) and 'schema cache' not in str(e)):
+            raise
+        logger.warning(f"⚠️ import_treatment_prices function missing, applying in batches: {str(e)}")
+        with track_stage("supabase_import_treatment_prices_fallback"):
+            result = _apply_without_rpc(client, user_id, settings, custom_rows)
+
+    logger.info(f"✅ Imported prices: {result.get('updated_count', 0)} updated, {result.get('custom_count', 0)} custom")
+    return result
@@ -0,0 +1,234 @@
+"""
+Treatment Matcher
+Matches clinic price-list rows to the master treatment catalogue locally
+
+Every master treatment is indexed by its insurance codes (all countries) and
+by normalised display name, patient-friendly name and code words, with common
+clinic abbreviations expanded ("RCT", "comp", "ext", "OPG"). A row is matched
+by exact insurance code first, then exact name, then a blend of token-set and
+character-trigram similarity with a penalty when counts differ ("1 canal" vs
+"each additional canal"). Rows below the accept threshold are returned with
+their top candidates so only those need GPT.
+"""
+import logging
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Clinic shorthand -> catalogue wording (applied token by token after normalising)
+ABBREVIATIONS = {
+    'rct': 'root canal treatment',
+    'endo': 'endodontic',
+    'ext': 'extraction',
+    'exo': 'extraction',
+    'xla': 'extraction',
+    'extn': 'extraction',
+    'sx': 'surgical',
+    'surg': 'surgical',
+    'comp': 'composite',
+    'resin': 'composite',
+    'fill': 'restoration',
+    'filling': 'restoration',
+    'fillings': 'restoration',
+    'gic': 'glass ionomer',
+    'tc': 'tooth coloured',
+    'colored': 'coloured',
+    'color': 'coloured',
+    'temp': 'temporary',
+    'prov': 'provisional',
+    'surf': 'surface',
+    'surfs': 'surface',
+    'surfaces': 'surface',
+    'canals': 'canal',
+    'roots': 'root',
+    'teeth': 'tooth',
+    'ant': 'anterior',
+    'post': 'posterior',
+    'opg': 'panoramic radiograph',
+    'pano': 'panoramic radiograph',
+    'xray': 'radiograph',
+    'xrays': 'radiograph',
+    'bw': 'bitewing',
+    'bwx': 'bitewing',
+    'pa': 'periapical',
+    'srp': 'scaling root planing',
+    'scale': 'scaling',
+    'clean': 'cleaning',
+    'exam': 'examination',
+    'check': 'examination',
+    'checkup': 'examination',
+    'ohi': 'oral hygiene instructions',
+    'fl': 'fluoride',
+    'fs': 'fissure sealant',
+    'i&d': 'incision drainage',
+    'nightguard': 'night guard',
+    'addl': 'additional',
+    'add': 'additional',
+    'ea': 'each',
+    'cbct': 'cbct 3d scan',
+    'pfm': 'porcelain fused metal',
+    'emax': 'porcelain',
+    'zirconia': 'tooth coloured',
+}
+
+NUMBER_WORDS = {
+    'one': '1', 'single': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5',
+}
+
+STOPWORDS = {'a', 'an', 'and', 'the', 'of', 'for', 'per', 'with', 'on', 'to', 'in', 'or', 'x', '&'}
+
+# Count-like tokens; a candidate whose counts differ from the row's is penalised
+COUNT_TOKEN = re.compile(r'^\d+\+?$')
+X_RAY = re.compile(r'\bx\s*-?\s*rays?\b')
+NON_WORD = re.compile(r"[^a-z0-9+&\s]")
+WHITESPACE = re.compile(r'\s+')
+
+EXACT_CODE_CONFIDENCE = 0.98
+EXACT_NAME_CONFIDENCE = 0.97
+COUNT_MISMATCH_PENALTY = 0.25
+# Fuzzy matches whose runner-up is this close are ambiguous ("RCT 1 canal": cleaning or filling?)
+AMBIGUITY_MARGIN = 0.04
+
+
+def normalise_name(text: str) -> str:
+    """Lowercase, ASCII, punctuation-free, abbreviations expanded"""
+    text = unicodedata.normalize('NFKD', str(text or '')).encode('ascii', 'ignore').decode()
+    text = X_RAY.sub('xray', text.lower())
+    text = text.replace('_', ' ').replace('/', ' ').replace('-', ' ')
+    text = re.sub(r'(\d)\s*\+', r'\1+', text)
+    text = NON_WORD.sub(' ', text)
+    words = []
+    for word in text.split():
+        word = NUMBER_WORDS.get(word, word)
+        expanded = ABBREVIATIONS.get(word, word)
+        words.extend(w for w in expanded.split() if w not in STOPWORDS)
+    return ' '.join(words)
+
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _normalise_code(code: str) -> str:
+    return str(code or '').strip().lstrip('0').upper()
+
+
+@dataclass
+class _Variant:
+    text: str
+    tokens: Set[str]
+    trigrams: Set[str]
+
+
+@dataclass
+class _Entry:
+    code: str
+    name: str
+    variants: List[_Variant]
+    counts: Set[str] = field(default_factory=set)
+
+
+@dataclass
+class MatchResult:
+    matched_code: Optional[str]
+    matched_name: Optional[str]
+    confidence: float
+    method: str  # insurance_code | exact_name | fuzzy | none
+    candidates: List[Tuple[str, str, float]]  # (code, name, score), best first
+
+    @property
+    def ambiguous(self) -> bool:
+        return self.method == 'fuzzy' and len(self.candidates) > 1 and \
+            self.candidates[0][2] - self.candidates[1][2] < AMBIGUITY_MARGIN
+
+
+class TreatmentMatcher:
+    def __init__(self, master_treatments: List[Dict]):
+        self.entries: List[_Entry] = []
+        self.by_insurance_code: Dict[str, int] = {}
+        self.by_exact_name: Dict[str, int] = {}
+        self.by_token: Dict[str, Set[int]] = {}
+
+        for index, treatment in enumerate(master_treatments):
+            names = [treatment.get('displayName', ''), treatment.get('friendlyPatientName', ''), treatment.get('code', '')]
+            names += treatment.get('synonyms') or []
+            variants = []
+            counts: Set[str] = set()
+            for name in names:
+                text = normalise_name(name)
+                if not text:
+                    continue
+                tokens = set(text.split())
+                variants.append(_Variant(text, tokens, _trigrams(text)))
+                counts |= {t for t in tokens if COUNT_TOKEN.match(t)}
+                self.by_exact_name.setdefault(text, index)
+                for token in tokens:
+                    self.by_token.setdefault(token, set()).add(index)
+
+            self.entries.append(_Entry(treatment['code'], treatment.get('displayName', treatment['code']), variants, counts))
+            for code in (treatment.get('insuranceCodes') or {}).values():
+                if code:
+                    self.by_insurance_code.setdefault(_normalise_code(code), index)
+
+        logger.info(f"Treatment matcher indexed {len(self.entries)} treatments ({len(self.by_insurance_code)} insurance codes)")
+
+    def _score(self, entry: _Entry, text: str, tokens: Set[str], trigrams: Set[str], counts: Set[str]) -> float:
+        best = 0.0
+        for variant in entry.variants:
+            if not variant.tokens:
+                continue
+            shared = len(tokens & variant.tokens)
+            token_score = max(shared / len(tokens), shared / len(variant.tokens)) * 0.5 + \
+                (2 * shared / (len(tokens) + len(variant.tokens))) * 0.5
+            trigram_score = 2 * len(trigrams & variant.trigrams) / (len(trigrams) + len(variant.trigrams))
+            best = max(best, 0.55 * token_score + 0.45 * trigram_score)
+        if counts and entry.counts and not (counts & entry.counts):
+            best -= COUNT_MISMATCH_PENALTY
+        elif counts and not entry.counts and 'additional' not in tokens:
+            best -= COUNT_MISMATCH_PENALTY / 2
+        return max(best, 0.0)
+
+    def match(self, name: str, insurance_code: Optional[str] = None, top_k: int = 5) -> MatchResult:
+        """Best master treatment for one clinic row, with the top-k candidates"""
+        if insurance_code:
+            index = self.by_insurance_code.get(_normalise_code(insurance_code))
+            if index is not None:
+                entry = self.entries[index]
+                return MatchResult(entry.code, entry.name, EXACT_CODE_CONFIDENCE, 'insurance_code',
+                                   [(entry.code, entry.name, EXACT_CODE_CONFIDENCE)])
+
+        text = normalise_name(name)
+        if not text:
+            return MatchResult(None, None, 0.0, 'none', [])
+
+        index = self.by_exact_name.get(text)
+        if index is not None:
+            entry = self.entries[index]
+            return MatchResult(entry.code, entry.name, EXACT_NAME_CONFIDENCE, 'exact_name',
+                               [(entry.code, entry.name, EXACT_NAME_CONFIDENCE)])
+
+        tokens = set(text.split())
+        trigrams = _trigrams(text)
+        counts = {t for t in tokens if COUNT_TOKEN.match(t)}
+
+        # Score treatments sharing a token; everything if nothing does (typos)
+        candidate_indexes: Set[int] = set()
+        for token in tokens:
+            candidate_indexes |= self.by_token.get(token, set())
+        if not candidate_indexes:
+            candidate_indexes = set(range(len(self.entries)))
+
+        scored = sorted(
+            ((self._score(self.entries[i], text, tokens, trigrams, counts), i) for i in candidate_indexes),
+            reverse=True
+        )[:top_k]
+        candidates = [(self.entries[i].code, self.entries[i].name, round(score, 3)) for score, i in scored]
+        if not candidates or candidates[0][2] <= 0:
+            return MatchResult(None, None, 0.0, 'none', candidates)
+
+        code, matched_name, score = candidates[0]
+        return MatchResult(code, matched_name, score, 'fuzzy', candidates)
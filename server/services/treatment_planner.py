@@ -0,0 +1,491 @@
+"""
+Treatment Planner
+Deterministic, rule-based treatment plans for /analyze-xray
+
+Maps detected and dentist-entered conditions to catalogue treatments using
+the same data the frontend uses (treatments.au.json autoMapConditions and
+toothNumberRules, mappings.core.json priorities), prices them from the
+clinic's treatment_settings, and stages them with StagingEngineV2. The output
+has the same shape as `OpenAIService.analyze_dental_conditions`, so GPT is only
+needed (optionally) for the prose fields.
+"""
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from services.registry import lazy_service, registry
+from services.staging_service import get_staging_service
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATA_DIR = Path(__file__).parent.parent.parent / 'client' / 'src' / 'data'
+
+# Roboflow classes and legacy condition names -> catalogue condition codes
+CONDITION_ALIASES = {
+    'caries': 'caries_dentine',
+    'cavity': 'caries_dentine',
+    'decay': 'caries_dentine',
+    'root_piece': 'retained_root',
+    'root_fracture': 'tooth_nonrestorable',
+    'fracture': 'fractured_cusp_restorable',
+    'tooth_wear': 'tooth_wear_attrition',
+    'attrition': 'tooth_wear_attrition',
+    'abrasion': 'tooth_wear_abfraction',
+    'missing_tooth': 'missing_single_tooth',
+    'missing_tooth_between': 'missing_single_tooth',
+    'missing_teeth_no_distal': 'partial_edentulism',
+    'bone_level': 'periodontitis_stage_i_ii',
+    'tissue_level': 'gingivitis_plaque',
+    'abscess': 'periapical_abscess',
+}
+
+# Existing dental work shows up in detections but needs no treatment
+EXISTING_DENTAL_WORK = {
+    'filling', 'crown', 'bridge', 'root_canal', 'root_canal_treatment', 'post', 'implant',
+    'existing_large_filling', 'implant_placement', 'composite_build_up',
+    'partial_denture', 'complete_denture', 'inlay', 'onlay', 'whitening',
+    'bonding', 'sealant',
+}
+
+# Diagnostic / isolation adjuncts listed first in some mappings; the X-ray is
+# already taken, so the plan uses the first definitive procedure instead
+ADJUNCT_PREFIXES = ('radiograph_', 'cbct_', 'exam_', 'records_', 'endo_rubber_dam_')
+
+# Staging category for catalogue treatments that mappings.core.json doesn't cover
+CATEGORY_STAGES = {
+    'emergency': 1,
+    'endodontics': 1,
+    'oral-surgery': 1,
+    'restorative': 2,
+    'periodontics': 2,
+    'preventive': 2,
+    'general': 2,
+    'functional': 2,
+    'prosthodontics': 3,
+    'orthodontics': 4,
+    'cosmetic': 4,
+}
+
+STAGE_FOCUS = {
+    1: "Urgent issues affecting oral health",
+    2: "Definitive restorations and disease control",
+    3: "Replacing missing teeth",
+    4: "Cosmetic and alignment improvements",
+}
+
+
+def normalize_condition(condition: str) -> str:
+    """Canonical key for a condition name ('Periapical lesion' -> 'periapical_lesion')"""
+    key = re.sub(r'[\s\-]+', '_', (condition or '').strip().lower())
+    return CONDITION_ALIASES.get(key, key)
+
+
+def _fdi_tooth(tooth: Any) -> Optional[int]:
+    """FDI number if `tooth` looks like one (permanent 11-48 or primary 51-85)"""
+    try:
+        number = int(str(tooth).strip())
+    except (TypeError, ValueError):
+        return None
+    quadrant, position = divmod(number, 10)
+    if 1 <= quadrant <= 4 and 1 <= position <= 8:
+        return number
+    if 5 <= quadrant <= 8 and 1 <= position <= 5:
+        return number
+    return None
+
+
+def _tooth_rules_allow(treatment: Dict, tooth: Optional[int]) -> bool:
+    """Same rules as TreatmentService.getByConditionAndTooth on the frontend"""
+    rules = treatment.get('toothNumberRules') or {}
+    if tooth is None or not any(rules.get(k) for k in ('anteriorFDI', 'premolarFDI', 'molarFDI', 'specificFDI')):
+        return True
+    for key in ('anteriorFDI', 'premolarFDI', 'molarFDI'):
+        if tooth in (rules.get(key) or []):
+            return True
+    return str(tooth) in (rules.get('specificFDI') or {})
+
+
+def _tooth_rules_match(treatment: Dict, tooth: Optional[int]) -> bool:
+    """True only when the treatment's rules explicitly list the tooth"""
+    rules = treatment.get('toothNumberRules') or {}
+    return tooth is not None and _tooth_rules_allow(treatment, tooth) and \
+        any(rules.get(k) for k in ('anteriorFDI', 'premolarFDI', 'molarFDI', 'specificFDI'))
+
+
+def format_detections(roboflow_predictions: Optional[Dict]) -> List[Dict]:
+    """Roboflow predictions in the response's `detections` format"""
+    return [
+        {
+            'class': pred.get('class', 'Unknown'),
+            'confidence': pred.get('confidence', 0),
+            'x': pred.get('x', 0),
+            'y': pred.get('y', 0),
+            'width': pred.get('width', 0),
+            'height': pred.get('height', 0)
+        }
+        for pred in (roboflow_predictions or {}).get('predictions', [])
+    ]
+
+
+def _fdi_to_universal(tooth: str) -> str:
+    """FDI (11-18, 21-28, 31-38, 41-48) to Universal (1-32); anything else is returned as is"""
+    try:
+        fdi = int(tooth)
+    except (TypeError, ValueError):
+        return tooth
+    quadrant, position = divmod(fdi, 10)
+    if not 1 <= position <= 8:
+        return tooth
+    if quadrant == 1:
+        return str(9 - position)  # 11..18 -> 8..1
+    if quadrant == 2:
+        return str(8 + position)  # 21..28 -> 9..16
+    if quadrant == 3:
+        return str(25 - position)  # 31..38 -> 24..17
+    if quadrant == 4:
+        return str(24 + position)  # 41..48 -> 25..32
+    return tooth
+
+
+def _teeth_to_fdi(staged: Dict[str, Any], to_fdi: Dict[str, str]) -> None:
+    """Put the plan's own tooth numbers back on a staged plan (in place)"""
+    for stage in staged.get('stages', []):
+        for visit in stage['visits']:
+            for treatment in visit['treatments']:
+                treatment['tooth'] = to_fdi.get(treatment['tooth'], treatment['tooth'])
+    for task in staged.get('future_tasks', []):
+        task['tooth'] = to_fdi.get(task['tooth'], task['tooth'])
+
+
+class TreatmentPlanner:
+    def __init__(self):
+        self.data_dir = Path(os.getenv('TREATMENT_DATA_DIR', str(DEFAULT_DATA_DIR)))
+        self.min_confidence = float(os.getenv('ANALYSIS_MIN_CONFIDENCE', '0.5'))
+
+        self.treatments: Dict[str, Dict] = {}
+        self.by_condition: Dict[str, List[Dict]] = {}
+        self.mappings: Dict[str, List[Dict]] = {}
+        self._load()
+
+        logger.info(f"Treatment planner initialized ({len(self.treatments)} treatments, {len(self.mappings)} condition mappings)")
+
+    def _load(self) -> None:
+        try:
+            with open(self.data_dir / 'treatments.au.json', 'r') as f:
+                catalogue = json.load(f)
+        except Exception as e:
+            logger.warning(f"⚠️ Treatment catalogue not available: {str(e)}")
+            catalogue = []
+
+        for treatment in catalogue:
+            self.treatments[treatment['code']] = treatment
+            for condition in treatment.get('autoMapConditions') or []:
+                self.by_condition.setdefault(normalize_condition(condition), []).append(treatment)
+
+        try:
+            with open(self.data_dir / 'mappings.core.json', 'r') as f:
+                mappings = json.load(f)
+        except Exception as e:
+            logger.warning(f"⚠️ Condition mappings not available: {str(e)}")
+            mappings = []
+
+        for mapping in mappings:
+            options = sorted(mapping.get('treatments') or [], key=lambda t: t.get('priority', 99))
+            # 'impacted-tooth' and 'impacted_tooth' both exist; the first entry wins
+            self.mappings.setdefault(normalize_condition(mapping['condition']), options)
+
+    @property
+    def available(self) -> bool:
+        return bool(self.treatments)
+
+    # ---------------- Condition -> treatment ----------------
+
+    def select_treatment(self, condition: str, tooth: Any = None) -> Optional[Tuple[Dict, int]]:
+        """
+        Preferred catalogue treatment and stage for a condition on a tooth
+
+        mappings.core.json priorities come first; otherwise the first
+        treatment listing the condition in autoMapConditions. Diagnostic
+        adjuncts are skipped unless nothing else is listed. When the tooth is
+        an FDI number and the preferred treatment's toothNumberRules exclude
+        it, a same-category variant for that tooth is used instead, then the
+        next treatment that allows the tooth.
+        """
+        key = normalize_condition(condition)
+        fdi = _fdi_tooth(tooth)
+
+        mapped = [
+            (self.treatments[option['treatment']], option.get('stage'))
+            for option in self.mappings.get(key, [])
+            if option.get('treatment') in self.treatments
+        ]
+        candidates = mapped or [(t, None) for t in self.by_condition.get(key, [])]
+        if not candidates:
+            return None
+        candidates = [c for c in candidates if not c[0]['code'].startswith(ADJUNCT_PREFIXES)] or candidates
+
+        treatment, stage = candidates[0]
+        if not _tooth_rules_allow(treatment, fdi):
+            # Prefer the same procedure for this tooth type (endo_rct_prep_1 ->
+            # endo_rct_prep_addl, ..._post -> ..._ant), then the same category,
+            # before dropping to a lower priority
+            variants = [t for t, _ in candidates] + self.by_condition.get(key, [])
+            family = treatment['code'].rsplit('_', 1)[0]
+            variant = next(
+                (t for t in variants if t['code'].rsplit('_', 1)[0] == family and _tooth_rules_match(t, fdi)),
+                None
+            ) or next(
+                (t for t in variants if t.get('category') == treatment.get('category') and _tooth_rules_match(t, fdi)),
+                None
+            )
+            if variant is not None:
+                treatment = variant
+            else:
+                treatment, stage = next(
+                    ((t, s) for t, s in candidates if _tooth_rules_allow(t, fdi)),
+                    candidates[0]
+                )
+        return treatment, stage or CATEGORY_STAGES.get(treatment.get('category'), 2)
+
+    @staticmethod
+    def _price_and_duration(treatment: Dict, treatment_settings: Dict[str, Dict]) -> Tuple[float, int]:
+        custom = treatment_settings.get(treatment['code']) or {}
+        price = custom.get('price', treatment.get('defaultPriceAUD') or 0)
+        duration = custom.get('duration', treatment.get('defaultDuration') or 45)
+        return price, int(duration)
+
+    # ---------------- Findings ----------------
+
+    def collect_findings(self, roboflow_predictions: Optional[Dict],
+                         patient_findings: List[Dict]) -> Tuple[List[Dict], List[str]]:
+        """
+        Condition findings to plan, plus the conditions that have no mapping
+
+        Dentist-entered findings always count and may name the treatment
+        directly. Automated detections below ANALYSIS_MIN_CONFIDENCE, those
+        showing existing dental work, and conditions the dentist already
+        recorded on the same tooth are skipped. Detections without a tooth number are grouped
+        per condition with a quantity.
+        """
+        findings: List[Dict] = []
+        manual_findings = set()
+        for finding in patient_findings or []:
+            condition = finding.get('condition', '')
+            if not condition:
+                continue
+            tooth = str(finding.get('tooth') or '')
+            manual_findings.add((normalize_condition(condition), tooth))
+            findings.append({
+                'tooth': tooth,
+                'condition': condition,
+                'treatment': finding.get('treatment') or '',
+                'quantity': 1,
+                'confidence': 1.0,
+            })
+
+        grouped: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        for pred in (roboflow_predictions or {}).get('predictions', []):
+            condition = pred.get('class', '')
+            key = normalize_condition(condition)
+            if not key or key in EXISTING_DENTAL_WORK:
+                continue
+            confidence = pred.get('confidence', 0) or 0
+            if confidence < self.min_confidence:
+                continue
+
+            tooth = str(pred.get('tooth_number') or pred.get('tooth') or '')
+            if (key, tooth) in manual_findings:
+                continue
+            entry = grouped.get((key, tooth))
+            if entry is None:
+                grouped[(key, tooth)] = {
+                    'tooth': tooth, 'condition': condition, 'treatment': '',
+                    'quantity': 1, 'confidence': confidence,
+                }
+            elif not tooth:
+                entry['quantity'] += 1
+                entry['confidence'] = max(entry['confidence'], confidence)
+            else:
+                entry['confidence'] = max(entry['confidence'], confidence)
+        findings.extend(grouped.values())
+
+        unmapped = []
+        for finding in findings:
+            if finding['treatment'] or self.select_treatment(finding['condition'], finding['tooth']):
+                continue
+            if finding['condition'] not in unmapped:
+                unmapped.append(finding['condition'])
+        return findings, unmapped
+
+    def _plan_item(self, finding: Dict, treatment_settings: Dict[str, Dict]) -> Optional[Dict]:
+        requested = finding['treatment']
+        if requested and requested not in self.treatments:
+            # Free-text / legacy treatment chosen by the dentist: keep it as entered
+            custom = treatment_settings.get(requested) or {}
+            return {
+                'tooth': finding['tooth'],
+                'condition': finding['condition'],
+                'recommended_treatment': requested,
+                'treatment_code': requested,
+                'quantity': finding['quantity'],
+                'ada_code': '',
+                'price': custom.get('price', 0),
+                'confidence': finding['confidence'],
+                'duration_min': int(custom.get('duration', 45)),
+                'stage_category': 2,
+            }
+
+        if requested:
+            treatment = self.treatments[requested]
+            selected = self.select_treatment(finding['condition'], finding['tooth'])
+            stage = selected[1] if selected and selected[0]['code'] == requested else \
+                CATEGORY_STAGES.get(treatment.get('category'), 2)
+        else:
+            selected = self.select_treatment(finding['condition'], finding['tooth'])
+            if selected is None:
+                return None
+            treatment, stage = selected
+
+        price, duration = self._price_and_duration(treatment, treatment_settings)
+        return {
+            'tooth': finding['tooth'],
+            'condition': finding['condition'],
+            'recommended_treatment': treatment.get('displayName') or treatment['code'],
+            'treatment_code': treatment['code'],
+            'quantity': finding['quantity'],
+            'ada_code': (treatment.get('insuranceCodes') or {}).get('AU') or '',
+            'price': price,
+            'confidence': finding['confidence'],
+            'duration_min': duration,
+            'stage_category': stage,
+        }
+
+    # ---------------- Plan ----------------
+
+    def build_plan(self, roboflow_predictions: Optional[Dict], patient_findings: List[Dict],
+                   treatment_settings: Optional[Dict[str, Dict]] = None,
+                   clinic_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Treatment plan in the `analyze_dental_conditions` response shape
+
+        Stages come from StagingEngineV2; each stage also carries its visits.
+        Summary and notes are templated from the plan.
+        """
+        treatment_settings = treatment_settings or {}
+
+        with track_stage("rules_treatment_plan"):
+            findings, unmapped = self.collect_findings(roboflow_predictions, patient_findings)
+            items = [item for item in (self._plan_item(f, treatment_settings) for f in findings) if item]
+
+            # StagingEngineV2 reads 1-32 as Universal numbering; the plan uses FDI
+            to_universal = {item['tooth']: _fdi_to_universal(item['tooth']) for item in items}
+            staging_input = [
+                {
+                    'tooth': to_universal[item['tooth']],
+                    'treatment': item['treatment_code'],
+                    'condition': item['condition'],
+                    'price': item['price'] * item['quantity'],
+                    'stage_category': item['stage_category'],
+                }
+                for item in items
+            ]
+            # Per-visit time of one procedure; durations are per treatment code
+            procedure_times = {item['treatment_code'].lower(): item['duration_min'] for item in items}
+            staged = get_staging_service().plan(
+                staging_input,
+                {**(clinic_config or {}), 'PROCEDURE_TIME_MIN': {
+                    **((clinic_config or {}).get('PROCEDURE_TIME_MIN') or {}), **procedure_times
+                }}
+            )['plan']
+            _teeth_to_fdi(staged, {universal: fdi for fdi, universal in to_universal.items()})
+
+            treatment_stages = self._to_treatment_stages(staged, items)
+
+        return {
+            'summary': self._summary(items, treatment_stages, staged),
+            'treatment_stages': treatment_stages,
+            'ai_notes': self._notes(treatment_stages, unmapped),
+            'detections': format_detections(roboflow_predictions),
+            'staged_plan': staged,
+            'unmapped_conditions': unmapped,
+        }
+
+    @staticmethod
+    def _to_treatment_stages(staged: Dict[str, Any], items: List[Dict]) -> List[Dict]:
+        # Staged treatments only carry tooth/procedure/condition; look the rest up
+        lookup: Dict[Tuple[str, str, str], List[Dict]] = {}
+        for item in items:
+            lookup.setdefault((item['tooth'], item['treatment_code'].lower(), item['condition']), []).append(item)
+
+        stages = staged.get('stages', [])
+        treatment_stages = []
+        for index, stage in enumerate(stages, start=1):
+            stage_items = []
+            for visit in stage['visits']:
+                for staged_treatment in visit['treatments']:
+                    matches = lookup.get((staged_treatment['tooth'], staged_treatment['procedure'], staged_treatment['condition']))
+                    if not matches:
+                        continue
+                    item = matches.pop(0)
+                    stage_items.append({
+                        key: item[key] for key in (
+                            'tooth', 'condition', 'recommended_treatment', 'treatment_code',
+                            'quantity', 'ada_code', 'price', 'confidence'
+                        )
+                    })
+
+            minutes = stage.get('total_duration_min', 0)
+            treatment_stages.append({
+                'stage': "Treatment Overview" if len(stages) == 1 else f"Stage {index}",
+                'focus': STAGE_FOCUS.get(stage['stage_number'], stage['stage_title']),
+                'summary': f"{stage['stage_title']}: {len(stage_items)} treatment{'s' if len(stage_items) != 1 else ''} "
+                           f"over {len(stage['visits'])} visit{'s' if len(stage['visits']) != 1 else ''}",
+                'duration': f"{round(minutes / 60, 1)} hours",
+                'items': stage_items,
+                'visits': stage['visits'],
+            })
+        return treatment_stages
+
+    @staticmethod
+    def _summary(items: List[Dict], treatment_stages: List[Dict], staged: Dict[str, Any]) -> str:
+        if not items:
+            return "No conditions requiring treatment were identified."
+
+        counts: "OrderedDict[str, int]" = OrderedDict()
+        for item in items:
+            label = item['condition'].replace('_', ' ').replace('-', ' ')
+            counts[label] = counts.get(label, 0) + item['quantity']
+        conditions = ", ".join(f"{count} × {label}" for label, count in counts.items())
+
+        meta = staged.get('meta', {})
+        visits = meta.get('total_visits', 0)
+        total_cost = sum(item['price'] * item['quantity'] for item in items)
+        return (f"Identified {conditions}. Recommended plan: {len(items)} treatment{'s' if len(items) != 1 else ''} "
+                f"across {len(treatment_stages)} stage{'s' if len(treatment_stages) != 1 else ''} "
+                f"and {visits} visit{'s' if visits != 1 else ''}, estimated at ${total_cost:,.0f}.")
+
+    @staticmethod
+    def _notes(treatment_stages: List[Dict], unmapped: List[str]) -> str:
+        lines = []
+        for stage in treatment_stages:
+            lines.append(f"{stage['stage']} — {stage['focus']}")
+            for visit in stage['visits']:
+                if visit.get('explain_note'):
+                    lines.append(f"- {visit['visit_label']}: {visit['explain_note']}")
+        if unmapped:
+            lines.append(f"No catalogue treatment for: {', '.join(unmapped)}. Please review manually.")
+        lines.append("Plan generated from detections and clinic pricing; confirm findings clinically before presenting.")
+        return "\n".join(lines)
+
+
+# Initialize service lazily on first use to keep imports cheap
+treatment_planner = lazy_service("treatment_planner", TreatmentPlanner)
+
+
+def get_treatment_planner():
+    return registry.get("treatment_planner")
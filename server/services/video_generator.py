@@ -5,7 +5,8 @@ import logging
 import requests
 import subprocess
 from typing import Tuple, Optional
-from moviepy import AudioFileClip
+from services.registry import lazy_service, registry
+from utils.metrics import track_stage
 
 logger = logging.getLogger(__name__)
 
@@ -46,17 +47,20 @@ class VideoGeneratorService:
         original_dir = os.getcwd()
         
         try:
+            # Heavy dependencies (torch via whisper, moviepy) are only loaded when a video is rendered
             import whisper
+            from moviepy import AudioFileClip
             
             # Change to temp directory to use relative paths
             os.chdir(self.temp_dir)
             
-            logger.info("Loading Whisper Tiny model...")
-            model = whisper.load_model("tiny")
+            with track_stage("whisper_transcribe", model="tiny"):
+                logger.info("Loading Whisper Tiny model...")
+                model = whisper.load_model("tiny")
 
-            logger.info("Transcribing audio...")
-            result = model.transcribe(audio_path, verbose=False)
-            segments = result['segments']
+                logger.info("Transcribing audio...")
+                result = model.transcribe(audio_path, verbose=False)
+                segments = result['segments']
 
             # Load audio to get duration
             audio_clip = AudioFileClip(audio_path)
@@ -72,50 +76,51 @@ class VideoGeneratorService:
                     text = seg['text'].strip()
                     srt_file.write(f"{i}\n{start} --> {end}\n{text}\n\n")
 
-            # Create temporary video (relative path)
-            logger.info("Creating temporary video...")
-            temp_video = "temp_video.mp4"
-            subprocess.run([
-                "ffmpeg", "-y",
-                "-loop", "1",
-                "-i", image_path,
-                "-i", audio_path,
-                "-shortest",
-                "-c:v", "libx264",
-                "-tune", "stillimage",
-                "-pix_fmt", "yuv420p",
-                "-c:a", "aac",
-                "-b:a", "192k",
-                "-vf", "scale=1280:720",
-                temp_video
-            ], check=True)
-
-            # Path to watermark (relative path)
-            watermark_path = "watermark.png"
-            if not os.path.exists(watermark_path):
-                # Create a simple watermark using ffmpeg
+            with track_stage("ffmpeg_render"):
+                # Create temporary video (relative path)
+                logger.info("Creating temporary video...")
+                temp_video = "temp_video.mp4"
                 subprocess.run([
                     "ffmpeg", "-y",
-                    "-f", "lavfi",
-                    "-i", "color=c=white@0.5:s=200x50",
-                    "-vf", "drawtext=text='Scanwise':fontcolor=blue:fontsize=24:x=(w-text_w)/2:y=(h-text_h)/2",
-                    "-frames:v", "1",
-                    watermark_path
+                    "-loop", "1",
+                    "-i", image_path,
+                    "-i", audio_path,
+                    "-shortest",
+                    "-c:v", "libx264",
+                    "-tune", "stillimage",
+                    "-pix_fmt", "yuv420p",
+                    "-c:a", "aac",
+                    "-b:a", "192k",
+                    "-vf", "scale=1280:720",
+                    temp_video
                 ], check=True)
+
+                # Path to watermark (relative path)
+                watermark_path = "watermark.png"
+                if not os.path.exists(watermark_path):
+                    # Create a simple watermark using ffmpeg
+                    subprocess.run([
+                        "ffmpeg", "-y",
+                        "-f", "lavfi",
+                        "-i", "color=c=white@0.5:s=200x50",
+                        "-vf", "drawtext=text='Scanwise':fontcolor=blue:fontsize=24:x=(w-text_w)/2:y=(h-text_h)/2",
+                        "-frames:v", "1",
+                        watermark_path
+                    ], check=True)
             
-            # Burn subtitles and add watermark (using relative paths)
-            logger.info("Burning subtitles and adding watermark...")
-            subprocess.run([
-                "ffmpeg", "-y",
-                "-i", temp_video,
-                "-i", watermark_path,
-                "-filter_complex", 
-                f"subtitles={srt_path}[sub];[1:v]scale=iw*0.15:-1[watermark];[sub][watermark]overlay=10:H-h-10[v]",
-                "-map", "[v]", 
-                "-map", "0:a",
-                "-c:a", "copy",
-                video_path
-            ], check=True)
+                # Burn subtitles and add watermark (using relative paths)
+                logger.info("Burning subtitles and adding watermark...")
+                subprocess.run([
+                    "ffmpeg", "-y",
+                    "-i", temp_video,
+                    "-i", watermark_path,
+                    "-filter_complex", 
+                    f"subtitles={srt_path}[sub];[1:v]scale=iw*0.15:-1[watermark];[sub][watermark]overlay=10:H-h-10[v]",
+                    "-map", "[v]", 
+                    "-map", "0:a",
+                    "-c:a", "copy",
+                    video_path
+                ], check=True)
 
             # Cleanup
             os.remove(temp_video)
@@ -146,19 +151,8 @@ class VideoGeneratorService:
         except Exception as e:
             logger.error(f"Error cleaning up temp directory: {str(e)}")
 
-# Create singleton instance
-# Initialize service lazily to avoid import-time errors
-_video_generator_service = None
+# Initialize service lazily on first use to keep imports cheap
+video_generator_service = lazy_service("video_generator", VideoGeneratorService)
 
 def get_video_generator_service():
-    global _video_generator_service
-    if _video_generator_service is None:
-        try:
-            _video_generator_service = VideoGeneratorService()
-        except Exception as e:
-            logger.error(f"Failed to initialize VideoGenerator service: {e}")
-            return None
-    return _video_generator_service
-
-# For backward compatibility
-video_generator_service = get_video_generator_service()
\ No newline at end of file
+    return registry.get("video_generator")
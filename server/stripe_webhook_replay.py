@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Replay recorded Stripe webhook payloads against a running server
+
+Payloads come from files (one event per .json file, directories of them, or
+.jsonl with one event per line - e.g. STRIPE_WEBHOOK_RECORD_DIR recordings or
+`stripe events retrieve` output) or, with --from-db, from the payloads stored
+in stripe_webhook_events. Each is signed with STRIPE_WEBHOOK_SECRET the same
+way Stripe signs them, so the server's verification path runs too.
+
+Stored and recorded payloads have registration checkouts'
+`metadata.registration_data` (the new user's details, password included)
+redacted once processed, so they can't register a user again; replaying a
+registration needs a fresh payload, e.g. from a new test-mode checkout.
+
+Examples:
+    python stripe_webhook_replay.py recordings/
+    python stripe_webhook_replay.py evt_1.json --times 3          # redeliveries are ignored
+    python stripe_webhook_replay.py recordings/ --fresh-ids       # process again as new events
+    python stripe_webhook_replay.py --from-db evt_123 evt_456
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List
+
+import requests
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+
+def stripe_signature(payload: bytes, secret: str, timestamp: int) -> str:
+    """Build a Stripe-Signature header the same way Stripe does"""
+    signed_payload = f"{timestamp}.".encode() + payload
+    signature = hmac.new(secret.encode(), signed_payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def load_files(paths: List[str]) -> List[Dict[str, Any]]:
+    events = []
+    for path in map(Path, paths):
+        files = sorted(path.glob("*.json*")) if path.is_dir() else [path]
+        for file in files:
+            text = file.read_text()
+            if file.suffix == ".jsonl":
+                events.extend(json.loads(line) for line in text.splitlines() if line.strip())
+            else:
+                events.append(json.loads(text))
+    return events
+
+
+def load_from_db(event_ids: List[str]) -> List[Dict[str, Any]]:
+    from supabase import create_client
+
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_service_key = os.getenv("SUPABASE_SERVICE_KEY")
+    if not supabase_url or not supabase_service_key:
+        print("❌ Error: SUPABASE_URL and SUPABASE_SERVICE_KEY must be set to replay from the database")
+        sys.exit(1)
+
+    client = create_client(supabase_url, supabase_service_key)
+    response = client.table("stripe_webhook_events").select("event_id, payload").in_("event_id", event_ids).execute()
+    payloads = {row["event_id"]: row["payload"] for row in response.data or []}
+    redacted = [event_id for event_id, event in payloads.items()
+                if ((event.get("data", {}).get("object", {}) or {}).get("metadata") or {}).get("registration_data") == "[redacted]"]
+    if redacted:
+        print(f"⚠️ Registration data redacted (these won't register a user): {', '.join(redacted)}")
+    missing = [event_id for event_id in event_ids if event_id not in payloads]
+    if missing:
+        print(f"⚠️ Not found in stripe_webhook_events: {', '.join(missing)}")
+    return [payloads[event_id] for event_id in event_ids if event_id in payloads]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded Stripe webhook payloads")
+    parser.add_argument("sources", nargs="*", help="Payload files/directories, or event ids with --from-db")
+    parser.add_argument("--from-db", action="store_true", help="Read the payloads of these event ids from stripe_webhook_events")
+    parser.add_argument("--url", default=os.getenv("STRIPE_WEBHOOK_REPLAY_URL", "http://localhost:8000/api/v1/stripe/webhook"))
+    parser.add_argument("--secret", default=os.getenv("STRIPE_WEBHOOK_SECRET"), help="Defaults to STRIPE_WEBHOOK_SECRET")
+    parser.add_argument("--times", type=int, default=1, help="Deliver each event this many times (test idempotency)")
+    parser.add_argument("--fresh-ids", action="store_true", help="Give each event a new id so it is processed again")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds between deliveries")
+    args = parser.parse_args()
+
+    if not args.sources:
+        parser.error("nothing to replay")
+    events = load_from_db(args.sources) if args.from_db else load_files(args.sources)
+    if not args.secret:
+        print("⚠️ No webhook secret; sending unsigned (the server must also have STRIPE_WEBHOOK_SECRET unset)")
+
+    print(f"🔄 Replaying {len(events)} events x{args.times} to {args.url}")
+    failures = 0
+    for event in events:
+        if args.fresh_ids:
+            event = {**event, "id": f"evt_replay_{uuid.uuid4().hex[:16]}"}
+        payload = json.dumps(event).encode()
+        for _ in range(args.times):
+            headers = {"Content-Type": "application/json"}
+            if args.secret:
+                headers["Stripe-Signature"] = stripe_signature(payload, args.secret, int(time.time()))
+            try:
+                response = requests.post(args.url, data=payload, headers=headers, timeout=30)
+                body = response.json() if response.headers.get("content-type", "").startswith("application/json") else response.text
+            except requests.RequestException as e:
+                response, body = None, str(e)
+            ok = response is not None and response.ok
+            failures += not ok
+            status = response.status_code if response is not None else "error"
+            print(f"{'✅' if ok else '❌'} {event.get('id')} ({event.get('type')}) -> {status} {body}")
+            if args.delay:
+                time.sleep(args.delay)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,3 @@ def cleanup_old_temp_files(temp_dir: str = "video_temp", max_age_hours: int = 24
             
     except Exception as e:
         logger.error(f"Error during cleanup: {str(e)}")
-
-# Run cleanup on import
-cleanup_old_temp_files()
\ No newline at end of file
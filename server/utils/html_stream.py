@@ -0,0 +1,76 @@
+import re
+from html.parser import HTMLParser
+from typing import List, Tuple
+
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'source', 'track', 'wbr',
+}
+
+# Document wrappers GPT sometimes adds; their children are treated as top level
+TRANSPARENT_TAGS = {'html', 'body'}
+
+# Containers that, as the first element of the report, are split into their children
+WRAPPER_TAGS = {'div', 'section', 'article', 'main'}
+
+
+class HtmlSectionStream(HTMLParser):
+    """
+    Splits streamed report HTML into complete top-level blocks as they arrive
+
+    Feed completion deltas to `push`; it returns every block whose closing tag
+    has now been seen. Blocks are the direct children of the report's wrapper
+    element (the first top-level container) and any whole top-level elements
+    outside it, sliced verbatim from the streamed text.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = ''
+        self.line_starts = [0]
+        self.stack: List[Tuple[str, int]] = []  # (tag, start offset)
+        self.in_wrapper = False
+        self.wrapper_seen = False
+        self._ready: List[str] = []
+
+    def push(self, chunk: str) -> List[str]:
+        base = len(self.buffer)
+        self.buffer += chunk
+        for match in re.finditer('\n', chunk):
+            self.line_starts.append(base + match.end())
+        self.feed(chunk)
+        ready, self._ready = self._ready, []
+        return ready
+
+    def _offset(self) -> int:
+        line, col = self.getpos()
+        return self.line_starts[line - 1] + col
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS or tag in TRANSPARENT_TAGS:
+            return
+        if not self.stack:
+            self.in_wrapper = not self.wrapper_seen and tag in WRAPPER_TAGS
+            self.wrapper_seen = True
+        self.stack.append((tag, self._offset()))
+
+    def handle_endtag(self, tag):
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return  # stray or transparent end tag
+        pos = self._offset()
+        close = self.buffer.find('>', pos)
+        end = close + 1 if close != -1 else len(self.buffer)
+
+        start = pos
+        while self.stack:
+            open_tag, start = self.stack.pop()
+            if open_tag == tag:
+                break
+
+        if self.in_wrapper:
+            if len(self.stack) == 1:
+                self._ready.append(self.buffer[start:end])
+            elif not self.stack:
+                self.in_wrapper = False
+        elif not self.stack:
+            self._ready.append(self.buffer[start:end])
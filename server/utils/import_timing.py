@@ -0,0 +1,71 @@
+import os
+import re
+import subprocess
+import sys
+import time
+import logging
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Line format written by `python -X importtime`:
+# import time:       self [us] |  cumulative | imported package
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s+(\s*)(\S+)")
+
+
+def collect_import_times(module: str = "main") -> Tuple[float, List[Tuple[str, int, int, int]]]:
+    """
+    Import a module in a fresh interpreter with -X importtime
+
+    A subprocess is used so modules already loaded in the current process
+    don't hide their cost. Returns the wall-clock seconds for the import and
+    a list of (module, self_us, cumulative_us, depth) tuples.
+    """
+    server_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start_time = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=server_dir,
+        capture_output=True,
+        text=True
+    )
+    wall_time = time.perf_counter() - start_time
+
+    if result.returncode != 0:
+        logger.error(f"Importing {module} failed: {result.stderr.strip().splitlines()[-1:]}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+
+    return wall_time, entries
+
+
+def print_import_time_report(module: str = "main", top: int = 25) -> float:
+    """Print the slowest imports (by cumulative time) triggered by importing `module`"""
+    wall_time, entries = collect_import_times(module)
+
+    print(f"Import-time report for '{module}'")
+    print(f"Total wall time (including interpreter start): {wall_time * 1000:.0f}ms")
+    print("")
+
+    if not entries:
+        print("No import timings captured")
+        return wall_time
+
+    # Top-level imports only, so nested packages aren't counted twice
+    top_level = [e for e in entries if e[3] == 0]
+    print("Slowest top-level imports:")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for name, self_us, cumulative_us, _ in sorted(top_level, key=lambda e: e[2], reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>10.1f}ms {self_us / 1000:>8.1f}ms  {name}")
+
+    print("")
+    print("Slowest individual modules (self time):")
+    for name, self_us, _, _ in sorted(entries, key=lambda e: e[1], reverse=True)[:top]:
+        print(f"{self_us / 1000:>10.1f}ms  {name}")
+
+    return wall_time
@@ -0,0 +1,228 @@
+"""
+Latency instrumentation - per-stage spans and Prometheus metrics
+
+Wrap external calls and CPU-heavy steps in `track_stage(...)` (context manager)
+or `@timed_stage(...)` (decorator, sync or async). Durations are recorded as
+Prometheus histograms labelled by endpoint, stage, model and outcome, and
+exposed at `/metrics` (behind METRICS_TOKEN when it is set).
+
+A stage's outcome is "error" when it raises. Methods that log their own
+failure and return None instead pass `failed=` to `timed_stage`, so those
+calls aren't counted as successes.
+
+Spans that run during an HTTP request are buffered on the request context and
+flushed by the `log_requests` middleware once the matched route is known, so
+the endpoint label is the route template ("/generate-pdf/{diagnosis_id}")
+rather than the raw path. The same buffer feeds the optional `Server-Timing`
+debug header.
+"""
+
+import contextvars
+import functools
+import hmac
+import inspect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+# External calls here range from ~50ms (Supabase) to minutes (Whisper + ffmpeg)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+STAGE_LATENCY = Histogram(
+    "scanwise_stage_duration_seconds",
+    "Duration of an instrumented stage (external call or CPU step)",
+    ["endpoint", "stage", "model", "outcome"],
+    buckets=LATENCY_BUCKETS
+)
+
+STAGE_CALLS = Counter(
+    "scanwise_stage_calls_total",
+    "Number of instrumented stage executions",
+    ["endpoint", "stage", "model", "outcome"]
+)
+
+REQUEST_LATENCY = Histogram(
+    "scanwise_request_duration_seconds",
+    "HTTP request duration",
+    ["endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS
+)
+
+COMPLETION_CACHE_LOOKUPS = Counter(
+    "scanwise_completion_cache_lookups_total",
+    "GPT completion cache lookups by prompt site and result (memory, disk, miss)",
+    ["site", "model", "result"]
+)
+
+# Endpoint label used for spans that don't belong to a request (background tasks, cron)
+BACKGROUND_ENDPOINT = "background"
+
+# Return the per-request breakdown as a Server-Timing header when this is true,
+# or when the client sends `X-Debug-Timing: 1`
+DEBUG_TIMING_HEADER = os.getenv("DEBUG_TIMING_HEADER", "false").lower() == "true"
+
+# Bearer token Prometheus must send to scrape /metrics. Without it the endpoint
+# is only served in development
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+class StageSpan:
+    """Handle yielded by `track_stage`; set `outcome` to "error" for failures that don't raise"""
+
+    def __init__(self):
+        self.outcome = "success"
+
+
+def returned_none(result: Any) -> bool:
+    """`failed` predicate for methods that return None when they fail"""
+    return result is None
+
+
+class RequestTimings:
+    """Spans collected while serving a single request"""
+
+    def __init__(self):
+        self.endpoint: Optional[str] = None
+        self.spans: List[Tuple[str, str, str, float]] = []  # (stage, model, outcome, seconds)
+        self.flushed = False
+
+
+_request_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "scanwise_request_timings", default=None
+)
+
+
+def _record(stage: str, model: str, outcome: str, seconds: float) -> None:
+    timings = _request_timings.get()
+    if timings is not None and not timings.flushed:
+        timings.spans.append((stage, model, outcome, seconds))
+        return
+
+    # Outside a request, or after the response was sent (e.g. BackgroundTasks)
+    endpoint = timings.endpoint if timings is not None and timings.endpoint else BACKGROUND_ENDPOINT
+    STAGE_LATENCY.labels(endpoint, stage, model, outcome).observe(seconds)
+    STAGE_CALLS.labels(endpoint, stage, model, outcome).inc()
+
+
+@contextmanager
+def track_stage(stage: str, model: Optional[str] = None):
+    """
+    Time a block of code as a named stage
+
+    Usage:
+        with track_stage("openai_edit_report", model=openai_service.model_edit) as span:
+            response = openai_service.client.chat.completions.create(...)
+            if not response.choices:
+                span.outcome = "error"
+    """
+    start_time = time.perf_counter()
+    span = StageSpan()
+    try:
+        yield span
+    except BaseException:
+        span.outcome = "error"
+        raise
+    finally:
+        _record(stage, model or "", span.outcome, time.perf_counter() - start_time)
+
+
+def timed_stage(stage: str, model: Optional[str] = None, model_attr: Optional[str] = None,
+                failed: Optional[Callable[[Any], bool]] = None) -> Callable:
+    """
+    Decorator form of `track_stage` for sync and async functions
+
+    `model_attr` names an attribute on `self` holding the model, so methods can
+    be labelled with env-configured models (e.g. model_attr="model_html").
+    `failed` is called with the return value and records the call as an error
+    when it returns True (e.g. failed=returned_none).
+    """
+    def decorator(func: Callable) -> Callable:
+        def resolve_model(args: Tuple[Any, ...]) -> Optional[str]:
+            if model_attr and args:
+                return getattr(args[0], model_attr, None) or model
+            return model
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with track_stage(stage, resolve_model(args)) as span:
+                    result = await func(*args, **kwargs)
+                    if failed is not None and failed(result):
+                        span.outcome = "error"
+                    return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def sync_wrapper(*args, **kwargs):
+            with track_stage(stage, resolve_model(args)) as span:
+                result = func(*args, **kwargs)
+                if failed is not None and failed(result):
+                    span.outcome = "error"
+                return result
+        return sync_wrapper
+
+    return decorator
+
+
+def record_cache_lookup(site: str, model: str, result: str) -> None:
+    """Count a completion cache lookup"""
+    COMPLETION_CACHE_LOOKUPS.labels(site, model or "", result).inc()
+
+
+def begin_request() -> Tuple[RequestTimings, contextvars.Token]:
+    """Start collecting spans for the current request (called by middleware)"""
+    timings = RequestTimings()
+    return timings, _request_timings.set(timings)
+
+
+def finish_request(timings: RequestTimings, token: contextvars.Token, endpoint: str,
+                   method: str, status_code: int, seconds: float) -> None:
+    """Flush buffered spans under the resolved endpoint label and record the request"""
+    timings.endpoint = endpoint
+    for stage, model, outcome, stage_seconds in timings.spans:
+        STAGE_LATENCY.labels(endpoint, stage, model, outcome).observe(stage_seconds)
+        STAGE_CALLS.labels(endpoint, stage, model, outcome).inc()
+    timings.flushed = True
+    REQUEST_LATENCY.labels(endpoint, method, str(status_code)).observe(seconds)
+    _request_timings.reset(token)
+
+
+def resolve_endpoint_label(scope: Dict[str, Any]) -> str:
+    """Route template for the request, falling back to the endpoint function name"""
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    endpoint = scope.get("endpoint")
+    if endpoint is not None:
+        return getattr(endpoint, "__name__", "unknown")
+    return "unmatched"
+
+
+def server_timing_header(timings: RequestTimings) -> str:
+    """Format collected spans as a Server-Timing header value"""
+    entries = []
+    for stage, model, outcome, seconds in timings.spans:
+        description = f"{stage} ({model})" if model else stage
+        if outcome != "success":
+            description += f" [{outcome}]"
+        entries.append(f'{stage.replace(".", "-")};desc="{description}";dur={seconds * 1000:.1f}')
+    return ", ".join(entries)
+
+
+def metrics_authorized(authorization: Optional[str]) -> bool:
+    """Whether a request's Authorization header may read /metrics"""
+    if not METRICS_TOKEN:
+        return os.getenv("ENVIRONMENT", "development") == "development"
+    scheme, _, token = (authorization or "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Prometheus text exposition for the /metrics endpoint"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,29 @@
+"""
+Newline-delimited JSON helpers for streaming endpoints
+
+Endpoints yield `ndjson_line(...)` strings from an async generator and wrap it
+in `ndjson_response(...)`. Each line is one complete JSON document, so clients
+can act on every result as soon as it arrives.
+"""
+
+import json
+from typing import Any, AsyncIterator
+
+from fastapi.responses import StreamingResponse
+
+
+def ndjson_line(data: Any) -> str:
+    """One JSON document on its own line"""
+    return json.dumps(data, default=str) + "\n"
+
+
+def ndjson_response(lines: AsyncIterator[str]) -> StreamingResponse:
+    """Stream lines without proxy buffering (nginx/Render hold chunked bodies otherwise)"""
+    return StreamingResponse(
+        lines,
+        media_type="application/x-ndjson",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
@@ -0,0 +1,268 @@
+"""
+Completeness checks for GPT-generated HTML reports
+
+`validate_report_html` parses the report once, picks out the condition
+explanation boxes (the yellow-header cards, or `class="condition-explanation"`)
+and checks each for length, unfinished sentences, generic filler and thin
+"What This Means" sections. The result says which boxes need regenerating, with
+their character offsets so just those boxes can be replaced.
+"""
+
+import re
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+from utils.html_stream import VOID_ELEMENTS
+
+MIN_BOX_TEXT = 150
+MIN_CARIES_BOX_TEXT = 200
+MIN_WHAT_THIS_MEANS_TEXT = 100
+# Lines shorter than this are labels/fragments, not sentences
+MIN_SENTENCE_CHECK_LENGTH = 20
+
+GENERIC_PHRASES = (
+    'is a dental condition that requires professional treatment',
+    'requires professional treatment',
+    'needs to be treated by a dentist',
+    'should be addressed by a dental professional',
+)
+
+# Tags whose boundaries end a line of text
+LINE_BREAK_TAGS = {'p', 'div', 'li', 'td', 'th', 'tr', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'table'}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+# Elements left open at the end of the document that mean the output was cut off
+STRUCTURAL_TAGS = {'div', 'table', 'ul', 'ol', 'section'}
+
+BOX_HEADER_STYLE = re.compile(r'background(?:-color)?\s*:\s*#ffeb3b', re.IGNORECASE)
+SENTENCE_END = re.compile(r'[.!?:;)\]"\'”’…]\s*$|[☀-➿\U0001F300-\U0001FAFF]\s*$')
+ELLIPSIS_END = re.compile(r'(?:\.\s*\.|…)\s*$')
+WHITESPACE = re.compile(r'\s+')
+
+
+@dataclass
+class BoxDiagnostic:
+    index: int
+    title: str
+    start: int
+    end: Optional[int]
+    text_length: int
+    issues: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> Dict:
+        return {
+            "index": self.index,
+            "title": self.title,
+            "text_length": self.text_length,
+            "issues": self.issues,
+        }
+
+
+@dataclass
+class ReportValidation:
+    boxes: List[BoxDiagnostic]
+    issues: List[str]  # document-level problems (e.g. output cut off mid-element)
+
+    @property
+    def flagged(self) -> List[BoxDiagnostic]:
+        return [box for box in self.boxes if box.issues]
+
+    @property
+    def ok(self) -> bool:
+        return not self.issues and not self.flagged
+
+    @property
+    def repairable(self) -> bool:
+        """Only individual boxes are bad, so they can be regenerated on their own"""
+        return not self.issues and bool(self.flagged) and all(box.end is not None for box in self.flagged)
+
+    def summary(self) -> str:
+        parts = list(self.issues)
+        parts += [f"box {box.index} '{box.title}': {', '.join(box.issues)}" for box in self.flagged]
+        return '; '.join(parts) or 'ok'
+
+    def to_dict(self) -> Dict:
+        return {
+            "ok": self.ok,
+            "issues": self.issues,
+            "boxes": [box.to_dict() for box in self.boxes],
+        }
+
+
+class _BoxState:
+    def __init__(self, index: int, start: int, depth: int):
+        self.diagnostic = BoxDiagnostic(index=index, title='', start=start, end=None, text_length=0)
+        self.depth = depth  # stack length when the box element was opened
+        self.header_depth: Optional[int] = None
+        self.text: List[str] = []
+        self.section: Optional[str] = None
+        self.section_length = 0
+        self.sections: Dict[str, int] = {}
+
+
+class _ReportValidator(HTMLParser):
+    def __init__(self, html: str):
+        super().__init__(convert_charrefs=True)
+        self.html = html
+        self.line_starts = [0] + [match.end() for match in re.finditer('\n', html)]
+        self.stack: List[Tuple[str, int]] = []  # (tag, start offset)
+        self.boxes: List[BoxDiagnostic] = []
+        self.box: Optional[_BoxState] = None
+        self.line: List[str] = []
+        self.line_is_heading = False
+
+    def _offset(self) -> int:
+        line, col = self.getpos()
+        return self.line_starts[line - 1] + col
+
+    # ---------------- Tags ----------------
+
+    def handle_starttag(self, tag, attrs):
+        if tag in LINE_BREAK_TAGS:
+            self._end_line()
+        if tag in VOID_ELEMENTS:
+            return
+
+        attributes = dict(attrs)
+        start = self._offset()
+        is_header = tag == 'div' and BOX_HEADER_STYLE.search(attributes.get('style') or '') is not None
+
+        if self.box is None:
+            if tag == 'div' and 'condition-explanation' in (attributes.get('class') or ''):
+                self._open_box(start, len(self.stack))
+            elif is_header and self.stack and self.stack[-1][0] == 'div':
+                # Yellow header card: the enclosing div is the box
+                parent_start = self.stack[-1][1]
+                self._open_box(parent_start, len(self.stack) - 1)
+
+        if self.box is not None and is_header and self.box.header_depth is None:
+            self.box.header_depth = len(self.stack)
+        if tag in HEADING_TAGS:
+            self.line_is_heading = True
+
+        self.stack.append((tag, start))
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in LINE_BREAK_TAGS:
+            self._end_line()
+
+    def handle_endtag(self, tag):
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return  # stray end tag
+        if tag in LINE_BREAK_TAGS:
+            self._end_line()
+
+        pos = self._offset()
+        close = self.html.find('>', pos)
+        end = close + 1 if close != -1 else len(self.html)
+        while self.stack:
+            open_tag, _ = self.stack.pop()
+            if self.box is not None and self.box.header_depth is not None and len(self.stack) == self.box.header_depth:
+                self.box.header_depth = None
+            if self.box is not None and len(self.stack) == self.box.depth:
+                self._close_box(end)
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.box is None:
+            return
+        if self.box.header_depth is not None:
+            self.box.diagnostic.title = WHITESPACE.sub(' ', f"{self.box.diagnostic.title} {data}").strip()
+            return
+        self.line.append(data)
+
+    # ---------------- Boxes ----------------
+
+    def _open_box(self, start: int, depth: int):
+        self._end_line()
+        self.box = _BoxState(len(self.boxes), start, depth)
+
+    def _end_line(self):
+        if self.box is None or not self.line:
+            self.line, self.line_is_heading = [], False
+            return
+        text = WHITESPACE.sub(' ', ''.join(self.line)).strip()
+        is_heading = self.line_is_heading
+        self.line, self.line_is_heading = [], False
+        if not text:
+            return
+
+        box = self.box
+        # Section labels: headings, or "What This Means:" written as bold text before a <br>
+        if is_heading or (text.endswith(':') and len(text) < 60):
+            self._end_section()
+            box.section = text.rstrip(':').strip().lower()
+            box.section_length = 0
+            return
+
+        box.text.append(text)
+        box.section_length += len(text)
+        issues = box.diagnostic.issues
+        if ELLIPSIS_END.search(text):
+            if 'ellipsis' not in issues:
+                issues.append('ellipsis')
+        elif len(text) > MIN_SENTENCE_CHECK_LENGTH and not SENTENCE_END.search(text):
+            if 'incomplete_sentence' not in issues:
+                issues.append('incomplete_sentence')
+
+    def _end_section(self):
+        box = self.box
+        if box.section is not None:
+            box.sections[box.section] = box.section_length
+        box.section = None
+
+    def _close_box(self, end: Optional[int]):
+        self._end_line()
+        box = self.box
+        self._end_section()
+        diagnostic = box.diagnostic
+        diagnostic.end = end
+
+        text = ' '.join(box.text)
+        lowered = text.lower()
+        diagnostic.text_length = len(text)
+        min_length = MIN_CARIES_BOX_TEXT if 'caries' in f"{diagnostic.title} {lowered}".lower() else MIN_BOX_TEXT
+        if diagnostic.text_length < min_length:
+            diagnostic.issues.append('too_short')
+        if any(phrase in lowered for phrase in GENERIC_PHRASES):
+            diagnostic.issues.append('generic_description')
+        for name, length in box.sections.items():
+            if length == 0:
+                diagnostic.issues.append(f"empty_section:{name}")
+            elif name.startswith('what this means') and length < MIN_WHAT_THIS_MEANS_TEXT:
+                diagnostic.issues.append('thin_what_this_means')
+
+        self.boxes.append(diagnostic)
+        self.box = None
+
+    def finish(self) -> ReportValidation:
+        self.close()
+        issues = []
+        if self.box is not None:
+            self._close_box(None)
+            issues.append('unclosed_condition_box')
+        if any(tag in STRUCTURAL_TAGS for tag, _ in self.stack):
+            issues.append('unclosed_html')
+        return ReportValidation(boxes=self.boxes, issues=issues)
+
+
+def validate_report_html(html: str) -> ReportValidation:
+    """Check every condition box in a generated report in one parse"""
+    parser = _ReportValidator(html)
+    parser.feed(html)
+    return parser.finish()
+
+
+def replace_boxes(html: str, validation: ReportValidation, replacements: Dict[int, str]) -> str:
+    """Swap the boxes at the given indexes for new HTML, leaving the rest byte-for-byte"""
+    by_index = {box.index: box for box in validation.boxes}
+    parts = []
+    position = 0
+    for index in sorted(replacements, key=lambda i: by_index[i].start):
+        box = by_index[index]
+        parts.append(html[position:box.start])
+        parts.append(replacements[index])
+        position = box.end
+    parts.append(html[position:])
+    return ''.join(parts)
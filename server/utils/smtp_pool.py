@@ -0,0 +1,114 @@
+import logging
+import queue
+import smtplib
+import threading
+from email.message import Message
+
+logger = logging.getLogger(__name__)
+
+
+class _PooledConnection:
+    """An authenticated SMTP session and how many messages it has carried"""
+
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.sent = 0
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Small pool of logged-in SMTP sessions shared by concurrent senders
+
+    Opening a Gmail session costs a TCP connect, STARTTLS and LOGIN (~1s), so
+    batch jobs reuse sessions instead of reconnecting per message. At most
+    `size` sessions are open at once; `send` blocks until one is free.
+    Sessions are recycled after `max_messages_per_connection` messages because
+    Gmail drops long-lived connections.
+    """
+
+    def __init__(self, host: str, port: int, username: str, password: str,
+                 size: int = 3, max_messages_per_connection: int = 90, timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = max(1, size)
+        self.max_messages_per_connection = max_messages_per_connection
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[_PooledConnection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._closed = False
+
+    def _connect(self) -> _PooledConnection:
+        if not self.username or not self.password:
+            raise Exception("Email credentials not configured")
+
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        logger.info(f"📮 Opened SMTP session to {self.host}:{self.port}")
+        return _PooledConnection(server)
+
+    def _checkout(self) -> _PooledConnection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _checkin(self, conn: _PooledConnection) -> None:
+        if self._closed or conn.sent >= self.max_messages_per_connection:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    def _deliver(self, conn: _PooledConnection, msg: Message) -> None:
+        conn.server.sendmail(self.username, msg['To'], msg.as_string())
+        conn.sent += 1
+
+    def send(self, msg: Message) -> bool:
+        """Send one message on a pooled session (thread-safe, blocking)"""
+        with self._slots:
+            conn = self._checkout()
+            try:
+                try:
+                    self._deliver(conn, msg)
+                except smtplib.SMTPServerDisconnected:
+                    # Idle session was dropped by the server - reconnect once
+                    conn.close()
+                    conn = self._connect()
+                    self._deliver(conn, msg)
+            except Exception:
+                conn.close()
+                raise
+
+            self._checkin(conn)
+            logger.info(f"Email sent successfully to {msg['To']}")
+            return True
+
+    def close(self) -> None:
+        """Quit every idle session"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self) -> "SMTPConnectionPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
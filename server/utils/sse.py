@@ -0,0 +1,32 @@
+"""
+Server-sent events helpers for streaming endpoints
+
+Endpoints yield `sse_event(...)` strings from an async generator and wrap it
+in `sse_response(...)`. Every event carries a JSON payload; clients switch on
+the event name.
+"""
+
+import json
+import logging
+from typing import Any, AsyncIterator
+
+from fastapi.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event: str, data: Any) -> str:
+    """One SSE frame with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    """Stream events without proxy buffering (nginx/Render hold chunked bodies otherwise)"""
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
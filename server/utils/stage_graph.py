@@ -0,0 +1,107 @@
+"""
+Run a request's stages as a small dependency graph
+
+Handlers declare each stage with the stages it needs; every stage starts as
+soon as its dependencies finish, so independent stages (an upload and a GPT
+call) overlap and the request takes about as long as its slowest path instead
+of the sum of all stages.
+
+    graph = StageGraph("analyze_xray")
+    graph.add("detect", detect, timeout=60)
+    graph.add("upload", upload, deps=("detect",), timeout=30)
+    graph.add("plan", plan, deps=("detect",), timeout=90)
+    graph.add("save", save, deps=("upload", "plan"))
+    results = await graph.run()
+
+A stage function receives its dependencies' results as keyword arguments.
+When a required stage fails or times out, the stages still running are
+cancelled and its exception is raised from `run()`. An `optional` stage that
+fails yields None instead, and its dependents still run.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimeoutError(TimeoutError):
+    """A stage ran past its timeout"""
+
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"Stage '{stage}' timed out after {timeout:g}s")
+        self.stage = stage
+
+
+@dataclass
+class _Stage:
+    name: str
+    fn: Callable[..., Awaitable[Any]]
+    deps: Tuple[str, ...] = ()
+    timeout: Optional[float] = None
+    optional: bool = False
+
+
+@dataclass
+class StageGraph:
+    name: str
+    stages: Dict[str, _Stage] = field(default_factory=dict)
+
+    def add(self, name: str, fn: Callable[..., Awaitable[Any]], deps: Tuple[str, ...] = (),
+            timeout: Optional[float] = None, optional: bool = False) -> "StageGraph":
+        """Declare a stage; dependencies must already be declared, which also rules out cycles"""
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Stage '{name}' depends on undeclared stage(s): {', '.join(missing)}")
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is already declared")
+        self.stages[name] = _Stage(name, fn, tuple(deps), timeout, optional)
+        return self
+
+    async def _run_stage(self, stage: _Stage, tasks: Dict[str, "asyncio.Task"]) -> Any:
+        inputs = {dep: await tasks[dep] for dep in stage.deps}
+        try:
+            with track_stage(f"{self.name}.{stage.name}"):
+                if stage.timeout is None:
+                    return await stage.fn(**inputs)
+                try:
+                    return await asyncio.wait_for(stage.fn(**inputs), stage.timeout)
+                except asyncio.TimeoutError:
+                    raise StageTimeoutError(stage.name, stage.timeout)
+        except Exception as e:
+            if not stage.optional:
+                raise
+            logger.warning(f"⚠️ Optional stage {self.name}.{stage.name} failed: {str(e) or type(e).__name__}")
+            return None
+
+    async def run(self) -> Dict[str, Any]:
+        """Run every stage, returning {stage name: result}"""
+        tasks: Dict[str, asyncio.Task] = {}
+        try:
+            async with asyncio.TaskGroup() as group:
+                # Declaration order is a topological order, so dependencies' tasks already exist
+                for stage in self.stages.values():
+                    tasks[stage.name] = group.create_task(self._run_stage(stage, tasks), name=f"{self.name}.{stage.name}")
+        except BaseExceptionGroup as group_error:
+            # Surface the failing stage's own exception (e.g. an HTTPException) rather than the group
+            first = group_error.exceptions[0]
+            while isinstance(first, BaseExceptionGroup):
+                first = first.exceptions[0]
+            raise first from None
+        return {name: task.result() for name, task in tasks.items()}
+
+
+async def in_thread(fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+    """
+    Await a service coroutine on a worker thread with its own event loop
+
+    Many service methods are `async def` but block on synchronous SDK clients
+    (Supabase, OpenAI, ElevenLabs, moviepy), so as graph stages they would hold
+    the event loop and serialise anyway. A timed-out stage stops being awaited,
+    but the thread finishes its current call in the background.
+    """
+    return await asyncio.to_thread(lambda: asyncio.run(fn(*args, **kwargs)))
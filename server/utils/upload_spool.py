@@ -0,0 +1,106 @@
+"""
+Spool uploads to disk in fixed-size chunks
+
+Upload endpoints copy the request body (a multipart `UploadFile` or the raw
+body stream) into a temporary file chunk by chunk, hashing as they go, instead
+of `await file.read()`. Worker memory stays at one chunk whatever the file
+size, and the SHA-256 is ready for content-addressed storage keys without a
+second pass. Hashing and disk writes run on a worker thread, buffered to
+UPLOAD_CHUNK_BYTES, so slow disks don't stall the event loop.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_BYTES = int(os.getenv('UPLOAD_CHUNK_BYTES', str(1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+
+class UploadTooLargeError(ValueError):
+    """The upload exceeded UPLOAD_MAX_BYTES"""
+
+
+@dataclass
+class SpooledUpload:
+    path: str
+    size: int
+    content_hash: str
+    filename: str
+    content_type: Optional[str] = None
+
+    def read_bytes(self) -> bytes:
+        """Whole file in memory, for consumers that need bytes (small images only)"""
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def cleanup(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> "SpooledUpload":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.cleanup()
+
+
+async def spool_chunks(chunks: AsyncIterator[bytes], filename: str, content_type: Optional[str] = None,
+                       max_bytes: int = UPLOAD_MAX_BYTES) -> SpooledUpload:
+    """Write an async stream of byte chunks to a temp file, hashing on the fly"""
+    suffix = os.path.splitext(filename or '')[1][:16]
+    digest = hashlib.sha256()
+    size = 0
+    buffer = bytearray()
+
+    def flush(data: bytes) -> None:
+        digest.update(data)
+        handle.write(data)
+
+    handle = await asyncio.to_thread(tempfile.NamedTemporaryFile, delete=False, prefix='upload_', suffix=suffix)
+    try:
+        with handle:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLargeError(f"Upload exceeds {max_bytes} bytes")
+                buffer += chunk
+                if len(buffer) >= UPLOAD_CHUNK_BYTES:
+                    await asyncio.to_thread(flush, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await asyncio.to_thread(flush, bytes(buffer))
+    except BaseException:
+        os.unlink(handle.name)
+        raise
+
+    logger.info(f"💾 Spooled upload {filename or 'unnamed'}: {size} bytes")
+    return SpooledUpload(handle.name, size, digest.hexdigest(), filename, content_type)
+
+
+async def spool_upload_file(file, max_bytes: int = UPLOAD_MAX_BYTES) -> SpooledUpload:
+    """Spool a FastAPI UploadFile"""
+    async def chunks():
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+
+    return await spool_chunks(chunks(), file.filename or '', file.content_type, max_bytes)
+
+
+async def spool_request_body(request, filename: str, content_type: Optional[str] = None,
+                             max_bytes: int = UPLOAD_MAX_BYTES) -> SpooledUpload:
+    """Spool a raw (non-multipart) request body as it arrives"""
+    return await spool_chunks(request.stream(), filename, content_type, max_bytes)